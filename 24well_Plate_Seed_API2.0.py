@@ -1,5 +1,5 @@
 #Readme:
-#Protocol: 24Well plate seeding (630ul)
+#Protocol: 24Well plate seeding (630ul), batch mode
 #Author: Oscar Swindley <oswindley1@sheffield.ac.uk>
 #Please confirm 'labware' matches labwere section below
 #Proceed with caution if any modifications are made (dilutions, volumes, not full plate)
@@ -7,13 +7,18 @@
 #Enjoy!!!
 
 #README:
-# trough  CD-CHO to columns 9 to 12 (18ml) for 4 plates
-# Can seed 4 plates at a time
-#TIPRACKS SETUP, Only include ODD rows of tips (A,C,E,G)
+# Set PLATE_COUNT and SEED_VOLUME below before each run
+# Plates go in slots 1, 2, 4, 5, 3, 6, 9, 10, 11 (in that order), up to 9 plates per deck load
+# More plates than fit on the deck are seeded in batches, robot pauses to swap plates and refill the trough between batches
+# Trough (slot 8) columns are assigned automatically from column 12 down, check the on screen comment for ml per column
+# CD-CHO only, dispenses are at the top of the wells so one tip column is used per batch
+#TIPRACKS SETUP, Only include ODD rows of tips (A,C,E,G), slot 7
+#Expected throughput: python -m ot2_tools.seeding --plates 16
 
 # imports
 from opentrons import protocol_api
 from itertools import product
+import math
 
 # metadata
 metadata = {
@@ -22,35 +27,72 @@ metadata = {
     'author': 'Oscar Swindley <oswindley1@sheffield.co.uk>',
     'description': '24Well plate seeding'}
 
+# batch settings
+PLATE_COUNT = 4                                               # Number of 24 well plates to seed
+SEED_VOLUME = 630                                             # ul per well
+PLATE_SLOTS = ['1', '2', '4', '5', '3', '6', '9', '10', '11']  # Deck slots for 24 well plates, filled in this order
+TROUGH_DEAD = 3300                                            # ul left in a trough column: the bottom 4mm (2mm aspirate clearance + 2mm
+                                                              # tip immersion) of the 8.2 x 71.2mm column, as python -m ot2_tools.ledger seed
+TROUGH_USABLE = 22000 - TROUGH_DEAD                           # ul per trough column that can be used (22ml column)
+AIR_GAP = 20
+
 def run(protocol: protocol_api.ProtocolContext):
     # labware
     trough = protocol.load_labware('axygen_12_reservior_22ml', '8')
     tip300_1 = protocol.load_labware('opentrons_96_tiprack_300ul', '7')
-    tip300_2 = protocol.load_labware('opentrons_96_tiprack_300ul', '10')
-
-    plate24_1A = protocol.load_labware('nunc_24_plate', '1')
-    plate24_2A = protocol.load_labware('nunc_24_plate', '2')
-    plate24_3A = protocol.load_labware('nunc_24_plate', '4')
-    plate24_4A = protocol.load_labware('nunc_24_plate', '5')
 
     # pipettes
-    p300m = protocol.load_instrument('p300_multi', mount='right', tip_racks=[tip300_1, tip300_2])
+    p300m = protocol.load_instrument('p300_multi', mount='right', tip_racks=[tip300_1])
     p300m.flow_rate.aspirate = 200
     p300m.well_bottom_clearance.aspirate = 2
     p300m.well_bottom_clearance.dispense = 2
-    
-    #Step 1: Create list of trough wells and plate names:
-    list_plate1 = [(11, plate24_1A), (10, plate24_2A), (9, plate24_3A), (8, plate24_4A)] # Defines plates to be seeded
-    # Creates function to seed plates. Variables: x = seed volume, col = start trough column for set of 4 plates, 24platelist = set of plates to use. 
-    for (col, plate24_1), j in product(list_plate1, range(6)):
+
+    #Step 1: Work out batches, trough trips and trough columns
+    if PLATE_COUNT < 1:
+        raise ValueError('PLATE_COUNT must be at least 1, it is %s' % PLATE_COUNT)
+    if SEED_VOLUME <= 0 or 4 * SEED_VOLUME > TROUGH_USABLE:
+        raise ValueError('SEED_VOLUME must be above 0 and at most %gul (one 24 well column from one trough column of '
+                         'TROUGH_USABLE %gul), it is %s' % (TROUGH_USABLE / 4.0, TROUGH_USABLE, SEED_VOLUME))
+    trips = int(math.ceil(SEED_VOLUME / float(p300m.max_volume - AIR_GAP)))  # Fewest trough trips per well that fit the tip with the air gap
+    trip_volume = SEED_VOLUME / float(trips)
+    column_volume = 4 * SEED_VOLUME                                            # One multichannel column = 4 wells (odd row tips)
+    columns_per_trough = int(TROUGH_USABLE // column_volume)                   # 24 well columns each trough column can seed
+    plates_per_load = int(min(len(PLATE_SLOTS), (12 * columns_per_trough) // 6, PLATE_COUNT))
+    batches = [list(range(b, min(b + plates_per_load, PLATE_COUNT))) for b in range(0, PLATE_COUNT, plates_per_load)]
+    plates = [protocol.load_labware('nunc_24_plate', slot) for slot in PLATE_SLOTS[:plates_per_load]]
+
+    def trough_columns(n_plates):   # Trough column for every 24 well column seeded, from column 12 down
+        cols = []
+        for k in range(n_plates * 6):
+            cols.append(11 - k // columns_per_trough)
+        return cols
+
+    #Step 2: Seed plates, one batch per deck load
+    tips_left = len(tip300_1.columns())
+    for b, batch in enumerate(batches):
+        cols = trough_columns(len(batch))
+        fill = ', '.join('A%d %.1fml' % (c + 1, (cols.count(c) * column_volume + TROUGH_DEAD) / 1000.0) for c in sorted(set(cols), reverse=True))
+        if b > 0:
+            protocol.home()
+            message = "ATTENTION: Replace seeded plates with %d empty plates in slots %s. Refill trough: %s" % (len(batch), ', '.join(PLATE_SLOTS[:len(batch)]), fill)
+            if tips_left == 0:
+                message += ". Replace tiprack in slot 7 (odd rows only)"
+            protocol.pause(message)
+            if tips_left == 0:
+                p300m.reset_tipracks()
+                tips_left = len(tip300_1.columns())
+        else:
+            protocol.comment("Seeding %d plates in %d batches, %d trough trips of %.1ful per well. Trough: %s" % (PLATE_COUNT, len(batches), trips, trip_volume, fill))
         p300m.pick_up_tip()
-        for i in range(3):
-            p300m.aspirate(20, trough.wells()[col].top())
-            p300m.aspirate(210, trough.wells()[col])
-            p300m.move_to(trough.wells()[col].top(-20))
-            protocol.delay(seconds=1.0)
-            p300m.dispense(220, plate24_1.wells()[4*j].top())
-            protocol.delay(seconds=1.0)
-            p300m.blow_out(plate24_1.wells()[4*j].top())
+        tips_left -= 1
+        for (plate24_1, j), col in zip(product(plates[:len(batch)], range(6)), cols):
+            for i in range(trips):
+                p300m.aspirate(AIR_GAP, trough.wells()[col].top())
+                p300m.aspirate(trip_volume, trough.wells()[col])
+                p300m.move_to(trough.wells()[col].top(-20))
+                protocol.delay(seconds=1.0)
+                p300m.dispense(trip_volume + AIR_GAP, plate24_1.wells()[4*j].top())
+                protocol.delay(seconds=1.0)
+                p300m.blow_out(plate24_1.wells()[4*j].top())
         p300m.drop_tip()
-    # End Script
\ No newline at end of file
+    # End Script
@@ -9,12 +9,19 @@
 #README:
 #First run prerequisite protocol 24well_Plate_Seed for as many plates as needed (multiples of 4)
 #Trough requires 'Nucleofection Solution' in 'A1' at start, 'resuspended cells' in 'A2' (add when prompted), and pre-gassed media to 'A3' (add when prompted)
-#DURING TIPRACK RESET (prior to seeding)tip200_1 rack (slot 7) requires only odd rows of tips (A. C, E, G), tip300_2 (slot 10) requires even rows (B, D, F, H). This allows transfer from 96-well-plate to 24-well-plates
+#SEEDING TIPS (SEED_TIPS below):
+# 'per_replicate' (default): one tip per replicate nucleofection column. Full tipracks at the start.
+#   DURING TIPRACK RESET (Intervention 4, prior to seeding) tip200_1 rack (slot 7) requires only odd rows of tips (A, C, E, G), tip200_2 (slot 10) requires even rows (B, D, F, H). This allows transfer from 96-well-plate to 24-well-plates
+# 'shared_per_sample': one tip per DNA sample per 24SWP for its 3 replicate columns, no tiprack reset (Intervention 4 is skipped).
+#   The tip goes from a mixed 24 well culture into the next replicate's nucleofection well, so the replicates are NOT independent. Agree with the protocol owner before using it.
+#   TIPRACKS SETUP: tip200_3 (slot 11) full rack. tip200_1 (slot 7) full tips in cols 1-3 only. tip200_2 (slot 10) cols 1-4 only odd rows of tips (A, C, E, G), cols 5-8 only even rows (B, D, F, H), cols 9-12 empty
+#Check the rack layout with: python -m ot2_tools.tipstate nucleofection --check
 #96-flat and 96-U plates have differnt depths so arent interchangable without ammending labware in the script
 
 # imports
 from opentrons import protocol_api
 from itertools import product
+from contextlib import contextmanager
 # metadata
 metadata = {
     'apiLevel': '2.0',
@@ -22,6 +29,45 @@ metadata = {
     'author': 'Oscar Swindley <oswindley1@sheffield.co.uk>',
     'description': 'Lonza Nucelofection protocol with 1.5fold excess and seeding into 24-shallow-well-plates'}
 
+# Step 8 seeding tips, see README above: 'per_replicate' or 'shared_per_sample' (replicates share a tip, not independent)
+SEED_TIPS = 'per_replicate'
+
+# Step 4 replicate distribution: 'single_aspirate' fills a tip with as many replicates as fit (+ overage) and dispenses them
+# one after the other, remixing only between tip loads. 'per_replicate' remixes and aspirates for every replicate.
+# Check the time cells sit in nucleofection solution against CELL_EXPOSURE_SECONDS with: python -m ot2_tools.exposure nucleofection
+REPLICATE_MODE = 'single_aspirate'
+REPLICATES = 3                  # nucleofection wells per DNA sample
+REPLICATE_VOLUME = 20           # ul per nucleofection well
+REPLICATE_OVERAGE = 5           # ul aspirated on top of the replicates, blown back into the DNA well
+REPLICATE_MIXES = 4             # mixes of the DNA well before each aspirate, half the volume left in the well + 5ul (50/40/30ul for 3 replicates)
+REPLICATE_MIX_MIN = 10          # ul, smallest mix volume as the DNA well empties
+CELL_EXPOSURE_SECONDS = 900     # advisory, not checked during the run: longest time cells should sit in nucleofection solution before electroporation
+
+# liquid classes: pipette settings for a block of steps, used as: with liquid_class(pipette, name):
+LIQUID_CLASSES = {
+    'cell_resuspend': {'well_bottom_clearance.aspirate': 2, 'well_bottom_clearance.dispense': 10},
+    'nuc_dispense': {'well_bottom_clearance.dispense': 2.5},
+    'media_top': {'well_bottom_clearance.dispense': 12},
+    'culture_mix': {'well_bottom_clearance.aspirate': 2.5, 'well_bottom_clearance.dispense': 2.5},
+}
+
+@contextmanager
+def liquid_class(pipette, name):
+    #Applies a LIQUID_CLASSES profile for a 'with' block. Only settings that differ from the pipette's are set, they are restored when the block ends
+    changed = []
+    for setting, value in LIQUID_CLASSES[name].items():
+        group, attribute = setting.split('.')
+        settings = getattr(pipette, group)
+        if getattr(settings, attribute) != value:
+            changed.append((settings, attribute, getattr(settings, attribute)))
+            setattr(settings, attribute, value)
+    try:
+        yield
+    finally:
+        for settings, attribute, value in reversed(changed):
+            setattr(settings, attribute, value)
+
+
 def run(protocol: protocol_api.ProtocolContext):
     # labware
     plate_stock = protocol.load_labware('cornering_96_wellplate_500ul', '9')
@@ -44,7 +90,7 @@ def run(protocol: protocol_api.ProtocolContext):
     p300m.maximum_volume = 200
     p300m.minimum_volume = 15
     
-    p50m = protocol.load_instrument('p50_multi', mount='left', tip_racks=[tip200_1, tip200_3])
+    p50m = protocol.load_instrument('p50_multi', mount='left', tip_racks=[tip200_3, tip200_1])
 
 	#Step 1: Distrubute Nuc Solution to DNA plate
     p50m.pick_up_tip()
@@ -72,29 +118,22 @@ def run(protocol: protocol_api.ProtocolContext):
     
 	#Step 3: Mix cells + transfer to DNA plate
     p300m.pick_up_tip()
-    p300m.well_bottom_clearance.aspirate = 2
-    p300m.well_bottom_clearance.dispense = 10  
-    for j in range(15):
-	    p300m.aspirate(190, trough.wells_by_name()['A2'], rate=3.0) 
-	    p300m.dispense(190, trough.wells_by_name()['A2'], rate=3.0) 
-    protocol.delay(seconds=1) 
-    p300m.blow_out(trough.wells_by_name()['A2'].top())
-    p300m.touch_tip()   
-    p300m.drop_tip()
+    with liquid_class(p300m, 'cell_resuspend'):
+        for j in range(15):
+            p300m.aspirate(190, trough.wells_by_name()['A2'], rate=3.0) 
+            p300m.dispense(190, trough.wells_by_name()['A2'], rate=3.0) 
+        protocol.delay(seconds=1) 
+        p300m.blow_out(trough.wells_by_name()['A2'].top())
+        p300m.touch_tip()   
+        p300m.drop_tip()
     p300m.flow_rate.aspirate = 150
-    p300m.flow_rate.dispense = 200
-    p300m.well_bottom_clearance.aspirate = 1
-    p300m.well_bottom_clearance.dispense = 1
 
     for i in range(4):
         p50m.pick_up_tip()
-        p50m.well_bottom_clearance.aspirate = 2
-        p50m.well_bottom_clearance.dispense = 10
-        for j in range(5):
-        	p50m.aspirate(50, trough.wells_by_name()['A2'], rate=5.0)
-        	p50m.dispense(50, trough.wells_by_name()['A2'], rate=5.0)
-        p50m.well_bottom_clearance.aspirate = 1
-        p50m.well_bottom_clearance.dispense = 1
+        with liquid_class(p50m, 'cell_resuspend'):
+            for j in range(5):
+                p50m.aspirate(50, trough.wells_by_name()['A2'], rate=5.0)
+                p50m.dispense(50, trough.wells_by_name()['A2'], rate=5.0)
         protocol.delay(seconds=1) 
         p50m.blow_out(trough.wells_by_name()['A2'].top())
         p50m.transfer(45, trough.wells('A2'), plate_dna.wells()[8*i], new_tip='never', mix_after=(2, 50), touch_tip=True)
@@ -103,20 +142,34 @@ def run(protocol: protocol_api.ProtocolContext):
         p50m.drop_tip()
 
     #Step 4: Distribute cells to nucleofection plate
+    dna_volume = 38 + 7 + 45    # ul in each DNA plate well after steps 1-3
+    if REPLICATES < 1 or 4 * REPLICATES > len(plate_nuc.columns()):
+        raise ValueError('REPLICATES must be 1-%d, 4 DNA samples x REPLICATES columns on the nucleofection plate, it is %s'
+                         % (len(plate_nuc.columns()) // 4, REPLICATES))
+    if REPLICATES * REPLICATE_VOLUME + REPLICATE_OVERAGE > dna_volume:
+        raise ValueError('REPLICATES x REPLICATE_VOLUME + REPLICATE_OVERAGE must fit the %dul in each DNA well, it is %d x %d + %d'
+                         % (dna_volume, REPLICATES, REPLICATE_VOLUME, REPLICATE_OVERAGE))
     for i in range(4): # loop for 4 columns on DNA setup plate
         p50m.pick_up_tip()
         p50m.mix(10, 50, plate_dna.wells()[8*i], rate=5.0)
         protocol.delay(seconds=1) 
         p50m.blow_out(plate_dna.wells()[8*i].top())
-        for j in range(3): # Subloop for 3 replicates
-            p50m.mix(4, (50-10*j), plate_dna.wells()[8*i], rate=5.0)
-            p50m.blow_out(plate_dna.wells()[8*i].top())
+        if REPLICATE_MODE == 'per_replicate':
+            loads = [[j] for j in range(REPLICATES)]
+        else:
+            per_load = int((p50m.max_volume - REPLICATE_OVERAGE) // REPLICATE_VOLUME)
+            loads = [list(range(REPLICATES))[k:k+per_load] for k in range(0, REPLICATES, per_load)]
+        for load in loads: # Subloop for the replicates dispensed from one aspirate
+            if REPLICATE_MIXES:
+                left = dna_volume - REPLICATE_VOLUME*load[0]   # overage of earlier loads was blown back
+                p50m.mix(REPLICATE_MIXES, max(REPLICATE_MIX_MIN, min(p50m.max_volume, left/2 + 5)), plate_dna.wells()[8*i], rate=5.0)
+                p50m.blow_out(plate_dna.wells()[8*i].top())
             protocol.delay(seconds=1.0)
-            p50m.well_bottom_clearance.dispense = 2.5
-            p50m.aspirate(25, plate_dna.wells()[8*i])
-            p50m.dispense(20, plate_nuc.wells()[8*(3*i+j)])
-            protocol.delay(seconds=1.5)
-            p50m.well_bottom_clearance.dispense = 1
+            with liquid_class(p50m, 'nuc_dispense'):
+                p50m.aspirate(REPLICATE_VOLUME*len(load) + REPLICATE_OVERAGE, plate_dna.wells()[8*i])
+                for j in load:
+                    p50m.dispense(REPLICATE_VOLUME, plate_nuc.wells()[8*(REPLICATES*i+j)])
+                    protocol.delay(seconds=1.5)
             p50m.blow_out(plate_dna.wells()[8*i].top()) 
         p50m.drop_tip()
 
@@ -125,45 +178,50 @@ def run(protocol: protocol_api.ProtocolContext):
     protocol.comment('ATTENTION: Ensure below criteris are met prior to resuming protocol. Perform electroporation and return nucleofection plate to position 3. During electroporation, add pregassed media to trough, position 8, col 3. Once complete click resume.')
 
     #Step 5: Add 80ul media to all wells
-    p300m.well_bottom_clearance.dispense = 12
-    p300m.pick_up_tip()
-    for i in range(12):
-        p300m.aspirate(80, trough.wells()[2])
-        p300m.dispense(80, plate_nuc.wells()[8*i])
-        protocol.delay(seconds=1)
-        p300m.blow_out(plate_nuc.wells()[8*i].top())
-    p300m.drop_tip()
-    p300m.well_bottom_clearance.dispense = 1
+    with liquid_class(p300m, 'media_top'):
+        p300m.pick_up_tip()
+        for i in range(12):
+            p300m.aspirate(80, trough.wells()[2])
+            p300m.dispense(80, plate_nuc.wells()[8*i])
+            protocol.delay(seconds=1)
+            p300m.blow_out(plate_nuc.wells()[8*i].top())
+        p300m.drop_tip()
     protocol.home()
 
-    #Intervention 4: Reset tipracks for seeding
-    protocol.pause()
-    protocol.comment('ATTENTION: Ensure below criteria are met prior to resuming protocol. Please reset tipracks as detailed below ready for seeding of cells. tip200_1 (slot 7) Only odd rows or tips. tip200_2 (slot 10) requires only even rows of tips. Extended details in ReadME section of script. Once complete click resume.')
-    p300m.reset_tipracks() # Reset tipracks
-   
+    if SEED_TIPS == 'per_replicate':
+        #Intervention 4: Reset tipracks for seeding
+        protocol.pause()
+        protocol.comment('ATTENTION: Ensure below criteria are met prior to resuming protocol. Please reset tipracks as detailed below ready for seeding of cells. tip200_1 (slot 7) Only odd rows or tips. tip200_2 (slot 10) requires only even rows of tips. Extended details in ReadME section of script. Once complete click resume.')
+        p300m.reset_tipracks() # Reset tipracks
+        share = 1
+        List_plate = [(0, plate24_1A, tip200_1, 1),(0, plate24_2B, tip200_2, 1), (6, plate24_3A, tip200_1, 7), (6, plate24_4B, tip200_2, 7)]
+    elif SEED_TIPS == 'shared_per_sample':
+        share = 3
+        List_plate = [(0, plate24_1A, tip200_2, 1),(0, plate24_2B, tip200_2, 5), (6, plate24_3A, tip200_2, 3), (6, plate24_4B, tip200_2, 7)]
+    else:
+        raise ValueError("SEED_TIPS must be 'per_replicate' or 'shared_per_sample', it is %r" % (SEED_TIPS,))
+
     #Step 8: Seed into 24SWPs
-    List_plate = [(0, plate24_1A, tip200_1),(0, plate24_2B, tip200_2), (6, plate24_3A, tip200_1), (6, plate24_4B, tip200_2)]
-                #In list arguments 1-4 are: 24SWP number, 24SWP name, tiprack, column offset adjuster
+                #In list arguments 1-4 are: column offset adjuster, 24SWP name, tiprack, first tip column (a new column every `share` replicates)
     
-    for (j, plate24, tip), i in product(List_plate, range(6)):    #'produt' multiplies two variables into a matrix, same as doubble loop.
+    for (j, plate24, tip, t), i in product(List_plate, range(6)):    #'produt' multiplies two variables into a matrix, same as doubble loop.
         isource = plate24.wells()[4*(i)]                            #isource and isource 2 are the same location, defined by wells or columns
         idest_nuc = plate_nuc.wells()[8*(i+j)]
 
-        p300m.well_bottom_clearance.aspirate = 2.5
-        p300m.well_bottom_clearance.dispense = 2.5
-        p300m.pick_up_tip(tip['A' + str(i+j+1)])
-        for m in range(10):
-            p300m.aspirate(70, idest_nuc, rate=2.0)
-            p300m.dispense(70, idest_nuc, rate=2.0)
-        protocol.delay(seconds=1.0)
-        p300m.blow_out(plate_nuc.wells()[8*(j+i)].top())
-        protocol.delay(seconds=1.0)
-        p300m.aspirate(70, idest_nuc, rate=0.5)
-        p300m.well_bottom_clearance.aspirate = 1.0
-        p300m.well_bottom_clearance.dispense = 1.0
+        with liquid_class(p300m, 'culture_mix'):
+            if i % share == 0:                                          #New tip for each replicate, or each DNA sample when shared
+                p300m.pick_up_tip(tip['A' + str(t + i//share)])
+            for m in range(10):
+                p300m.aspirate(70, idest_nuc, rate=2.0)
+                p300m.dispense(70, idest_nuc, rate=2.0)
+            protocol.delay(seconds=1.0)
+            p300m.blow_out(plate_nuc.wells()[8*(j+i)].top())
+            protocol.delay(seconds=1.0)
+            p300m.aspirate(70, idest_nuc, rate=0.5)
         p300m.dispense(70, isource)
         p300m.mix(2, 190, isource)
         protocol.delay(seconds=1.0)
         p300m.blow_out(isource.top())
-        p300m.drop_tip()
+        if i % share == share - 1:
+            p300m.drop_tip()
     #END SCRIPT!!!
\ No newline at end of file
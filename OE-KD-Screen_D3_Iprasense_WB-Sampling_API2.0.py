@@ -18,6 +18,7 @@
 from opentrons import protocol_api
 from itertools import product
 from opentrons import types
+from contextlib import contextmanager
 
 # metadata
 metadata = {
@@ -26,6 +27,60 @@ metadata = {
     'author': 'Oscar Swindley <oswindley1@sheffield.co.uk>',
     'description': 'Sampling 24_shallow_well_plate cultures for measurements on the iprasense. Includes dilution step. This require tricking the OT2 to use multichannels on 24 well plate',}
 
+# liquid classes: pipette settings for a block of steps, used as: with liquid_class(pipette, name):
+LIQUID_CLASSES = {
+    'culture': {'well_bottom_clearance.aspirate': 1.0, 'well_bottom_clearance.dispense': 2.5},
+    'feed': {'well_bottom_clearance.aspirate': 1.0, 'well_bottom_clearance.dispense': 15.0},
+    'slide_mix': {'flow_rate.aspirate': 50, 'flow_rate.dispense': 100},
+    'slide_load': {'flow_rate.aspirate': 25, 'flow_rate.dispense': 2.5},
+    'reagent_top': {'well_bottom_clearance.aspirate': 1.0, 'well_bottom_clearance.dispense': 9.0, 'flow_rate.aspirate': 150, 'flow_rate.dispense': 50},
+}
+
+# mixing patterns for resuspending the 24 well cultures (compare them with: python -m ot2_tools.mixing). Offsets in mm from the well bottom,
+# one (aspirate point, dispense point) pair per move. Step 2 uses MIX_PATTERN
+MIX_PATTERN = 'edge_cross'
+MIX_PATTERNS = {
+    'edge_cross': {'moves': [((5.5, 0, 1.5), (-5.5, 0, 1.5)), ((0, 3.75, 1.5), (0, -3.75, 1.5)), ((-5.5, 0, 1.5), (5.5, 0, 1.5)), ((0, -3.75, 1.5), (0, 3.75, 1.5))],
+                   'repeats': 2, 'aspirate': 290, 'dispense': 300, 'rates': (2.0, 3.0), 'centre_mixes': 1},
+    'orbital': {'moves': [((0, 0, 1.5), (5.5, 0, 1.5)), ((0, 0, 1.5), (3.89, 2.65, 1.5)), ((0, 0, 1.5), (0, 3.75, 1.5)), ((0, 0, 1.5), (-3.89, 2.65, 1.5)),
+                          ((0, 0, 1.5), (-5.5, 0, 1.5)), ((0, 0, 1.5), (-3.89, -2.65, 1.5)), ((0, 0, 1.5), (0, -3.75, 1.5)), ((0, 0, 1.5), (3.89, -2.65, 1.5))],
+                'repeats': 1, 'aspirate': 290, 'dispense': 290, 'rates': (2.0, 3.0), 'centre_mixes': 0},
+    'bottom_sweep': {'moves': [((-5.5, 2.25, 1), (5.5, 2.25, 1)), ((5.5, 0, 1), (-5.5, 0, 1)), ((-5.5, -2.25, 1), (5.5, -2.25, 1)),
+                               ((5.5, -2.25, 1), (-5.5, -2.25, 1)), ((-5.5, 0, 1), (5.5, 0, 1)), ((5.5, 2.25, 1), (-5.5, 2.25, 1))],
+                     'repeats': 1, 'aspirate': 250, 'dispense': 250, 'rates': (2.0, 3.0), 'centre_mixes': 0},
+}
+
+@contextmanager
+def liquid_class(pipette, name):
+    #Applies a LIQUID_CLASSES profile for a 'with' block. Only settings that differ from the pipette's are set, they are restored when the block ends
+    changed = []
+    for setting, value in LIQUID_CLASSES[name].items():
+        group, attribute = setting.split('.')
+        settings = getattr(pipette, group)
+        if getattr(settings, attribute) != value:
+            changed.append((settings, attribute, getattr(settings, attribute)))
+            setattr(settings, attribute, value)
+    try:
+        yield
+    finally:
+        for settings, attribute, value in reversed(changed):
+            setattr(settings, attribute, value)
+
+
+def pattern_mix(pipette, well, name):
+    #Runs a MIX_PATTERNS pattern in well: full volume mixes in the centre, the pattern moves, the centre mixes again
+    pattern = MIX_PATTERNS[name]
+    volume = max(pattern['aspirate'], pattern['dispense'])
+    if pattern['centre_mixes']:
+        pipette.mix(pattern['centre_mixes'], volume, well, rate=pattern['rates'][0])
+    for r in range(pattern['repeats']):
+        for aspirate, dispense in pattern['moves']:
+            pipette.aspirate(pattern['aspirate'], well.bottom().move(types.Point(*aspirate)), rate=pattern['rates'][0])
+            pipette.dispense(pattern['dispense'], well.bottom().move(types.Point(*dispense)), rate=pattern['rates'][1])
+    if pattern['centre_mixes']:
+        pipette.mix(pattern['centre_mixes'], volume, well, rate=pattern['rates'][0])
+
+
 def run(protocol: protocol_api.ProtocolContext):
     # labware
     plate_pel = protocol.load_labware('nunc_96_ubottom', '9') 
@@ -60,45 +115,27 @@ def run(protocol: protocol_api.ProtocolContext):
     #Step 2: Mix and transfer 300ul 24wp_culture 1 into supernatant plate, transfer 30ul into dilution plate
     List_plate = [(0, plate24_1A, tip300_1, 0, 0), (3, plate24_1A, tip300_1, 1, 0), (0, plate24_2B, tip300_2, 0, 0), (3, plate24_2B, tip300_2, 1, 0), (0, plate24_3A, tip300_1, 2, 6), (3, plate24_3A, tip300_1, 3, 6), (0, plate24_4B, tip300_2, 2, 6), (3, plate24_4B, tip300_2, 3, 6)]
                     #In list arguments 1-4 are: 24SWP number, 24SWP name, tiprack, column offset adjuster
-    p300m.well_bottom_clearance.aspirate = 1.0
-    p300m.well_bottom_clearance.dispense = 2.5  
-    for (j, plate24, tip, k, l), i in product(List_plate, range(3)):    #'produt' multiplies two variables into a matrix, same as doubble loop.   
-        isource = plate24.wells()[4*(i+j)]                            #isource and isource 2 are the same location, defined by wells or columns
-        idest_intermediate = plate_dil.wells()[8*(i+j+l)]                      # save the source and destinations to variables based on 'i', 'j' 'k', 'l'
-        idest_wb = plate_pel.wells()[8*k]
-
-        well_edge_x1 = isource.bottom().move(types.Point(x=5.5, y=0, z=1.5))   # define 4 edges of the well for mixing
-        well_edge_x2 = isource.bottom().move(types.Point(x=-5.5, y=0, z=1.5))
-        well_edge_y1 = isource.bottom().move(types.Point(x=0, y=3.75, z=1.5))
-        well_edge_y2 = isource.bottom().move(types.Point(x=0, y=-3.75, z=1.5))
+    with liquid_class(p300m, 'culture'):
+        for (j, plate24, tip, k, l), i in product(List_plate, range(3)):    #'produt' multiplies two variables into a matrix, same as doubble loop.   
+            isource = plate24.wells()[4*(i+j)]                            #isource and isource 2 are the same location, defined by wells or columns
+            idest_intermediate = plate_dil.wells()[8*(i+j+l)]                      # save the source and destinations to variables based on 'i', 'j' 'k', 'l'
+            idest_wb = plate_pel.wells()[8*k]
 
         
-        p300m.pick_up_tip(tip['A' + str(i+k*3+1)]) #Chooses tip to pick up, as cant slect only rack
-        p300m.mix(1, 300, isource, rate=2.0)
-        for r in range(2):                      # 2 loops of mixing each well edge
-            p300m.aspirate(290, well_edge_x1, rate=2.0)
-            p300m.dispense(300, well_edge_x2, rate=3.0)
-            p300m.aspirate(290, well_edge_y1, rate=2.0)
-            p300m.dispense(300, well_edge_y2, rate=3.0)            
-            p300m.aspirate(290, well_edge_x2, rate=2.0)
-            p300m.dispense(300, well_edge_x1, rate=3.0)            
-            p300m.aspirate(290, well_edge_y2, rate=2.0)
-            p300m.dispense(300, well_edge_y1, rate=3.0)
-        p300m.mix(1, 300, isource, rate=2.0)
-        protocol.delay(seconds=1.0)
-        p300m.blow_out(isource.top())   
-        p300m.transfer(30, isource, idest_intermediate, mix_after=(2, 45), new_tip='never')
-        protocol.delay(seconds=1)
-        p300m.blow_out(idest_intermediate.top())
-        p300m.mix(1, 300, isource, rate=2.0)
-        protocol.delay(seconds=1.0)
-        p300m.blow_out(isource.top())
-        p300m.transfer(75, isource, idest_wb, new_tip='never')
-        protocol.delay(seconds=1)
-        p300m.blow_out(idest_wb.top())
-        p300m.drop_tip()
-    p300m.well_bottom_clearance.aspirate = 1.0
-    p300m.well_bottom_clearance.dispense = 1.0 
+            p300m.pick_up_tip(tip['A' + str(i+k*3+1)]) #Chooses tip to pick up, as cant slect only rack
+            pattern_mix(p300m, isource, MIX_PATTERN)       # resuspend the culture, 4 edges x2 by default
+            protocol.delay(seconds=1.0)
+            p300m.blow_out(isource.top())   
+            p300m.transfer(30, isource, idest_intermediate, mix_after=(2, 45), new_tip='never')
+            protocol.delay(seconds=1)
+            p300m.blow_out(idest_intermediate.top())
+            p300m.mix(1, 300, isource, rate=2.0)
+            protocol.delay(seconds=1.0)
+            p300m.blow_out(isource.top())
+            p300m.transfer(75, isource, idest_wb, new_tip='never')
+            protocol.delay(seconds=1)
+            p300m.blow_out(idest_wb.top())
+            p300m.drop_tip()
 
     #Intervention 1:
     protocol.home()
@@ -118,32 +155,27 @@ def run(protocol: protocol_api.ProtocolContext):
             p300m.blow_out(plate_name.wells()[4*i].top())
         p300m.drop_tip()
 
-    p300m.well_bottom_clearance.aspirate = 1.0
-    p300m.well_bottom_clearance.dispense = 15.0  
-    Feed_Plate(plate24_1A)
-    Feed_Plate(plate24_3A)
-    Feed_Plate(plate24_2B)
-    Feed_Plate(plate24_4B)
+    with liquid_class(p300m, 'feed'):
+        Feed_Plate(plate24_1A)
+        Feed_Plate(plate24_3A)
+        Feed_Plate(plate24_2B)
+        Feed_Plate(plate24_4B)
 
-    p300m.well_bottom_clearance.aspirate = 1.0
-    p300m.well_bottom_clearance.dispense = 1.0 
     protocol.home()
     
     #Function_create: Load into IP_slide, x indicates column miltipier on 96well plate, value = 0 or 1
     def IP_slide_load(x):
         for i in range(6):
             p50m.pick_up_tip()
-            p50m.mix(8, 50, plate_dil.wells()[8*(2*i+x)], rate=4.0)
-            protocol.delay(seconds=1) 
-            p50m.blow_out(plate_dil.wells()[8*(2*i+x)].top())
-            p50m.aspirate(10, plate_dil.wells()[8*(2*i+x)].top())
-            p50m.flow_rate.aspirate = 25
-            p50m.flow_rate.dispense = 2.5
-            p50m.aspirate(9.0, plate_dil.wells()[8*(2*i+x)])
-            p50m.dispense(30, plate_ip.wells()[8*(2*i+x)])
-            protocol.delay(seconds=1.0)
-            p50m.flow_rate.aspirate = 50
-            p50m.flow_rate.dispense = 100
+            with liquid_class(p50m, 'slide_mix'):
+                p50m.mix(8, 50, plate_dil.wells()[8*(2*i+x)], rate=4.0)
+                protocol.delay(seconds=1) 
+                p50m.blow_out(plate_dil.wells()[8*(2*i+x)].top())
+                p50m.aspirate(10, plate_dil.wells()[8*(2*i+x)].top())
+            with liquid_class(p50m, 'slide_load'):
+                p50m.aspirate(9.0, plate_dil.wells()[8*(2*i+x)])
+                p50m.dispense(30, plate_ip.wells()[8*(2*i+x)])
+                protocol.delay(seconds=1.0)
             p50m.drop_tip()
 
     #Step 3: Load into IP_slide 1, swaps slides, load IP_slide 2
@@ -171,24 +203,21 @@ def run(protocol: protocol_api.ProtocolContext):
     protocol.comment("ATTENTION: Remove western blot at qPCR plates, pellet cells and return. Add 8ml RNA_Later to trough A5. Add 8ml ice cold PBS to trough A6")
    
     #Step 5: Add PBC to western blot samples and mix, Add RNA later to qPCR samples
-    p300m.well_bottom_clearance.aspirate = 1.0
-    p300m.well_bottom_clearance.dispense = 9.0 
-    p300m.flow_rate.aspirate = 150
-    p300m.flow_rate.dispense = 50
+    with liquid_class(p300m, 'reagent_top'):
     
-    p300m.pick_up_tip()
-    for i in range(4):
-        p300m.transfer(100, trough.wells('A6'), plate_pel.wells()[8*i], new_tip='never')
-        protocol.delay(seconds=1)
-        p300m.blow_out(plate_pel.wells()[8*i].top())
-    p300m.drop_tip()
+        p300m.pick_up_tip()
+        for i in range(4):
+            p300m.transfer(100, trough.wells('A6'), plate_pel.wells()[8*i], new_tip='never')
+            protocol.delay(seconds=1)
+            p300m.blow_out(plate_pel.wells()[8*i].top())
+        p300m.drop_tip()
     
-    p300m.pick_up_tip()
-    for i in range(4):
-        p300m.transfer(100, trough.wells('A5'), plate_dil.wells()[8*i], new_tip='never')
-        protocol.delay(seconds=1)
-        p300m.blow_out(plate_dil.wells()[8*i].top())
-    p300m.drop_tip()
+        p300m.pick_up_tip()
+        for i in range(4):
+            p300m.transfer(100, trough.wells('A5'), plate_dil.wells()[8*i], new_tip='never')
+            protocol.delay(seconds=1)
+            p300m.blow_out(plate_dil.wells()[8*i].top())
+        p300m.drop_tip()
 
 
     #END SCRIPT!!!
\ No newline at end of file
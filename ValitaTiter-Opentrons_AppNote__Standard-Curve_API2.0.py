@@ -15,6 +15,7 @@
 
 # imports
 from opentrons import protocol_api
+from contextlib import contextmanager
 
 # metadata
 metadata = {
@@ -23,6 +24,29 @@ metadata = {
     'author': 'Oscar Swindley <oswindley1@sheffield.co.uk>',
     'description': 'First python protocol, ValitaTiterAssay, 1in15 sample dilution',
 }
+
+# liquid classes: pipette settings for a block of steps, used as: with liquid_class(pipette, name):
+LIQUID_CLASSES = {
+    'vt_buffer': {'well_bottom_clearance.dispense': 7},
+}
+
+@contextmanager
+def liquid_class(pipette, name):
+    #Applies a LIQUID_CLASSES profile for a 'with' block. Only settings that differ from the pipette's are set, they are restored when the block ends
+    changed = []
+    for setting, value in LIQUID_CLASSES[name].items():
+        group, attribute = setting.split('.')
+        settings = getattr(pipette, group)
+        if getattr(settings, attribute) != value:
+            changed.append((settings, attribute, getattr(settings, attribute)))
+            setattr(settings, attribute, value)
+    try:
+        yield
+    finally:
+        for settings, attribute, value in reversed(changed):
+            setattr(settings, attribute, value)
+
+
 def run(protocol: protocol_api.ProtocolContext):
 
     # labware: Labware used in the protocol is loaded, format: variable = labware.load('labware name', 'Position on deck')
@@ -81,17 +105,16 @@ def run(protocol: protocol_api.ProtocolContext):
         protocol.home()
 
        #Step3: Add 60ul VT-Buff to VT plate
-        p300m.well_bottom_clearance.dispense = 7
-        p300m.pick_up_tip()
-        for i in range(12):
-            p300m.aspirate(60, trough.wells()[trough_well])
-            p300m.move_to(trough.wells()[trough_well].top(-20))
-            protocol.delay(seconds=1)
-            p300m.dispense(60, plate_vt.wells()[8*i])
-            protocol.delay(seconds=1)
-            p300m.blow_out(plate_vt.wells()[8*i].top())
-        p300m.drop_tip()
-        p300m.well_bottom_clearance.dispense = 1
+        with liquid_class(p300m, 'vt_buffer'):
+            p300m.pick_up_tip()
+            for i in range(12):
+                p300m.aspirate(60, trough.wells()[trough_well])
+                p300m.move_to(trough.wells()[trough_well].top(-20))
+                protocol.delay(seconds=1)
+                p300m.dispense(60, plate_vt.wells()[8*i])
+                protocol.delay(seconds=1)
+                p300m.blow_out(plate_vt.wells()[8*i].top())
+            p300m.drop_tip()
         protocol.home()
 
         #Step 4: Add 60ul Dil.Sample to VT plate + mix.
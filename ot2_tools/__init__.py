@@ -0,0 +1,35 @@
+#Readme:
+#Offline tools for the OT2 protocols in this repository.
+#The protocols themselves stay as standalone files so they can still be uploaded to the OT2 app as they are.
+#These tools run each protocol's run(protocol) against a local recording stand-in for the opentrons API,
+#so nothing here needs a robot, the opentrons package or a network connection.
+#
+#Modules:
+#   labware  - OT2 deck slot geometry, labware (custom ones read from the labware/ bundle) and pipette specs
+#   sim      - recording stand-in for ProtocolContext, protocol loader (python -m ot2_tools.sim <protocol>)
+#   runtime  - run-time model, predicted time per step (python -m ot2_tools.runtime <protocol>)
+#   bench    - benchmark suite with stored timing baselines (python -m ot2_tools.bench)
+#   multidispense - single-aspirate multi-dispense planner for fill loops (python -m ot2_tools.multidispense <protocol>)
+#   pathopt  - gantry path optimizer, reorders independent well operations (python -m ot2_tools.pathopt <protocol>)
+#   compression - 24-well -> 96-well compression index for any number of plates (python -m ot2_tools.compression --plates 8)
+#   seeding  - plates per hour for the 24well_Plate_Seed batch mode (python -m ot2_tools.seeding --plates 16)
+#   shard    - multi-robot sharding runner, parallel simulation of per-robot shards (python -m ot2_tools.shard <protocol> --plates N --robots R)
+#   dilution - serial-dilution engine: curve volumes, pipetting plan, concentration map export (python -m ot2_tools.dilution --top 2000 --bottom 5)
+#   tippolicy - declarative tip policies per step (reagent, same_sample, low_to_high), fewest tips and rack columns (python -m ot2_tools.tippolicy <protocol>)
+#   tipstate - tip by tip rack tracker (odd/even row racks), rack layout check and whole-run rack planner (python -m ot2_tools.tipstate <protocol> [--check])
+#   interventions - merges protocol pauses into the fewest operator interventions, idle time per intervention (python -m ot2_tools.interventions <protocol> [--latency-minutes 5])
+#   plancache - compiled protocol cache: run() frozen into a flat versioned command plan, replayed until the source changes (python -m ot2_tools.plancache <protocol> [--verify])
+#   trace    - tracing hooks around the protocol API calls, Chrome/Perfetto timeline and cost per step/call/line, simulated or real runs (python -m ot2_tools.trace <protocol> [--out t.json])
+#   settle   - settle-time model per liquid class, volume, tip and flow rate in place of the fixed delay(seconds=1) calls (python -m ot2_tools.settle <protocol> [--write])
+#   liquids  - liquid-class profile checks: redundant / dead setting changes, settings carried across steps, fastest safe flow rate per class (python -m ot2_tools.liquids <protocol> [--rates])
+#   ledger   - numpy well-volume ledger: reagent bill of materials with dead volumes, preflight fill check, liquid heights and level following clearances (python -m ot2_tools.ledger <protocol> [--fill volumes.json] [--levels])
+#   accuracy - numpy Monte Carlo pipetting errors: volume / concentration CV per final well through serial dilutions, fastest rates per step within a CV target (python -m ot2_tools.accuracy <protocol> [--samples 1000] [--wells] [--search] [--target-cv 5])
+#   campaign - multi-day screen scheduler: seed -> nucleofection -> sampling -> harvest -> valitatiter jobs on several robots with lag windows, working hours, trough pool and tip rack stock (python -m ot2_tools.campaign --plates 16 --robots 2 [--out schedule.json])
+#   deckopt  - numpy deck-layout optimizer: slot swaps that cut the travel between slots, pinned trash and instruction slots, ranked layouts with their savings (python -m ot2_tools.deckopt <protocol> [--top 5] [--pin 9] [--free-pauses])
+#   mixing   - numpy mixing-pattern library: edge_cross / orbital / bottom_sweep / centre offset tables per well geometry, resuspension coverage and turnover, cheapest pattern and time per well (python -m ot2_tools.mixing [--labware nunc_24_pseudo_a] [--table])
+#   exposure - time cells sit in nucleofection solution per Step 4 replicate mode and mix count, most mixing within CELL_EXPOSURE_SECONDS (python -m ot2_tools.exposure nucleofection [--budget 900])
+#   checkpoint - checkpoint and resume for interrupted runs: resumable replay protocol writing a checkpoint per command group, rehearsed stop and resume offline (python -m ot2_tools.checkpoint <protocol> [--fail-at N] [--emit-protocol out.py])
+#   motionopt - removes homes not needed before a pause or at the end, moves to where the head already is and no-op setting changes from a compiled plan, replay-proven equivalent (python -m ot2_tools.motionopt <protocol> [--rehome-minutes 30] [--emit-protocol out.py])
+#   sampleage - interleaves culture sampling with Iprasense slide loading: sample age per column within --max-age-minutes, slides within the ~15 min window, warns before the run when no order fits (python -m ot2_tools.sampleage <protocol> [--emit-protocol out.py])
+#   geometry - versioned custom labware bundle (labware/, offline approximations) compiled into a cached, memory-mapped well geometry index the simulator builds decks from (python -m ot2_tools.geometry [--rebuild] [--labware name])
+#   telemetry - pyarrow run telemetry store: per step actual vs predicted seconds from traced real runs, append-only Arrow files, drift per step, calibration per liquid class, slow robots (python -m ot2_tools.telemetry <protocol> --record run.trace.json --robot OT2-A)
@@ -0,0 +1,400 @@
+#Readme:
+#Monte Carlo pipetting-error simulator. Needs numpy. Every aspirate / dispense of a run is repeated over SAMPLES runs
+#at once (numpy arrays of samples x nozzles) with a volume error from the pipette and the liquid class of its step:
+#   random CV   = (cv + cv_ul / volume) x max(0.8, 1 + speed_cv x (speed - 1))     speed = flow rate / pipette default
+#   aspirate    falls short by speed_bias x (speed - 1) above the default rate, plus a fixed error per nozzle (channel_cv)
+#   dispense    a full dispense leaves retention x speed^0.5 in the tip (carried to the next well, or blown out)
+#Wells track what they hold per source (each trough well and each loaded plate is a source, see ledger), so errors
+#compound through serial dilutions (VT_SC_Plate: 10 transfers down the curve). Every final well (its last operation
+#put liquid in) is reported at the end of the run, or when a pause takes its labware away (IP slides): CV of its volume
+#and of the concentration of each source it is meant to hold (fraction in the error free run), and the mean bias.
+#--search finds the fastest rate multipliers per step and action (MULTIPLIERS, up to the liquids.SAFE_RATES class rate)
+#that keep the worst CV under --target-cv: first slows the steps that buy most CV per second if the target is missed,
+#then speeds each step up, biggest time share first, as far as the target allows.
+#Error constants are first guesses: calibrate CLASS_ERRORS / PIPETTE_ERRORS against gravimetric data.
+#Usage: python -m ot2_tools.accuracy valitatiter [--samples 1000] [--target-cv 5] [--search] [--wells]
+
+import math
+
+import numpy as np
+
+from . import labware as lw
+from . import ledger
+from . import liquids
+from . import runtime
+from . import settle
+from . import sim
+
+# cv + cv_ul / volume is the random CV of one channel, channel_cv the fixed error of each nozzle
+PIPETTE_ERRORS = {
+    'p300_multi': {'cv': 0.005, 'cv_ul': 0.6, 'channel_cv': 0.003},
+    'p50_multi': {'cv': 0.006, 'cv_ul': 0.1, 'channel_cv': 0.004},
+    'p300_single': {'cv': 0.004, 'cv_ul': 0.5, 'channel_cv': 0.0},
+    'p50_single': {'cv': 0.005, 'cv_ul': 0.08, 'channel_cv': 0.0},
+}
+
+CLASS_ERRORS = {
+    'media': {'speed_cv': 0.3, 'speed_bias': 0.003, 'retention': 0.002},
+    'cell_suspension': {'speed_cv': 0.6, 'speed_bias': 0.006, 'retention': 0.004},
+    'nucleofection_solution': {'speed_cv': 1.2, 'speed_bias': 0.012, 'retention': 0.008},
+    'viscous_standard': {'speed_cv': 1.5, 'speed_bias': 0.015, 'retention': 0.01},
+}
+
+MULTIPLIERS = (0.5, 0.75, 1.0, 1.5, 2.0, 3.0)
+SAMPLES = 1000
+SEARCH_SAMPLES = 300
+TARGET_CV = 5.0             # %
+MIN_VOLUME = 0.5            # ul, emptier wells are not reported
+
+
+class _Tip(object):
+    def __init__(self, samples, nozzles, components, chan):
+        self.volume = np.zeros((samples, len(nozzles)))
+        self.amounts = np.zeros((samples, len(nozzles), components))
+        self.nozzles = nozzles
+        self.chan = chan
+        self.nominal = 0.0
+        self.air = 0.0
+
+
+def plan_sources(protocol, name):
+    # Sources of a run from the ledger's bill of materials: ({(slot, well, when): (ul, component)}, component names,
+    # reloads). A reservoir well is a source of its own, the wells of a loaded plate share one
+    commands = protocol.commands
+    reloads = ledger.pause_reloads(name, commands)
+    labels = dict((slot, labware.label) for slot, labware in protocol.labware.items())
+    book, _ = ledger.run_ledger(commands, protocol.deck_layout(), None, reloads)
+    sources = {}
+    names = []
+    for entry in ledger.bill_of_materials(book, labels):
+        if lw.labware_spec(entry['labware'])['kind'] == 'reservoir':
+            component = 'slot %s %s' % (entry['slot'], entry['well'])
+        else:
+            component = 'slot %s %s' % (entry['slot'], entry['label'] or entry['labware'])
+        if entry['when'] != 'setup':
+            component += ' (refill)'
+        if component not in names:
+            names.append(component)
+        sources[(entry['slot'], entry['well'], entry['when'])] = (entry['required'], names.index(component))
+    return sources, names, reloads
+
+
+def _errors(command, liquids_map):
+    pipette = PIPETTE_ERRORS[command['pipette']]
+    liquid = CLASS_ERRORS.get(settle.step_class(liquids_map, command['step']), CLASS_ERRORS['media'])
+    default = lw.PIPETTES[command['pipette']][command['name']]
+    speed = command['flow_rate'] * command.get('rate', 1.0) / default
+    cv = (pipette['cv'] + pipette['cv_ul'] / max(command['volume'], 1e-6)) * max(0.8, 1.0 + liquid['speed_cv'] * (speed - 1.0))
+    return cv, liquid['speed_bias'] * max(0.0, speed - 1.0), liquid['retention'] * math.sqrt(speed)
+
+
+def propagate(commands, deck, sources, components, reloads=None, liquids_map=None, samples=SAMPLES, seed=1, ideal=False,
+              labels=None):
+    # Runs the trace over samples runs. Returns the final wells: [{slot, label, well, when, volume (samples),
+    # amounts (samples x components)}]. ideal = one error free run
+    if ideal:
+        samples = 1
+    rng = np.random.default_rng(seed)
+    geometry = ledger.Ledger(deck)
+    nozzles = ledger.tip_nozzles(commands)
+    liquids_map = liquids_map or {'classes': {}, 'steps': {}}
+    reloads = reloads or {}
+    labels = labels or {}
+    count = len(components)
+    volume, amounts, received = {}, {}, {}
+    outputs = []
+    tips = {}
+
+    def collect(slot, wells, when):
+        for w in wells:
+            if received[slot][w] and volume[slot][:, w].mean() > MIN_VOLUME:
+                outputs.append({'slot': slot, 'label': labels.get(slot), 'well': geometry.names[slot][w], 'when': when,
+                                'volume': volume[slot][:, w].copy(), 'amounts': amounts[slot][:, w, :].copy()})
+
+    def load(slot, when, wells=None):
+        index = range(len(geometry.names[slot])) if wells is None else [geometry.names[slot].index(w) for w in wells]
+        if slot not in volume:
+            volume[slot] = np.zeros((samples, len(geometry.names[slot])))
+            amounts[slot] = np.zeros((samples, len(geometry.names[slot]), count))
+            received[slot] = np.zeros(len(geometry.names[slot]), dtype=bool)
+        else:
+            collect(slot, index, when)
+        for w in index:
+            filled, component = sources.get((slot, geometry.names[slot][w], when), (0.0, None))
+            volume[slot][:, w] = filled
+            amounts[slot][:, w, :] = 0.0
+            if component is not None:
+                amounts[slot][:, w, component] = filled
+            received[slot][w] = False
+
+    def into_wells(tip, positions, wells, slot, out, moved):
+        for j, w in enumerate(wells):
+            if slot is not None:
+                volume[slot][:, w] += out[:, j]
+                amounts[slot][:, w, :] += moved[:, j, :]
+                received[slot][w] = True
+        tip.volume[:, positions] -= out
+        tip.amounts[:, positions, :] -= moved
+
+    for slot in geometry.deck:
+        load(slot, 'setup')
+    for command in commands:
+        name = command['name']
+        mount = command.get('mount')
+        location = command.get('location') or {}
+        slot = location.get('slot') if location.get('slot') in volume else None
+        if name == 'pause':
+            for resource in reloads.get(command['index'], []):
+                if isinstance(resource, (tuple, list)):
+                    if resource[0] in volume:
+                        load(resource[0], command['index'], [resource[1]])
+                elif resource in volume:
+                    load(resource, command['index'])
+        elif name == 'pick_up_tip':
+            active = nozzles[command['index']]
+            spread = PIPETTE_ERRORS[command['pipette']]['channel_cv']
+            chan = np.zeros((samples, len(active))) if ideal else rng.normal(0.0, spread, (samples, len(active)))
+            tips[mount] = _Tip(samples, active, count, chan)
+        elif name in ('drop_tip', 'return_tip'):
+            tips.pop(mount, None)
+        elif name == 'blow_out' and mount in tips:
+            tip = tips[mount]
+            if slot is not None:
+                positions, wells = geometry.nozzle_wells(command, tip.nozzles)
+                into_wells(tip, positions, wells, slot, tip.volume[:, positions].copy(), tip.amounts[:, positions, :].copy())
+            tip.volume[:] = 0.0
+            tip.amounts[:] = 0.0
+            tip.nominal = tip.air = 0.0
+        elif name == 'aspirate' and mount in tips:
+            tip = tips[mount]
+            if slot is None:
+                continue
+            if location['offset'][2] >= geometry.specs[slot]['depth']:
+                tip.air += command['volume']
+                continue
+            positions, wells = geometry.nozzle_wells(command, tip.nozzles)
+            tip.nominal += command['volume']
+            if not len(wells):
+                continue
+            cv, bias, _ = _errors(command, liquids_map)
+            if ideal:
+                actual = np.full((samples, len(wells)), float(command['volume']))
+            else:
+                actual = command['volume'] * (1.0 - bias + cv * rng.standard_normal((samples, len(wells))) + tip.chan[:, positions])
+            for j, w in enumerate(wells):
+                available = volume[slot][:, w]
+                take = np.clip(actual[:, j], 0.0, available)
+                fraction = np.divide(take, available, out=np.zeros(samples), where=available > 0)
+                moved = amounts[slot][:, w, :] * fraction[:, None]
+                amounts[slot][:, w, :] -= moved
+                volume[slot][:, w] -= take
+                received[slot][w] = False
+                tip.amounts[:, positions[j], :] += moved
+                tip.volume[:, positions[j]] += take
+        elif name == 'dispense' and mount in tips:
+            tip = tips[mount]
+            dispensed = command['volume']
+            if tip.air:
+                released = min(tip.air, dispensed)
+                tip.air -= released
+                dispensed -= released
+            if dispensed <= 0:
+                continue
+            if slot is not None:
+                positions, wells = geometry.nozzle_wells(command, tip.nozzles)
+            else:
+                positions, wells = np.arange(len(tip.nozzles)), []
+            full = dispensed >= tip.nominal - 1e-6
+            tip.nominal = max(0.0, tip.nominal - dispensed)
+            held = tip.volume[:, positions]
+            cv, _, retention = _errors(dict(command, volume=dispensed), liquids_map)
+            if ideal:
+                out = held if full else np.minimum(np.full(held.shape, dispensed), held)
+            elif full:
+                out = held * (1.0 - retention)
+            else:
+                out = np.clip(dispensed * (1.0 + cv * rng.standard_normal(held.shape) + tip.chan[:, positions]), 0.0, held)
+            fraction = np.divide(out, held, out=np.zeros(held.shape), where=held > 0)
+            moved = tip.amounts[:, positions, :] * fraction[:, :, None]
+            into_wells(tip, positions, wells, slot, out, moved)
+    for slot in volume:
+        collect(slot, range(len(geometry.names[slot])), 'end')
+    return outputs
+
+
+def well_stats(outputs, ideal_outputs, components):
+    # Per output well: volume, volume_cv, bias (mean / error free - 1) and per intended source (fraction, cv, bias).
+    # cv = the worst of the volume and concentration CVs
+    ideal = dict(((o['slot'], o['well'], o['when']), o) for o in ideal_outputs)
+    stats = []
+    for o in outputs:
+        reference = ideal.get((o['slot'], o['well'], o['when']))
+        if reference is None:
+            continue
+        mean = o['volume'].mean()
+        entry = {'slot': o['slot'], 'label': o['label'], 'well': o['well'], 'when': o['when'], 'volume': mean,
+                 'volume_cv': 100.0 * o['volume'].std() / mean, 'bias': 100.0 * (mean / reference['volume'][0] - 1.0),
+                 'sources': {}}
+        fractions = o['amounts'] / o['volume'][:, None]
+        target = reference['amounts'][0] / reference['volume'][0]
+        for c in np.nonzero(target > 1e-9)[0]:
+            if target[c] > 1.0 - 1e-9:
+                continue
+            column = fractions[:, c]
+            entry['sources'][components[c]] = (float(target[c]), 100.0 * column.std() / column.mean(),
+                                               100.0 * (column.mean() / target[c] - 1.0))
+        entry['cv'] = max([entry['volume_cv']] + [cv for _, cv, _ in entry['sources'].values()])
+        stats.append(entry)
+    return stats
+
+
+class Model(object):
+    # One protocol's trace, sources and error free run, ready for repeated Monte Carlo runs
+    def __init__(self, name, classes_path=None):
+        self.protocol = sim.simulate(name)
+        self.name = next((short for short, filename in sim.PROTOCOLS.items()
+                          if filename == self.protocol.path.split('/')[-1]), name)
+        self.deck = self.protocol.deck_layout()
+        self.labels = dict((slot, labware.label) for slot, labware in self.protocol.labware.items())
+        self.liquids = settle.load_classes(self.name, classes_path)
+        self.sources, self.components, self.reloads = plan_sources(self.protocol, self.name)
+        self.ideal = self.run(self.protocol.commands, ideal=True)
+
+    def run(self, commands, samples=SAMPLES, seed=1, ideal=False):
+        return propagate(commands, self.deck, self.sources, self.components, self.reloads, self.liquids, samples, seed,
+                         ideal, self.labels)
+
+    def stats(self, commands, samples=SAMPLES, seed=1):
+        return well_stats(self.run(commands, samples, seed), self.ideal, self.components)
+
+
+def rate_groups(commands, liquids_map):
+    # {(step, action): {'indices', 'flow_rate' (fastest effective), 'safe'}} for the aspirates / dispenses
+    groups = {}
+    for command in commands:
+        if command['name'] not in ('aspirate', 'dispense'):
+            continue
+        liquid = settle.step_class(liquids_map, command['step'])
+        group = groups.setdefault((command['step'], command['name']), {'indices': [], 'flow_rate': 0.0, 'safe': None})
+        group['indices'].append(command['index'])
+        group['flow_rate'] = max(group['flow_rate'], command['flow_rate'] * command.get('rate', 1.0))
+        safe = liquids.safe_rate(liquid, command['name'], command['pipette'])
+        group['safe'] = safe if group['safe'] is None else min(group['safe'], safe)
+    return groups
+
+
+def scaled(commands, groups, multipliers):
+    # Copy of the trace with the rate of each group's commands multiplied
+    factor = {}
+    for key, m in multipliers.items():
+        if m != 1.0:
+            for index in groups[key]['indices']:
+                factor[index] = m
+    return [dict(c, rate=c.get('rate', 1.0) * factor[c['index']]) if c['index'] in factor else c for c in commands]
+
+
+def search(model, target=TARGET_CV, samples=SEARCH_SAMPLES, seed=1, runtime_model=None):
+    # Fastest multipliers per (step, action) that keep the worst CV <= target. Returns (multipliers, worst cv, seconds)
+    commands = model.protocol.commands
+    groups = rate_groups(commands, model.liquids)
+    allowed = {}
+    for key, group in groups.items():
+        ceiling = max(group['flow_rate'], group['safe'])
+        allowed[key] = [m for m in MULTIPLIERS if m <= 1.0 or group['flow_rate'] * m <= ceiling + 1e-6]
+    cache = {}
+
+    def evaluate(multipliers):
+        key = tuple(sorted(multipliers.items()))
+        if key not in cache:
+            trial = scaled(commands, groups, multipliers)
+            worst = max(s['cv'] for s in model.stats(trial, samples, seed))
+            seconds = sum(t['total'] for t in runtime.estimate(trial, model.deck, runtime_model))
+            cache[key] = (worst, seconds)
+        return cache[key]
+
+    current = dict((key, 1.0) for key in groups)
+    worst, seconds = evaluate(current)
+    # too inaccurate: slow down the group with the most CV gained per second added until the target is met
+    while worst > target:
+        best = None
+        for key in groups:
+            lower = [m for m in allowed[key] if m < current[key]]
+            if not lower:
+                continue
+            trial = dict(current)
+            trial[key] = max(lower)
+            trial_worst, trial_seconds = evaluate(trial)
+            score = (worst - trial_worst) / max(trial_seconds - seconds, 1e-3)
+            if trial_worst < worst and (best is None or score > best[0]):
+                best = (score, trial, trial_worst, trial_seconds)
+        if best is None:
+            break
+        _, current, worst, seconds = best
+    # speed up, largest time share first, while the target holds
+    shares = dict((key, 0.0) for key in groups)
+    for command, timing in zip(commands, runtime.estimate(commands, model.deck, runtime_model)):
+        if (command['step'], command['name']) in shares:
+            shares[(command['step'], command['name'])] += timing['action']
+    for key in sorted(groups, key=lambda key: -shares[key]):
+        for m in [m for m in allowed[key] if m > current[key]]:
+            trial = dict(current)
+            trial[key] = m
+            trial_worst, trial_seconds = evaluate(trial)
+            if trial_worst > target or trial_seconds >= seconds:
+                break
+            current, worst, seconds = trial, trial_worst, trial_seconds
+    return current, worst, seconds
+
+
+def format_stats(name, stats, samples, wells=False):
+    worst = max(stats, key=lambda s: s['cv']) if stats else None
+    lines = ['%s: %d runs, %d wells, worst CV %.2f%% (slot %s %s)' % (
+        name, samples, len(stats), worst['cv'] if worst else 0.0, worst['slot'] if worst else '-', worst['well'] if worst else '')]
+    groups = {}
+    for s in stats:
+        groups.setdefault((s['slot'], s['when']), []).append(s)
+    for (slot, when), entries in groups.items():
+        label = ' ' + entries[0]['label'] if entries[0]['label'] else ''
+        volume_cv = [e['volume_cv'] for e in entries]
+        concentration = [(cv, e['well'], source) for e in entries for source, (_, cv, _) in e['sources'].items()]
+        text = '    slot %s%s%s: %d wells, volume CV %.2f-%.2f%%' % (
+            slot, label, '' if when == 'end' else ' (taken off at command %s)' % when, len(entries), min(volume_cv), max(volume_cv))
+        if concentration:
+            cv, well, source = max(concentration)
+            text += ', concentration CV up to %.2f%% (%s, %s)' % (cv, well, source)
+        lines.append(text)
+        if wells:
+            for e in entries:
+                sources = ', '.join('%s %.4g CV %.2f%% bias %+.2f%%' % (source, fraction, cv, bias)
+                                    for source, (fraction, cv, bias) in sorted(e['sources'].items()))
+                lines.append('        %-4s %7.1ful CV %5.2f%% bias %+.2f%%  %s' % (e['well'], e['volume'], e['volume_cv'], e['bias'], sources))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Monte Carlo pipetting errors: CV per well and fastest rates within a CV target')
+    parser.add_argument('protocols', nargs='+', help='protocol files or: %s' % ', '.join(sorted(sim.PROTOCOLS)))
+    parser.add_argument('--samples', type=int, default=SAMPLES, help='Monte Carlo runs (default %d)' % SAMPLES)
+    parser.add_argument('--classes', help='JSON file with liquid class / step overrides (see settle)')
+    parser.add_argument('--wells', action='store_true', help='list every well')
+    parser.add_argument('--search', action='store_true', help='search the fastest rate multipliers within --target-cv')
+    parser.add_argument('--target-cv', type=float, default=TARGET_CV, help='worst CV allowed in %% (default %g)' % TARGET_CV)
+    args = parser.parse_args(argv)
+    for name in args.protocols:
+        model = Model(name, args.classes)
+        print(format_stats(name, model.stats(model.protocol.commands, args.samples), args.samples, args.wells))
+        if args.search:
+            before = sum(t['total'] for t in runtime.estimate(model.protocol.commands, model.deck))
+            multipliers, worst, seconds = search(model, args.target_cv)
+            print('    target CV %g%%: run %s -> %s, worst CV %.2f%% (%d runs per trial)' % (
+                args.target_cv, runtime.format_seconds(before), runtime.format_seconds(seconds), worst, SEARCH_SAMPLES))
+            for (step, action), m in sorted(multipliers.items(), key=lambda item: item[0]):
+                if m != 1.0:
+                    print('        rate x%-4g %-8s %s' % (m, action, step))
+            best = scaled(model.protocol.commands, rate_groups(model.protocol.commands, model.liquids), multipliers)
+            print(format_stats('%s at these rates' % name, model.stats(best, args.samples), args.samples))
+
+
+if __name__ == '__main__':
+    main()
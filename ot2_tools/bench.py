@@ -0,0 +1,118 @@
+#Readme:
+#Benchmark suite: predicted run time of every protocol, checked against the stored baselines in benchmarks/baselines.json.
+#Run after editing a protocol to see which steps got faster or slower before standing next to the robot with a stopwatch.
+#   python -m ot2_tools.bench                    compare all protocols against the baselines, exit 1 on a regression
+#   python -m ot2_tools.bench harvest valitatiter
+#   python -m ot2_tools.bench --update           accept the current timings as the new baselines
+#A step counts as a regression when it is slower by more than --tolerance (fraction) AND by more than --min-seconds.
+
+import json
+import os
+import sys
+from collections import OrderedDict
+
+from . import runtime
+from . import sim
+
+BASELINE_PATH = os.path.join(sim.REPO_DIR, 'benchmarks', 'baselines.json')
+BASELINE_VERSION = 1
+
+
+def run_benchmarks(names=None, model=None):
+    results = OrderedDict()
+    for name in names or sorted(sim.PROTOCOLS):
+        protocol, timings = runtime.estimate_protocol(name, model)
+        results[name] = runtime.summarise(protocol, timings)
+    return results
+
+
+def load_baselines(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        data = json.load(f, object_pairs_hook=OrderedDict)
+    if data.get('version') != BASELINE_VERSION:
+        raise ValueError('%s is baseline version %s, expected %s. Rerun with --update' % (path, data.get('version'), BASELINE_VERSION))
+    return data['protocols']
+
+
+def save_baselines(results, path=BASELINE_PATH):
+    baselines = load_baselines(path) if os.path.exists(path) else OrderedDict()
+    baselines.update(results)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        json.dump({'version': BASELINE_VERSION, 'protocols': OrderedDict(sorted(baselines.items()))}, f, indent=2)
+        f.write('\n')
+
+
+def _change(name, current, baseline, tolerance, min_seconds):
+    delta = current - baseline
+    if abs(delta) <= min_seconds or (baseline and abs(delta) / baseline <= tolerance):
+        return None
+    return {'name': name, 'baseline': baseline, 'current': current, 'delta': delta, 'regression': delta > 0}
+
+
+def compare(results, baselines, tolerance=0.02, min_seconds=5.0):
+    # Returns {protocol: [changes]} for the totals and every step that moved past the thresholds
+    report = OrderedDict()
+    for protocol, result in results.items():
+        baseline = baselines.get(protocol)
+        if baseline is None:
+            report[protocol] = None
+            continue
+        changes = []
+        total = _change('TOTAL', result['total'], baseline['total'], tolerance, min_seconds)
+        if total:
+            changes.append(total)
+        for step, seconds in result['steps'].items():
+            change = _change(step, seconds, baseline['steps'].get(step, 0.0), tolerance, min_seconds)
+            if change:
+                changes.append(change)
+        for step, seconds in baseline['steps'].items():
+            if step not in result['steps'] and seconds > min_seconds:
+                changes.append({'name': step, 'baseline': seconds, 'current': 0.0, 'delta': -seconds, 'regression': False})
+        report[protocol] = changes
+    return report
+
+
+def format_comparison(results, report):
+    lines = []
+    for protocol, changes in report.items():
+        lines.append('%s  %s' % (runtime.format_seconds(results[protocol]['total']), protocol))
+        if changes is None:
+            lines.append('    no baseline, run with --update to store one')
+            continue
+        for change in changes:
+            lines.append('    %-10s %s -> %s (%s%s)  %s' % (
+                'REGRESSION' if change['regression'] else 'faster',
+                runtime.format_seconds(change['baseline']), runtime.format_seconds(change['current']),
+                '+' if change['delta'] > 0 else '', runtime.format_seconds(change['delta']), change['name']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Predicted run-time benchmarks for the OT2 protocols')
+    parser.add_argument('protocols', nargs='*', help='default all: %s' % ', '.join(sorted(sim.PROTOCOLS)))
+    parser.add_argument('--update', action='store_true', help='store the current timings as the baselines')
+    parser.add_argument('--tolerance', type=float, default=0.02, help='fractional slowdown allowed per step (default 0.02)')
+    parser.add_argument('--min-seconds', type=float, default=5.0, help='ignore changes smaller than this (default 5)')
+    parser.add_argument('--baselines', default=BASELINE_PATH)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.protocols)
+    if args.update:
+        save_baselines(results, args.baselines)
+        for name, result in results.items():
+            print(runtime.format_report(name, result))
+        print('Baselines written to %s' % args.baselines)
+        return 0
+    report = compare(results, load_baselines(args.baselines), args.tolerance, args.min_seconds)
+    print(format_comparison(results, report))
+    regressions = [c for changes in report.values() if changes for c in changes if c['regression']]
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,342 @@
+#Readme:
+#Campaign scheduler for multi-day screens across several OT2s. The plates of a screen go through the protocol chain in
+#STAGES per batch of 4 (one protocol run): seed -> nucleofection -> sampling (day 3) -> harvest -> valitatiter on the
+#harvest supernatants. A job is one stage of one batch. Its duration comes from the simulated robots: runtime.py time of
+#the protocol + operator time at its pauses (interventions.py idle time, --latency-minutes) + --swap-minutes to set the
+#deck up. Each stage starts min..max hours after the batch's previous stage ended (lag_hours), time a batch waits past
+#the minimum is plate waiting time, starting past the maximum is a missed window. Shared resources:
+#   robots     - --robots identical OT2s, one run at a time
+#   troughs    - --troughs reservoirs, a run holds the ones on its deck, back in the pool --wash-minutes after the run
+#   tip racks  - consumed, tips per rack type from the run's pick-ups (tipstate), --tip-racks stock per type is checked
+#Runs need an operator for their pauses, so they start and end inside --day-hours (a run longer than the day starts at
+#the start of the day). The schedule is built by list scheduling: the next job is the eligible one first under a
+#priority RULE, it goes on the robot where it can start soonest. Every rule is tried, the schedule with the fewest
+#missed windows, then the lowest makespan + --wait-weight x plate waiting (hours) is kept.
+#--campaign takes a JSON file with the same keys as STAGES entries by stage name to override lags, eg
+#   {"harvest": {"lag_hours": [92, 100]}}
+#Usage: python -m ot2_tools.campaign --plates 16 --robots 2 [--troughs 4] [--tip-racks opentrons_96_tiprack_300ul=60] [--out s.json]
+
+import json
+import math
+from collections import OrderedDict
+
+from . import interventions
+from . import labware as lw
+from . import plancache
+from . import runtime
+from . import tipstate
+
+PLATES_PER_RUN = 4
+
+# Protocol chain per batch: protocol settings for a 4 plate run, previous stage and the hours allowed between the end
+# of the previous stage and the start of this one
+STAGES = OrderedDict([
+    ('seed', {'overrides': {'PLATE_COUNT': PLATES_PER_RUN}, 'after': None, 'lag_hours': (0, 0)}),
+    # cells go into the freshly seeded media the same day
+    ('nucleofection', {'overrides': {}, 'after': 'seed', 'lag_hours': (0, 6)}),
+    ('sampling', {'overrides': {}, 'after': 'nucleofection', 'lag_hours': (68, 76)}),
+    ('harvest', {'overrides': {}, 'after': 'sampling', 'lag_hours': (68, 76)}),
+    # supernatants keep at 4C until the titre assay
+    ('valitatiter', {'overrides': {}, 'after': 'harvest', 'lag_hours': (0, 48)}),
+])
+
+# Job order rules: key of an eligible job given its earliest start
+RULES = OrderedDict([
+    ('earliest', lambda job, start: (start, job['latest'])),
+    ('slack', lambda job, start: (job['latest'] - start, start)),
+    ('batch', lambda job, start: (job['batch'], job['position'], start)),
+    ('longest', lambda job, start: (start, -job['seconds'])),
+])
+
+DAY = 86400.0
+
+
+def load_stages(path=None):
+    stages = OrderedDict((name, dict(stage)) for name, stage in STAGES.items())
+    if path:
+        with open(path) as f:
+            overrides = json.load(f)
+        for name, values in overrides.items():
+            if name not in stages:
+                raise ValueError("Unknown stage '%s', stages are: %s" % (name, ', '.join(stages)))
+            unknown = set(values) - set(STAGES['seed'])
+            if unknown:
+                raise ValueError("Unknown settings for stage '%s': %s" % (name, ', '.join(sorted(unknown))))
+            stages[name].update(values)
+    for name, stage in stages.items():
+        if stage['after'] is not None and stage['after'] not in stages:
+            raise ValueError("Stage '%s' follows unknown stage '%s'" % (name, stage['after']))
+        if stage['lag_hours'][0] > stage['lag_hours'][1]:
+            raise ValueError("Stage '%s' lag_hours minimum is above its maximum" % name)
+    return stages
+
+
+def profile_run(name, overrides=None, latency_minutes=5.0, swap_minutes=10.0, model=None):
+    # One simulated run of a protocol: {'seconds', 'robot', 'operator', 'troughs', 'tips': {rack type: tips}}
+    protocol = plancache.simulate(name, overrides)
+    deck = protocol.deck_layout()
+    robot = sum(t['total'] for t in runtime.estimate(protocol.commands, deck, model))
+    operator = 0.0
+    if any(c['name'] == 'pause' for c in protocol.commands):
+        units, stops = interventions.split_trace(protocol.commands)
+        tasks = interventions.build_tasks(name, units, stops, overrides)
+        timings = dict((t['index'], t['total']) for t in runtime.estimate(protocol.commands, deck, model))
+        seconds = dict((u['number'], sum(timings[c['index']] for c in u['commands'])) for u in units)
+        phases, _ = interventions.original_phases(units, tasks, stops)
+        operator = sum(interventions.idle_time(phases, units, tasks, seconds, latency_minutes))
+    tips = OrderedDict()
+    for demand in tipstate.tip_demands(protocol.commands):
+        if demand['reuse']:
+            continue
+        count = len(tipstate.PATTERNS[demand['pattern']]) if lw.PIPETTES[demand['pipette']]['channels'] > 1 else 1
+        tips[demand['tip_type']] = tips.get(demand['tip_type'], 0) + count
+    troughs = sum(1 for labware in deck.values() if lw.LABWARE[labware]['kind'] == 'reservoir')
+    return {'seconds': robot + operator + swap_minutes * 60.0, 'robot': robot, 'operator': operator,
+            'troughs': troughs, 'tips': tips}
+
+
+def build_jobs(plates, stages, profiles):
+    # One job per batch and stage: {'number', 'batch', 'stage', 'position', 'plates', 'after', 'lag', 'seconds', ...}
+    jobs = []
+    numbers = list(range(1, plates + 1))
+    for batch, first in enumerate(range(0, plates, PLATES_PER_RUN)):
+        previous = {}
+        for position, (name, stage) in enumerate(stages.items()):
+            job = dict(profiles[name], number=len(jobs), batch=batch + 1, stage=name, position=position,
+                       plates=numbers[first:first + PLATES_PER_RUN], after=previous.get(stage['after']),
+                       lag=(stage['lag_hours'][0] * 3600.0, stage['lag_hours'][1] * 3600.0))
+            previous[name] = job['number']
+            jobs.append(job)
+    return jobs
+
+
+def attended_start(t, seconds, hours=None):
+    # First start >= t that keeps the run inside the working hours of one day
+    if hours is None:
+        return t
+    begin, end = hours[0] * 3600.0, hours[1] * 3600.0
+    day = math.floor(t / DAY)
+    while True:
+        start = max(t, day * DAY + begin)
+        if start + seconds <= day * DAY + end or (seconds > end - begin and start == day * DAY + begin):
+            return start
+        day += 1
+
+
+def attended_seconds(begin, end, hours=None):
+    # Working hours between begin and end
+    if hours is None:
+        return end - begin
+    total = 0.0
+    for day in range(int(begin // DAY), int(end // DAY) + 1):
+        total += max(0.0, min(end, day * DAY + hours[1] * 3600.0) - max(begin, day * DAY + hours[0] * 3600.0))
+    return total
+
+
+def _trough_time(pool, count):
+    # Time the pool (release times) has count troughs free
+    if count == 0:
+        return 0.0
+    if count > len(pool):
+        raise ValueError('A run needs %d troughs, only %d in the pool (--troughs)' % (count, len(pool)))
+    return sorted(pool)[count - 1]
+
+
+def schedule(jobs, robots, troughs, rule, hours=None, start=0.0, wash_minutes=30.0, releases=None):
+    # List scheduling under one rule, releases holds {batch: seconds} to hold a batch's first stage back.
+    # Returns {job number: {'robot', 'start', 'end'}}
+    key = RULES[rule]
+    releases = releases or {}
+    robot_free = [start] * robots
+    pool = [start] * troughs
+    placed = {}
+    while len(placed) < len(jobs):
+        choice = None
+        for job in jobs:
+            if job['number'] in placed or (job['after'] is not None and job['after'] not in placed):
+                continue
+            if job['after'] is None:
+                ready = start + releases.get(job['batch'], 0.0)
+            else:
+                ready = placed[job['after']]['end'] + job['lag'][0]
+            ready = max(ready, _trough_time(pool, job['troughs']))
+            best = None
+            for r, free in enumerate(robot_free):
+                t = attended_start(max(ready, free), job['seconds'], hours)
+                if best is None or t < best[0]:
+                    best = (t, r)
+            rank = key(job, best[0])
+            if choice is None or rank < choice[0]:
+                choice = (rank, job, best)
+        _, job, (t, r) = choice
+        end = t + job['seconds']
+        placed[job['number']] = {'robot': r, 'start': t, 'end': end}
+        robot_free[r] = end
+        for _ in range(job['troughs']):
+            pool.remove(min(pool))
+            pool.append(end + wash_minutes * 60.0)
+    return placed
+
+
+def _latest_starts(jobs, deadline=None):
+    # Latest start of each job that keeps its batch inside every window after it, and the campaign deadline
+    latest = {}
+    for job in reversed(jobs):
+        bound = deadline - job['seconds'] if deadline is not None else float('inf')
+        for later in jobs:
+            if later['after'] == job['number'] and later['number'] in latest:
+                bound = min(bound, latest[later['number']] - later['lag'][0] - job['seconds'])
+        latest[job['number']] = bound
+    return latest
+
+
+def evaluate(jobs, placed, robots, stock=None, deadline=None, hours=None):
+    # Plate waiting, missed windows, utilisation (of the working hours) and tip stock of a schedule
+    waiting, missed, late = 0.0, [], []
+    for job in jobs:
+        slot = placed[job['number']]
+        if job['after'] is not None:
+            ready = placed[job['after']]['end']
+            waiting += max(0.0, slot['start'] - ready - job['lag'][0])
+            if slot['start'] - ready > job['lag'][1] + 1e-6:
+                missed.append((job['number'], 'starts %s after %s, window %gh' % (
+                    runtime.format_seconds(slot['start'] - ready), jobs[job['after']]['stage'], job['lag'][1] / 3600.0)))
+                late.append(job['batch'])
+        if deadline is not None and slot['end'] > deadline + 1e-6:
+            missed.append((job['number'], 'ends after the deadline'))
+    begin = min(s['start'] for s in placed.values())
+    end = max(s['end'] for s in placed.values())
+    makespan = end - begin
+    busy = [0.0] * robots
+    for job in jobs:
+        busy[placed[job['number']]['robot']] += job['seconds']
+    used = OrderedDict()
+    short = OrderedDict()
+    for job in sorted(jobs, key=lambda job: placed[job['number']]['start']):
+        for tip_type, tips in job['tips'].items():
+            used[tip_type] = used.get(tip_type, 0) + tips
+            if stock and tip_type in stock and used[tip_type] > stock[tip_type] * 96 and tip_type not in short:
+                short[tip_type] = job['number']
+    return {'waiting': waiting, 'missed': missed, 'late': sorted(set(late)), 'makespan': makespan, 'busy': busy,
+            'utilisation': sum(busy) / (robots * max(attended_seconds(begin, end, hours), 1.0)),
+            'racks': OrderedDict((tip_type, int(math.ceil(tips / 96.0))) for tip_type, tips in used.items()),
+            'short': short}
+
+
+def plan_campaign(plates, robots=1, troughs=4, hours=(8, 18), start_hour=8.0, stages=None, stock=None,
+                  deadline_days=None, latency_minutes=5.0, swap_minutes=10.0, wash_minutes=30.0, wait_weight=1.0, model=None):
+    # Tries every rule, returns the best {'rule', 'jobs', 'placed', 'score', 'results': {rule: result}}
+    if plates < 1 or robots < 1:
+        raise ValueError('A campaign needs at least one plate and one robot')
+    stages = stages or load_stages()
+    profiles = dict((name, profile_run(name, stage['overrides'], latency_minutes, swap_minutes, model))
+                    for name, stage in stages.items())
+    jobs = build_jobs(plates, stages, profiles)
+    start = start_hour * 3600.0
+    deadline = start + deadline_days * DAY if deadline_days else None
+    latest = _latest_starts(jobs, deadline)
+    for job in jobs:
+        job['latest'] = latest[job['number']]
+    results = OrderedDict()
+    for rule in RULES:
+        # A batch that misses a window starts a day later (the last such batch first) until no window is missed
+        releases = {}
+        for _ in range(len(jobs)):
+            placed = schedule(jobs, robots, troughs, rule, hours, start, wash_minutes, releases)
+            result = evaluate(jobs, placed, robots, stock, deadline, hours)
+            result['placed'] = placed
+            result['score'] = (len(result['missed']), (result['makespan'] + wait_weight * result['waiting']) / 3600.0)
+            if rule not in results or result['score'] < results[rule]['score']:
+                results[rule] = result
+            if not result['late']:
+                break
+            releases[result['late'][-1]] = releases.get(result['late'][-1], 0.0) + DAY
+    rule = min(results, key=lambda rule: results[rule]['score'])
+    return {'rule': rule, 'jobs': jobs, 'profiles': profiles, 'robots': robots, 'results': results}
+
+
+def format_clock(seconds):
+    day = int(seconds // DAY)
+    minutes = int(round((seconds - day * DAY) / 60.0))
+    return 'day %d %02d:%02d' % (day, minutes // 60, minutes % 60)
+
+
+def format_plan(plan):
+    jobs, robots = plan['jobs'], plan['robots']
+    best = plan['results'][plan['rule']]
+    lines = ['%d batches, %d jobs on %d robots: rule %s, makespan %s, plate waiting %s, %d missed windows, robots busy %.0f%% of the working hours' % (
+        len(set(job['batch'] for job in jobs)), len(jobs), robots, plan['rule'], runtime.format_seconds(best['makespan']),
+        runtime.format_seconds(best['waiting']), len(best['missed']), 100.0 * best['utilisation'])]
+    for rule, result in plan['results'].items():
+        lines.append('    rule %-8s makespan %s, waiting %s, %d missed' % (
+            rule, runtime.format_seconds(result['makespan']), runtime.format_seconds(result['waiting']), len(result['missed'])))
+    for name, profile in plan['profiles'].items():
+        lines.append('    %-13s %s per run (robot %s, operator %s), %d troughs, tips %s' % (
+            name, runtime.format_seconds(profile['seconds']), runtime.format_seconds(profile['robot']),
+            runtime.format_seconds(profile['operator']), profile['troughs'],
+            ', '.join('%s %d' % item for item in profile['tips'].items()) or '-'))
+    placed = best['placed']
+    for r in range(robots):
+        lines.append('OT2-%d: busy %s' % (r + 1, runtime.format_seconds(best['busy'][r])))
+        for job in sorted((j for j in jobs if placed[j['number']]['robot'] == r), key=lambda j: placed[j['number']]['start']):
+            slot = placed[job['number']]
+            lines.append('    %s - %s  batch %d %-13s plates %s' % (
+                format_clock(slot['start']), format_clock(slot['end']), job['batch'], job['stage'],
+                ','.join(str(p) for p in job['plates'])))
+    for number, reason in best['missed']:
+        lines.append('MISSED batch %d %s: %s' % (jobs[number]['batch'], jobs[number]['stage'], reason))
+    lines.append('tip racks: %s' % ', '.join('%s %d' % item for item in best['racks'].items()))
+    for tip_type, number in best['short'].items():
+        lines.append('SHORT %s: stock runs out at batch %d %s' % (tip_type, jobs[number]['batch'], jobs[number]['stage']))
+    return '\n'.join(lines)
+
+
+def schedule_json(plan):
+    best = plan['results'][plan['rule']]
+    return {'rule': plan['rule'], 'makespan': best['makespan'], 'waiting': best['waiting'],
+            'missed': [{'job': number, 'reason': reason} for number, reason in best['missed']],
+            'jobs': [{'batch': job['batch'], 'stage': job['stage'], 'plates': job['plates'],
+                      'robot': 'OT2-%d' % (best['placed'][job['number']]['robot'] + 1),
+                      'start': best['placed'][job['number']]['start'], 'end': best['placed'][job['number']]['end']}
+                     for job in plan['jobs']]}
+
+
+def _stock(values):
+    stock = {}
+    for value in values or []:
+        tip_type, _, racks = value.partition('=')
+        if tip_type not in lw.LABWARE or not racks:
+            raise ValueError("--tip-racks takes <tip rack labware>=<racks>, got '%s'" % value)
+        stock[tip_type] = int(racks)
+    return stock
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Schedule a multi-day screen across several simulated OT2s')
+    parser.add_argument('--plates', type=int, required=True, help='24-well plates in the screen')
+    parser.add_argument('--robots', type=int, default=1, help='OT2s (default 1)')
+    parser.add_argument('--troughs', type=int, default=4, help='reservoirs in the pool (default 4)')
+    parser.add_argument('--tip-racks', nargs='+', help='tip rack stock, eg opentrons_96_tiprack_300ul=60')
+    parser.add_argument('--day-hours', type=float, nargs=2, default=[8, 18], help='attended hours (default 8 18)')
+    parser.add_argument('--unattended', action='store_true', help='runs may start at any hour')
+    parser.add_argument('--deadline-days', type=float, help='every job ends within this many days of the start')
+    parser.add_argument('--campaign', help='JSON file with stage overrides (lag_hours, overrides)')
+    parser.add_argument('--latency-minutes', type=float, default=5.0, help='operator response time per pause (default 5)')
+    parser.add_argument('--swap-minutes', type=float, default=10.0, help='deck setup per run (default 10)')
+    parser.add_argument('--wash-minutes', type=float, default=30.0, help='trough turnaround after a run (default 30)')
+    parser.add_argument('--wait-weight', type=float, default=1.0, help='plate waiting hours per makespan hour (default 1)')
+    parser.add_argument('--out', help='write the schedule to this JSON file')
+    args = parser.parse_args(argv)
+    plan = plan_campaign(args.plates, args.robots, args.troughs, None if args.unattended else tuple(args.day_hours),
+                         args.day_hours[0], load_stages(args.campaign), _stock(args.tip_racks), args.deadline_days,
+                         args.latency_minutes, args.swap_minutes, args.wash_minutes, args.wait_weight)
+    print(format_plan(plan))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(schedule_json(plan), f, indent=2)
+        print('Schedule written to %s' % args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+#Readme:
+#Checkpoint and resume for compiled plans (plancache). The plan is cut into command groups, each group is one well
+#operation that starts with every tip empty (before an aspirate, a tip pick up or a pause) and never splits a mix() or
+#transfer() call. The replay protocol (--emit-protocol) writes a checkpoint after each completed group:
+#   index / group  - first command not done yet
+#   settings       - flow rate / clearance settings in effect per mount
+#   tips           - tip on each mount (rack slot, well) and the tips used per rack
+#   volumes        - ul moved into (+) / out of (-) each well since the start, per addressed well (A row for a multi)
+#With RESUME = True in the replay protocol the run starts at the first incomplete group: a pause asks the operator to
+#put fresh tips where the mounts had theirs, the settings are set again and the plan continues from that command, so a
+#failure at well 20 of 24 only redoes the well it stopped in. The group that was running may have moved part of its
+#liquid already, the resume pause and --status name its wells.
+#Checkpoints are only written on the robot (not during simulation), to CHECKPOINT_DIR.
+#Without --emit-protocol / --status the run is replayed on the simulator, stopped at --fail-at (default: half way)
+#and resumed from its checkpoint, with the time the resumed run takes against a full rerun.
+#Usage: python -m ot2_tools.checkpoint harvest [--fail-at 1500] [--emit-protocol harvest_resumable.py] [--status harvest.checkpoint.json]
+
+import inspect
+import json
+import os
+import shutil
+import tempfile
+
+from . import plancache
+from . import runtime
+from . import sim
+
+CHECKPOINT_DIR = '/data/user_storage'
+
+
+def command_groups(commands):
+    # First command index of every group
+    starts, tip_volume = [0], {}
+    for index, command in enumerate(commands):
+        if index and command['name'] in ('aspirate', 'pick_up_tip', 'pause') and not any(tip_volume.values()):
+            previous = commands[index - 1]
+            if not (command.get('group') and command.get('group') == previous.get('group') and command['name'] == 'aspirate'):
+                starts.append(index)
+        mount = command.get('mount')
+        if command['name'] == 'aspirate':
+            tip_volume[mount] = tip_volume.get(mount, 0.0) + command['volume']
+        elif command['name'] == 'dispense':
+            tip_volume[mount] = max(0.0, tip_volume.get(mount, 0.0) - command['volume'])
+        elif command['name'] in ('blow_out', 'pick_up_tip', 'drop_tip', 'return_tip'):
+            tip_volume[mount] = 0.0
+    return starts
+
+
+def new_state(plan):
+    return {'protocol': os.path.basename(plan['path']), 'plan': plan['key'], 'index': 0, 'group': 0,
+            'groups': len(command_groups(plan['commands'])), 'commands': len(plan['commands']), 'complete': False,
+            'settings': {}, 'tips': {}, 'used_tips': {}, 'volumes': {}}
+
+
+def advance(state, command):
+    # Updates the state with one done command
+    mount, location = command.get('mount'), command.get('location') or {}
+    name = command['name']
+    if name == 'set':
+        state['settings'].setdefault(mount, {})[command['setting']] = command['value']
+    elif name == 'pick_up_tip':
+        state['tips'][mount] = [location['slot'], location['well']]
+        state['used_tips'].setdefault(location['slot'], []).append(location['well'])
+    elif name in ('drop_tip', 'return_tip'):
+        state['tips'][mount] = None
+        if name == 'return_tip' and location.get('well'):
+            state['used_tips'][location['slot']].remove(location['well'])
+    elif name in ('aspirate', 'dispense') and location.get('well'):
+        key = '%s:%s' % (location['slot'], location['well'])
+        volume = command['volume'] if name == 'dispense' else -command['volume']
+        state['volumes'][key] = round(state['volumes'].get(key, 0.0) + volume, 3)
+    elif name == 'reset_tipracks':
+        for slot in command.get('racks', []):
+            state['used_tips'].pop(slot, None)
+    state['index'] += 1
+
+
+def checkpoint_writer(plan, path, state=None):
+    # after(command) hook for replay: keeps the state and writes it to path after every completed group
+    state = json.loads(json.dumps(state)) if state else new_state(plan)
+    starts = set(command_groups(plan['commands']))
+
+    def after(command):
+        if command.get('resume'):
+            return
+        advance(state, command)
+        state['complete'] = state['index'] >= state['commands']
+        if state['index'] in starts or state['complete']:
+            state['group'] = sum(1 for start in starts if start <= state['index']) - 1
+            partial = path + '.tmp'
+            with open(partial, 'w') as f:
+                json.dump(state, f)
+            os.replace(partial, path)
+    return after
+
+
+def read_checkpoint(path, plan):
+    with open(path) as f:
+        state = json.load(f)
+    if state['plan'] != plan['key']:
+        raise ValueError('%s was written by another plan (%s), not %s' % (path, state['plan'][:12], plan['key'][:12]))
+    return state
+
+
+def group_wells(plan, state):
+    # Wells the group at the checkpoint dispenses into, they may hold part of its liquid
+    starts = command_groups(plan['commands']) + [len(plan['commands'])]
+    wells = []
+    for command in plan['commands'][state['index']:starts[state['group'] + 1]]:
+        location = command.get('location') or {}
+        if command['name'] == 'dispense' and location.get('well'):
+            well = 'slot %s %s' % (location['slot'], location['well'])
+            if well not in wells:
+                wells.append(well)
+    return wells
+
+
+def resume_plan(plan, state):
+    # The plan from the checkpoint on: fresh tips for the mounts that had one, the settings in effect, then the commands
+    if state['complete']:
+        raise ValueError('The checkpoint is of a complete run, nothing to resume')
+    preamble = [{'name': 'comment', 'mount': None, 'resume': True,
+                 'message': 'Resuming %s at command %d of %d (group %d of %d)' % (
+                     state['protocol'], state['index'] + 1, state['commands'], state['group'] + 1, state['groups'])}]
+    tips = sorted((mount, tip) for mount, tip in state['tips'].items() if tip)
+    checks = ['Remove any tips left on the pipettes.']
+    for mount, (slot, well) in tips:
+        checks.append('Put a fresh tip (column) in slot %s %s for the %s pipette.' % (slot, well, mount))
+    wells = group_wells(plan, state)
+    if wells:
+        checks.append('The interrupted operation may have dispensed into %s already.' % ', '.join(wells))
+    preamble.append({'name': 'pause', 'mount': None, 'resume': True, 'message': ' '.join(checks) + ' Then click resume.'})
+    for mount, (slot, well) in tips:
+        preamble.append({'name': 'pick_up_tip', 'mount': mount, 'resume': True, 'location': {'slot': slot, 'well': well}})
+    for mount, settings in sorted(state['settings'].items()):
+        for setting, value in sorted(settings.items()):
+            preamble.append({'name': 'set', 'mount': mount, 'resume': True, 'setting': setting, 'value': value})
+    return dict(plan, commands=preamble + plan['commands'][state['index']:])
+
+
+def replay_sim(plan, after=None, stop=None):
+    # Replays the plan on a SimProtocol, stopping before command index stop (an interruption). Returns the protocol
+    protocol = sim.SimProtocol()
+
+    class Interrupted(Exception):
+        pass
+
+    done = [0]
+
+    def hook(command):
+        if after is not None:
+            after(command)
+        if not command.get('resume'):
+            done[0] += 1
+        if stop is not None and done[0] >= stop:
+            raise Interrupted()
+    with sim.offline_opentrons():
+        import opentrons.types as ot_types
+        try:
+            plancache.replay(plan, protocol, ot_types, hook)
+        except Interrupted:
+            pass
+    return protocol
+
+
+def run_seconds(protocol, model=None):
+    return sum(t['total'] for t in runtime.estimate(protocol.commands, protocol.deck_layout(), model))
+
+
+def rehearse(name, fail_at=None, model=None):
+    # Interrupts a replay of the plan at command fail_at, resumes it from the checkpoint and checks the commands
+    plan = plancache.load_plan(name)[0]
+    commands = plan['commands']
+    fail_at = len(commands) // 2 if fail_at is None else fail_at
+    if not 0 < fail_at < len(commands):
+        raise ValueError('--fail-at must be between 1 and %d' % (len(commands) - 1))
+    folder = tempfile.mkdtemp()
+    try:
+        path = os.path.join(folder, 'checkpoint.json')
+        first = replay_sim(plan, checkpoint_writer(plan, path), fail_at)
+        state = read_checkpoint(path, plan)
+        resume = resume_plan(plan, state)
+        resumed = replay_sim(resume, checkpoint_writer(plan, path, state))
+        final = read_checkpoint(path, plan)
+    finally:
+        shutil.rmtree(folder)
+    preamble = sum(1 for c in resume['commands'] if c.get('resume'))
+    matches = [sim.describe(c) for c in resumed.commands[preamble:]] == [sim.describe(c) for c in commands[state['index']:]]
+    full = run_seconds(plancache.PlanProtocol(plan), model)
+    return {'plan': plan, 'groups': state['groups'], 'fail_at': fail_at, 'state': state, 'final': final,
+            'matches': matches, 'done': run_seconds(first, model), 'resumed': run_seconds(resumed, model), 'full': full,
+            'step': commands[state['index']]['step'], 'wells': group_wells(plan, state)}
+
+
+def format_status(state):
+    lines = ['%s: %s, command %d of %d, group %d of %d' % (
+        state['protocol'], 'complete' if state['complete'] else 'stopped', state['index'] + 1 if not state['complete'] else state['commands'],
+        state['commands'], state['group'] + 1, state['groups'])]
+    for mount, tip in sorted(state['tips'].items()):
+        lines.append('    %-5s tip %s' % (mount, 'slot %s %s' % tuple(tip) if tip else '-'))
+    for slot, wells in sorted(state['used_tips'].items(), key=lambda item: int(item[0])):
+        lines.append('    rack slot %-2s %d tip positions used' % (slot, len(wells)))
+    for mount, settings in sorted(state['settings'].items()):
+        lines.append('    %-5s %s' % (mount, ', '.join('%s=%s' % item for item in sorted(settings.items()))))
+    moved = sorted(state['volumes'].items(), key=lambda item: item[1])
+    lines.append('    volumes moved: %d wells, most drawn %s, most filled %s' % (
+        len(moved), ', '.join('%s %+gul' % item for item in moved[:3]), ', '.join('%s %+gul' % item for item in moved[-3:][::-1])))
+    return '\n'.join(lines)
+
+
+def format_report(name, result):
+    state = result['state']
+    lines = ['%s: %d commands in %d groups, interrupted at command %d' % (
+        name, state['commands'], result['groups'], result['fail_at'] + 1)]
+    lines.append('    checkpoint: command %d, group %d (%s)' % (state['index'] + 1, state['group'] + 1, result['step']))
+    if result['wells']:
+        lines.append('    interrupted operation dispenses into %s' % ', '.join(result['wells']))
+    lines.append('    run before the stop %s, resumed run %s, full rerun %s (%s saved)' % (
+        runtime.format_seconds(result['done']), runtime.format_seconds(result['resumed']),
+        runtime.format_seconds(result['full']), runtime.format_seconds(result['full'] - result['resumed'])))
+    lines.append('    resumed commands %s the rest of the plan, final checkpoint %s' % (
+        'match' if result['matches'] else 'DO NOT match', 'complete' if result['final']['complete'] else 'incomplete'))
+    return '\n'.join(lines)
+
+
+def emit_protocol(plan, path, checkpoint_dir=CHECKPOINT_DIR):
+    # Standalone replay protocol (plancache.emit_protocol) that writes checkpoints and can resume from them
+    name = os.path.splitext(os.path.basename(plan['path']))[0]
+    metadata = dict(plan['metadata'])
+    metadata['protocolName'] = '%s (resumable plan)' % metadata.get('protocolName', os.path.basename(plan['path']))
+    plan = dict(plan, commands=[dict((k, v) for k, v in c.items() if k not in ('point', 'line', 'index')) for c in plan['commands']])
+    helpers = [command_groups, new_state, advance, checkpoint_writer, read_checkpoint, group_wells, resume_plan, plancache.replay]
+    lines = ['#Readme:',
+             '#Resumable compiled plan of %s, generated by ot2_tools.checkpoint. Do not edit, recompile the source protocol.' % os.path.basename(plan['path']),
+             '#A checkpoint is written to CHECKPOINT after every completed command group. To resume an interrupted run set',
+             '#RESUME = True and run this protocol again: it starts at the first incomplete group.',
+             '#Plan key %s' % plan['key'],
+             '',
+             'import json',
+             'import os',
+             '',
+             'from opentrons import protocol_api',
+             'from opentrons import types',
+             '',
+             'metadata = %r' % metadata,
+             '',
+             'RESUME = False',
+             'CHECKPOINT = %r' % os.path.join(checkpoint_dir, name + '.checkpoint.json'),
+             '',
+             'PLAN = json.loads(%r)' % json.dumps(plan, separators=(',', ':')),
+             '']
+    for helper in helpers:
+        lines.extend(['', inspect.getsource(helper)])
+    lines.extend(['',
+                  'def run(protocol: protocol_api.ProtocolContext):',
+                  '    # Checkpoints are only read and written on the robot, the app analyses the full plan',
+                  '    if protocol.is_simulating():',
+                  '        replay(PLAN, protocol, types)',
+                  '        return',
+                  '    state = read_checkpoint(CHECKPOINT, PLAN) if RESUME else None',
+                  '    replay(resume_plan(PLAN, state) if state else PLAN, protocol, types, checkpoint_writer(PLAN, CHECKPOINT, state))',
+                  ''])
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Checkpoint and resume interrupted protocol runs')
+    parser.add_argument('protocols', nargs='*', help='protocol files or: %s' % ', '.join(sorted(sim.PROTOCOLS)))
+    parser.add_argument('--fail-at', type=int, help='command the rehearsed run stops at (default: half way)')
+    parser.add_argument('--emit-protocol', help='write a resumable replay protocol (one protocol only)')
+    parser.add_argument('--checkpoint-dir', default=CHECKPOINT_DIR, help='where the robot keeps checkpoints (default %s)' % CHECKPOINT_DIR)
+    parser.add_argument('--status', help='summarise a checkpoint file copied from the robot')
+    args = parser.parse_args(argv)
+    if args.status:
+        with open(args.status) as f:
+            print(format_status(json.load(f)))
+    for name in args.protocols:
+        if args.emit_protocol:
+            emit_protocol(plancache.load_plan(name)[0], args.emit_protocol, args.checkpoint_dir)
+            print('%s: resumable replay protocol written to %s' % (name, args.emit_protocol))
+        else:
+            print(format_report(name, rehearse(name, args.fail_at)))
+
+
+if __name__ == '__main__':
+    main()
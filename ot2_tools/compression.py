@@ -0,0 +1,202 @@
+#Readme:
+#24-well -> 96-well plate compression index. Replaces the nunc_24_pseudo_a/b trick and the inline index math
+#(plate24.wells()[4*(i+j)], plate_dil.wells()[8*(i+j+l)], tip['A' + str(i+j+1)]) with one precomputed lookup table.
+#How the compression works: a multichannel with tips only in rows A,C,E,G (18mm pitch) reaches the 4 rows of a 24-well
+#column (19.3mm pitch) and lands in rows A,C,E,G of a 96-well column. Tips only in rows B,D,F,H land in rows B,D,F,H.
+#So two 24-well plates share 6 columns of a 96-well plate, 4 plates fill one 96-well plate, 8 plates two, 12 plates three.
+#   parity 'a' = odd-row tips (A,C,E,G), parity 'b' = even-row tips (B,D,F,H)
+#Instead of an off-calibrated labware definition, each move carries an offset for the A nozzle on a plain nunc_24_plate:
+#parity b shifts 9mm back so the B nozzle is over the well, and both parities are centred on the 4 rows so the
+#18 vs 19.3mm pitch error is split (max 1.95mm) instead of piling up on row D (3.9mm).
+#Scope: the protocols are not wired to the table, they still use the pseudo_a/b definitions and their own index math
+#(they are uploaded as standalone files). The table and nozzle_offset() are the layout for a protocol on plain
+#nunc_24_plates and --check keeps the existing index math honest against it.
+#--check finds the 96-well plates the protocol moves liquid to or from a pseudo 24-well plate (or takes --target-slot)
+#and fails if no column move is found. Pooling (several 24-well columns into one 96-well column, eg the OE-KD WB pool in
+#slot 9) is reported as pooled, the table has one 24-well column per 96-well column and cannot represent it.
+#Usage: python -m ot2_tools.compression --plates 8          print the table
+#       python -m ot2_tools.compression --check harvest     check a protocol's index math against the table
+
+from . import labware as lw
+from . import sim
+
+ROWS_24 = 4
+COLS_24 = 6
+COLS_96 = 12
+PARITIES = ('a', 'b')
+NOZZLE_PITCH = 9.0
+PLATE_LABWARE = 'nunc_24_plate'
+PSEUDO_PARITY = {'nunc_24_pseudo_a': 'a', 'nunc_24_pseudo_b': 'b'}
+
+
+def nozzle_offset(parity, load_name=PLATE_LABWARE):
+    # (x, y, z) to add to a 24-well well.bottom() so the tips of this parity sit over the column's 4 wells
+    pitch = lw.labware_spec(load_name)['dy']
+    centre = -(ROWS_24 - 1) * (pitch - 2 * NOZZLE_PITCH) / 2.0
+    return (0.0, centre + (NOZZLE_PITCH if parity == 'b' else 0.0), 0.0)
+
+
+def max_row_error(load_name=PLATE_LABWARE):
+    pitch = lw.labware_spec(load_name)['dy']
+    return (ROWS_24 - 1) * abs(pitch - 2 * NOZZLE_PITCH) / 2.0
+
+
+def build_index(plates):
+    # plates = number of 24-well plates or a list of names. Plate n: parity n % 2, 96-well target n // 4,
+    # target columns 1-6 or 7-12 by (n % 4) // 2. Tipracks are per parity, one rack covers 12 columns = 2 plates.
+    if isinstance(plates, int):
+        plates = ['plate24_%d' % (n + 1) for n in range(plates)]
+    index = {'plates': [], 'moves': [], 'wells': [], 'by_source': {}, 'by_target': {}}
+    for n, name in enumerate(plates):
+        parity = PARITIES[n % 2]
+        target = n // 4
+        first_column = ((n % 4) // 2) * COLS_24
+        rack = n // 4
+        index['plates'].append({'name': name, 'number': n, 'parity': parity, 'target': target,
+                                'columns': (first_column, first_column + COLS_24), 'tip_rack': rack})
+        for c in range(COLS_24):
+            column = first_column + c
+            move = {'plate': n, 'name': name, 'parity': parity, 'source_column': c, 'source_well': 'A%d' % (c + 1),
+                    'offset': nozzle_offset(parity), 'target': target, 'target_column': column,
+                    'target_well': 'A%d' % (column + 1), 'tip_rack': (parity, rack), 'tip_well': 'A%d' % (column + 1)}
+            index['moves'].append(move)
+            for r in range(ROWS_24):
+                row96 = 2 * r + (1 if parity == 'b' else 0)
+                entry = {'plate': n, 'source_well': lw.ROW_NAMES[r] + str(c + 1), 'target': target,
+                         'target_well': lw.ROW_NAMES[row96] + str(column + 1), 'tip': lw.ROW_NAMES[row96] + str(column + 1),
+                         'move': len(index['moves']) - 1}
+                index['wells'].append(entry)
+                index['by_source'][(n, entry['source_well'])] = entry
+                index['by_target'][(target, entry['target_well'])] = entry
+    return index
+
+
+def target_plates(index):
+    return max(p['target'] for p in index['plates']) + 1 if index['plates'] else 0
+
+
+def tip_racks(index):
+    # (parity, rack number) -> columns used. Parity a racks hold only rows A,C,E,G, parity b racks rows B,D,F,H
+    racks = {}
+    for move in index['moves']:
+        racks.setdefault(move['tip_rack'], []).append(move['target_column'])
+    return racks
+
+
+def deck_batches(index, slots=('1', '2', '4', '5')):
+    # Splits the plates into deck loads that fit the 24-well slots, [{slot: plate number}]
+    batches = []
+    for start in range(0, len(index['plates']), len(slots)):
+        plates = index['plates'][start:start + len(slots)]
+        batches.append(dict((slot, p['number']) for slot, p in zip(slots, plates)))
+    return batches
+
+
+def moves_for(index, plate):
+    return [m for m in index['moves'] if m['plate'] == plate]
+
+
+def column_moves(commands):
+    # [(pseudo plate end, other end)] for every aspirate followed by a dispense with exactly one end on a pseudo
+    # 24-well plate, so tip cycles that carry out several moves give one entry per move
+    pairs = []
+    aspirate = None
+    for c in commands:
+        if c['name'] == 'aspirate':
+            aspirate = c['location']
+            continue
+        if c['name'] != 'dispense' or aspirate is None:
+            continue
+        ends = (aspirate, c['location'])
+        aspirate = None
+        pseudo = [e for e in ends if e['labware'] in PSEUDO_PARITY]
+        if len(pseudo) == 1:
+            pairs.append((pseudo[0], ends[1] if pseudo[0] is ends[0] else ends[0]))
+    return pairs
+
+
+def target_slots(commands):
+    # Slots of the 96-well plates (not troughs or tipracks) the protocol moves liquid to or from a pseudo plate
+    slots = []
+    for _, other in column_moves(commands):
+        if lw.labware_spec(other['labware'])['kind'] == 'plate' and other['slot'] not in slots:
+            slots.append(other['slot'])
+    return slots
+
+
+def check_trace(commands, target_slot):
+    # Compares the column moves a protocol makes between pseudo 24-well plates and the 96-well plate in target_slot
+    # (either direction, eg Harvest sampling or Nucleofection seeding) with the table. Which tips are picked up is
+    # checked by tipstate (rack layouts). Target wells reached from more than one 24-well column by tips of the same
+    # parity (the same 4 of the 8 rows) are pooled: the table cannot represent them, they are returned apart and not
+    # compared.
+    # Returns (checked, mismatches, pooled). Plates are numbered in slot order of the pseudo labware they sit in.
+    plates = []
+    moves = []
+    for source, target in column_moves(commands):
+        if target['slot'] != target_slot:
+            continue
+        if source['slot'] not in plates:
+            plates.append(source['slot'])
+        move = (plates.index(source['slot']), PSEUDO_PARITY[source['labware']], source['well'], target['well'])
+        if move not in moves:
+            moves.append(move)
+    sources = {}
+    for plate, parity, source_well, target_well in moves:
+        sources.setdefault((parity, target_well), set()).add((plate, source_well))
+    index = build_index(len(plates))
+    mismatches, pooled = [], []
+    for plate, parity, source_well, target_well in moves:
+        if len(sources[(parity, target_well)]) > 1:
+            pooled.append({'plate_slot': plates[plate], 'source_well': source_well, 'target_well': target_well})
+            continue
+        expected = index['by_source'][(plate, source_well)]
+        move = index['moves'][expected['move']]
+        if (parity, target_well) != (move['parity'], move['target_well']):
+            mismatches.append({'plate_slot': plates[plate], 'source_well': source_well, 'found': (parity, target_well),
+                               'expected': (move['parity'], move['target_well'])})
+    return len(moves) - len(pooled), mismatches, pooled
+
+
+def format_index(index):
+    lines = ['%d x 24-well plates -> %d x 96-well plates, max row error %.2fmm' % (
+        len(index['plates']), target_plates(index), max_row_error())]
+    for p in index['plates']:
+        lines.append('    %-12s parity %s (%s tips) -> 96 plate %d cols %d-%d, tiprack %s%d, A nozzle y offset %+.2fmm' % (
+            p['name'], p['parity'], 'A,C,E,G' if p['parity'] == 'a' else 'B,D,F,H', p['target'] + 1,
+            p['columns'][0] + 1, p['columns'][1], p['parity'], p['tip_rack'] + 1, nozzle_offset(p['parity'])[1]))
+    for n, batch in enumerate(deck_batches(index)):
+        lines.append('    deck load %d: %s' % (n + 1, ', '.join('slot %s = %s' % (s, index['plates'][p]['name']) for s, p in sorted(batch.items()))))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='24-well -> 96-well compression index')
+    parser.add_argument('--plates', type=int, default=4, help='number of 24-well plates (default 4)')
+    parser.add_argument('--check', metavar='PROTOCOL', help='check a protocol against the table')
+    parser.add_argument('--target-slot', help='96-well plate slot to check (default: every 96-well plate the protocol '
+                                              'moves liquid to or from a pseudo 24-well plate)')
+    args = parser.parse_args(argv)
+    if args.check:
+        protocol = sim.simulate(args.check)
+        slots = [args.target_slot] if args.target_slot else target_slots(protocol.commands)
+        total = 0
+        for slot in slots:
+            checked, mismatches, pooled = check_trace(protocol.commands, slot)
+            total += checked
+            print('%s slot %s: %d column moves checked, %d differ from the table' % (args.check, slot, checked, len(mismatches)))
+            for m in mismatches:
+                print('    slot %s %s: protocol %s, table %s' % (m['plate_slot'], m['source_well'], m['found'], m['expected']))
+            if pooled:
+                print('    %d moves pool several 24-well columns into one 96-well column (%s), the table cannot represent '
+                      'pooling, not checked' % (len(pooled), ', '.join(sorted(set(m['target_well'] for m in pooled)))))
+        if not total:
+            raise SystemExit('%s: no column moves between a pseudo 24-well plate and slot %s, nothing checked' % (
+                args.check, ', '.join(slots) or '(no 96-well plate found)'))
+        return
+    print(format_index(build_index(args.plates)))
+
+
+if __name__ == '__main__':
+    main()
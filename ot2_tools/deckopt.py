@@ -0,0 +1,177 @@
+#Readme:
+#Deck-layout optimizer. Needs numpy. Takes a protocol's labware and recorded trace and searches slot assignments that
+#cut the predicted gantry travel. Moving a labware moves every point the trace visits in it by the same slot offset,
+#so moves inside one labware and the arc heights (tallest labware on the deck, see runtime) do not change: only the
+#xy legs between slots do. Those legs are scored together with numpy, a layout is improved by swapping the contents of
+#two slots (empty slots included) until no swap helps, from the protocol's own layout and --restarts shuffled ones.
+#The layouts found are ranked by their full runtime.py prediction on the remapped trace.
+#Constraints:
+#   fixed    - the trash (slot 12)
+#   pinned   - slots named in the pause / comment instructions ('position 3', "slot 7"), so the operator text stays
+#              true (--free-pauses releases them, the instructions then need editing), and --pin slots
+#   labware  - each labware moves with its own definition, the 96-flat / 96-U interchange in the Harvest README
+#              (a flat definition, lower than the U plate, so the tips do not clash) goes wherever the plate goes
+#Usage: python -m ot2_tools.deckopt harvest [--top 5] [--restarts 20] [--pin 9] [--free-pauses]
+
+import re
+
+import numpy as np
+
+from . import labware as lw
+from . import runtime
+from . import sim
+
+SLOTS = [str(n) for n in range(1, 12)]
+SLOT_PATTERN = re.compile(r"(?:slot|position)\s*'?\s*(\d{1,2})\b", re.IGNORECASE)
+
+
+def instruction_slots(commands):
+    # Slots named in pause / comment messages
+    slots = set()
+    for command in commands:
+        if command['name'] in ('pause', 'comment') and command.get('message'):
+            slots.update(s for s in SLOT_PATTERN.findall(command['message']) if s in SLOTS)
+    return slots
+
+
+def slot_legs(commands):
+    # Moves between slots as numpy arrays: start / end slot index (0 = home, n = slot n) and the head position relative
+    # to that slot's origin (home is at origin 0, 0)
+    starts, ends = [], []
+    head, slot = None, None
+    for command in commands:
+        if command.get('point') is not None:
+            x, y, _ = runtime._head_point(command)
+            end = command['location']['slot']
+            if end != slot:
+                ex, ey = lw.DECK_SLOTS[end]
+                if head is None:
+                    starts.append((0, lw.HOME_POINT[0], lw.HOME_POINT[1]))
+                else:
+                    sx, sy = lw.DECK_SLOTS[slot]
+                    starts.append((int(slot), head[0] - sx, head[1] - sy))
+                ends.append((int(end), x - ex, y - ey))
+            head, slot = (x, y), end
+        elif command['name'] == 'home':
+            head, slot = None, None
+    starts, ends = np.array(starts or np.zeros((0, 3))), np.array(ends or np.zeros((0, 3)))
+    return {'start': starts[:, 0].astype(int), 'start_xy': starts[:, 1:], 'end': ends[:, 0].astype(int), 'end_xy': ends[:, 1:]}
+
+
+def _origins(layout):
+    # Row n = origin of the slot the contents of slot n move to (row 0 = home)
+    origins = np.zeros((13, 2))
+    for n in range(1, 13):
+        origins[n] = lw.DECK_SLOTS[layout.get(str(n), str(n))]
+    return origins
+
+
+def leg_seconds(legs, layout, model=None):
+    # xy seconds of the moves between slots with the contents of slot s in layout[s]
+    model = model or runtime.TimingModel()
+    origins = _origins(layout)
+    start = legs['start_xy'] + origins[legs['start']] * (legs['start'] > 0)[:, None]
+    end = legs['end_xy'] + origins[legs['end']]
+    return float(np.hypot(*(end - start).T).sum() / model.xy_speed)
+
+
+def improve(legs, layout, movable, model=None):
+    # Best-improvement slot swaps until no swap cuts the leg time. Returns (layout, seconds)
+    layout = dict(layout)
+    seconds = leg_seconds(legs, layout, model)
+    while True:
+        best = None
+        for i, a in enumerate(movable):
+            for b in movable[i + 1:]:
+                trial = dict(layout)
+                trial[a], trial[b] = layout[b], layout[a]
+                trial_seconds = leg_seconds(legs, trial, model)
+                if trial_seconds < seconds - 1e-6 and (best is None or trial_seconds < best[1]):
+                    best = (trial, trial_seconds)
+        if best is None:
+            return layout, seconds
+        layout, seconds = best
+
+
+def remap(commands, layout):
+    # Copy of the trace with every point and slot moved to its new slot
+    moved = []
+    for command in commands:
+        location = command.get('location')
+        if not location or location.get('slot') not in layout or layout[location['slot']] == location['slot']:
+            moved.append(command)
+            continue
+        old, new = lw.DECK_SLOTS[location['slot']], lw.DECK_SLOTS[layout[location['slot']]]
+        entry = dict(command, location=dict(location, slot=layout[location['slot']]))
+        if command.get('point') is not None:
+            x, y, z = command['point']
+            entry['point'] = [round(x + new[0] - old[0], 3), round(y + new[1] - old[1], 3), z]
+        moved.append(entry)
+    return moved
+
+
+def optimise(name, pins=(), free_pauses=False, restarts=20, top=5, seed=0, model=None):
+    # Returns {'protocol', 'deck', 'pinned', 'before', 'layouts': [{'layout', 'moves', 'seconds', 'saving'}]}, best first
+    protocol = sim.simulate(name)
+    deck = protocol.deck_layout()
+    pinned = set(str(p) for p in pins)
+    for slot in pinned:
+        if slot not in SLOTS:
+            raise ValueError("Slot %s cannot be pinned, slots are 1-11 (12 is the trash)" % slot)
+    if not free_pauses:
+        pinned |= instruction_slots(protocol.commands)
+    movable = [s for s in SLOTS if s not in pinned]
+    legs = slot_legs(protocol.commands)
+    identity = dict((s, s) for s in SLOTS)
+    rng = np.random.RandomState(seed)
+    found = {}
+    for start in range(restarts + 1):
+        layout = dict(identity)
+        if start:
+            for a, b in zip(movable, rng.permutation(movable)):
+                layout[a] = b
+        layout, _ = improve(legs, layout, movable, model)
+        # only slots that hold labware matter, layouts that differ in empty slots are the same
+        key = tuple(sorted((s, layout[s]) for s in deck if s in layout))
+        found[key] = layout
+    before = sum(t['total'] for t in runtime.estimate(protocol.commands, deck, model))
+    layouts = []
+    for key, layout in found.items():
+        moved_deck = dict((layout.get(s, s), labware) for s, labware in deck.items())
+        seconds = sum(t['total'] for t in runtime.estimate(remap(protocol.commands, layout), moved_deck, model))
+        moves = [(deck[s], s, layout[s]) for s in sorted(deck, key=int) if s in layout and layout[s] != s]
+        layouts.append({'layout': layout, 'deck': moved_deck, 'moves': moves, 'seconds': seconds, 'saving': before - seconds})
+    layouts.sort(key=lambda entry: entry['seconds'])
+    return {'protocol': protocol, 'deck': deck, 'pinned': sorted(pinned, key=int), 'before': before,
+            'layouts': [entry for entry in layouts if entry['moves']][:top]}
+
+
+def format_report(name, result):
+    lines = ['%s: run %s, %d labware, pinned slots %s, trash 12' % (
+        name, runtime.format_seconds(result['before']), len(result['deck']), ', '.join(result['pinned']) or '-')]
+    if not result['layouts']:
+        lines.append('    no layout with less travel found')
+    for rank, entry in enumerate(result['layouts']):
+        lines.append('    %d. run %s (%s saved, %.1f%%)' % (
+            rank + 1, runtime.format_seconds(entry['seconds']), runtime.format_seconds(entry['saving']),
+            100.0 * entry['saving'] / result['before']))
+        for labware, old, new in entry['moves']:
+            lines.append('          %-34s slot %-2s -> %s' % (labware, old, new))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Search deck layouts that cut predicted travel time')
+    parser.add_argument('protocols', nargs='+', help='protocol files or: %s' % ', '.join(sorted(sim.PROTOCOLS)))
+    parser.add_argument('--top', type=int, default=5, help='layouts to list (default 5)')
+    parser.add_argument('--restarts', type=int, default=20, help='shuffled starting layouts (default 20)')
+    parser.add_argument('--pin', nargs='+', default=[], help='slots that keep their labware')
+    parser.add_argument('--free-pauses', action='store_true', help='also move the slots named in pause instructions')
+    args = parser.parse_args(argv)
+    for name in args.protocols:
+        print(format_report(name, optimise(name, args.pin, args.free_pauses, args.restarts, args.top)))
+
+
+if __name__ == '__main__':
+    main()
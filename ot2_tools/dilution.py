@@ -0,0 +1,222 @@
+#Readme:
+#Serial-dilution engine for standard curves (eg the ValitaTiter VT_SC_Plate curve). Needs numpy.
+#Each dilution column holds `final` ul of diluent, receives `transfer` ul from the column before and passes `transfer` on:
+#   ratio = transfer / (final + transfer)        transfer = ratio x final / (1 - ratio)
+#VT_SC_Plate today: 222ul standard in col 1, 100ul media in cols 2-12, ten 122ul transfers -> ratio 122/222 = 0.55 ("0.6"),
+#col 11 keeps 222ul, col 12 is the media blank.
+#The plan fills media for every plate with one tip (packed multi-dispense trips), adds standard to the empty column 1
+#of every plate with one tip, then runs each plate's dilution series with its own tip.
+#Diluent columns and transfers above the tip volume are split into equal parts over several trips. Up to 3 plates
+#(slots 4/5/6 of the ValitaTiter deck).
+#Usage: python -m ot2_tools.dilution --top 2000 --bottom 5 --points 11 --plates 3 [--map curve.csv]
+#       python -m ot2_tools.dilution --top 2000 --transfer 122 --points 11       (describe an existing curve)
+
+import csv
+import math
+
+import numpy as np
+
+from . import multidispense
+from . import runtime
+from . import sim
+
+ROWS = 'ABCDEFGH'
+PLATE_SLOTS = ['4', '5', '6']   # dilution plates on the ValitaTiter deck
+
+
+def design_curve(top, points, bottom=None, transfer=None, final=100.0, blanks=1, discard_last=False):
+    # Concentrations and volumes per column, as numpy arrays. Give either bottom (lowest standard) or transfer (ul)
+    if (bottom is None) == (transfer is None):
+        raise ValueError('Give either bottom or transfer')
+    if points < 2 or points + blanks > 12:
+        raise ValueError('points + blanks must fit 12 columns, with at least 2 points')
+    if bottom is not None:
+        ratio = (float(bottom) / top) ** (1.0 / (points - 1))
+        transfer = ratio * final / (1.0 - ratio)
+    else:
+        ratio = transfer / (final + float(transfer))
+    k = np.arange(points + blanks)
+    curve = k < points
+    first = k == 0
+    last = k == points - 1
+    concentration = np.where(curve, top * ratio ** np.minimum(k, points - 1), 0.0)
+    diluent = np.where(first, 0.0, final)
+    standard = np.where(first, final + transfer, 0.0)
+    transfer_in = np.where(curve & ~first, transfer, 0.0)
+    transfer_out = np.where(curve & (~last | discard_last), transfer, 0.0)
+    return {'top': float(top), 'ratio': ratio, 'points': points, 'blanks': blanks, 'final': float(final),
+            'transfer': float(transfer), 'concentration': concentration, 'diluent': diluent, 'standard': standard,
+            'transfer_in': transfer_in, 'transfer_out': transfer_out,
+            'volume': diluent + standard + transfer_in - transfer_out, 'discard_last': discard_last}
+
+
+def concentration_map(curve, plates=1):
+    # plate x 8 rows x columns array of expected concentrations (every row of a column is the same, multichannel)
+    return np.broadcast_to(curve['concentration'], (plates, len(ROWS), len(curve['concentration']))).copy()
+
+
+def export_map(curve, path, plates=1, units='mg/L'):
+    conc = concentration_map(curve, plates)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['plate', 'well', 'column', 'concentration_%s' % units.replace('/', '_per_'), 'blank'])
+        for p in range(plates):
+            for c in range(conc.shape[2]):
+                for r, row in enumerate(ROWS):
+                    writer.writerow([p + 1, '%s%d' % (row, c + 1), c + 1, '%.6g' % conc[p, r, c], int(c >= curve['points'])])
+
+
+def pipetting_plan(curve, plates=1, max_volume=200.0, media_wells=None, standard_well='A1', mix=6, settle=1.0):
+    # Ordered list of actions. Labware are named by role: 'trough', 'plate1', 'plate2' ...
+    # media_wells = trough well of the diluent for each plate (default A3, A4, A5 like VT_SC_Plate)
+    media_wells = media_wells or ['A%d' % (3 + p) for p in range(plates)]
+    if curve['discard_last'] and curve['transfer'] > max_volume:
+        raise ValueError('The discarded %gul transfer from column %d does not fit a %gul tip' % (
+            curve['transfer'], curve['points'], max_volume))
+    columns = len(curve['concentration'])
+    plan = []
+
+    def act(action, **fields):
+        fields['action'] = action
+        plan.append(fields)
+
+    # Media fill, one tip for every plate, packed trips per trough column. A column that does not fit one trip
+    # (diluent above the tip volume less the disposal) is filled with equal parts from several trips
+    capacity = max_volume - multidispense.min_disposal(max_volume)
+    dests = []
+    for c in range(columns):
+        if curve['diluent'][c] > 0:
+            parts = int(math.ceil(curve['diluent'][c] / capacity))
+            dests.extend([(c, float(curve['diluent'][c]) / parts)] * parts)
+    act('pick_up_tip', step='Fill diluent')
+    for p in range(plates):
+        trips = multidispense.plan_multi_dispense([volume for c, volume in dests], max_volume)
+        for trip in trips:
+            act('aspirate', volume=trip['aspirate'], labware='trough', well=media_wells[p], step='Fill diluent')
+            for d in trip['dispenses']:
+                act('dispense', volume=dests[d][1], labware='plate%d' % (p + 1), well='A%d' % (dests[d][0] + 1), step='Fill diluent')
+            act('delay', seconds=settle, step='Fill diluent')
+            act('blow_out', labware='trough', well=media_wells[p], step='Fill diluent')
+    act('drop_tip', step='Fill diluent')
+
+    # Standard into the empty first column of every plate, one tip
+    standard = float(curve['standard'][0])
+    chunks = int(math.ceil(standard / max_volume))
+    act('pick_up_tip', step='Add standard')
+    act('mix', repetitions=10, volume=max_volume * 0.95, labware='trough', well=standard_well, step='Add standard')
+    for p in range(plates):
+        for n in range(chunks):
+            act('aspirate', volume=standard / chunks, labware='trough', well=standard_well, step='Add standard')
+            act('dispense', volume=standard / chunks, labware='plate%d' % (p + 1), well='A1', step='Add standard')
+            act('delay', seconds=settle, step='Add standard')
+            act('blow_out', labware='plate%d' % (p + 1), well='A1', step='Add standard')
+    act('drop_tip', step='Add standard')
+
+    # Dilution series, one tip per plate. Transfers above the tip volume go in equal chunks before the mix
+    mix_volume = min(max_volume * 0.9, 0.8 * (curve['final'] + curve['transfer']))
+    transfers = int(math.ceil(curve['transfer'] / max_volume))
+    for p in range(plates):
+        plate = 'plate%d' % (p + 1)
+        act('pick_up_tip', step='Dilute')
+        for c in range(curve['points'] - 1):
+            for n in range(transfers):
+                act('aspirate', volume=curve['transfer'] / transfers, labware=plate, well='A%d' % (c + 1), step='Dilute')
+                act('dispense', volume=curve['transfer'] / transfers, labware=plate, well='A%d' % (c + 2), step='Dilute')
+            act('mix', repetitions=mix, volume=mix_volume, labware=plate, well='A%d' % (c + 2), step='Dilute')
+            act('delay', seconds=settle, step='Dilute')
+            act('blow_out', labware=plate, well='A%d' % (c + 2), top=True, step='Dilute')
+        if curve['discard_last']:
+            act('aspirate', volume=curve['transfer'], labware=plate, well='A%d' % curve['points'], step='Dilute')
+        act('drop_tip', step='Dilute')
+    return plan
+
+
+def execute_plan(plan, protocol, pipette, labware):
+    # Issues the plan through the opentrons API (a real ProtocolContext or sim.SimProtocol). labware = {role: labware}
+    for a in plan:
+        well = labware[a['labware']].wells_by_name()[a['well']] if 'labware' in a else None
+        # top=True: at the top of the well, else where the API puts the action (bottom, top for blow outs)
+        target = well.top() if well is not None and a.get('top') else well
+        if a['action'] == 'pick_up_tip':
+            pipette.pick_up_tip()
+        elif a['action'] == 'drop_tip':
+            pipette.drop_tip()
+        elif a['action'] == 'aspirate':
+            pipette.aspirate(a['volume'], target)
+        elif a['action'] == 'dispense':
+            pipette.dispense(a['volume'], target)
+        elif a['action'] == 'mix':
+            pipette.mix(a['repetitions'], a['volume'], target)
+        elif a['action'] == 'blow_out':
+            pipette.blow_out(target)
+        elif a['action'] == 'delay':
+            protocol.delay(seconds=a['seconds'])
+
+
+def simulate_plan(plan, plates=1):
+    # Runs the plan on the ValitaTiter deck (trough 8, dilution plates 4/5/6, filter tips 7/10/11/9)
+    protocol = sim.SimProtocol()
+    labware = {'trough': protocol.load_labware('axygen_12_reservior_22ml', '8')}
+    for p, slot in enumerate(PLATE_SLOTS[:plates]):
+        labware['plate%d' % (p + 1)] = protocol.load_labware('nunc_96_ubottom', slot)
+    racks = [protocol.load_labware('opentrons_96_filtertiprack_200ul', slot) for slot in ['7', '10', '11', '9']]
+    pipette = protocol.load_instrument('p300_multi', 'right', tip_racks=racks)
+    pipette.flow_rate.aspirate = 100
+    pipette.flow_rate.dispense = 200
+    execute_plan(plan, protocol, pipette, labware)
+    return protocol
+
+
+def plan_summary(plan, plates=1):
+    protocol = simulate_plan(plan, plates)
+    timings = runtime.estimate(protocol.commands, protocol.deck_layout())
+    return {'tips': sum(1 for a in plan if a['action'] == 'pick_up_tip'),
+            'trough_trips': sum(1 for a in plan if a['action'] == 'aspirate' and a['labware'] == 'trough'),
+            'seconds': sum(t['total'] for t in timings)}
+
+
+def format_curve(curve, units='mg/L'):
+    lines = ['%d point curve, ratio %.4f (1 in %.3g per step), transfer %.1ful into %.1ful%s' % (
+        curve['points'], curve['ratio'], 1.0 / curve['ratio'], curve['transfer'], curve['final'],
+        ', last transfer discarded' if curve['discard_last'] else '')]
+    lines.append('    col  conc %-6s diluent  standard  in      out     final ul' % units)
+    for c in range(len(curve['concentration'])):
+        lines.append('    %-4d %-12.4g %-8.1f %-9.1f %-7.1f %-7.1f %.1f' % (
+            c + 1, curve['concentration'][c], curve['diluent'][c], curve['standard'][c],
+            curve['transfer_in'][c], curve['transfer_out'][c], curve['volume'][c]))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Serial dilution standard curve engine')
+    parser.add_argument('--top', type=float, required=True, help='concentration of the standard in column 1')
+    parser.add_argument('--points', type=int, default=11, help='curve points incl. the top (default 11)')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--bottom', type=float, help='lowest curve concentration')
+    group.add_argument('--transfer', type=float, help='transfer volume ul (describe an existing curve)')
+    parser.add_argument('--final', type=float, default=100.0, help='diluent/final ul per column (default 100)')
+    parser.add_argument('--blanks', type=int, default=1, help='blank media columns after the curve (default 1)')
+    parser.add_argument('--discard-last', action='store_true', help='take the last transfer out so every column ends at --final')
+    parser.add_argument('--plates', type=int, default=1, help='plates run together (default 1, VT deck holds 3)')
+    parser.add_argument('--units', default='mg/L')
+    parser.add_argument('--map', help='write the expected concentration map to this CSV file')
+    args = parser.parse_args(argv)
+    if not 1 <= args.plates <= len(PLATE_SLOTS):
+        parser.error('--plates must be 1 to %d, the dilution plates on slots %s' % (len(PLATE_SLOTS), '/'.join(PLATE_SLOTS)))
+    try:
+        curve = design_curve(args.top, args.points, args.bottom, args.transfer, args.final, args.blanks, args.discard_last)
+        plan = pipetting_plan(curve, args.plates)
+    except ValueError as error:
+        raise SystemExit('dilution: %s' % error)
+    print(format_curve(curve, args.units))
+    summary = plan_summary(plan, args.plates)
+    print('Plan for %d plates: %d tips, %d trough trips, %s predicted' % (
+        args.plates, summary['tips'], summary['trough_trips'], runtime.format_seconds(summary['seconds'])))
+    if args.map:
+        export_map(curve, args.map, args.plates, args.units)
+        print('Concentration map written to %s' % args.map)
+
+
+if __name__ == '__main__':
+    main()
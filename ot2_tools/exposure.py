@@ -0,0 +1,106 @@
+#Readme:
+#Cell exposure check for the Nucleofection Step 4 replicate distribution. Cells go into the nucleofection solution of
+#the DNA plate in Step 3 and stay in it until the electroporation pause, so the time the robot spends in between (plus
+#the operator getting to the pause) is time the cells sit in solution. EXPOSURES names the cell source well, the pause
+#that ends the exposure and the protocol setting that holds the budget (CELL_EXPOSURE_SECONDS).
+#Arrivals are the dispenses of liquid aspirated from the cell source into another well, exposure per well = predicted
+#time (runtime.py) from its arrival to the pause + --latency-minutes. The first column filled waits longest.
+#Every REPLICATE_MODE and REPLICATE_MIXES up to the protocol's setting (or --mixes) is simulated (plancache), the
+#setting with the most mixes per aspirate that keeps every well within the budget is picked, faster first on a tie.
+#   single_aspirate - as many replicates per tip load as fit the pipette with the overage, one mix per tip load
+#   per_replicate   - mix and aspirate for every replicate
+#Usage: python -m ot2_tools.exposure nucleofection [--budget 900] [--latency-minutes 5] [--mixes 0 2 4]
+
+from . import plancache
+from . import runtime
+from . import sim
+
+# cells: (slot, well) the cells are taken from, until: word in the step of the pause that ends the exposure
+EXPOSURES = {
+    'nucleofection': {'cells': ('8', 'A2'), 'until': 'electroporation', 'budget': 'CELL_EXPOSURE_SECONDS',
+                      'step': 'Step 4', 'modes': ('single_aspirate', 'per_replicate')},
+}
+
+
+def exposure_times(commands, deck, cells, until, latency_minutes=5.0, model=None):
+    # Returns [((slot, well), seconds in solution)] in arrival order
+    timings = runtime.estimate(commands, deck, model)
+    clock, sources, arrivals = 0.0, {}, []
+    for command, timing in zip(commands, timings):
+        location = command.get('location') or {}
+        well = (location.get('slot'), location.get('well'))
+        if command['name'] == 'aspirate':
+            sources[command['mount']] = well
+        elif command['name'] in ('drop_tip', 'return_tip'):
+            sources.pop(command['mount'], None)
+        elif command['name'] == 'dispense' and sources.get(command['mount']) == cells and well != cells:
+            if well not in [w for w, _ in arrivals]:
+                arrivals.append((well, clock))
+        elif command['name'] == 'pause' and arrivals and until.lower() in command['step'].lower():
+            return [(w, clock - t + latency_minutes * 60) for w, t in arrivals]
+        clock += timing['total']
+    raise ValueError("No pause in a step naming '%s' after the cells are dispensed" % until)
+
+
+def step_seconds(commands, deck, step, model=None):
+    return sum(t['total'] for t in runtime.estimate(commands, deck, model) if t['step'].startswith(step))
+
+
+def compare(name, budget=None, mixes=None, latency_minutes=5.0, model=None):
+    # Returns {'budget', 'source', 'rows': [{'mode', 'mixes', 'step', 'wells', 'worst', 'fits'}], 'best'}
+    if name not in EXPOSURES:
+        raise ValueError("No exposure settings for '%s', known: %s" % (name, ', '.join(sorted(EXPOSURES))))
+    spec = EXPOSURES[name]
+    settings = sim.load_protocol(name)
+    source = spec['budget'] if budget is None else '--budget'
+    budget = settings[spec['budget']] if budget is None else budget
+    if mixes is None:
+        mixes = range(settings['REPLICATE_MIXES'] + 1)
+    rows = []
+    for mode in spec['modes']:
+        for count in sorted(set(mixes), reverse=True):
+            protocol = plancache.simulate(name, {'REPLICATE_MODE': mode, 'REPLICATE_MIXES': count})
+            deck = protocol.deck_layout()
+            wells = exposure_times(protocol.commands, deck, spec['cells'], spec['until'], latency_minutes, model)
+            worst = max(seconds for _, seconds in wells)
+            rows.append({'mode': mode, 'mixes': count, 'wells': wells, 'worst': worst, 'fits': worst <= budget,
+                         'step': step_seconds(protocol.commands, deck, spec['step'], model)})
+    fitting = [row for row in rows if row['fits']]
+    best = min(fitting, key=lambda row: (-row['mixes'], row['worst'])) if fitting else None
+    return {'budget': budget, 'source': source, 'rows': rows, 'best': best}
+
+
+def format_report(name, result):
+    spec = EXPOSURES[name]
+    lines = ['%s: cells in nucleofection solution, budget %s (%s)' % (
+        name, runtime.format_seconds(result['budget']), result['source'])]
+    wells = ['%s' % well for (_, well), _ in result['rows'][0]['wells']]
+    lines.append('    %-16s %5s  %7s  %s' % ('mode', 'mixes', spec['step'].lower(), '  '.join('%7s' % w for w in wells)))
+    for row in result['rows']:
+        lines.append('    %-16s %5d  %7s  %s%s' % (
+            row['mode'], row['mixes'], runtime.format_seconds(row['step']),
+            '  '.join('%7s' % runtime.format_seconds(s) for _, s in row['wells']),
+            '' if row['fits'] else '  over budget'))
+    best = result['best']
+    if best is None:
+        lines.append('    no setting keeps the cells within the budget')
+    else:
+        lines.append("    use REPLICATE_MODE = '%s', REPLICATE_MIXES = %d (longest exposure %s)" % (
+            best['mode'], best['mixes'], runtime.format_seconds(best['worst'])))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Time cells sit in nucleofection solution per replicate setting')
+    parser.add_argument('protocols', nargs='+', help='one of: %s' % ', '.join(sorted(EXPOSURES)))
+    parser.add_argument('--budget', type=float, help="seconds cells may sit in solution (default: the protocol's setting)")
+    parser.add_argument('--latency-minutes', type=float, default=5.0, help='operator time to reach the pause (default 5)')
+    parser.add_argument('--mixes', type=int, nargs='+', help='REPLICATE_MIXES values to try (default 0 up to the setting)')
+    args = parser.parse_args(argv)
+    for name in args.protocols:
+        print(format_report(name, compare(name, args.budget, args.mixes, args.latency_minutes)))
+
+
+if __name__ == '__main__':
+    main()
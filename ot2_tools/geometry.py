@@ -0,0 +1,246 @@
+#Readme:
+#Compiled labware geometry index. Every labware in labware.LABWARE (the versioned labware/ bundle plus the opentrons
+#definitions built into the robot) is compiled once into flat arrays: per well the centre x/y, bottom z, top z and depth
+#from the front-left corner of the labware, per labware its well names in opentrons order and the row its wells start
+#at. Bundle labware is read well by well from its definition (wells x/y/z and depth, cornerOffsetFromSlot), the built
+#in ones from their grid in labware.py. The arrays go to .labware_cache/ as one file of doubles plus a JSON header with the names, keyed on a hash of the
+#definitions and this file, and are memory-mapped on load (stdlib mmap, no numpy), so the simulator builds a deck by
+#slicing them instead of working every well out from the definitions.
+#   index()  the index for this process, loaded from the cache or compiled and stored on first use
+#Without a writable cache directory the index is compiled in memory. Nothing here needs a robot or a network.
+#Usage: python -m ot2_tools.geometry [--rebuild] [--labware nunc_24_pseudo_a]
+
+import hashlib
+import json
+import mmap
+import os
+import time
+from array import array
+
+from . import labware as lw
+
+GEOMETRY_VERSION = 1
+FIELDS = ('x', 'y', 'bottom', 'top', 'depth')
+CACHE_DIR = os.path.join(os.path.dirname(lw.BUNDLE_DIR), '.labware_cache')
+SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'geometry.py')
+HEADER = 'geometry.json'
+
+_indexes = {}
+
+
+class GeometryIndex(object):
+    # values: FIELDS per well, labware after labware. header['labware'][load_name] = {'start': first row, 'names': [...]}
+    def __init__(self, header, values, path=None):
+        self.header = header
+        self.key = header['key']
+        self.values = values
+        self.path = path
+        self._lookup = {}
+
+    def __contains__(self, load_name):
+        return load_name in self.header['labware']
+
+    def _entry(self, load_name):
+        if load_name not in self.header['labware']:
+            raise KeyError("Unknown labware '%s'. Add its definition to the labware/ bundle" % load_name)
+        return self.header['labware'][load_name]
+
+    def names(self, load_name):
+        return self._entry(load_name)['names']
+
+    def lookup(self, load_name):
+        # well name -> index in wells()
+        if load_name not in self._lookup:
+            self._lookup[load_name] = dict((name, n) for n, name in enumerate(self.names(load_name)))
+        return self._lookup[load_name]
+
+    def wells(self, load_name):
+        # [(name, (x, y, bottom, top, depth))] in opentrons order
+        entry = self._entry(load_name)
+        width = len(FIELDS)
+        start = entry['start'] * width
+        rows = self.values[start:start + len(entry['names']) * width].tolist()
+        return [(name, tuple(rows[n * width:(n + 1) * width])) for n, name in enumerate(entry['names'])]
+
+    def well(self, load_name, well_name):
+        width = len(FIELDS)
+        start = (self._entry(load_name)['start'] + self.lookup(load_name)[well_name]) * width
+        return tuple(self.values[start:start + width].tolist())
+
+    def position(self, load_name, slot, well_name):
+        # Same as labware.well_position: (x, y, bottom z, top z) in deck coordinates
+        x, y, bottom, top, _ = self.well(load_name, well_name)
+        sx, sy = lw.DECK_SLOTS[str(slot)]
+        return sx + x, sy + y, bottom, top
+
+
+def index_key():
+    # Hash of the definitions and of the code that compiles them
+    digest = hashlib.sha256(('geometry %d\n' % GEOMETRY_VERSION).encode())
+    with open(SOURCE, 'rb') as f:
+        digest.update(f.read())
+    digest.update(json.dumps({'labware': lw.LABWARE, 'rows': lw.ROW_NAMES}, sort_keys=True).encode())
+    with open(lw.BUNDLE_MANIFEST, 'rb') as f:
+        digest.update(f.read())
+    for load_name, version in sorted(lw.bundle_manifest()['labware'].items()):
+        with open(lw.definition_path(load_name, version), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def definition_wells(definition):
+    # [(name, (x, y, bottom, top, depth))] in opentrons order, straight from the wells of a schema 2 definition
+    corner = definition.get('cornerOffsetFromSlot', {})
+    rows = []
+    for column in definition['ordering']:
+        for name in column:
+            well = definition['wells'][name]
+            bottom = well['z'] + corner.get('z', 0)
+            rows.append((name, (well['x'] + corner.get('x', 0), well['y'] + corner.get('y', 0), bottom,
+                                bottom + well['depth'], well['depth'])))
+    return rows
+
+
+def compile_index(key=None):
+    # Returns (header, values array)
+    values, labware = array('d'), {}
+    manifest = lw.bundle_manifest()
+    for load_name in sorted(lw.LABWARE):
+        if load_name in manifest['labware']:
+            wells = definition_wells(lw.load_definition(load_name, manifest['labware'][load_name]))
+        else:
+            depth = lw.LABWARE[load_name]['depth']
+            wells = [(name, lw.well_offset(load_name, name) + (depth,)) for name in lw.well_names(load_name)]
+        labware[load_name] = {'start': len(values) // len(FIELDS), 'names': [name for name, _ in wells],
+                              'source': 'bundle v%d' % manifest['labware'][load_name]
+                              if load_name in manifest['labware'] else 'built in'}
+        for _, row in wells:
+            values.extend(row)
+    header = {'version': GEOMETRY_VERSION, 'key': key or index_key(), 'fields': list(FIELDS),
+              'bundle_version': manifest['bundle_version'], 'wells': len(values) // len(FIELDS), 'labware': labware}
+    return header, values
+
+
+def _write(path, data, mode):
+    # Written aside and moved into place, shard workers may build the index at the same time
+    partial = '%s.%d.tmp' % (path, os.getpid())
+    with open(partial, mode) as f:
+        f.write(data)
+    os.replace(partial, path)
+
+
+def save_index(header, values, cache_dir=CACHE_DIR):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    data = 'geometry-%s.bin' % header['key'][:16]
+    _write(os.path.join(cache_dir, data), values.tobytes(), 'wb')
+    _write(os.path.join(cache_dir, HEADER), json.dumps(dict(header, data=data), separators=(',', ':')), 'w')
+    for name in os.listdir(cache_dir):
+        if name.startswith('geometry-') and name.endswith('.bin') and name != data:
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+    return os.path.join(cache_dir, data)
+
+
+def map_index(cache_dir=CACHE_DIR, key=None):
+    # The cached index memory-mapped read only, None when missing or out of date
+    try:
+        with open(os.path.join(cache_dir, HEADER)) as f:
+            header = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if header.get('version') != GEOMETRY_VERSION or header.get('key') != (key or index_key()):
+        return None
+    path = os.path.join(cache_dir, header['data'])
+    try:
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return None
+    if len(mapped) != header['wells'] * len(FIELDS) * 8:
+        return None
+    return GeometryIndex(header, memoryview(mapped).cast('d'), path)
+
+
+def load_index(cache_dir=CACHE_DIR, rebuild=False):
+    # Returns (index, compiled)
+    key = index_key()
+    if not rebuild:
+        mapped = map_index(cache_dir, key)
+        if mapped is not None:
+            return mapped, False
+    header, values = compile_index(key)
+    try:
+        save_index(header, values, cache_dir)
+    except (IOError, OSError):
+        return GeometryIndex(header, memoryview(values)), True
+    return map_index(cache_dir, key) or GeometryIndex(header, memoryview(values)), True
+
+
+def index(cache_dir=CACHE_DIR):
+    if cache_dir not in _indexes:
+        _indexes[cache_dir] = load_index(cache_dir)[0]
+    return _indexes[cache_dir]
+
+
+def format_report(geometry, compiled, seconds, labware=None):
+    header = geometry.header
+    lines = ['labware bundle v%d: %d labware, %d wells, index %s (%s in %.1f ms)' % (
+        header['bundle_version'], len(header['labware']), header['wells'], geometry.path or 'in memory',
+        'compiled' if compiled else 'memory-mapped', seconds * 1000)]
+    for load_name in sorted(header['labware']):
+        if labware and load_name != labware:
+            continue
+        entry = header['labware'][load_name]
+        lines.append('    %-34s %-10s %3d wells' % (load_name, entry['source'], len(entry['names'])))
+        if labware:
+            for name, row in geometry.wells(load_name):
+                lines.append('        %-4s ' % name + '  '.join('%s %7.2f' % (f, v) for f, v in zip(FIELDS, row)))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Compile the labware geometry index and time the simulator start')
+    parser.add_argument('--rebuild', action='store_true', help='compile the index even if the cached one is current')
+    parser.add_argument('--labware', help='list the wells of one labware')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    args = parser.parse_args(argv)
+    if args.labware and args.labware not in lw.LABWARE:
+        raise ValueError("Unknown labware '%s', known: %s" % (args.labware, ', '.join(sorted(lw.LABWARE))))
+    start = time.time()
+    geometry, compiled = load_index(args.cache_dir, args.rebuild)
+    print(format_report(geometry, compiled, time.time() - start, args.labware))
+    if args.labware:
+        return
+    from . import sim
+    _indexes[args.cache_dir] = geometry
+    print('simulator start (protocol loaded, deck set up, first command) and whole run:')
+    for name in sorted(sim.PROTOCOLS):
+        start = time.time()
+        path = sim.protocol_path(name)
+        namespace = sim.load_protocol(path)
+        protocol = sim.SimProtocol(path)
+        first = _stamp_first_command(protocol)
+        namespace['run'](protocol)
+        total = time.time() - start
+        print('    %-14s start %6.1f ms   run %7.1f ms   %d commands' % (
+            name, (first[0] - start) * 1000, total * 1000, len(protocol.commands)))
+
+
+def _stamp_first_command(protocol):
+    # [time of the first recorded command], the command itself is recorded as usual
+    stamps, record = [], protocol._record
+
+    def wrapped(*args, **kwargs):
+        if not stamps:
+            stamps.append(time.time())
+        return record(*args, **kwargs)
+    protocol._record = wrapped
+    return stamps
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+#Readme:
+#Intervention consolidation scheduler for protocol.pause() calls.
+#Each pause of a protocol is split into operator tasks (INTERVENTIONS), each task names the deck resources it changes:
+#a slot ('3' = IP slide) or a trough well (('8', 'A5') = RNAlater). The recorded trace is cut into units (runs of one
+#step between pauses) and the dependency graph is built from it:
+#   unit -> unit  one reads/writes a well the other writes (pathopt.depends)
+#   unit -> task  the unit uses the resource in its old state (before the task's pause in the protocol)
+#   task -> unit  the unit uses the resource in its new state (after the task's pause)
+#   task -> task  tasks on the same resource keep their order
+#The scheduler runs as much robot work as it can (original order where possible), then stops once with every task that
+#is ready, so the number of stops is the fewest the graph allows. Tasks nothing waits for are done before the run
+#(setup), tasks marked jit (ice cold PBS, fresh cells) only join a stop right before the work that needs them.
+#Idle time per stop = operator latency + hands-on minutes of its tasks + waiting for labware that is off the deck
+#(offline minutes, eg pelleting), which the robot covers with the work it can do in the meantime.
+#Usage: python -m ot2_tools.interventions sampling [--latency-minutes 5]
+
+from . import pathopt
+from . import runtime
+from . import sim
+
+# Tasks per pause, in trace order: text, resources (slots or (slot, well)), hands-on minutes, offline minutes,
+# jit (add just before use), reset (the task reloads tip racks)
+INTERVENTIONS = {
+    'harvest': [
+        [{'text': 'Insert IP_slide 1 into position 3 (odd columns)', 'resources': ['3']}],
+        [{'text': 'Remove IP_slide 1 to read and replace with IP_slide 2 (even columns)', 'resources': ['3']},
+         {'text': 'Remove supernatant plate and pellet cells', 'resources': ['9'], 'offline': 10}],
+        [{'text': 'Remove IP_slide 2 to read', 'resources': ['3']},
+         {'text': 'Replace IP dilution plate with fresh nunc-96U for supernatant transfer', 'resources': ['6']},
+         {'text': "Replace tip300_1 in 'slot 7' with a full rack", 'resources': ['7'], 'reset': True}],
+    ],
+    'sampling': [
+        [{'text': "Replace 'tiprack-300-1' in 'slot 7' as follows: Cols 1+2 odd rows, 3+4 even rows, rest of rack full. "
+                  "Replace 'tiprack-300-2' in slot 10 with a full rack", 'resources': ['7', '10'], 'minutes': 3, 'reset': True},
+         {'text': 'Insert IP slide into slot 3 for odd wells', 'resources': ['3']},
+         {'text': 'Add feed to trough A3', 'resources': [('8', 'A3')]}],
+        [{'text': 'Replace loaded iprasense slide with empty slide, run IP_slide one on Iprasense', 'resources': ['3']}],
+        [{'text': 'Replace dilution plate with empty nunc_96U to take samples for qPCR', 'resources': ['6']}],
+        [{'text': 'Remove western blot and qPCR plates, pellet cells and return', 'resources': ['9', '6'], 'offline': 10},
+         {'text': 'Add 8ml RNA_Later to trough A5', 'resources': [('8', 'A5')], 'jit': True},
+         {'text': 'Add 8ml ice cold PBS to trough A6', 'resources': [('8', 'A6')], 'jit': True}],
+    ],
+    # by SEED_TIPS (INTERVENTION_SETTINGS), per_replicate reloads the tip racks before seeding
+    'nucleofection': {
+        'per_replicate': [
+            [{'text': 'Add resuspended cells to trough, position 8, column 2', 'resources': [('8', 'A2')], 'jit': True}],
+            [{'text': 'Perform electroporation and return nucleofection plate to position 3', 'resources': ['3'], 'offline': 5},
+             {'text': 'Add pregassed media to trough, position 8, col 3', 'resources': [('8', 'A3')], 'jit': True}],
+            [{'text': "Reset tipracks for seeding: tip200_1 in 'slot 7' odd rows only (A,C,E,G), tip200_2 in 'slot 10' even "
+                      "rows only (B,D,F,H)", 'resources': ['7', '10'], 'minutes': 3, 'reset': True}],
+        ],
+        'shared_per_sample': [
+            [{'text': 'Add resuspended cells to trough, position 8, column 2', 'resources': [('8', 'A2')], 'jit': True}],
+            [{'text': 'Perform electroporation and return nucleofection plate to position 3', 'resources': ['3'], 'offline': 5},
+             {'text': 'Add pregassed media to trough, position 8, col 3', 'resources': [('8', 'A3')], 'jit': True}],
+        ],
+    },
+}
+
+# Protocol setting that picks the interventions when they depend on it
+INTERVENTION_SETTINGS = {'nucleofection': 'SEED_TIPS'}
+
+
+def declared_interventions(name, overrides=None):
+    # Declared tasks per pause for a protocol and its overrides, None for protocols without a table
+    declared = INTERVENTIONS.get(name)
+    if declared is not None and name in INTERVENTION_SETTINGS:
+        setting = INTERVENTION_SETTINGS[name]
+        value = (overrides or {}).get(setting, sim.load_protocol(name)[setting])
+        if value not in declared:
+            raise ValueError("No interventions declared for %s %s=%r, known: %s" % (name, setting, value, ', '.join(sorted(declared))))
+        declared = declared[value]
+    return declared
+
+
+def split_trace(commands):
+    # Returns (units, stops). A stop is a pause with the home before it and the comments / tip reset after it,
+    # a unit is a run of one step between stops
+    units, stops = [], []
+    n = 0
+    while n < len(commands):
+        c = commands[n]
+        if c['name'] == 'pause' or (c['name'] == 'home' and n + 1 < len(commands) and commands[n + 1]['name'] == 'pause'):
+            stop = {'commands': [], 'position': len(units)}
+            while n < len(commands) and commands[n]['name'] == 'home':
+                stop['commands'].append(commands[n])
+                n += 1
+            stop['commands'].append(commands[n])
+            n += 1
+            while n < len(commands) and commands[n]['name'] in ('comment', 'reset_tipracks'):
+                stop['commands'].append(commands[n])
+                n += 1
+            pause = next(s for s in stop['commands'] if s['name'] == 'pause')
+            stop['message'] = ' '.join(s.get('message') or '' for s in stop['commands'] if s['name'] in ('pause', 'comment')).strip()
+            stop['index'] = pause['index']
+            stops.append(stop)
+            continue
+        if not units or units[-1]['stop'] != len(stops) or units[-1]['step'] != c['step']:
+            units.append({'step': c['step'], 'stop': len(stops), 'commands': []})
+        units[-1]['commands'].append(c)
+        n += 1
+    for number, unit in enumerate(units):
+        unit['number'] = number
+        unit.update(pathopt._operation(unit['commands']))
+        unit['slots'] = set(c['location']['slot'] for c in unit['commands'] if (c.get('location') or {}).get('slot'))
+        unit['wells'] = set(w for w in (pathopt._well(c) for c in unit['commands']) if w)
+    return units, stops
+
+
+def _uses(unit, resource):
+    if resource is None:
+        return True
+    if isinstance(resource, (tuple, list)):
+        return tuple(resource) in unit['wells']
+    return resource in unit['slots']
+
+
+def build_tasks(name, units, stops, overrides=None):
+    # Declared tasks for the protocol's pauses, or for protocols without a table one task per pause that keeps its
+    # place (all resources). A table that does not match the pauses is an error
+    declared = declared_interventions(name, overrides)
+    if declared is not None and len(declared) != len(stops):
+        raise ValueError('%s has %d pauses, INTERVENTIONS declares %d: update the table' % (name, len(stops), len(declared)))
+    if declared is None:
+        declared = [[{'text': stop['message'] or 'Resume', 'resources': [None],
+                      'reset': any(c['name'] == 'reset_tipracks' for c in stop['commands'])}] for stop in stops]
+    tasks = []
+    for s, (stop, entries) in enumerate(zip(stops, declared)):
+        for entry in entries:
+            resources = entry.get('resources') or [None]
+            task = {'number': len(tasks), 'stop': s, 'text': entry['text'], 'resources': resources,
+                    'minutes': entry.get('minutes', 1.0), 'offline': entry.get('offline', 0.0),
+                    'jit': entry.get('jit', False), 'reset': entry.get('reset', False),
+                    'before': set(u['number'] for u in units if u['stop'] <= s and any(_uses(u, r) for r in resources)),
+                    'after': set(u['number'] for u in units if u['stop'] > s and any(_uses(u, r) for r in resources)),
+                    'tasks': set(t['number'] for t in tasks if t['stop'] < s and (
+                        None in resources or None in t['resources'] or set(map(str, resources)) & set(map(str, t['resources']))))}
+            task['resets'] = [c for c in stop['commands'] if c['name'] == 'reset_tipracks'] if task['reset'] else []
+            tasks.append(task)
+    return tasks
+
+
+def schedule(units, tasks, order=None, depends=pathopt.depends):
+    # Returns [{'units': [...], 'tasks': [...]}], the first entry's tasks are setup tasks (before the run),
+    # every later entry starts with a stop. Tasks nothing depends on after the last unit are left for after the run.
+    # order(runnable, done) ranks the runnable units (default: trace order), a None in the ranking stops there
+    # if a (not jit) task is ready, so the operator comes in before the units after it. depends(a, b): unit b has to
+    # run after unit a
+    before_unit = dict((u['number'], set(j for j in range(u['number']) if depends(units[j], u))) for u in units)
+    waits_for = dict((u['number'], set(t['number'] for t in tasks if u['number'] in t['after'])) for u in units)
+    done_units, done_tasks = set(), set()
+    phases = []
+    pending = [t['number'] for t in tasks]
+
+    def runnable(u, extra=()):
+        return before_unit[u] <= done_units and waits_for[u] <= done_tasks | set(extra)
+
+    while True:
+        ready = [t for t in pending if tasks[t]['before'] <= done_units and tasks[t]['tasks'] <= done_tasks]
+        plain = [t for t in ready if not tasks[t]['jit']]
+        remaining = [u['number'] for u in units if u['number'] not in done_units]
+        if phases and not remaining:
+            break
+        blocked = [u for u in remaining if not runnable(u)]
+        # jit tasks only join when they let work start right after this stop
+        jit = [t for t in ready if tasks[t]['jit']]
+        while True:
+            keep = [t for t in jit if any(u in tasks[t]['after'] and runnable(u, plain + jit) for u in blocked)]
+            if keep == jit:
+                break
+            jit = keep
+        stop = plain + jit
+        if phases and not stop:
+            raise sim.SimulationError('Tasks and steps depend on each other in a loop, cannot schedule: %s' % (
+                ', '.join(units[u]['step'] for u in remaining)))
+        done_tasks |= set(stop)
+        pending = [t for t in pending if t not in done_tasks]
+        phase = {'tasks': sorted(stop), 'units': []}
+        progressed = True
+        while progressed:
+            progressed = False
+            candidates = [u for u in remaining if u not in done_units and runnable(u)]
+            for u in (candidates if order is None else order(candidates, done_units)):
+                if u is None:
+                    if any(tasks[t]['before'] <= done_units and tasks[t]['tasks'] <= done_tasks and not tasks[t]['jit']
+                           for t in pending):
+                        break
+                    continue
+                phase['units'].append(u)
+                done_units.add(u)
+                progressed = True
+                break
+        phases.append(phase)
+    return phases, pending
+
+
+def original_phases(units, tasks, stops):
+    phases = [{'tasks': [], 'units': [u['number'] for u in units if u['stop'] == 0]}]
+    for s in range(len(stops)):
+        phases.append({'tasks': [t['number'] for t in tasks if t['stop'] == s],
+                       'units': [u['number'] for u in units if u['stop'] == s + 1]})
+    return phases, []
+
+
+def idle_time(phases, units, tasks, seconds, latency_minutes=5.0):
+    # Robot idle seconds per stop (phases[1:]). Offline labware comes back at the last stop before the first unit
+    # that needs it, the robot work done since it left counts against the offline time.
+    position = {}
+    for p, phase in enumerate(phases):
+        for u in phase['units']:
+            position[u] = p
+    work = [sum(seconds[u] for u in phase['units']) for phase in phases]
+    idle = [0.0] * len(phases)
+    for p, phase in enumerate(phases):
+        if p == 0:
+            continue
+        idle[p] += latency_minutes * 60.0 + sum(tasks[t]['minutes'] * 60.0 for t in phase['tasks'])
+        for t in phase['tasks']:
+            if not tasks[t]['offline']:
+                continue
+            back = min([position[u] for u in tasks[t]['after']] or [len(phases) - 1])
+            back = max(back, p)
+            away = sum(work[p:back]) + sum(idle[q] for q in range(p + 1, back))
+            idle[back] += max(0.0, tasks[t]['offline'] * 60.0 - away)
+    return idle
+
+
+def settings_snapshots(units):
+    # Settings each unit starts with in the original trace: {unit: {(pipette, setting): set command}}
+    state, snapshots = {}, {}
+    for u in units:
+        snapshots[u['number']] = dict(state)
+        for c in u['commands']:
+            if c['name'] == 'set':
+                state[(c['pipette'], c['setting'])] = c
+    return snapshots
+
+
+def build_commands(phases, units, tasks, stops):
+    # Rewritten trace: units in the new order, one merged pause per stop, settings restored where a unit moved
+    snapshots = settings_snapshots(units)
+    state = {}
+    plan = []
+    for p, phase in enumerate(phases):
+        if p == 0 and phase['tasks']:
+            plan.append({'name': 'comment', 'step': 'Setup', 'message': 'Before starting: ' + '. '.join(
+                tasks[t]['text'] for t in phase['tasks'])})
+        elif p > 0:
+            plan.append({'name': 'home', 'step': 'Intervention'})
+            plan.append({'name': 'pause', 'step': 'Intervention', 'message': merged_message([tasks[t] for t in phase['tasks']])})
+            for t in phase['tasks']:
+                plan.extend(dict(c) for c in tasks[t]['resets'])
+        for u in phase['units']:
+            for key, command in sorted(snapshots[u].items()):
+                if state.get(key, command)['value'] != command['value']:
+                    plan.append(dict(command, previous=state[key]['value'], step=units[u]['step']))
+                    state[key] = command
+            for c in units[u]['commands']:
+                if c['name'] == 'set':
+                    state[(c['pipette'], c['setting'])] = c
+                plan.append(c)
+    return [dict(c, index=n, original_index=c.get('index')) for n, c in enumerate(plan)]
+
+
+def merged_message(tasks):
+    if len(tasks) == 1:
+        return 'ATTENTION: %s' % tasks[0]['text']
+    return 'ATTENTION: %s' % ' '.join('%d: %s.' % (n + 1, t['text'].rstrip('.')) for n, t in enumerate(tasks))
+
+
+def consolidate(name, latency_minutes=5.0, model=None):
+    protocol = sim.simulate(name)
+    deck = protocol.deck_layout()
+    units, stops = split_trace(protocol.commands)
+    tasks = build_tasks(name, units, stops)
+    timings = dict((t['index'], t['total']) for t in runtime.estimate(protocol.commands, deck, model))
+    seconds = dict((u['number'], sum(timings[c['index']] for c in u['commands'])) for u in units)
+    result = {'name': name, 'units': units, 'tasks': tasks, 'stops': stops, 'latency_minutes': latency_minutes}
+    for key, (phases, after_run) in (('before', original_phases(units, tasks, stops)), ('after', schedule(units, tasks))):
+        idle = idle_time(phases, units, tasks, seconds, latency_minutes)
+        result[key] = {'phases': phases, 'after_run': after_run, 'idle': idle, 'stops': len(phases) - 1,
+                       'robot': sum(seconds.values())}
+    result['commands'] = build_commands(result['after']['phases'], units, tasks, stops)
+    return result
+
+
+def format_report(result):
+    before, after = result['before'], result['after']
+    lines = ['%s: %d -> %d interventions, robot idle %s -> %s (operator latency %g min)' % (
+        result['name'], before['stops'], after['stops'], runtime.format_seconds(sum(before['idle'])),
+        runtime.format_seconds(sum(after['idle'])), result['latency_minutes'])]
+    tasks, units = result['tasks'], result['units']
+    for p, phase in enumerate(after['phases']):
+        if p == 0:
+            if phase['tasks']:
+                lines.append('    setup (before the run): %s' % '; '.join(tasks[t]['text'] for t in phase['tasks']))
+        else:
+            lines.append('    PAUSE %d, idle %s: %s' % (p, runtime.format_seconds(after['idle'][p]),
+                                                    merged_message([tasks[t] for t in phase['tasks']])))
+        for u in phase['units']:
+            moved = '  (was after pause %d)' % units[u]['stop'] if units[u]['stop'] != p else ''
+            lines.append('        #%s%s' % (units[u]['step'][:70], moved))
+    if after['after_run']:
+        lines.append('    after the run: %s' % '; '.join(tasks[t]['text'] for t in after['after_run']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Merge operator interventions into the fewest pauses')
+    parser.add_argument('protocols', nargs='+', help='protocol files or: %s' % ', '.join(sorted(sim.PROTOCOLS)))
+    parser.add_argument('--latency-minutes', type=float, default=5.0, help='operator response time per pause (default 5)')
+    args = parser.parse_args(argv)
+    for name in args.protocols:
+        print(format_report(consolidate(name, args.latency_minutes)))
+
+
+if __name__ == '__main__':
+    main()
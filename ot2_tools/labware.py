@@ -0,0 +1,149 @@
+#Readme:
+#OT2 deck, labware and pipette geometry used by the offline tools.
+#All positions are in mm, deck coordinates: x left->right, y front->back, z up from the deck surface.
+#Custom labware (nunc_24_pseudo_a/b, iprasense_48_slide etc) are read from the versioned bundle in labware/ (opentrons
+#schema 2 definitions in their own ot2_tools_offline namespace), the rest are opentrons definitions the robot has built
+#in. The bundle is an offline approximation laid out as regular grids from the plate dimensions, NOT the definitions
+#loaded in the OT2 app: measure the real plates before trusting it to <0.5mm, and do not import it into the app.
+import json
+import os
+
+# labware/bundle.json lists each custom load name with its definition version, read from labware/<load_name>/<version>.json
+BUNDLE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'labware')
+BUNDLE_MANIFEST = os.path.join(BUNDLE_DIR, 'bundle.json')
+CATEGORY_KINDS = {'wellPlate': 'plate', 'other': 'plate', 'reservoir': 'reservoir', 'tipRack': 'tiprack', 'trash': 'trash'}
+
+# Deck slot origins (front-left corner of each slot). Slot 12 holds the fixed trash
+DECK_SLOTS = {
+    '1': (0.0, 0.0), '2': (132.5, 0.0), '3': (265.0, 0.0),
+    '4': (0.0, 90.5), '5': (132.5, 90.5), '6': (265.0, 90.5),
+    '7': (0.0, 181.0), '8': (132.5, 181.0), '9': (265.0, 181.0),
+    '10': (0.0, 271.5), '11': (132.5, 271.5), '12': (265.0, 271.5)}
+SLOT_SIZE = (127.76, 85.48)
+TRASH_SLOT = '12'
+TRASH_LABWARE = 'opentrons_1_trash'
+
+# Head position after home(), as seen by the right mount nozzle
+HOME_POINT = (418.0, 353.0, 205.0)
+
+# Nozzle offset of each mount relative to the right mount. The head carries both pipettes.
+MOUNT_OFFSETS = {'right': (0.0, 0.0, 0.0), 'left': (-34.0, 0.0, 0.0)}
+
+ROW_NAMES = 'ABCDEFGHIJKLMNOP'
+
+
+def _grid(rows, cols, x0, y0, dx, dy, height, depth, volume, shape='circular', diameter=None, size=None, kind='plate', tip_length=None,
+          bottom='flat'):
+    # x0/y0 = centre of A1 from the front-left corner of the labware. Rows run back->front so y falls with each row.
+    # bottom = 'flat' or 'u' (hemisphere of the well diameter)
+    return {
+        'rows': rows, 'cols': cols, 'x0': x0, 'y0': y0, 'dx': dx, 'dy': dy,
+        'height': height, 'depth': depth, 'volume': volume,
+        'shape': shape, 'diameter': diameter, 'size': size, 'kind': kind, 'tip_length': tip_length, 'bottom': bottom}
+
+
+def bundle_manifest():
+    with open(BUNDLE_MANIFEST) as f:
+        return json.load(f)
+
+
+def definition_path(load_name, version):
+    return os.path.join(BUNDLE_DIR, load_name, '%d.json' % version)
+
+
+def load_definition(load_name, version=None):
+    # Opentrons schema 2 labware definition from the bundle, the version listed in the manifest unless given
+    if version is None:
+        versions = bundle_manifest()['labware']
+        if load_name not in versions:
+            raise KeyError("'%s' is not in the labware bundle (%s)" % (load_name, BUNDLE_MANIFEST))
+        version = versions[load_name]
+    with open(definition_path(load_name, version)) as f:
+        definition = json.load(f)
+    if definition.get('schemaVersion') != 2 or definition['parameters']['loadName'] != load_name:
+        raise ValueError('%s is not a schema 2 definition of %s' % (definition_path(load_name, version), load_name))
+    if definition.get('namespace') != bundle_manifest()['namespace']:
+        raise ValueError('%s is in namespace %s, the bundle is %s' % (definition_path(load_name, version),
+                                                                     definition.get('namespace'), bundle_manifest()['namespace']))
+    return definition
+
+
+def from_definition(definition):
+    # _grid spec of a definition: A1 gives the origin, the next column / row the pitch. Wells have to be a regular grid
+    ordering, wells = definition['ordering'], definition['wells']
+    first = wells[ordering[0][0]]
+    dx = round(wells[ordering[1][0]]['x'] - first['x'], 3) if len(ordering) > 1 else 0.0
+    dy = round(first['y'] - wells[ordering[0][1]]['y'], 3) if len(ordering[0]) > 1 else 0.0
+    for c, column in enumerate(ordering):
+        for r, name in enumerate(column):
+            well = wells[name]
+            if abs(well['x'] - first['x'] - c * dx) > 0.01 or abs(first['y'] - well['y'] - r * dy) > 0.01:
+                raise ValueError("%s well %s is off the grid" % (definition['parameters']['loadName'], name))
+    shape = first['shape']
+    groups = definition.get('groups') or [{}]
+    parameters = definition['parameters']
+    return _grid(len(ordering[0]), len(ordering), first['x'], first['y'], dx, dy,
+                 definition['dimensions']['zDimension'], first['depth'], first['totalLiquidVolume'], shape=shape,
+                 diameter=first.get('diameter'),
+                 size=(first['xDimension'], first['yDimension']) if shape == 'rectangular' else None,
+                 kind=CATEGORY_KINDS[definition['metadata']['displayCategory']], tip_length=parameters.get('tipLength'),
+                 bottom=groups[0].get('metadata', {}).get('wellBottomShape', 'flat'))
+
+
+def load_bundle():
+    return dict((load_name, from_definition(load_definition(load_name, version)))
+                for load_name, version in bundle_manifest()['labware'].items())
+
+
+# Opentrons definitions built into the robot, the custom ones come from the bundle. Notes on the custom labware:
+#   iprasense_48_slide is addressed like a 96 well plate (wells()[8*n]) so the p50 multi can load it
+#   nunc_24_pseudo_a puts the A nozzle over A1 (odd row tips), nunc_24_pseudo_b puts the B nozzle over A1 (even row tips)
+LABWARE = {
+    'corning_96_wellplate_360ul_flat': _grid(8, 12, 14.38, 74.24, 9.0, 9.0, 14.22, 10.67, 360, diameter=6.86),
+    TRASH_LABWARE: _grid(1, 1, 82.84, 53.56, 0.0, 0.0, 82.0, 0.0, 0, shape='rectangular', size=(172.86, 165.86), kind='trash'),
+    # Tipracks, depth = how far the nozzle drops to seat a tip
+    'opentrons_96_tiprack_300ul': _grid(8, 12, 14.38, 74.24, 9.0, 9.0, 64.49, 59.3, 300, diameter=5.23, kind='tiprack', tip_length=51.7),
+    'opentrons_96_filtertiprack_200ul': _grid(8, 12, 14.38, 74.24, 9.0, 9.0, 64.49, 59.3, 200, diameter=5.23, kind='tiprack', tip_length=48.5),
+}
+LABWARE.update(load_bundle())
+
+# Pipette specs, API 2.0 GEN1 defaults. Flow rates in ul/s
+PIPETTES = {
+    'p300_multi': {'channels': 8, 'max_volume': 300, 'min_volume': 30, 'aspirate': 150.0, 'dispense': 300.0, 'blow_out': 300.0},
+    'p50_multi': {'channels': 8, 'max_volume': 50, 'min_volume': 5, 'aspirate': 25.0, 'dispense': 50.0, 'blow_out': 50.0},
+    'p300_single': {'channels': 1, 'max_volume': 300, 'min_volume': 30, 'aspirate': 150.0, 'dispense': 300.0, 'blow_out': 300.0},
+    'p50_single': {'channels': 1, 'max_volume': 50, 'min_volume': 5, 'aspirate': 25.0, 'dispense': 50.0, 'blow_out': 50.0},
+}
+
+
+def labware_spec(load_name):
+    if load_name not in LABWARE:
+        raise KeyError("Unknown labware '%s'. Add its definition to the labware/ bundle" % load_name)
+    return LABWARE[load_name]
+
+
+def well_names(load_name):
+    # Well names in opentrons order: down each column, then across (A1, B1, C1 ... A2)
+    spec = labware_spec(load_name)
+    return [ROW_NAMES[r] + str(c + 1) for c in range(spec['cols']) for r in range(spec['rows'])]
+
+
+def well_offset(load_name, well_name):
+    # (x, y) centre of a well and the z of its bottom and top, from the front-left corner of the labware
+    spec = labware_spec(load_name)
+    row = ROW_NAMES.index(well_name[0])
+    col = int(well_name[1:]) - 1
+    top = spec['height']
+    return spec['x0'] + col * spec['dx'], spec['y0'] - row * spec['dy'], top - spec['depth'], top
+
+
+def well_position(load_name, slot, well_name):
+    # (x, y) centre of a well and the z of its bottom and top, in deck coordinates
+    x, y, bottom, top = well_offset(load_name, well_name)
+    sx, sy = DECK_SLOTS[str(slot)]
+    return sx + x, sy + y, bottom, top
+
+
+def slot_center(slot):
+    sx, sy = DECK_SLOTS[str(slot)]
+    return sx + SLOT_SIZE[0] / 2, sy + SLOT_SIZE[1] / 2
@@ -0,0 +1,364 @@
+#Readme:
+#Well-volume ledger. Needs numpy. Every labware on the deck gets an array of well volumes (ul, well_names order) and
+#every aspirate / dispense of a run moves liquid in the wells under the nozzles that carry a tip (a multichannel in a
+#trough column takes 8x the volume, odd / even row tips on a 24-well plate only reach every other well, see tipstate).
+#Pauses reload what their interventions.INTERVENTIONS tasks name: a slot comes back as new labware, a trough well is
+#refilled. Labware a task takes off the deck for a while ('offline', eg pelleting) comes back with its contents.
+#From the ledger:
+#   bill of materials - the volume each well must hold when it is loaded (most it is ever short) plus its dead volume,
+#                       the liquid below the lowest tip position + IMMERSION. --fill volumes.json checks what is loaded
+#                       ({"8": {"A1": 20000}, "6": 250} = ul per well each time it is loaded, a number for every well
+#                       of the slot), exits 1 if a well runs dry
+#   liquid levels     - height of the liquid from the well geometry (straight walls over a flat or U bottom; a flat
+#                       well's cross section is the larger of the drawn one and volume / depth, so tapered wells read
+#                       low), and per aspirate line the
+#                       clearance that follows the level: IMMERSION under the surface left after the aspirate, never
+#                       below MIN_CLEARANCE. A tip that follows the level stays shallow, so faster flow rates do not
+#                       push liquid up the outside of the tip, and it can never reach the bottom
+#Usage: python -m ot2_tools.ledger valitatiter [--fill volumes.json] [--levels]
+
+import json
+import math
+
+import numpy as np
+
+from . import interventions
+from . import labware as lw
+from . import sim
+from . import tipstate
+
+NOZZLE_PITCH = 9.0       # mm between multichannel nozzles, A nozzle at the back
+IMMERSION = 2.0          # mm the tip is kept under the surface
+MIN_CLEARANCE = 1.0      # mm above the well bottom, lowest a level following tip goes
+TRACKED = ('plate', 'reservoir')
+
+
+def well_area(spec):
+    # Cross section in mm2 of one well above its bottom
+    if spec['shape'] == 'circular':
+        drawn = math.pi * spec['diameter'] ** 2 / 4.0
+    else:
+        drawn = spec['size'][0] * spec['size'][1]
+    if spec.get('bottom') == 'u':
+        return drawn
+    return max(drawn, spec['volume'] / float(spec['depth']))
+
+
+def well_profile(spec, steps=400):
+    # (volumes, heights) table of one well, volume in ul held up to each height from the bottom
+    heights = np.linspace(0.0, spec['depth'], steps + 1)
+    area = well_area(spec)
+    if spec.get('bottom') == 'u':
+        r = spec['diameter'] / 2.0
+        cap = np.minimum(heights, r)
+        volumes = math.pi * cap ** 2 * (3 * r - cap) / 3.0 + area * np.maximum(heights - r, 0.0)
+    else:
+        volumes = area * heights
+    return volumes, heights
+
+
+def liquid_height(volumes, spec, profile=None):
+    # Liquid height (mm above the well bottom) for an array of volumes, capped at the well depth
+    table, heights = profile or well_profile(spec)
+    return np.interp(np.asarray(volumes, dtype=float), table, heights)
+
+
+def height_volume(height, spec, profile=None):
+    # Volume (ul) held up to a height
+    table, heights = profile or well_profile(spec)
+    return float(np.interp(height, heights, table))
+
+
+class Ledger(object):
+    # Well volumes per slot. 'low' is the least each well has held since it was loaded (negative = short),
+    # 'loads' lists every (slot, well index) load: at setup and at each pause that reloads it. initial = volumes per
+    # slot / well for every load, planned = {(slot, well, when): ul} for single loads
+    def __init__(self, deck, initial=None, planned=None):
+        self.deck = dict((slot, name) for slot, name in deck.items() if lw.labware_spec(name)['kind'] in TRACKED)
+        self.specs = dict((slot, lw.labware_spec(name)) for slot, name in self.deck.items())
+        self.names = dict((slot, lw.well_names(name)) for slot, name in self.deck.items())
+        self.profiles = dict((slot, well_profile(spec)) for slot, spec in self.specs.items())
+        self.centres = {}
+        for slot, name in self.deck.items():
+            self.centres[slot] = np.array([lw.well_position(name, slot, well)[:2] for well in self.names[slot]])
+        self.initial = initial or {}
+        self.planned = planned or {}
+        self.volumes = {}
+        self.low = {}
+        self.high = {}
+        self.lowest_tip = {}
+        self.loads = []
+        for slot in self.deck:
+            self.load(slot, 'setup')
+
+    def load(self, slot, when, wells=None):
+        # Fresh contents for a slot, or for some of its wells
+        count = len(self.names[slot])
+        index = np.arange(count) if wells is None else np.array([self.names[slot].index(w) for w in wells])
+        if slot not in self.volumes:
+            self.volumes[slot] = np.zeros(count)
+            self.low[slot] = np.zeros(count)
+            self.high[slot] = np.zeros(count)
+            self.lowest_tip[slot] = np.full(count, np.inf)
+        for i in index:
+            self.close(slot, i)
+            self.loads.append({'slot': slot, 'well': self.names[slot][i], 'index': i, 'when': when,
+                               'filled': self._filled(slot, self.names[slot][i], when), 'used': 0.0, 'lowest_tip': None})
+        self.volumes[slot][index] = [self.loads[-len(index) + n]['filled'] for n in range(len(index))]
+        self.low[slot][index] = self.volumes[slot][index]
+        self.high[slot][index] = self.volumes[slot][index]
+        self.lowest_tip[slot][index] = np.inf
+
+    def _filled(self, slot, well, when):
+        if (slot, well, when) in self.planned:
+            return float(self.planned[(slot, well, when)])
+        filled = self.initial.get(slot, 0.0)
+        if isinstance(filled, dict):
+            filled = filled.get(well, 0.0)
+        return float(filled)
+
+    def close(self, slot, i):
+        # Settles the open load of a well: how much it had to hold and the lowest tip position it saw
+        for entry in reversed(self.loads):
+            if entry['slot'] == slot and entry['index'] == i:
+                entry['used'] = entry['filled'] - self.low[slot][i]
+                tip = self.lowest_tip[slot][i]
+                entry['lowest_tip'] = None if np.isinf(tip) else float(tip)
+                entry['peak'] = float(self.high[slot][i])
+                return
+
+    def close_all(self):
+        for slot in self.volumes:
+            for i in range(len(self.names[slot])):
+                self.close(slot, i)
+
+    def channel_wells(self, command, nozzles):
+        # Indices of the wells under the nozzles (numbers from the back, 0 = A), one entry per nozzle in a well
+        # (repeats in a trough)
+        return self.nozzle_wells(command, nozzles)[1]
+
+    def nozzle_wells(self, command, nozzles):
+        # (positions in nozzles, well indices) of the nozzles that are over a well
+        slot = command['location']['slot']
+        spec = self.specs[slot]
+        x, y = command['point'][0], command['point'][1]
+        if spec['kind'] == 'reservoir':
+            # reservoirs centre a multichannel on the well (centerMultichannelOnWells), not its back nozzle
+            y += NOZZLE_PITCH * (lw.PIPETTES[command['pipette']]['channels'] - 1) / 2.0
+        nozzles = np.column_stack([np.full(len(nozzles), x), y - NOZZLE_PITCH * np.asarray(nozzles)])
+        offsets = np.abs(nozzles[:, None, :] - self.centres[slot][None, :, :])
+        if spec['shape'] == 'circular':
+            inside = np.hypot(offsets[..., 0], offsets[..., 1]) <= spec['diameter'] / 2.0
+        else:
+            inside = (offsets[..., 0] <= spec['size'][0] / 2.0) & (offsets[..., 1] <= spec['size'][1] / 2.0)
+        return np.nonzero(inside)
+
+    def move(self, command, nozzles):
+        # Applies one aspirate / dispense through the nozzles holding a tip. Returns (slot, well indices) or None for
+        # untracked labware
+        location = command.get('location') or {}
+        slot = location.get('slot')
+        if slot not in self.volumes:
+            return None
+        wells = self.channel_wells(command, nozzles)
+        sign = -1.0 if command['name'] == 'aspirate' else 1.0
+        np.add.at(self.volumes[slot], wells, sign * command['volume'])
+        self.low[slot][wells] = np.minimum(self.low[slot][wells], self.volumes[slot][wells])
+        self.high[slot][wells] = np.maximum(self.high[slot][wells], self.volumes[slot][wells])
+        if command['name'] == 'aspirate':
+            self.lowest_tip[slot][wells] = np.minimum(self.lowest_tip[slot][wells], location['offset'][2])
+        return slot, wells
+
+    def heights(self, slot, wells=None):
+        volumes = self.volumes[slot] if wells is None else self.volumes[slot][wells]
+        return liquid_height(volumes, self.specs[slot], self.profiles[slot])
+
+
+def pause_reloads(name, commands, overrides=None):
+    # {pause command index: resources reloaded} from the protocol's declared interventions, {} without a table
+    pauses = [c['index'] for c in commands if c['name'] == 'pause']
+    declared = interventions.declared_interventions(name, overrides)
+    if declared is None:
+        return {}
+    if len(declared) != len(pauses):
+        raise ValueError('%s has %d pauses, interventions.INTERVENTIONS declares %d' % (name, len(pauses), len(declared)))
+    return dict((index, [r for task in tasks if not task.get('offline') for r in task.get('resources', [])])
+                for index, tasks in zip(pauses, declared))
+
+
+def tip_nozzles(commands):
+    # {pick_up_tip index: nozzles that hold a tip}, from the tip rows each pick-up needs (tipstate)
+    nozzles = {}
+    for demand in tipstate.tip_demands(commands):
+        channels = lw.PIPETTES[demand['pipette']]['channels']
+        rows = tipstate.PATTERNS[demand['pattern']] if channels > 1 else tipstate.ROWS[0]
+        nozzles[demand['index']] = np.array([n for n in range(channels) if tipstate.ROWS[n] in rows])
+    return nozzles
+
+
+def run_ledger(commands, deck, initial=None, reloads=None, planned=None):
+    # Runs a trace through a Ledger. Returns (ledger, aspirates): one aspirate entry per aspirate of tracked labware
+    # with the tip height and the liquid height left in its wells. Aspirates at or above the well top are air gaps,
+    # they take no liquid and the next dispense lets the air out first
+    ledger = Ledger(deck, initial, planned)
+    reloads = reloads or {}
+    aspirates = []
+    nozzles = tip_nozzles(commands)
+    tips = {}
+    air = {}
+    for command in commands:
+        mount = command.get('mount')
+        if command['name'] in ('pick_up_tip', 'blow_out', 'drop_tip', 'return_tip'):
+            air[mount] = 0.0
+            if command['name'] == 'pick_up_tip':
+                tips[mount] = nozzles[command['index']]
+            continue
+        if command['name'] == 'pause':
+            for resource in reloads.get(command['index'], []):
+                if isinstance(resource, (tuple, list)):
+                    if resource[0] in ledger.volumes:
+                        ledger.load(resource[0], command['index'], [resource[1]])
+                elif resource in ledger.volumes:
+                    ledger.load(resource, command['index'])
+            continue
+        if command['name'] not in ('aspirate', 'dispense'):
+            continue
+        slot = (command.get('location') or {}).get('slot')
+        if slot not in ledger.volumes:
+            continue
+        if command['name'] == 'aspirate' and command['location']['offset'][2] >= ledger.specs[slot]['depth']:
+            air[mount] = air.get(mount, 0.0) + command['volume']
+            continue
+        if command['name'] == 'dispense' and air.get(mount):
+            released = min(air[mount], command['volume'])
+            air[mount] -= released
+            command = dict(command, volume=command['volume'] - released)
+        moved = ledger.move(command, tips[mount])
+        if moved is None or command['name'] != 'aspirate' or not len(moved[1]):
+            continue
+        slot, wells = moved
+        aspirates.append({'index': command['index'], 'line': command['line'], 'step': command['step'], 'slot': slot,
+                          'wells': wells, 'tip': command['location']['offset'][2],
+                          'level': float(ledger.heights(slot, wells).min())})
+    ledger.close_all()
+    return ledger, aspirates
+
+
+def dead_volume(spec, lowest_tip, profile=None):
+    # Liquid a well keeps below a tip aspirating lowest_tip mm above the bottom
+    return height_volume(lowest_tip + IMMERSION, spec, profile)
+
+
+def bill_of_materials(ledger, labels=None):
+    # One entry per well load that liquid is taken from: {slot, label, labware, well, when, used, dead, required,
+    # filled, short}. required = used + dead, short = required - filled if the load is short
+    labels = labels or {}
+    bom = []
+    for entry in ledger.loads:
+        if entry['used'] <= 1e-6:
+            continue
+        spec = ledger.specs[entry['slot']]
+        dead = dead_volume(spec, entry['lowest_tip'] if entry['lowest_tip'] is not None else MIN_CLEARANCE,
+                           ledger.profiles[entry['slot']])
+        required = entry['used'] + dead
+        bom.append({'slot': entry['slot'], 'label': labels.get(entry['slot']), 'labware': ledger.deck[entry['slot']],
+                    'well': entry['well'], 'when': entry['when'], 'used': entry['used'], 'dead': dead,
+                    'required': required, 'filled': entry['filled'], 'short': max(0.0, required - entry['filled'])})
+    return bom
+
+
+def overflows(ledger):
+    # [(slot, well, peak ul, capacity ul)] for well loads that were filled past their capacity
+    return [(e['slot'], e['well'], e['peak'], ledger.specs[e['slot']]['volume']) for e in ledger.loads
+            if e['peak'] > ledger.specs[e['slot']]['volume'] + 1e-6]
+
+
+def level_plan(aspirates):
+    # Per aspirate line: {line, step, calls, tip, levels (min, max), follow (min, max)}. follow = the clearance
+    # IMMERSION under the liquid left by each aspirate, floored at MIN_CLEARANCE. 'dry' counts the aspirates
+    # whose fixed tip height is not under the liquid
+    lines = {}
+    for a in aspirates:
+        follow = max(MIN_CLEARANCE, a['level'] - IMMERSION)
+        entry = lines.setdefault(a['line'], {'line': a['line'], 'step': a['step'], 'calls': 0, 'tip': a['tip'],
+                                             'levels': [a['level'], a['level']], 'follow': [follow, follow], 'dry': 0})
+        entry['calls'] += 1
+        entry['levels'] = [min(entry['levels'][0], a['level']), max(entry['levels'][1], a['level'])]
+        entry['follow'] = [min(entry['follow'][0], follow), max(entry['follow'][1], follow)]
+        if a['tip'] >= a['level']:
+            entry['dry'] += 1
+    return [lines[line] for line in sorted(lines)]
+
+
+def load_fill(path):
+    with open(path) as f:
+        fill = json.load(f)
+    for slot, volumes in fill.items():
+        if not isinstance(volumes, (dict, int, float)):
+            raise ValueError("Fill volumes for slot %s must be ul or {well: ul}" % slot)
+    return dict((str(slot), volumes) for slot, volumes in fill.items())
+
+
+def evaluate(name, fill=None):
+    # Runs the ledger from the bill of materials volumes (or the fill volumes given) so the levels are the ones
+    # of a run loaded as planned
+    protocol = sim.simulate(name)
+    short_name = next((short for short, filename in sim.PROTOCOLS.items() if filename == protocol.path.split('/')[-1]), name)
+    reloads = pause_reloads(short_name, protocol.commands)
+    labels = dict((slot, labware.label) for slot, labware in protocol.labware.items())
+    ledger, aspirates = run_ledger(protocol.commands, protocol.deck_layout(), fill, reloads)
+    bom = bill_of_materials(ledger, labels)
+    if fill is None:
+        # levels of a run loaded with exactly the bill of materials
+        planned = dict(((e['slot'], e['well'], e['when']), e['required']) for e in bom)
+        ledger, aspirates = run_ledger(protocol.commands, protocol.deck_layout(), None, reloads, planned)
+        for entry in bom:
+            entry['filled'], entry['short'] = entry['required'], 0.0
+    return {'protocol': protocol, 'ledger': ledger, 'bom': bom, 'levels': level_plan(aspirates),
+            'overflows': overflows(ledger), 'fill': fill}
+
+
+def format_report(name, result, levels=False):
+    bom = result['bom']
+    lines = ['%s: %d wells to fill, %.1f ml in total' % (name, len(bom), sum(e['required'] for e in bom) / 1000.0)]
+    slot = None
+    for e in sorted(bom, key=lambda e: (str(e['when']) != 'setup', int(e['slot']), e['when'] if e['when'] != 'setup' else 0,
+                                         lw.well_names(e['labware']).index(e['well']))):
+        if (e['slot'], e['when']) != slot:
+            slot = (e['slot'], e['when'])
+            lines.append('    slot %s %s (%s), %s' % (e['slot'], e['label'] or '', e['labware'],
+                                                     'at setup' if e['when'] == 'setup' else 'refilled at the pause (command %s)' % e['when']))
+        text = '        %-4s %8.0ful  (%.0ful used + %.0ful dead)' % (e['well'], e['required'], e['used'], e['dead'])
+        if result['fill'] is not None:
+            text += '  loaded %.0ful%s' % (e['filled'], '  SHORT %.0ful' % e['short'] if e['short'] > 0 else '')
+        lines.append(text)
+    for slot, well, peak, capacity in result['overflows']:
+        lines.append('    OVERFLOW slot %s %s holds %.0ful, capacity %.0ful' % (slot, well, peak, capacity))
+    if levels:
+        lines.append('    aspirate lines: fixed clearance -> level following clearance (liquid height range)')
+        for entry in result['levels']:
+            lines.append('        line %-4s %4dx  %4.1fmm -> %4.1f-%4.1fmm  (liquid %4.1f-%4.1fmm)%s  %s' % (
+                entry['line'], entry['calls'], entry['tip'], entry['follow'][0], entry['follow'][1],
+                entry['levels'][0], entry['levels'][1], '  %d dry' % entry['dry'] if entry['dry'] else '', entry['step']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Well-volume ledger: reagent bill of materials and liquid levels')
+    parser.add_argument('protocols', nargs='+', help='protocol files or: %s' % ', '.join(sorted(sim.PROTOCOLS)))
+    parser.add_argument('--fill', help='JSON file with the volumes loaded per slot / well (preflight check)')
+    parser.add_argument('--levels', action='store_true', help='list liquid heights and level following clearances per aspirate line')
+    args = parser.parse_args(argv)
+    fill = load_fill(args.fill) if args.fill else None
+    short = False
+    for name in args.protocols:
+        result = evaluate(name, fill)
+        print(format_report(name, result, args.levels))
+        short = short or any(e['short'] > 0 for e in result['bom'])
+    if short:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
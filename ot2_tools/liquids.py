@@ -0,0 +1,212 @@
+#Readme:
+#Liquid-class profiles. The protocols group their flow rate / well bottom clearance changes into named LIQUID_CLASSES
+#profiles applied with 'with liquid_class(pipette, name):' blocks (a copy of liquid_class() below sits in each protocol,
+#they stay standalone). A profile only sets what differs from the pipette's current settings and puts it back when
+#the block ends. This tool checks a run for:
+#   churn    - settings assigned to the value they already had (redundant) or replaced before any action used them (dead).
+#              Restores to the pipette default are not counted as dead, a profile block ending puts them back on purpose
+#   carried  - non default settings changed in one step and still in effect when another step aspirates / dispenses
+#   lines    - protocol lines whose aspirates / dispenses run at different flow rates from one call to the next
+#and plans the fastest safe flow rate per liquid class (SAFE_RATES, pipette max volumes per second). Actions at the
+#pipette's default rate (rate=1.0, no profile) are moved to the class rate, explicitly chosen rates are only checked.
+#Liquid classes per step are the settle.py ones (settle.CLASSES, --classes to override).
+#maximum_volume / minimum_volume are not API 2.0 settings, nothing reads them: every assignment of them counts as dead.
+#Usage: python -m ot2_tools.liquids sampling [--classes liquids.json] [--rates]
+
+import contextlib
+
+from . import labware as lw
+from . import runtime
+from . import settle
+from . import sim
+
+# Fastest flow rates a liquid class tolerates, in pipette max volumes per second (p300: 1.0 = 300ul/s)
+SAFE_RATES = {
+    'media': {'aspirate': 0.8, 'dispense': 1.0},
+    'cell_suspension': {'aspirate': 0.5, 'dispense': 0.8},
+    'nucleofection_solution': {'aspirate': 0.33, 'dispense': 0.5},
+    'viscous_standard': {'aspirate': 0.33, 'dispense': 0.5},
+}
+
+# Settings each command uses
+READS = {
+    'aspirate': ('flow_rate.aspirate', 'well_bottom_clearance.aspirate'),
+    'dispense': ('flow_rate.dispense', 'well_bottom_clearance.dispense'),
+    'blow_out': ('flow_rate.blow_out',),
+}
+
+CLEARANCE = 1.0
+
+
+@contextlib.contextmanager
+def liquid_class(pipette, profile):
+    # Applies profile ({'flow_rate.aspirate': 50, 'well_bottom_clearance.dispense': 2.5, ...}) for a 'with' block.
+    # Only settings that differ are set, they are restored in reverse order when the block ends
+    changed = []
+    for setting, value in profile.items():
+        group, attribute = setting.split('.')
+        settings = getattr(pipette, group)
+        if getattr(settings, attribute) != value:
+            changed.append((settings, attribute, getattr(settings, attribute)))
+            setattr(settings, attribute, value)
+    try:
+        yield
+    finally:
+        for settings, attribute, value in reversed(changed):
+            setattr(settings, attribute, value)
+
+
+def default_setting(pipette, setting):
+    # The value a freshly loaded pipette has, None for settings API 2.0 does not have
+    group, _, action = setting.partition('.')
+    if group == 'flow_rate':
+        return lw.PIPETTES[pipette][action]
+    if group == 'well_bottom_clearance':
+        return CLEARANCE
+    return None
+
+
+def setting_churn(commands):
+    # {'total', 'redundant', 'dead', 'sets': [...]}: every 'set' command, tagged 'redundant' / 'dead' / None
+    sets = []
+    pending = {}
+    for command in commands:
+        mount = command.get('mount')
+        if command['name'] == 'set':
+            entry = dict(command, waste=None)
+            if command['value'] == command['previous']:
+                entry['waste'] = 'redundant'
+            else:
+                key = (mount, command['setting'])
+                if key in pending:
+                    pending[key]['waste'] = 'dead'
+                pending.pop(key, None)
+                if command['value'] != default_setting(command['pipette'], command['setting']):
+                    pending[key] = entry
+            sets.append(entry)
+        for setting in READS.get(command['name'], ()):
+            pending.pop((mount, setting), None)
+    for entry in pending.values():
+        entry['waste'] = 'dead'
+    return {'total': len(sets), 'redundant': sum(1 for s in sets if s['waste'] == 'redundant'),
+            'dead': sum(1 for s in sets if s['waste'] == 'dead'), 'sets': sets}
+
+
+def carried_settings(commands):
+    # Settings set in one step and used by another: [{mount, setting, value, set_step, set_line, steps: [...]}]
+    current = {}
+    carried = {}
+    for command in commands:
+        mount = command.get('mount')
+        if command['name'] == 'set':
+            current[(mount, command['setting'])] = command
+            continue
+        for setting in READS.get(command['name'], ()):
+            origin = current.get((mount, setting))
+            if origin is None or origin['step'] == command['step'] or \
+                    origin['value'] == default_setting(origin['pipette'], setting):
+                continue
+            entry = carried.setdefault((origin['line'], mount, setting, origin['value']), {
+                'mount': mount, 'pipette': command['pipette'], 'setting': setting, 'value': origin['value'],
+                'set_step': origin['step'], 'set_line': origin['line'], 'steps': []})
+            if command['step'] not in entry['steps']:
+                entry['steps'].append(command['step'])
+    return [carried[key] for key in sorted(carried, key=lambda key: (key[0], key[1], key[2]))]
+
+
+def inconsistent_lines(commands):
+    # {(line, action): sorted flow rates} for lines whose aspirates / dispenses ran at more than one flow rate
+    rates = {}
+    for command in commands:
+        if command['name'] in ('aspirate', 'dispense'):
+            key = (command['line'], command['name'])
+            rates.setdefault(key, set()).add(round(command['flow_rate'] * command.get('rate', 1.0), 3))
+    return dict((key, sorted(values)) for key, values in sorted(rates.items()) if len(values) > 1)
+
+
+def safe_rate(liquid, action, pipette):
+    fractions = SAFE_RATES.get(liquid, SAFE_RATES['media'])
+    return round(fractions[action] * lw.PIPETTES[pipette]['max_volume'], 1)
+
+
+def plan_rates(commands, liquids):
+    # One entry per aspirate / dispense: {index, step, line, liquid, pipette, action, flow_rate, safe, new, kind}.
+    # kind 'default' actions run at the pipette's default rate and get the class rate, 'chosen' ones keep their rate
+    plan = []
+    for command in commands:
+        action = command['name']
+        if action not in ('aspirate', 'dispense'):
+            continue
+        liquid = settle.step_class(liquids, command['step'])
+        safe = safe_rate(liquid, action, command['pipette'])
+        flow_rate = command['flow_rate'] * command.get('rate', 1.0)
+        default = command.get('rate', 1.0) == 1.0 and command['flow_rate'] == lw.PIPETTES[command['pipette']][action]
+        plan.append({'index': command['index'], 'step': command['step'], 'line': command['line'], 'liquid': liquid,
+                     'pipette': command['pipette'], 'action': action, 'flow_rate': flow_rate, 'safe': safe,
+                     'new': safe if default else flow_rate, 'kind': 'default' if default else 'chosen'})
+    return plan
+
+
+def apply_rates(commands, plan):
+    # Copy of the trace with the planned flow rates (rate folded in)
+    new = dict((p['index'], p['new']) for p in plan if p['new'] != p['flow_rate'])
+    return [dict(c, flow_rate=new[c['index']], rate=1.0) if c['index'] in new else c for c in commands]
+
+
+def suggested_profiles(plan):
+    # {(step, pipette): {'flow_rate.aspirate': ul/s, ...}} for the actions moved to their class rate
+    profiles = {}
+    for p in plan:
+        if p['kind'] == 'default' and p['new'] != p['flow_rate']:
+            profiles.setdefault((p['step'], p['pipette']), {})['flow_rate.%s' % p['action']] = p['new']
+    return profiles
+
+
+def evaluate(name, classes_path=None, model=None):
+    protocol = sim.simulate(name)
+    liquids = settle.load_classes(name, classes_path)
+    plan = plan_rates(protocol.commands, liquids)
+    deck = protocol.deck_layout()
+    before = sum(t['total'] for t in runtime.estimate(protocol.commands, deck, model))
+    after = sum(t['total'] for t in runtime.estimate(apply_rates(protocol.commands, plan), deck, model))
+    return {'protocol': protocol, 'churn': setting_churn(protocol.commands), 'carried': carried_settings(protocol.commands),
+            'lines': inconsistent_lines(protocol.commands), 'plan': plan, 'before': before, 'after': after}
+
+
+def format_report(name, result, rates=False):
+    churn = result['churn']
+    lines = ['%s: %d setting changes, %d redundant, %d dead' % (name, churn['total'], churn['redundant'], churn['dead'])]
+    for s in churn['sets']:
+        if s['waste']:
+            lines.append('    %-9s line %-4s %s %s = %s  (%s)' % (s['waste'], s['line'], s['pipette'], s['setting'], s['value'], s['step']))
+    for c in result['carried']:
+        lines.append('    carried   line %-4s %s %s = %s set in %s, used in %s' % (
+            c['set_line'], c['pipette'], c['setting'], c['value'], c['set_step'], ', '.join(c['steps'])))
+    for (line, action), values in result['lines'].items():
+        lines.append('    mixed     line %-4s %s at %s ul/s' % (line, action, ', '.join('%g' % v for v in values)))
+    if rates:
+        plan = result['plan']
+        moved = [p for p in plan if p['new'] != p['flow_rate']]
+        above = [p for p in plan if p['kind'] == 'chosen' and p['flow_rate'] > p['safe']]
+        change = result['after'] - result['before']
+        lines.append('%s: %d actions to class rates, run %s -> %s (%s%s), %d actions with chosen rates above their class rate' % (
+            name, len(moved), runtime.format_seconds(result['before']), runtime.format_seconds(result['after']),
+            '+' if change >= 0 else '-', runtime.format_seconds(abs(change)), len(above)))
+        for (step, pipette), profile in suggested_profiles(plan).items():
+            lines.append('    %-12s %s  %s' % (pipette, profile, step))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Check liquid-class setting changes and plan safe flow rates')
+    parser.add_argument('protocols', nargs='+', help='protocol files or: %s' % ', '.join(sorted(sim.PROTOCOLS)))
+    parser.add_argument('--classes', help='JSON file with liquid class / step overrides (see settle)')
+    parser.add_argument('--rates', action='store_true', help='plan the fastest safe flow rate per liquid class')
+    args = parser.parse_args(argv)
+    for name in args.protocols:
+        print(format_report(name, evaluate(name, args.classes), args.rates))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+#Readme:
+#Mixing-pattern library for resuspending 24-well cultures before sampling (Harvest / OE-KD Step 2). Needs numpy.
+#A pattern is a list of (aspirate point, dispense point) moves in units of the well's reach, repeated, with optional
+#full volume mixes in the centre before and after (PATTERNS):
+#   edge_cross   - across the well edge to edge in x and y, both directions (the protocols' pattern)
+#   orbital      - from the centre out to 8 points around the edge in turn
+#   bottom_sweep - low across the bottom in 3 lanes, back and forth
+#   centre       - plain mix() in the centre
+#offset_table() turns a pattern into mm offsets from the well bottom for one labware. The reach is how far from the
+#centre every tip of the multichannel can go: measured for the 24-well plates (REACH, x 5.5 / y 3.75, y is shorter as
+#the 4 tips of a pseudo plate drift 1.3mm per row against the 19.3mm well pitch), well radius - TIP_CLEARANCE otherwise.
+#Resuspension is scored on a grid over the well bottom: a dispense washes the bottom within JET_RADIUS x
+#(flow rate / 300ul/s)^0.5 of its point, an aspirate within ASPIRATE_RADIUS. coverage = share of the bottom washed
+#at least --passes times, turnover = volume dispensed / culture volume. The cheapest pattern variant (repeats and
+#volume) that meets --coverage and --turnover is picked, time per well comes from runtime.py.
+#--table prints MIX_PATTERNS for a protocol (the protocols keep a copy of these offsets, they stay standalone).
+#Usage: python -m ot2_tools.mixing [--labware nunc_24_pseudo_a] [--culture 700] [--coverage 0.9] [--turnover 3] [--wells 24] [--table]
+
+import math
+from collections import OrderedDict
+
+import numpy as np
+
+from . import labware as lw
+from . import runtime
+
+# Measured in-well reach (x, y) of a p300 multi on the 24-well plates, mm from the well centre, and mixing height
+REACH = {'nunc_24_plate': (5.5, 3.75), 'nunc_24_pseudo_a': (5.5, 3.75), 'nunc_24_pseudo_b': (5.5, 3.75)}
+TIP_CLEARANCE = 2.3
+MIX_HEIGHT = 1.5
+
+JET_RADIUS = 3.0
+ASPIRATE_RADIUS = 1.5
+GRID = 0.25
+
+_ORBIT = [(round(math.cos(math.pi * k / 4), 3), round(math.sin(math.pi * k / 4), 3)) for k in range(8)]
+
+# moves in reach units, repeats, aspirate / dispense ul, aspirate / dispense rate, centre mixes before and after
+PATTERNS = OrderedDict([
+    ('edge_cross', {'moves': [((1, 0), (-1, 0)), ((0, 1), (0, -1)), ((-1, 0), (1, 0)), ((0, -1), (0, 1))],
+                    'repeats': 2, 'aspirate': 290, 'dispense': 300, 'rates': (2.0, 3.0), 'centre_mixes': 1}),
+    ('orbital', {'moves': [((0, 0), point) for point in _ORBIT], 'repeats': 1, 'aspirate': 290, 'dispense': 290,
+                 'rates': (2.0, 3.0), 'centre_mixes': 0}),
+    ('bottom_sweep', {'moves': [((-1, 0.6), (1, 0.6)), ((1, 0), (-1, 0)), ((-1, -0.6), (1, -0.6)),
+                                ((1, -0.6), (-1, -0.6)), ((-1, 0), (1, 0)), ((1, 0.6), (-1, 0.6))],
+                      'repeats': 1, 'aspirate': 250, 'dispense': 250, 'rates': (2.0, 3.0), 'centre_mixes': 0, 'height': 1.0}),
+    ('centre', {'moves': [], 'repeats': 0, 'aspirate': 300, 'dispense': 300, 'rates': (2.0, 2.0), 'centre_mixes': 4}),
+])
+
+VARIANT_REPEATS = (1, 2, 3, 4)
+VARIANT_VOLUMES = (150, 200, 250, 290)
+
+
+def reach(labware):
+    # (x, y) mm a tip can go from the well centre
+    if labware in REACH:
+        return REACH[labware]
+    spec = lw.labware_spec(labware)
+    if spec['shape'] == 'circular':
+        radius = spec['diameter'] / 2.0 - TIP_CLEARANCE
+        return radius, radius
+    return spec['size'][0] / 2.0 - TIP_CLEARANCE, spec['size'][1] / 2.0 - TIP_CLEARANCE
+
+
+def offset_table(labware, name, pattern=None):
+    # The pattern as mm offsets from the well bottom: [((x, y, z) aspirate, (x, y, z) dispense), ...] for one repeat
+    pattern = pattern or PATTERNS[name]
+    rx, ry = reach(labware)
+    z = pattern.get('height', MIX_HEIGHT)
+    return [(tuple(round(v, 2) + 0.0 for v in (a[0] * rx, a[1] * ry, z)), tuple(round(v, 2) + 0.0 for v in (d[0] * rx, d[1] * ry, z)))
+            for a, d in pattern['moves']]
+
+
+def variants(name):
+    # The named pattern with its own settings, then every repeat / volume variant of it
+    base = PATTERNS[name]
+    yield dict(base, name=name)
+    repeats = VARIANT_REPEATS if base['moves'] else (0,)
+    for count, volume in ((r, v) for r in repeats for v in VARIANT_VOLUMES):
+        mixes = base['centre_mixes'] if base['moves'] else count
+        yield dict(base, name=name, repeats=count if base['moves'] else 0, centre_mixes=mixes, aspirate=volume,
+                   dispense=volume + base['dispense'] - base['aspirate'])
+
+
+def pattern_commands(labware, pattern, pipette='p300_multi'):
+    # The commands one well of the pattern records (same fields as sim.py), the tip starts over the well centre
+    spec = lw.labware_spec(labware)
+    centre = (spec['x0'], spec['y0'])
+    location = {'slot': '1', 'labware': labware, 'well': 'A1'}
+    defaults = lw.PIPETTES[pipette]
+    commands = []
+    held = [0.0]
+
+    def add(name, point, volume, rate):
+        if name == 'dispense':
+            volume = min(volume, held[0])
+            held[0] -= volume
+        else:
+            held[0] += volume
+        commands.append({'index': len(commands), 'name': name, 'step': 'mix', 'mount': 'right', 'pipette': pipette,
+                         'location': location, 'point': [centre[0] + point[0], centre[1] + point[1], point[2]],
+                         'volume': float(volume), 'flow_rate': defaults[name], 'rate': rate})
+
+    mix_volume = max(pattern['aspirate'], pattern['dispense'])
+    middle = (0.0, 0.0, 1.0)
+
+    def centre_mix():
+        for _ in range(pattern['centre_mixes']):
+            add('aspirate', middle, mix_volume, pattern['rates'][0])
+            add('dispense', middle, mix_volume, pattern['rates'][0])
+
+    centre_mix()
+    for _ in range(pattern['repeats']):
+        for aspirate, dispense in offset_table(labware, None, pattern):
+            add('aspirate', aspirate, pattern['aspirate'], pattern['rates'][0])
+            add('dispense', dispense, pattern['dispense'], pattern['rates'][1])
+    centre_mix()
+    return commands
+
+
+def _bottom_grid(labware):
+    spec = lw.labware_spec(labware)
+    radius = spec['diameter'] / 2.0 if spec['shape'] == 'circular' else None
+    half = (radius, radius) if radius else (spec['size'][0] / 2.0, spec['size'][1] / 2.0)
+    xs, ys = np.meshgrid(np.arange(-half[0], half[0] + GRID, GRID), np.arange(-half[1], half[1] + GRID, GRID))
+    inside = np.hypot(xs, ys) <= radius if radius else np.ones_like(xs, dtype=bool)
+    return np.column_stack([xs[inside], ys[inside]])
+
+
+def score(labware, pattern, culture, passes=2, pipette='p300_multi'):
+    # {'seconds', 'coverage', 'turnover', 'max_flow'} for one well
+    commands = pattern_commands(labware, pattern, pipette)
+    spec = lw.labware_spec(labware)
+    grid = _bottom_grid(labware)
+    hits = np.zeros(len(grid))
+    for c in commands:
+        flow = c['flow_rate'] * c['rate']
+        radius = JET_RADIUS * math.sqrt(flow / 300.0) if c['name'] == 'dispense' else ASPIRATE_RADIUS
+        offset = np.array(c['point'][:2]) - (spec['x0'], spec['y0'])
+        hits += np.hypot(*(grid - offset).T) <= radius
+    timings = runtime.estimate(commands, {'1': labware})
+    dispensed = sum(c['volume'] for c in commands if c['name'] == 'dispense')
+    return {'seconds': sum(t['total'] for t in timings) - timings[0]['travel'] if timings else 0.0,
+            'coverage': float(np.mean(hits >= passes)) if len(grid) else 0.0,
+            'turnover': dispensed / float(culture),
+            'max_flow': max([c['flow_rate'] * c['rate'] for c in commands if c['name'] == 'dispense'] or [0.0]),
+            'commands': len(commands)}
+
+
+def choose(labware, culture=700.0, coverage=0.9, turnover=3.0, passes=2, max_flow=None, pipette='p300_multi'):
+    # Every named pattern with its own settings and its cheapest variant that meets the requirement. Returns
+    # (rows, best): rows = [{'pattern', 'variant', 'score', 'meets'}], best = cheapest row that meets it or None
+    rows = []
+    for name in PATTERNS:
+        cheapest = None
+        for n, pattern in enumerate(variants(name)):
+            result = score(labware, pattern, culture, passes, pipette)
+            meets = (result['coverage'] >= coverage and result['turnover'] >= turnover and
+                     (max_flow is None or result['max_flow'] <= max_flow))
+            row = {'pattern': pattern, 'score': result, 'meets': meets, 'default': n == 0}
+            if n == 0:
+                rows.append(row)
+            elif meets and (cheapest is None or result['seconds'] < cheapest['score']['seconds']):
+                cheapest = row
+        if cheapest is not None and any(cheapest['pattern'][k] != rows[-1]['pattern'][k] for k in ('repeats', 'aspirate', 'centre_mixes')):
+            rows.append(cheapest)
+    passing = [row for row in rows if row['meets']]
+    return rows, min(passing, key=lambda row: row['score']['seconds']) if passing else None
+
+
+def describe(pattern):
+    parts = []
+    if pattern['centre_mixes']:
+        parts.append('%dx centre mix' % pattern['centre_mixes'])
+    if pattern['repeats']:
+        parts.append('%dx %d moves %g/%gul' % (pattern['repeats'], len(pattern['moves']), pattern['aspirate'], pattern['dispense']))
+    return ', '.join(parts)
+
+
+def protocol_table(labware, names=None):
+    # MIX_PATTERNS source for a protocol: the offsets of each pattern for labware
+    lines = ['MIX_PATTERNS = {']
+    for name in names or [n for n in PATTERNS if PATTERNS[n]['moves']]:
+        pattern = PATTERNS[name]
+        moves = ', '.join('(%s, %s)' % (_point(a), _point(d)) for a, d in offset_table(labware, name))
+        lines.append("    '%s': {'moves': [%s], 'repeats': %d, 'aspirate': %g, 'dispense': %g, 'rates': (%r, %r), 'centre_mixes': %d}," % (
+            name, moves, pattern['repeats'], pattern['aspirate'], pattern['dispense'], float(pattern['rates'][0]), float(pattern['rates'][1]),
+            pattern['centre_mixes']))
+    lines.append('}')
+    return '\n'.join(lines)
+
+
+def _point(point):
+    return '(%s)' % ', '.join('%g' % v for v in point)
+
+
+def format_report(labware, rows, best, wells=24, requirement=''):
+    lines = ['%s: %s' % (labware, requirement)]
+    default = next(row for row in rows if row['default'] and row['pattern']['name'] == 'edge_cross')
+    for row in rows:
+        s = row['score']
+        lines.append('    %-12s %-9s %5.1fs/well %5.1f min/%d wells  coverage %3.0f%%  turnover %4.1f  max %g ul/s  %s%s' % (
+            row['pattern']['name'], 'default' if row['default'] else 'cheapest', s['seconds'], s['seconds'] * wells / 60.0,
+            wells, 100.0 * s['coverage'], s['turnover'], s['max_flow'], describe(row['pattern']), '' if row['meets'] else '  (misses)'))
+    if best is None:
+        lines.append('    no pattern meets the requirement')
+    else:
+        saved = (default['score']['seconds'] - best['score']['seconds']) * wells
+        lines.append('    cheapest: %s (%s), %s per %d wells against edge_cross' % (
+            best['pattern']['name'], describe(best['pattern']), '%s saved' % runtime.format_seconds(saved) if saved >= 0
+            else '%s more' % runtime.format_seconds(-saved), wells))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Compare mixing patterns and pick the cheapest that resuspends the well')
+    parser.add_argument('--labware', default='nunc_24_pseudo_a', help='well geometry (default nunc_24_pseudo_a)')
+    parser.add_argument('--culture', type=float, default=700.0, help='culture volume per well in ul (default 700)')
+    parser.add_argument('--coverage', type=float, default=0.9, help='share of the bottom washed --passes times (default 0.9)')
+    parser.add_argument('--passes', type=int, default=2, help='washes per bottom point (default 2)')
+    parser.add_argument('--turnover', type=float, default=3.0, help='culture volumes dispensed (default 3)')
+    parser.add_argument('--max-flow', type=float, help='highest dispense flow rate allowed, ul/s (shear)')
+    parser.add_argument('--wells', type=int, default=24, help='pattern runs to total the time over (default 24)')
+    parser.add_argument('--table', action='store_true', help='print MIX_PATTERNS offsets for a protocol')
+    args = parser.parse_args(argv)
+    if args.labware not in lw.LABWARE:
+        raise ValueError("Unknown labware '%s'" % args.labware)
+    if args.table:
+        print(protocol_table(args.labware))
+        return
+    rows, best = choose(args.labware, args.culture, args.coverage, args.turnover, args.passes, args.max_flow)
+    requirement = 'coverage >= %g%% (%d passes), turnover >= %g x %gul%s' % (
+        100 * args.coverage, args.passes, args.turnover, args.culture, ', dispense <= %g ul/s' % args.max_flow if args.max_flow else '')
+    print(format_report(args.labware, rows, best, args.wells, requirement))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#Readme:
+#Redundant motion and homing elimination on a compiled plan (plancache). Three passes, in this order:
+#   homes    - protocol.home() calls that are not followed by a pause (the gantry is parked out of the operator's way)
+#              or the end of the run are removed, a full home costs TimingModel.home (10s). --rehome-minutes keeps one
+#              home per interval if the robots need re-zeroing on long runs
+#   moves    - move_to the point the head is already at, or straight before a command that goes to the same point
+#   settings - setting changes liquids.setting_churn flags: assigned the value they already had (redundant) or replaced
+#              before any action read them (dead)
+#The pruned plan is proven equivalent by replaying it on the simulator: every action (aspirate, dispense, blow out,
+#touch tip, tips, delays, pauses, comments) has to come out with the same point, volume, flow rate and message as in
+#the original plan, and every pause keeps the home it had before it. Seconds removed per pass come from runtime.py.
+#Usage: python -m ot2_tools.motionopt valitatiter [--rehome-minutes 30] [--out plan.json] [--emit-protocol valitatiter_pruned.py]
+
+import hashlib
+import os
+
+from . import liquids
+from . import plancache
+from . import runtime
+from . import sim
+
+MOTION = ('home', 'move_to', 'set')
+EFFECT_FIELDS = ('name', 'pipette', 'location', 'point', 'volume', 'flow_rate', 'rate', 'seconds', 'message', 'tips')
+
+
+def _next_action(commands, index):
+    # Next command after index that is not a comment or setting change, None at the end of the run
+    for command in commands[index + 1:]:
+        if command['name'] not in ('comment', 'set'):
+            return command
+    return None
+
+
+def prune_homes(commands, deck, rehome_minutes=None, model=None):
+    # Indices of the homes that can go
+    removed, clock, last_home = set(), 0.0, 0.0
+    for n, (command, timing) in enumerate(zip(commands, runtime.estimate(commands, deck, model))):
+        if command['name'] == 'home' and command.get('mount') is None:
+            following = _next_action(commands, n)
+            due = rehome_minutes is not None and clock - last_home >= rehome_minutes * 60
+            if following is None or following['name'] == 'pause' or due:
+                last_home = clock
+            else:
+                removed.add(command['index'])
+        clock += timing['total']
+    return removed
+
+
+def prune_moves(commands):
+    # Indices of move_to commands that go where the head already is, or where the next command goes anyway
+    removed, head = set(), None
+    for n, command in enumerate(commands):
+        if command['name'] == 'move_to':
+            point = runtime._head_point(command)
+            following = commands[n + 1] if n + 1 < len(commands) else None
+            if point == head or (following is not None and following.get('point') is not None
+                                 and following.get('mount') == command.get('mount')
+                                 and runtime._head_point(following) == point and not command.get('force_direct')):
+                removed.add(command['index'])
+                continue
+        if command.get('point') is not None:
+            head = runtime._head_point(command)
+        elif command['name'] == 'home':
+            head = None
+    return removed
+
+
+def prune_settings(commands):
+    # Indices of the redundant / dead setting changes
+    return set(entry['index'] for entry in liquids.setting_churn(commands)['sets'] if entry['waste'])
+
+
+def pruned_plan(plan, removed):
+    commands = [dict(c, index=n, original_index=c['index'])
+                for n, c in enumerate(c for c in plan['commands'] if c['index'] not in removed)]
+    key = hashlib.sha256(('%s motionopt %s' % (plan['key'], sorted(removed))).encode()).hexdigest()
+    return dict(plan, key=key, commands=commands)
+
+
+def effects(commands):
+    # What the plan does to the deck, motion and settings left out. Pauses carry whether the gantry was homed before
+    out = []
+    for n, command in enumerate(commands):
+        if command['name'] in MOTION:
+            continue
+        entry = tuple(repr(command.get(field)) for field in EFFECT_FIELDS)
+        if command['name'] == 'pause':
+            entry += (n > 0 and commands[n - 1]['name'] == 'home',)
+        out.append(entry)
+    return out
+
+
+def prove(plan, pruned):
+    # Replays the pruned plan on the simulator. Returns the differing actions, [] when equivalent, and the replay
+    protocol = sim.SimProtocol()
+    with sim.offline_opentrons():
+        import opentrons.types as ot_types
+        plancache.replay(pruned, protocol, ot_types)
+    before, after = effects(plan['commands']), effects(protocol.commands)
+    diffs = [{'action': n, 'planned': a[0], 'replayed': b[0]} for n, (a, b) in enumerate(zip(before, after)) if a != b]
+    if len(before) != len(after):
+        diffs.append({'action': min(len(before), len(after)), 'planned': len(before), 'replayed': len(after)})
+    return diffs, protocol
+
+
+def optimise(name, rehome_minutes=None, model=None):
+    # Returns {'plan', 'pruned', 'passes': [(pass, commands removed, seconds after)], 'before', 'after', 'diffs'}
+    plan = plancache.load_plan(name)[0]
+    deck = plancache.PlanProtocol(plan).deck_layout()
+    commands = plan['commands']
+    before = sum(t['total'] for t in runtime.estimate(commands, deck, model))
+    removed, passes = set(), []
+    for label, found in (('homes', lambda cs: prune_homes(cs, deck, rehome_minutes, model)),
+                         ('moves', prune_moves), ('settings', prune_settings)):
+        remaining = [c for c in commands if c['index'] not in removed]
+        found = found(remaining)
+        removed |= found
+        seconds = sum(t['total'] for t in runtime.estimate([c for c in commands if c['index'] not in removed], deck, model))
+        passes.append((label, len(found), seconds))
+    pruned = pruned_plan(plan, removed)
+    diffs, replayed = prove(plan, pruned)
+    after = sum(t['total'] for t in runtime.estimate(replayed.commands, deck, model))
+    return {'plan': plan, 'pruned': pruned, 'passes': passes, 'before': before, 'after': after, 'diffs': diffs,
+            'homes': sum(1 for c in commands if c['name'] == 'home')}
+
+
+def format_report(name, result):
+    lines = ['%s: %d commands, %d homes, run %s' % (
+        name, len(result['plan']['commands']), result['homes'], runtime.format_seconds(result['before']))]
+    previous = result['before']
+    for label, count, seconds in result['passes']:
+        lines.append('    %-9s %3d removed  %s' % (label, count, runtime.format_seconds(seconds - previous)))
+        previous = seconds
+    lines.append('    pruned plan: %d commands, run %s (%s, %.1f%%)' % (
+        len(result['pruned']['commands']), runtime.format_seconds(result['after']),
+        runtime.format_seconds(result['after'] - result['before']),
+        100.0 * (result['after'] - result['before']) / result['before']))
+    if result['diffs']:
+        lines.append('    NOT equivalent, %d actions differ:' % len(result['diffs']))
+        for diff in result['diffs'][:10]:
+            lines.append('        %r' % diff)
+    else:
+        lines.append('    equivalent: every action replays with the same point, volume, flow rate and message')
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Remove redundant homes, moves and setting changes from compiled plans')
+    parser.add_argument('protocols', nargs='+', help='protocol files or: %s' % ', '.join(sorted(sim.PROTOCOLS)))
+    parser.add_argument('--rehome-minutes', type=float, help='keep a home when the last one is this long ago')
+    parser.add_argument('--out', help='write the pruned plan as JSON (one protocol only)')
+    parser.add_argument('--emit-protocol', help='write a standalone protocol that replays the pruned plan (one protocol only)')
+    args = parser.parse_args(argv)
+    for name in args.protocols:
+        result = optimise(name, args.rehome_minutes)
+        print(format_report(name, result))
+        if result['diffs']:
+            continue
+        if args.out:
+            plancache.save_plan(result['pruned'], os.path.abspath(args.out))
+            print('    pruned plan written to %s' % args.out)
+        if args.emit_protocol:
+            plancache.emit_protocol(result['pruned'], args.emit_protocol)
+            print('    standalone replay protocol written to %s' % args.emit_protocol)
+
+
+if __name__ == '__main__':
+    main()
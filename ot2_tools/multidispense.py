@@ -0,0 +1,255 @@
+#Readme:
+#Single-aspirate multi-dispense planner for reagent fill loops.
+#A fill loop is a run of trips with the same tip: aspirate from one source well -> dispense into one destination -> (blow out).
+#eg Harvest/OE-KD Step 1 (35ul aspirated per 30ul dispensed x12), VT_SC_Plate media and VT-buffer fills, Nucleofection Step 5.
+#The planner packs those dispenses into as few aspirates as the tip allows:
+#   aspirate = conditioning + sum(dispenses) + disposal <= min(pipette max volume, tip volume)
+#Conditioning volume is dispensed straight back into the source to wet the tip, disposal volume stays in the tip
+#and is blown out back into the source after the last dispense of the trip.
+#If no disposal volume is given, each loop keeps the overage the protocol already uses (eg 35 - 30 = 5ul).
+#The disposal volume is never below MIN_DISPOSAL of the tip volume: the last dispense of a trip is the one that runs
+#short without it. Loops where the protocol has no overage (ValitaTiter fills) are flagged, they get the minimum.
+#Loops where two dispenses do not fit one tip (Harvest Step 1, 2 x 30ul in a 50ul tip) are reported as not packable.
+#Air gaps (aspirates at the top of the source) are kept once per trip and take up tip volume.
+#Report only: no protocol runs the planned trips, copy a plan into the protocol by hand after checking it.
+#Usage: python -m ot2_tools.multidispense valitatiter [--conditioning 5] [--disposal 10]
+
+import copy
+
+from . import labware as lw
+from . import runtime
+from . import sim
+
+# Commands allowed between the aspirate and dispense of a trip without breaking a fill loop
+_PASSIVE = ('delay', 'move_to', 'set', 'comment')
+MIN_DISPOSAL = 0.05   # fraction of the tip volume always kept as disposal volume
+
+
+def min_disposal(max_volume):
+    return MIN_DISPOSAL * max_volume
+
+
+def plan_multi_dispense(volumes, max_volume, conditioning=0.0, disposal=None):
+    # volumes = dispense volume per destination, in visit order. Returns a list of trips:
+    # {'aspirate': ul, 'conditioning': ul, 'disposal': ul, 'dispenses': [destination index, ...]}
+    # disposal=None uses the minimum, MIN_DISPOSAL of max_volume
+    if disposal is None:
+        disposal = min_disposal(max_volume)
+    elif disposal < min_disposal(max_volume):
+        raise ValueError('Disposal of %gul is below the %gul minimum for a %gul tip (%g%% of the tip volume)' % (
+            disposal, min_disposal(max_volume), max_volume, MIN_DISPOSAL * 100))
+    capacity = max_volume - conditioning - disposal
+    trips = []
+    for i, volume in enumerate(volumes):
+        if volume > capacity:
+            raise ValueError('Dispense of %sul does not fit a %sul tip with %sul conditioning + %sul disposal' % (
+                volume, max_volume, conditioning, disposal))
+        if trips and trips[-1]['_load'] + volume <= capacity:
+            trips[-1]['dispenses'].append(i)
+            trips[-1]['_load'] += volume
+        else:
+            trips.append({'dispenses': [i], '_load': volume})
+    for trip in trips:
+        load = trip.pop('_load')
+        trip.update({'aspirate': conditioning + load + disposal, 'conditioning': conditioning, 'disposal': disposal})
+    return trips
+
+
+def _is_air(command):
+    # Aspirates at/above the top of the well only draw air (air gaps such as aspirate(20, well.top()))
+    location = command.get('location') or {}
+    if not location.get('labware'):
+        return False
+    spec = lw.labware_spec(location['labware'])
+    return location['offset'][2] >= spec['depth'] - 1e-6
+
+
+def _same_well(a, b):
+    return a and b and a['slot'] == b['slot'] and a['well'] == b['well']
+
+
+def _tip_capacity(commands, end, mount, pipette):
+    capacity = lw.PIPETTES[pipette]['max_volume']
+    for command in reversed(commands[:end]):
+        if command['name'] == 'pick_up_tip' and command['mount'] == mount:
+            return min(capacity, lw.labware_spec(command['location']['labware'])['volume'])
+    return capacity
+
+
+def _trips(commands):
+    # Splits the trace into single-dispense trips: [aspirates from one well] [passive] dispense [passive] [blow_out]
+    trips = []
+    i = 0
+    while i < len(commands):
+        command = commands[i]
+        if command['name'] != 'aspirate' or command['group'] is not None:
+            i += 1
+            continue
+        trip = {'start': i, 'mount': command['mount'], 'pipette': command['pipette'], 'source': None,
+                'aspirates': [], 'dispense': None, 'blow_out': None, 'after_aspirate': [], 'after_dispense': []}
+        j = i
+        while j < len(commands):
+            c = commands[j]
+            if c['group'] is not None or (c['mount'] not in (None, trip['mount'])):
+                break
+            if c['name'] == 'aspirate' and trip['dispense'] is None:
+                if trip['source'] and not _same_well(trip['source'], c['location']):
+                    break
+                trip['source'] = c['location']
+                trip['aspirates'].append(c)
+            elif c['name'] == 'dispense' and trip['dispense'] is None:
+                trip['dispense'] = c
+            elif c['name'] == 'blow_out' and trip['dispense'] is not None and trip['blow_out'] is None:
+                trip['blow_out'] = c
+            elif c['name'] in _PASSIVE and c['name'] != 'set':
+                (trip['after_dispense'] if trip['dispense'] else trip['after_aspirate']).append(c)
+            elif c['name'] != 'set':
+                break
+            j += 1
+            if trip['blow_out'] is not None:
+                break
+        trip['end'] = j
+        if trip['dispense'] is not None and not _same_well(trip['source'], trip['dispense']['location']):
+            trips.append(trip)
+        i = max(j, i + 1)
+    return trips
+
+
+def find_fill_loops(commands):
+    # Runs of 2+ back to back trips from the same source well with the same pipette and tip
+    loops = []
+    current = []
+    for trip in _trips(commands):
+        if current and (trip['start'] != current[-1]['end'] or trip['mount'] != current[-1]['mount']
+                        or not _same_well(trip['source'], current[-1]['source'])):
+            loops.append(current)
+            current = []
+        current.append(trip)
+    loops.append(current)
+    result = []
+    for trips in loops:
+        if len(trips) < 2:
+            continue
+        first = trips[0]
+        liquid = [sum(a['volume'] for a in t['aspirates'] if not _is_air(a)) for t in trips]
+        # A dispense that also pushes out an air gap only delivers the liquid that was in the tip
+        volumes = [min(t['dispense']['volume'], l) for t, l in zip(trips, liquid)]
+        overage = max(0.0, min(l - v for l, v in zip(liquid, volumes)))
+        air = sum(a['volume'] for a in first['aspirates'] if _is_air(a))
+        result.append({
+            'step': commands[first['start']]['step'], 'pipette': first['pipette'], 'mount': first['mount'],
+            'source': first['source'], 'start': first['start'], 'end': trips[-1]['end'],
+            'volumes': volumes, 'overage': overage, 'air_gap': air, 'trips': trips,
+            'max_volume': _tip_capacity(commands, first['start'], first['mount'], first['pipette'])})
+    return result
+
+
+def plan_commands(loop, plan):
+    # Command list for a planned loop, built from the recorded commands so locations and rates stay the same
+    first = loop['trips'][0]
+    air = [a for a in first['aspirates'] if _is_air(a)]
+    liquid = [a for a in first['aspirates'] if not _is_air(a)] or first['aspirates']
+    out = []
+
+    def add(template, **fields):
+        command = copy.deepcopy(template)
+        command.update(fields)
+        command['index'] = len(out)
+        out.append(command)
+
+    for trip in plan:
+        for gap in air:
+            add(gap)
+        add(liquid[-1], volume=trip['aspirate'])
+        for extra in first['after_aspirate']:
+            add(extra)
+        if trip['conditioning']:
+            add(dict(liquid[-1], name='dispense', flow_rate=first['dispense']['flow_rate']), volume=trip['conditioning'])
+        for d in trip['dispenses']:
+            last = d == trip['dispenses'][-1]
+            add(loop['trips'][d]['dispense'], volume=loop['volumes'][d] + (loop['air_gap'] if last else 0.0))
+            for extra in first['after_dispense']:
+                add(extra)
+        if first['blow_out'] is not None:
+            blow_out = copy.deepcopy(first['blow_out'])
+            if trip['disposal'] or trip['conditioning']:
+                # disposal volume goes back into the source
+                source = loop['trips'][0]['aspirates'][-1]
+                spec = lw.labware_spec(source['location']['labware'])
+                blow_out['location'] = dict(source['location'], offset=[0.0, 0.0, spec['depth']], reference='top', z=0.0)
+                blow_out['point'] = [source['point'][0], source['point'][1], spec['height']]
+            add(blow_out)
+    return out
+
+
+def plan_loops(commands, deck, conditioning=0.0, disposal=None, model=None):
+    # Plans every fill loop in a trace. disposal=None keeps each loop's own overage as its disposal volume
+    reports = []
+    for loop in find_fill_loops(commands):
+        minimum = min_disposal(loop['max_volume'])
+        if disposal is not None and disposal < minimum:
+            raise ValueError('Disposal of %gul is below the %gul minimum for a %gul tip (%g%% of the tip volume)' % (
+                disposal, minimum, loop['max_volume'], MIN_DISPOSAL * 100))
+        loop_disposal = max(loop['overage'], minimum) if disposal is None else disposal
+        warnings = []
+        if not loop['overage'] and disposal is None:
+            warnings.append('the protocol aspirates no overage for these dispenses, planned with the %gul minimum '
+                            'disposal: check the last dispense of each trip' % loop_disposal)
+        plan = plan_multi_dispense(loop['volumes'], loop['max_volume'] - loop['air_gap'], conditioning, loop_disposal)
+        if len(plan) == len(loop['trips']):
+            # Two dispenses do not fit one tip, nothing to plan
+            plan, warnings = None, []
+        original = commands[loop['start']:loop['end']]
+        before = sum(t['total'] for t in runtime.estimate(original, deck, model))
+        after = sum(t['total'] for t in runtime.estimate(plan_commands(loop, plan), deck, model)) if plan else before
+        reports.append({'step': loop['step'], 'pipette': loop['pipette'], 'source': loop['source'],
+                        'dispenses': len(loop['volumes']), 'volumes': loop['volumes'],
+                        'max_volume': loop['max_volume'], 'conditioning': conditioning, 'disposal': loop_disposal,
+                        'air_gap': loop['air_gap'], 'original_trips': len(loop['trips']),
+                        'planned_trips': len(plan) if plan else len(loop['trips']),
+                        'saved_trips': len(loop['trips']) - len(plan) if plan else 0, 'packable': plan is not None,
+                        'warnings': warnings, 'original_seconds': before, 'planned_seconds': after, 'plan': plan})
+    return reports
+
+
+def format_report(name, reports):
+    lines = ['%s: %d fill loops, %d packable, %d trough round trips saved, %s saved' % (
+        name, len(reports), sum(1 for r in reports if r['packable']), sum(r['saved_trips'] for r in reports),
+        runtime.format_seconds(sum(r['original_seconds'] - r['planned_seconds'] for r in reports)))]
+    for r in reports:
+        loop = '    %s: %s %d x %gul from %s on %s, tip %gul, disposal %gul: ' % (
+            r['step'], r['pipette'], r['dispenses'], r['volumes'][0], r['source']['well'], r['source']['slot'],
+            r['max_volume'], r['disposal'])
+        if r['packable']:
+            lines.append(loop + '%d -> %d trips (%s -> %s)' % (
+                r['original_trips'], r['planned_trips'], runtime.format_seconds(r['original_seconds']),
+                runtime.format_seconds(r['planned_seconds'])))
+        else:
+            parts = ['%gul' % v for v in r['volumes'][:2]] + ['%gul %s' % (r[k], k.replace('_', ' '))
+                                                              for k in ('conditioning', 'disposal', 'air_gap') if r[k]]
+            lines.append(loop + 'not packable, %s does not fit the tip' % ' + '.join(parts))
+        for warning in r['warnings']:
+            lines.append('        warning: %s' % warning)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Plan single-aspirate multi-dispense fills for a protocol')
+    parser.add_argument('protocols', nargs='+', help='protocol files or: %s' % ', '.join(sorted(sim.PROTOCOLS)))
+    parser.add_argument('--conditioning', type=float, default=0.0, help='ul dispensed back to the source after each aspirate')
+    parser.add_argument('--disposal', type=float, default=None,
+                        help='ul left in the tip per trip, at least %g%% of the tip volume (default: the protocol\'s own '
+                             'overage or that minimum)' % (MIN_DISPOSAL * 100))
+    args = parser.parse_args(argv)
+    for name in args.protocols:
+        protocol = sim.simulate(name)
+        try:
+            reports = plan_loops(protocol.commands, protocol.deck_layout(), args.conditioning, args.disposal)
+        except ValueError as error:
+            raise SystemExit('multidispense: %s' % error)
+        print(format_report(name, reports))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+#Readme:
+#Gantry path optimizer. Reorders independent well operations in a recorded command trace to cut deck travel.
+#An operation is one tip cycle: everything from the command after the previous tip drop up to and including the next
+#drop_tip/return_tip (settings changed just before a pick-up travel with that pick-up). Each operation keeps its own
+#commands, so explicit tip choices like tip['A' + str(i+j+1)] stay with the well they were picked for.
+#Operations are only swapped when they are independent: two operations depend on each other if one dispenses into a well
+#the other aspirates from or dispenses into (eg dilution plate filled in Step 2 before IP_slide_load mixes it).
+#Pauses, comments, homes and tiprack resets are barriers, nothing moves across an operator intervention.
+#A segment is only reordered when it saves more than min_saving seconds, so the plan does not churn for nothing.
+#Note: operations that start at a tiprack and end at the trash all cost about the same to reach, the big wins come
+#once tips are kept across wells (see tippolicy) or labware is moved (deck layout).
+#Usage: python -m ot2_tools.pathopt harvest [--show-order]
+
+from . import labware as lw
+from . import runtime
+from . import sim
+
+BARRIERS = ('pause', 'comment', 'home', 'reset_tipracks')
+TIP_ENDS = ('drop_tip', 'return_tip')
+
+
+def _well(command):
+    location = command.get('location')
+    if not location or not location.get('well'):
+        return None
+    return location['slot'], location['well']
+
+
+def _operation(commands):
+    reads, writes = set(), set()
+    for c in commands:
+        well = _well(c)
+        if well is None:
+            continue
+        if c['name'] == 'aspirate':
+            reads.add(well)
+        elif c['name'] in ('dispense', 'pick_up_tip', 'return_tip'):
+            writes.add(well)
+    positioned = [c for c in commands if c.get('point') is not None]
+    return {'commands': commands, 'reads': reads, 'writes': writes, 'step': commands[0]['step'],
+            'first': positioned[0] if positioned else None, 'last': positioned[-1] if positioned else None}
+
+
+def split_operations(commands):
+    # [{'barrier': command}] or [{'ops': [operation, ...]}] in trace order
+    segments = []
+    ops = []
+    pending = []
+    for command in commands:
+        if command['name'] in BARRIERS:
+            if pending:
+                ops.append(_operation(pending))
+                pending = []
+            if ops:
+                segments.append({'ops': ops})
+                ops = []
+            segments.append({'barrier': command})
+            continue
+        pending.append(command)
+        if command['name'] in TIP_ENDS:
+            ops.append(_operation(pending))
+            pending = []
+    if pending:
+        ops.append(_operation(pending))
+    if ops:
+        segments.append({'ops': ops})
+    return segments
+
+
+def depends(a, b):
+    return bool(a['writes'] & (b['reads'] | b['writes']) or b['writes'] & a['reads'])
+
+
+def _transition(previous, op, deck, model):
+    if op['first'] is None:
+        return 0.0
+    start = runtime._head_point(previous) if previous is not None else None
+    return runtime.travel_time(start, runtime._head_point(op['first']), previous['location'] if previous else None,
+                               op['first']['location'], deck, model)
+
+
+def _cost(order, start, deck, model):
+    total = 0.0
+    previous = start
+    for op in order:
+        total += _transition(previous, op, deck, model)
+        if op['last'] is not None:
+            previous = op['last']
+    return total
+
+
+def _predecessors(ops):
+    # predecessors[i] = operations that must stay before operation i
+    return [set(j for j in range(i) if depends(ops[j], ops[i])) for i in range(len(ops))]
+
+
+def _greedy(ops, before, start, deck, model):
+    done, order = set(), []
+    previous = start
+    while len(order) < len(ops):
+        ready = [i for i in range(len(ops)) if i not in done and before[i] <= done]
+        best = min(ready, key=lambda i: (_transition(previous, ops[i], deck, model), i))
+        done.add(best)
+        order.append(best)
+        if ops[best]['last'] is not None:
+            previous = ops[best]['last']
+    return order
+
+
+def _improve(order, ops, before, start, deck, model):
+    # Adjacent swaps while they cut travel and keep every dependency in order
+    cost = _cost([ops[i] for i in order], start, deck, model)
+    improved = True
+    while improved:
+        improved = False
+        for k in range(len(order) - 1):
+            a, b = order[k], order[k + 1]
+            if a in before[b]:
+                continue
+            trial = order[:k] + [b, a] + order[k + 2:]
+            trial_cost = _cost([ops[i] for i in trial], start, deck, model)
+            if trial_cost < cost - 1e-9:
+                order, cost, improved = trial, trial_cost, True
+    return order
+
+
+def order_operations(ops, start, deck, model=None, min_saving=0.5):
+    # Lowest-travel order of one barrier-free segment, as indexes into ops
+    model = model or runtime.TimingModel()
+    before = _predecessors(ops)
+    original = list(range(len(ops)))
+    candidates = [original, _greedy(ops, before, start, deck, model)]
+    candidates = [_improve(order, ops, before, start, deck, model) for order in candidates]
+    best = min(candidates, key=lambda order: (_cost([ops[i] for i in order], start, deck, model), order))
+    saving = _cost([ops[i] for i in original], start, deck, model) - _cost([ops[i] for i in best], start, deck, model)
+    return best if saving > min_saving else original
+
+
+def optimise(commands, deck, model=None, min_saving=0.5):
+    # Returns the reordered plan and how much travel it saves
+    model = model or runtime.TimingModel()
+    deck = dict(deck)
+    deck.setdefault(lw.TRASH_SLOT, lw.TRASH_LABWARE)
+    plan = []
+    moved = 0
+    previous = None
+    for segment in split_operations(commands):
+        if 'barrier' in segment:
+            plan.append(segment['barrier'])
+            if segment['barrier']['name'] == 'home':
+                previous = None
+            continue
+        ops = segment['ops']
+        order = order_operations(ops, previous, deck, model, min_saving)
+        moved += sum(1 for position, i in enumerate(order) if position != i)
+        for i in order:
+            plan.extend(ops[i]['commands'])
+            if ops[i]['last'] is not None:
+                previous = ops[i]['last']
+    plan = [dict(c, index=n, original_index=c['index']) for n, c in enumerate(plan)]
+    before = sum(t['travel'] for t in runtime.estimate(commands, deck, model))
+    after = sum(t['travel'] for t in runtime.estimate(plan, deck, model))
+    return {'commands': plan, 'travel_before': before, 'travel_after': after, 'moved': moved}
+
+
+def format_report(name, result, show_order=False):
+    lines = ['%s: travel %s -> %s (%s saved), %d operations moved' % (
+        name, runtime.format_seconds(result['travel_before']), runtime.format_seconds(result['travel_after']),
+        runtime.format_seconds(result['travel_before'] - result['travel_after']), result['moved'])]
+    if show_order:
+        step = None
+        for c in result['commands']:
+            if c['name'] != 'pick_up_tip':
+                continue
+            if c['step'] != step:
+                step = c['step']
+                lines.append('  #%s' % step)
+            lines.append('    op at command %d' % c['original_index'])
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Reorder independent well operations to cut gantry travel')
+    parser.add_argument('protocols', nargs='+', help='protocol files or: %s' % ', '.join(sorted(sim.PROTOCOLS)))
+    parser.add_argument('--show-order', action='store_true', help='list the new operation order')
+    args = parser.parse_args(argv)
+    for name in args.protocols:
+        protocol = sim.simulate(name)
+        print(format_report(name, optimise(protocol.commands, protocol.deck_layout()), args.show_order))
+
+
+if __name__ == '__main__':
+    main()
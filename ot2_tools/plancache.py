@@ -0,0 +1,268 @@
+#Readme:
+#Compiled protocol cache. A protocol's run() is executed once against the recording simulator and frozen into a flat
+#command plan: deck, pipettes, then every command with its resolved location (deck point + offset from the well bottom),
+#volume, flow rate, delay and pause message. The plan is stored as JSON in .plan_cache/ keyed on a hash of the protocol
+#source, the overrides, the labware/pipette definitions and the simulator itself, so it is rebuilt only when one changes.
+#   plancache.simulate(name)      drop-in for sim.simulate, replays the cached plan (no run(), no well lookups)
+#   replay(plan, protocol, types) issues the plan through the opentrons API, on the robot or on a sim.SimProtocol
+#Points are replayed from the well point the protocol addressed, top(z), bottom(z) or center(), of the robot's own
+#labware, so its definitions and calibration still apply to top referenced moves too (blow outs and air gaps at the top,
+#trough.top(-20)); the deck points and bottom offsets are the simulator's geometry and only used offline.
+#Usage: python -m ot2_tools.plancache sampling [--verify] [--emit-protocol sampling_plan.py]
+
+import hashlib
+import inspect
+import json
+import os
+import time
+
+from . import geometry
+from . import labware as lw
+from . import sim
+
+PLAN_VERSION = 2
+CACHE_DIR = os.path.join(sim.REPO_DIR, '.plan_cache')
+SIM_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sim.py')
+
+
+class PlanProtocol(object):
+    # What sim.simulate returns, rebuilt from a plan: commands and the deck
+    def __init__(self, plan):
+        self.path = plan['path']
+        self.plan = plan
+        self.commands = plan['commands']
+
+    def deck_layout(self):
+        return dict((slot, entry['load_name']) for slot, entry in self.plan['labware'].items())
+
+
+def plan_key(path, overrides=None):
+    # Hash of everything the compiled commands depend on
+    digest = hashlib.sha256()
+    digest.update(('plan %d\n' % PLAN_VERSION).encode())
+    for source in (path, SIM_SOURCE):
+        with open(source, 'rb') as f:
+            digest.update(f.read())
+    digest.update(geometry.index_key().encode())
+    definitions = {'labware': lw.LABWARE, 'pipettes': lw.PIPETTES, 'slots': lw.DECK_SLOTS, 'trash': lw.TRASH_SLOT}
+    digest.update(json.dumps(definitions, sort_keys=True).encode())
+    digest.update(json.dumps(overrides or {}, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def cache_path(path, overrides=None, cache_dir=CACHE_DIR):
+    # One file per protocol and override set, the key inside says whether it is still current
+    name = os.path.splitext(os.path.basename(path))[0]
+    if overrides:
+        name += '.' + hashlib.sha256(json.dumps(overrides, sort_keys=True).encode()).hexdigest()[:10]
+    return os.path.join(cache_dir, name + '.plan.json')
+
+
+def compile_protocol(path, overrides=None):
+    # Runs the protocol once and returns the flat plan
+    path = sim.protocol_path(path)
+    namespace = sim.load_protocol(path)
+    protocol = sim.simulate(path, overrides)
+    commands = []
+    for command in protocol.commands:
+        command = dict(command)
+        if command['name'] == 'touch_tip':
+            # replayed as touch_tip(well, v_offset=...), which is measured from the well top
+            well = protocol.labware[command['location']['slot']][command['location']['well']]
+            command['v_offset'] = round(command['point'][2] - well.top().point.z, 3)
+        commands.append(command)
+    return {'version': PLAN_VERSION, 'key': plan_key(path, overrides), 'path': path,
+            'overrides': overrides or {}, 'metadata': namespace.get('metadata', {}),
+            'labware': dict((slot, {'load_name': labware.load_name, 'label': labware.label})
+                            for slot, labware in protocol.labware.items()),
+            'instruments': dict((mount, {'name': pipette.name, 'tip_racks': [rack.slot for rack in pipette.tip_racks]})
+                                for mount, pipette in protocol.instruments.items()),
+            'commands': commands}
+
+
+def save_plan(plan, path):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    # Written aside and moved into place, shard workers may compile the same protocol at the same time
+    partial = '%s.%d.tmp' % (path, os.getpid())
+    with open(partial, 'w') as f:
+        json.dump(plan, f, separators=(',', ':'))
+    os.replace(partial, path)
+
+
+def read_plan(path):
+    with open(path) as f:
+        plan = json.load(f)
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError('%s is plan version %s, expected %s' % (path, plan.get('version'), PLAN_VERSION))
+    return plan
+
+
+def load_plan(path, overrides=None, cache_dir=CACHE_DIR):
+    # Cached plan if its key still matches, else compiles and stores a new one. Returns (plan, compiled)
+    path = sim.protocol_path(path)
+    key = plan_key(path, overrides)
+    cached = cache_path(path, overrides, cache_dir)
+    if os.path.exists(cached):
+        try:
+            plan = read_plan(cached)
+        except ValueError:
+            plan = None
+        if plan is not None and plan['key'] == key:
+            return plan, False
+    plan = compile_protocol(path, overrides)
+    save_plan(plan, cached)
+    return plan, True
+
+
+def simulate(path, overrides=None, cache_dir=CACHE_DIR):
+    # sim.simulate through the cache
+    return PlanProtocol(load_plan(path, overrides, cache_dir)[0])
+
+
+def replay(plan, protocol, types, after=None):
+    # Issues a plan through the opentrons API 2.0. types = opentrons.types. Self contained so it can be copied
+    # into a standalone protocol file (emit_protocol). after(command) is called once each command is done
+    labware = {}
+    for slot, entry in sorted(plan['labware'].items(), key=lambda item: int(item[0])):
+        labware[slot] = protocol.load_labware(entry['load_name'], slot, entry['label'])
+    pipettes = {}
+    for mount, entry in sorted(plan['instruments'].items()):
+        pipettes[mount] = protocol.load_instrument(entry['name'], mount, tip_racks=[labware[s] for s in entry['tip_racks']])
+
+    def well(command):
+        location = command['location']
+        if location['slot'] not in labware:
+            return None
+        return labware[location['slot']][location['well']]
+
+    def place(command):
+        # The point from the well's top(z) / bottom(z) / center() as the protocol addressed it, x/y moves kept
+        target = well(command)
+        if target is None:
+            return None
+        location = command['location']
+        x, y = location['offset'][0], location['offset'][1]
+        if location['reference'] == 'center':
+            return target.center().move(types.Point(x, y, location['z']))
+        point = getattr(target, location['reference'])(location['z'])
+        return point.move(types.Point(x, y, 0)) if x or y else point
+
+    for command in plan['commands']:
+        name = command['name']
+        pipette = pipettes.get(command['mount'])
+        if name == 'set':
+            group, _, setting = command['setting'].rpartition('.')
+            setattr(getattr(pipette, group) if group else pipette, setting, command['value'])
+        elif name == 'aspirate':
+            pipette.aspirate(command['volume'], place(command), rate=command['rate'])
+        elif name == 'dispense':
+            pipette.dispense(command['volume'], place(command), rate=command['rate'])
+        elif name == 'blow_out':
+            pipette.blow_out(place(command))
+        elif name == 'touch_tip':
+            pipette.touch_tip(well(command), v_offset=command['v_offset'], speed=command['speed'])
+        elif name == 'move_to':
+            pipette.move_to(place(command), force_direct=command['force_direct'])
+        elif name == 'pick_up_tip':
+            pipette.pick_up_tip(well(command))
+        elif name == 'drop_tip':
+            target = well(command)
+            if target is None:
+                pipette.drop_tip()
+            else:
+                pipette.drop_tip(target)
+        elif name == 'return_tip':
+            pipette.return_tip()
+        elif name == 'reset_tipracks':
+            pipette.reset_tipracks()
+        elif name == 'home':
+            if pipette is None:
+                protocol.home()
+            else:
+                pipette.home()
+        elif name == 'delay':
+            protocol.delay(seconds=command['seconds'], msg=command['message'])
+        elif name == 'pause':
+            protocol.pause(command['message'])
+        elif name == 'comment':
+            protocol.comment(command['message'])
+        else:
+            raise ValueError('Cannot replay command %r' % name)
+        if after is not None:
+            after(command)
+
+
+def verify(plan):
+    # Replays the plan on a fresh SimProtocol and returns the commands that differ from the plan
+    protocol = sim.SimProtocol()
+    with sim.offline_opentrons():
+        import opentrons.types as ot_types
+        replay(plan, protocol, ot_types)
+    fields = ('name', 'pipette', 'location', 'point', 'volume', 'flow_rate', 'rate', 'seconds', 'message', 'setting', 'value', 'tips')
+    replayed = protocol.commands
+    if len(replayed) != len(plan['commands']):
+        return [{'index': min(len(replayed), len(plan['commands'])), 'planned': len(plan['commands']), 'replayed': len(replayed)}]
+    return [{'index': a['index'], 'planned': sim.describe(a), 'replayed': sim.describe(b)}
+            for a, b in zip(plan['commands'], replayed) if any(a.get(f) != b.get(f) for f in fields)]
+
+
+def emit_protocol(plan, path):
+    # Standalone OT2 protocol that replays the plan: metadata, the plan as JSON and replay()
+    metadata = dict(plan['metadata'])
+    metadata['protocolName'] = '%s (compiled plan)' % metadata.get('protocolName', os.path.basename(plan['path']))
+    plan = dict(plan, commands=[dict((k, v) for k, v in c.items() if k not in ('point', 'line', 'group', 'index')) for c in plan['commands']])
+    lines = ['#Readme:',
+             '#Compiled plan of %s, generated by ot2_tools.plancache. Do not edit, recompile the source protocol.' % os.path.basename(plan['path']),
+             '#Plan key %s' % plan['key'],
+             '',
+             'import json',
+             '',
+             'from opentrons import protocol_api',
+             'from opentrons import types',
+             '',
+             'metadata = %r' % metadata,
+             '',
+             'PLAN = json.loads(%r)' % json.dumps(plan, separators=(',', ':')),
+             '',
+             '',
+             inspect.getsource(replay),
+             '',
+             'def run(protocol: protocol_api.ProtocolContext):',
+             '    replay(PLAN, protocol, types)',
+             '']
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Compile protocols into cached command plans')
+    parser.add_argument('protocols', nargs='+', help='protocol files or: %s' % ', '.join(sorted(sim.PROTOCOLS)))
+    parser.add_argument('--verify', action='store_true', help='replay each plan on the simulator and compare')
+    parser.add_argument('--emit-protocol', help='write a standalone protocol that replays the plan (one protocol only)')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    args = parser.parse_args(argv)
+    for name in args.protocols:
+        start = time.time()
+        sim.simulate(name)
+        run_seconds = time.time() - start
+        plan, compiled = load_plan(name, cache_dir=args.cache_dir)
+        start = time.time()
+        simulate(name, cache_dir=args.cache_dir)
+        replay_seconds = time.time() - start
+        print('%s: %d commands, %s plan %s, run() %.0fms, cached replay %.0fms' % (
+            name, len(plan['commands']), 'compiled' if compiled else 'cached', plan['key'][:12],
+            run_seconds * 1000, replay_seconds * 1000))
+        if args.verify:
+            diffs = verify(plan)
+            print('    replay check: %s' % ('identical' if not diffs else '%d commands differ' % len(diffs)))
+            for diff in diffs[:10]:
+                print('        %r' % diff)
+        if args.emit_protocol:
+            emit_protocol(plan, args.emit_protocol)
+            print('    standalone replay protocol written to %s' % args.emit_protocol)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+#Readme:
+#Run-time model for recorded OT2 commands (see sim.py). Predicts wall-clock seconds per command and per protocol step.
+#Liquid handling = volume / (flow_rate x rate). Gantry travel = arc up to a safe height, straight xy move, down again.
+#Constants are OT2 GEN1 defaults, override any of them with TimingModel(home=12.0, ...) once measured on our robots.
+#pause() is operator time, not robot time: counted separately, the robot sits idle until someone clicks resume.
+#Usage: python -m ot2_tools.runtime harvest      (or a path to any protocol file)
+
+import math
+from collections import OrderedDict
+
+from . import labware as lw
+from . import sim
+
+
+class TimingModel(object):
+    xy_speed = 400.0        # mm/s gantry
+    z_speed = 125.0         # mm/s mount
+    move_overhead = 0.15    # s acceleration/settling per move
+    arc_clearance = 10.0    # mm above the tallest labware for moves between labware
+    well_clearance = 1.0    # mm above the labware for moves between wells of the same labware
+    pick_up_tip = 3.0       # s, 3 presses for GEN1 multichannels
+    drop_tip = 2.5          # s, plunger drop + retract
+    blow_out = 1.0          # s
+    touch_tip = 1.5         # s, 4 sides
+    plunger_reset = 0.5     # s to bring the plunger back to bottom after a blow out, before the next aspirate
+    home = 10.0             # s full home, all axes
+    setting = 0.0           # s, flow rate/clearance changes are software only
+
+    def __init__(self, **overrides):
+        for name, value in overrides.items():
+            if not hasattr(TimingModel, name):
+                raise AttributeError("TimingModel has no constant '%s'" % name)
+            setattr(self, name, value)
+
+
+def _head_point(command):
+    # Right-mount head position for a command point, so moves with either pipette compare on the same gantry
+    offset = lw.MOUNT_OFFSETS.get(command.get('mount') or 'right', (0.0, 0.0, 0.0))
+    x, y, z = command['point']
+    return x - offset[0], y - offset[1], z
+
+
+def travel_time(start, end, start_location, end_location, deck, model):
+    # start/end = (x, y, z) head positions. Direct move inside a well, arc otherwise
+    if start is None:
+        start = lw.HOME_POINT
+        start_location = None
+    xy = math.hypot(end[0] - start[0], end[1] - start[1])
+    same_well = (start_location and end_location and start_location['slot'] == end_location['slot']
+                 and start_location['well'] == end_location['well'])
+    if same_well:
+        dz = abs(end[2] - start[2])
+        if xy == 0 and dz == 0:
+            return 0.0
+        return model.move_overhead + max(xy / model.xy_speed, dz / model.z_speed)
+    if start_location and end_location and start_location['slot'] == end_location['slot']:
+        safe = lw.labware_spec(end_location['labware'])['height'] + model.well_clearance
+    else:
+        safe = max(lw.labware_spec(name)['height'] for name in deck.values()) + model.arc_clearance
+    safe = max(safe, start[2], end[2])
+    return model.move_overhead + (safe - start[2]) / model.z_speed + xy / model.xy_speed + (safe - end[2]) / model.z_speed
+
+
+def action_time(command, model):
+    name = command['name']
+    if name in ('aspirate', 'dispense'):
+        return command['volume'] / (command['flow_rate'] * command.get('rate', 1.0))
+    if name == 'blow_out':
+        return model.blow_out
+    if name == 'pick_up_tip':
+        return model.pick_up_tip
+    if name in ('drop_tip', 'return_tip'):
+        return model.drop_tip
+    if name == 'touch_tip':
+        return model.touch_tip
+    if name == 'home':
+        return model.home
+    if name == 'delay':
+        return command['seconds']
+    if name == 'set':
+        return model.setting
+    return 0.0
+
+
+def estimate(commands, deck, model=None):
+    # Returns one timing dict per command: travel, action and total seconds
+    model = model or TimingModel()
+    deck = dict(deck)
+    deck.setdefault(lw.TRASH_SLOT, lw.TRASH_LABWARE)
+    timings = []
+    head = None
+    head_location = None
+    blown_out = set()
+    for command in commands:
+        travel = 0.0
+        action = action_time(command, model)
+        if command['name'] == 'aspirate' and command['mount'] in blown_out:
+            action += model.plunger_reset
+            blown_out.discard(command['mount'])
+        elif command['name'] == 'blow_out':
+            blown_out.add(command['mount'])
+        elif command['name'] in ('pick_up_tip', 'drop_tip', 'return_tip'):
+            blown_out.discard(command['mount'])
+        if command.get('point') is not None:
+            end = _head_point(command)
+            travel = travel_time(head, end, head_location, command['location'], deck, model)
+            head, head_location = end, command['location']
+        elif command['name'] == 'home':
+            head, head_location = None, None
+        timings.append({'index': command['index'], 'step': command['step'], 'name': command['name'],
+                        'travel': travel, 'action': action, 'total': travel + action})
+    return timings
+
+
+def step_summary(timings):
+    # Seconds per step, in the order the steps first run
+    steps = OrderedDict()
+    for t in timings:
+        steps[t['step']] = steps.get(t['step'], 0.0) + t['total']
+    return steps
+
+
+def estimate_protocol(path, model=None):
+    # Simulates a protocol and returns (protocol, timings)
+    protocol = sim.simulate(path)
+    return protocol, estimate(protocol.commands, protocol.deck_layout(), model)
+
+
+def summarise(protocol, timings):
+    return {
+        'total': round(sum(t['total'] for t in timings), 1),
+        'travel': round(sum(t['travel'] for t in timings), 1),
+        'commands': len(protocol.commands),
+        'pauses': sum(1 for c in protocol.commands if c['name'] == 'pause'),
+        'tips': sum(1 for c in protocol.commands if c['name'] == 'pick_up_tip'),
+        'steps': OrderedDict((step, round(seconds, 1)) for step, seconds in step_summary(timings).items()),
+    }
+
+
+def format_seconds(seconds):
+    sign = '-' if seconds < 0 else ''
+    seconds = abs(int(round(seconds)))
+    return '%s%d:%02d:%02d' % (sign, seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def format_report(name, summary):
+    lines = ['%s: %s predicted (%s travel), %d commands, %d tips, %d operator pauses' % (
+        name, format_seconds(summary['total']), format_seconds(summary['travel']),
+        summary['commands'], summary['tips'], summary['pauses'])]
+    for step, seconds in summary['steps'].items():
+        lines.append('    %s  %s' % (format_seconds(seconds), step))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Predict OT2 run time per protocol step')
+    parser.add_argument('protocols', nargs='+', help='protocol files or: %s' % ', '.join(sorted(sim.PROTOCOLS)))
+    args = parser.parse_args(argv)
+    for name in args.protocols:
+        protocol, timings = estimate_protocol(name)
+        print(format_report(name, summarise(protocol, timings)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+#Readme:
+#Sample-age scheduler for the Iprasense sampling protocols (Harvest, OE-KD). A column's sample age is the time from
+#mixing its first 24-well culture (Step 2) to loading the diluted column onto the iprasense_48_slide. As written, all
+#cultures are sampled before IP_slide_load(0) starts, so the first columns wait for the whole of Step 2.
+#The trace is cut into tip cycles (units) and the operator tasks of interventions.py are kept (slide in / swap / out,
+#tip rack reloads, plates off the deck), so the order still respects every well and resource dependency (pathopt, but
+#units that only add to the same well, the pooled western blot wells, commute). The slide
+#loads are then interleaved with the sampling: the cultures of the current slide's columns are sampled in column
+#order and a column is loaded once --lead columns are waiting (1 = load each column as soon as it is sampled,
+#6 = sample the whole slide first). The next slide is swapped in as soon as the last column of the current one is on.
+#Every lead is timed (runtime.py, operator latency and task minutes at each stop) against two limits:
+#   --max-age-minutes      oldest sample per column, mixing to slide
+#   --slide-window-minutes a loaded slide has to be on the Iprasense within this time of its first well (README: ~15 min),
+#                          the operator takes it at the first stop after its last column (+ --latency-minutes)
+#The lead with the youngest samples that keeps every slide in its window is picked. If no order meets both, the
+#report warns before the run with the columns / slides that miss. --emit-protocol writes the interleaved plan as a
+#standalone replay protocol (plancache).
+#Usage: python -m ot2_tools.sampleage harvest [--max-age-minutes 10] [--slide-window-minutes 15] [--emit-protocol harvest_interleaved.py]
+
+import hashlib
+
+from . import interventions
+from . import pathopt
+from . import plancache
+from . import runtime
+
+# slide: slot of the Iprasense slide, dilution: dilution plate slot, cultures: 24-well plate slots
+SAMPLING = {
+    'harvest': {'slide': '3', 'dilution': '6', 'cultures': ('1', '2', '4', '5')},
+    'sampling': {'slide': '3', 'dilution': '6', 'cultures': ('1', '2', '4', '5')},
+}
+MAX_AGE_MINUTES = 10.0
+SLIDE_WINDOW_MINUTES = 15.0
+
+
+def split_units(commands):
+    # interventions.split_trace with every unit cut into tip cycles. Returns (units, stops)
+    steps, stops = interventions.split_trace(commands)
+    units = []
+    for step in steps:
+        cycles, pending = [], []
+        for command in step['commands']:
+            pending.append(command)
+            if command['name'] in pathopt.TIP_ENDS:
+                cycles.append(pending)
+                pending = []
+        if pending:
+            if cycles and not any(c['name'] in ('aspirate', 'pick_up_tip') for c in pending):
+                cycles[-1].extend(pending)
+            else:
+                cycles.append(pending)
+        for cycle in cycles:
+            unit = {'step': step['step'], 'stop': step['stop'], 'commands': cycle, 'number': len(units)}
+            unit.update(pathopt._operation(cycle))
+            unit['slots'] = set(c['location']['slot'] for c in cycle if (c.get('location') or {}).get('slot'))
+            unit['wells'] = set(w for w in (pathopt._well(c) for c in cycle) if w)
+            # wells the unit only dispenses into (pooled samples), adds into the same well commute
+            unit['adds'] = set(pathopt._well(c) for c in cycle if c['name'] == 'dispense') - unit['reads'] - set(
+                pathopt._well(c) for c in cycle if c['name'] in ('pick_up_tip', 'return_tip'))
+            units.append(unit)
+    return units, stops
+
+
+def depends(a, b):
+    # pathopt.depends, except two units that only add liquid to the same well can go in either order
+    return bool(a['writes'] & b['reads'] or b['writes'] & a['reads'] or (a['writes'] & b['writes']) - (a['adds'] & b['adds']))
+
+
+def classify(units, spec):
+    # {'loads': {unit: (slide, rank, column)}, 'samples': {column: [units]}, 'ancestors': {unit: set}}
+    slides = sorted(set(u['stop'] for u in units if any(w[0] == spec['slide'] for w in u['writes'])))
+    loads = {}
+    for u in units:
+        if any(w[0] == spec['slide'] for w in u['writes']):
+            column = sorted(w for w in u['reads'] if w[0] == spec['dilution'])[0]
+            loads[u['number']] = (slides.index(u['stop']), len(loads), column)
+    samples = {}
+    for u in units:
+        if any(w[0] in spec['cultures'] for w in u['reads']):
+            for well in u['writes']:
+                if well[0] == spec['dilution']:
+                    samples.setdefault(well, []).append(u['number'])
+    ancestors = {}
+    for u in units:
+        ancestors[u['number']] = set()
+        for j in range(u['number']):
+            if depends(units[j], u):
+                ancestors[u['number']] |= ancestors[j] | {j}
+    return {'loads': loads, 'samples': samples, 'ancestors': ancestors, 'slides': len(slides)}
+
+
+def make_order(units, info, lead):
+    # order(runnable, done) for interventions.schedule: current slide's work first, loads once lead columns wait
+    loads, ancestors = info['loads'], info['ancestors']
+    # first slide / rank each unit is needed for
+    needed = {}
+    for load, (slide, rank, _) in loads.items():
+        for u in ancestors[load]:
+            needed[u] = min(needed.get(u, (slide, rank)), (slide, rank))
+
+    def order(runnable, done):
+        open_slides = sorted(set(slide for u, (slide, _, _) in loads.items() if u not in done))
+        if not open_slides:
+            return runnable
+        slide = open_slides[0]
+        ranking = []
+        if slide and not any(u in done for u, entry in loads.items() if entry[0] == slide):
+            ranking.append(None)
+        waiting = sorted((u for u in runnable if u in loads and loads[u][0] == slide), key=lambda u: loads[u][1])
+        feeding = sorted((u for u in runnable if u not in loads and u in needed and needed[u][0] == slide),
+                         key=lambda u: (needed[u], u))
+        pending = [u for u, (s, _, _) in loads.items() if s == slide and u not in done and u not in runnable]
+        if len(waiting) >= lead or not pending:
+            ranking += waiting + feeding
+        else:
+            ranking += feeding + waiting
+        ranking.append(None)
+        rest = [u for u in runnable if u not in ranking]
+        return ranking + sorted(rest, key=lambda u: (needed.get(u, (info['slides'], 0)), u))
+    return order
+
+
+def timeline(commands, idle, deck, model=None):
+    # Start seconds per command position, pauses add the operator idle time of their stop
+    times, clock, stop = [], 0.0, 0
+    for command, timing in zip(commands, runtime.estimate(commands, deck, model)):
+        times.append(clock)
+        clock += timing['total']
+        if command['name'] == 'pause':
+            stop += 1
+            clock += idle[stop]
+    return times, clock
+
+
+def evaluate(name, units, tasks, stops, info, phases, after_run, deck, latency_minutes, model=None):
+    commands = [dict(c, mount=c.get('mount')) for c in interventions.build_commands(phases, units, tasks, stops)]
+    timings = dict((c['index'], t['total']) for c, t in zip(
+        (c for u in units for c in u['commands']), runtime.estimate([c for u in units for c in u['commands']], deck, model)))
+    seconds = dict((u['number'], sum(timings[c['index']] for c in u['commands'])) for u in units)
+    idle = interventions.idle_time(phases, units, tasks, seconds, latency_minutes)
+    times, end = timeline(commands, idle, deck, model)
+    at = dict((c['original_index'], t) for c, t in zip(commands, times) if c.get('original_index') is not None)
+    pauses = [t for c, t in zip(commands, times) if c['name'] == 'pause']
+    columns, slides = [], []
+    for load, (slide, rank, column) in sorted(info['loads'].items(), key=lambda item: item[1][1]):
+        start = min(at[units[u]['commands'][0]['index']] for u in info['samples'].get(column, [load]))
+        loaded = min(at[c['index']] for c in units[load]['commands'] if c['name'] == 'dispense')
+        columns.append({'slide': slide, 'column': column, 'age': loaded - start, 'loaded': loaded})
+    for slide in range(info['slides']):
+        # the operator takes a slide to the Iprasense at the first stop after its last column
+        mine = [c for c in columns if c['slide'] == slide]
+        first, last = min(c['loaded'] for c in mine), max(c['loaded'] for c in mine)
+        out = min([t for t in pauses if t > last] or [end]) + latency_minutes * 60.0
+        slides.append({'slide': slide, 'first': first, 'out': out, 'open': out - first})
+    return {'phases': phases, 'after_run': after_run, 'commands': commands, 'columns': columns, 'slides': slides,
+            'stops': len(phases) - 1, 'end': end, 'max_age': max(c['age'] for c in columns),
+            'max_open': max(s['open'] for s in slides)}
+
+
+def plan_schedule(name, max_age_minutes=MAX_AGE_MINUTES, window_minutes=SLIDE_WINDOW_MINUTES, latency_minutes=5.0,
+                  model=None):
+    # Returns {'original', 'candidates': {lead: result}, 'best', 'lead', 'feasible', 'plan'}
+    if name not in SAMPLING:
+        raise ValueError("No sampling layout for '%s', known: %s" % (name, ', '.join(sorted(SAMPLING))))
+    spec = SAMPLING[name]
+    plan = plancache.load_plan(name)[0]
+    deck = plancache.PlanProtocol(plan).deck_layout()
+    units, stops = split_units(plan['commands'])
+    tasks = interventions.build_tasks(name, units, stops)
+    info = classify(units, spec)
+    run = lambda phases, after_run: evaluate(name, units, tasks, stops, info, phases, after_run, deck, latency_minutes, model)
+    original = run(*interventions.original_phases(units, tasks, stops))
+    per_slide = max(sum(1 for entry in info['loads'].values() if entry[0] == s) for s in range(info['slides']))
+    candidates = {}
+    for lead in range(1, per_slide + 1):
+        candidates[lead] = run(*interventions.schedule(units, tasks, make_order(units, info, lead), depends))
+    fits = lambda r: r['max_open'] <= window_minutes * 60.0
+    young = lambda r: r['max_age'] <= max_age_minutes * 60.0
+    ranked = sorted(candidates, key=lambda lead: (not fits(candidates[lead]), not young(candidates[lead]),
+                                                   candidates[lead]['max_age'], candidates[lead]['end']))
+    lead = ranked[0]
+    best = candidates[lead]
+    key = hashlib.sha256(('%s sampleage %d' % (plan['key'], lead)).encode()).hexdigest()
+    return {'original': original, 'candidates': candidates, 'best': best, 'lead': lead, 'fits': fits(best),
+            'young': young(best), 'max_age': max_age_minutes * 60.0, 'window': window_minutes * 60.0,
+            'plan': dict(plan, key=key, commands=best['commands'])}
+
+
+def format_report(name, result):
+    original, best = result['original'], result['best']
+    fmt = runtime.format_seconds
+    lines = ['%s: max sample age %s, slide window %s' % (name, fmt(result['max_age']), fmt(result['window']))]
+    lines.append('    %-14s %8s %8s %9s %6s' % ('order', 'oldest', 'slides', 'run', 'stops'))
+    rows = [('as written', original)] + [('lead %d' % lead, r) for lead, r in sorted(result['candidates'].items())]
+    for label, r in rows:
+        lines.append('    %-14s %8s %8s %9s %6d%s' % (label, fmt(r['max_age']), fmt(r['max_open']), fmt(r['end']),
+                                                     r['stops'], '  <- picked' if r is best else ''))
+    lines.append('    lead %d, column ages (mixing -> slide):' % result['lead'])
+    for c in best['columns']:
+        was = [o for o in original['columns'] if o['column'] == c['column']][0]
+        lines.append('        slide %d %-4s %s (was %s)%s' % (c['slide'] + 1, c['column'][1], fmt(c['age']), fmt(was['age']),
+                                                          '  OVER' if c['age'] > result['max_age'] else ''))
+    for s in best['slides']:
+        lines.append('        slide %d on the deck loaded for %s%s' % (s['slide'] + 1, fmt(s['open']),
+                                                                 '  OVER' if s['open'] > result['window'] else ''))
+    if not result['fits']:
+        lines.append('    WARNING: no order keeps every slide within %s, shortest is %s. Read the slides sooner or load fewer columns per slide' % (
+            fmt(result['window']), fmt(min(r['max_open'] for r in result['candidates'].values()))))
+    if not result['young']:
+        lines.append('    WARNING: %d columns are older than %s at loading' % (
+            sum(1 for c in best['columns'] if c['age'] > result['max_age']), fmt(result['max_age'])))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Interleave culture sampling with Iprasense slide loading')
+    parser.add_argument('protocols', nargs='+', help='one of: %s' % ', '.join(sorted(SAMPLING)))
+    parser.add_argument('--max-age-minutes', type=float, default=MAX_AGE_MINUTES, help='oldest sample at loading (default %g)' % MAX_AGE_MINUTES)
+    parser.add_argument('--slide-window-minutes', type=float, default=SLIDE_WINDOW_MINUTES,
+                        help='loaded slide to Iprasense (default %g)' % SLIDE_WINDOW_MINUTES)
+    parser.add_argument('--latency-minutes', type=float, default=5.0, help='operator response time per pause (default 5)')
+    parser.add_argument('--emit-protocol', help='write the picked order as a standalone replay protocol (one protocol only)')
+    args = parser.parse_args(argv)
+    for name in args.protocols:
+        if name not in SAMPLING:
+            raise SystemExit("Unsupported protocol '%s': no sampling layout, supported: %s" % (name, ', '.join(sorted(SAMPLING))))
+    for name in args.protocols:
+        result = plan_schedule(name, args.max_age_minutes, args.slide_window_minutes, args.latency_minutes)
+        print(format_report(name, result))
+        if args.emit_protocol:
+            plancache.emit_protocol(result['plan'], args.emit_protocol)
+            print('    standalone replay protocol written to %s' % args.emit_protocol)
+
+
+if __name__ == '__main__':
+    main()
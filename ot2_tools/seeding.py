@@ -0,0 +1,42 @@
+#Readme:
+#Throughput planner for 24well_Plate_Seed batch mode. Simulates the protocol for a plate count and seed volume
+#and reports batches, trough trips, tips and the plates per hour to expect.
+#Plates per hour counts robot time plus the operator swap at every batch pause (--swap-minutes).
+#Usage: python -m ot2_tools.seeding --plates 16 [--volume 630] [--swap-minutes 5]
+
+from . import runtime
+from . import sim
+
+
+def plan_seeding(plates, volume=630, swap_minutes=5.0, model=None):
+    protocol = sim.simulate('seed', {'PLATE_COUNT': plates, 'SEED_VOLUME': volume})
+    timings = runtime.estimate(protocol.commands, protocol.deck_layout(), model)
+    robot = sum(t['total'] for t in timings)
+    pauses = sum(1 for c in protocol.commands if c['name'] == 'pause')
+    wall = robot + pauses * swap_minutes * 60.0
+    dispenses = [c for c in protocol.commands if c['name'] == 'dispense']
+    return {'plates': plates, 'volume': volume, 'batches': pauses + 1, 'plates_per_load': len(protocol.deck_layout()) - 2,
+            'trips_per_well': len(dispenses) // (plates * 6) if plates else 0, 'tips': sum(1 for c in protocol.commands if c['name'] == 'pick_up_tip'),
+            'robot_seconds': robot, 'wall_seconds': wall, 'plates_per_hour': plates * 3600.0 / wall if wall else 0.0}
+
+
+def format_plan(plan):
+    return ('%d plates x %gul/well: %d batches of up to %d plates, %d trough trips per well, %d tip pick-ups\n'
+            '    robot %s, with swaps %s -> %.1f plates/hour') % (
+        plan['plates'], plan['volume'], plan['batches'], plan['plates_per_load'], plan['trips_per_well'], plan['tips'],
+        runtime.format_seconds(plan['robot_seconds']), runtime.format_seconds(plan['wall_seconds']), plan['plates_per_hour'])
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Plates per hour for 24well_Plate_Seed batch mode')
+    parser.add_argument('--plates', type=int, nargs='+', default=[4], help='plate counts to plan (default 4)')
+    parser.add_argument('--volume', type=float, default=630, help='seed volume per well in ul (default 630)')
+    parser.add_argument('--swap-minutes', type=float, default=5.0, help='operator time per batch swap (default 5)')
+    args = parser.parse_args(argv)
+    for plates in args.plates:
+        print(format_plan(plan_seeding(plates, args.volume, args.swap_minutes)))
+
+
+if __name__ == '__main__':
+    main()
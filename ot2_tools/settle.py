@@ -0,0 +1,214 @@
+#Readme:
+#Adaptive settle-time model for the short protocol.delay() calls that follow dispenses, mixes, blow outs and the
+#move_to(top(-20)) drip checks. Each wait is computed from the liquid class of the step, the volume, the tip type and
+#the flow rate of the action it follows:
+#   after a dispense / mix   base + film x volume/100ul x (flow rate / reference rate)^0.5   (film draining off the tip wall)
+#   after an aspirate (held) base + lag x volume/100ul x (flow rate / reference rate)^0.5    (liquid catching up with the plunger)
+#   after a blow out         base                                                              (last droplet)
+#times the tip factor, clipped to the class minimum/maximum and rounded up to 0.1s. Liquid classes are assigned per
+#step (CLASSES, longest label prefix wins, unlisted steps are media). Delays longer than KEEP_SECONDS are process waits
+#(incubations) and are kept. Constants are first guesses: calibrate against gravimetric data with --classes, eg
+#   {"classes": {"cell_suspension": {"film": 0.35}}, "steps": {"Step 4": "nucleofection_solution"}}
+#--write puts the computed waits into the protocol source (largest wait per line).
+#Usage: python -m ot2_tools.settle harvest [--classes liquids.json] [--by-line] [--write]
+
+import json
+import math
+import os
+import re
+
+from . import runtime
+from . import sim
+
+# s, s per 100ul, s per 100ul, ul/s, s, s
+LIQUID_CLASSES = {
+    'media': {'base': 0.2, 'film': 0.15, 'lag': 0.1, 'reference_rate': 150.0, 'minimum': 0.2, 'maximum': 1.0},
+    'cell_suspension': {'base': 0.3, 'film': 0.2, 'lag': 0.15, 'reference_rate': 150.0, 'minimum': 0.3, 'maximum': 1.5},
+    'nucleofection_solution': {'base': 0.5, 'film': 0.4, 'lag': 0.3, 'reference_rate': 50.0, 'minimum': 0.5, 'maximum': 2.0},
+    'viscous_standard': {'base': 0.6, 'film': 0.5, 'lag': 0.4, 'reference_rate': 150.0, 'minimum': 0.6, 'maximum': 2.5},
+}
+
+# Film left on the tip wall relative to a standard 300ul tip
+TIP_FACTORS = {'opentrons_96_tiprack_300ul': 1.0, 'opentrons_96_filtertiprack_200ul': 1.15}
+
+# Liquid class per step label prefix
+CLASSES = {
+    'harvest': {'Step 1': 'media', 'Step 2': 'cell_suspension', 'Step 3': 'cell_suspension', 'Step 5': 'media'},
+    'sampling': {'Step 1': 'media', 'Step 2': 'cell_suspension', 'Step 3': 'cell_suspension', 'Step 4: Feed': 'media',
+                 'Step 4: Seperate': 'cell_suspension', 'Step 5': 'media'},
+    'nucleofection': {'Step 1': 'nucleofection_solution', 'Step 2': 'nucleofection_solution',
+                      'Step 3': 'cell_suspension', 'Step 4': 'nucleofection_solution', 'Step 5': 'media',
+                      'Step 8': 'cell_suspension'},
+    'seed': {'Step 2': 'media'},
+    'valitatiter': {'Step1': 'media', 'Step2': 'viscous_standard', 'Step3: Dilute': 'viscous_standard',
+                    'Step3: Add': 'media', 'Step 4': 'media'},
+}
+
+KEEP_SECONDS = 2.0
+LIQUID_ACTIONS = ('aspirate', 'dispense', 'blow_out', 'move_to')
+DELAY_PATTERN = re.compile(r'(\.delay\(\s*seconds\s*=\s*)([0-9.]+)(\s*\))')
+
+
+def load_classes(name, path=None):
+    # Built-in classes and step assignments for a protocol, with the overrides from a JSON file
+    classes = dict((k, dict(v)) for k, v in LIQUID_CLASSES.items())
+    # protocol files of this repo given by path use their short name's assignments
+    name = next((short for short, filename in sim.PROTOCOLS.items() if filename == os.path.basename(name)), name)
+    steps = dict(CLASSES.get(name, {}))
+    if path:
+        with open(path) as f:
+            overrides = json.load(f)
+        for liquid, values in overrides.get('classes', {}).items():
+            unknown = set(values) - set(LIQUID_CLASSES['media'])
+            if unknown:
+                raise ValueError("Unknown settings for liquid class '%s': %s" % (liquid, ', '.join(sorted(unknown))))
+            classes.setdefault(liquid, dict(LIQUID_CLASSES['media'])).update(values)
+        steps.update(overrides.get('steps', {}))
+    for step, liquid in steps.items():
+        if liquid not in classes:
+            raise ValueError("Step '%s' uses unknown liquid class '%s'" % (step, liquid))
+    return {'classes': classes, 'steps': steps}
+
+
+def step_class(liquids, step):
+    matches = [key for key in liquids['steps'] if step.startswith(key)]
+    return liquids['steps'][max(matches, key=len)] if matches else 'media'
+
+
+def settle_time(liquid, action, volume, flow_rate, tip_factor=1.0):
+    # Seconds to wait after action ('dispense', 'aspirate', 'blow_out') of volume ul at flow_rate ul/s
+    speed = math.sqrt(max(flow_rate, 1e-6) / liquid['reference_rate'])
+    if action == 'dispense':
+        seconds = liquid['base'] + liquid['film'] * volume / 100.0 * speed
+    elif action == 'aspirate':
+        seconds = liquid['base'] + liquid['lag'] * volume / 100.0 * speed
+    else:
+        seconds = liquid['base']
+    seconds = min(liquid['maximum'], max(liquid['minimum'], seconds * tip_factor))
+    return math.ceil(seconds * 10.0 - 1e-9) / 10.0
+
+
+def plan_waits(commands, liquids):
+    # One entry per delay the model replaces: {index, line, step, liquid, after, volume, flow_rate, tip, old, new}
+    waits = []
+    last = {}
+    held = {}
+    tips = {}
+    rates = {}
+    previous = None
+    for command in commands:
+        mount = command.get('mount')
+        name = command['name']
+        if name == 'pick_up_tip':
+            tips[mount] = command['location']['labware']
+            held[mount] = 0.0
+        elif name == 'aspirate':
+            held[mount] = held.get(mount, 0.0) + command['volume']
+            rates[mount] = command['flow_rate'] * command.get('rate', 1.0)
+        elif name == 'dispense':
+            held[mount] = max(0.0, held.get(mount, 0.0) - command['volume'])
+        elif name in ('blow_out', 'drop_tip', 'return_tip'):
+            held[mount] = 0.0
+        if name in LIQUID_ACTIONS:
+            last[mount] = dict(command, held=held.get(mount, 0.0))
+            previous = mount
+        if name != 'delay' or command['seconds'] > KEEP_SECONDS or previous is None:
+            continue
+        action = last[previous]
+        kind = action['name']
+        if kind == 'move_to':
+            # drip check above the liquid: the tip holds liquid that was just aspirated
+            kind, volume, flow_rate = 'aspirate', action['held'], rates.get(previous, 150.0)
+        else:
+            volume, flow_rate = action.get('volume', 0.0), action['flow_rate'] * action.get('rate', 1.0)
+        liquid = step_class(liquids, command['step'])
+        tip = tips.get(previous)
+        new = settle_time(liquids['classes'][liquid], kind, volume, flow_rate, TIP_FACTORS.get(tip, 1.0))
+        waits.append({'index': command['index'], 'line': command['line'], 'step': command['step'], 'liquid': liquid,
+                      'after': action['name'], 'volume': volume, 'flow_rate': flow_rate, 'tip': tip,
+                      'old': command['seconds'], 'new': new})
+    return waits
+
+
+def apply_waits(commands, waits):
+    # Copy of the trace with the computed waits in place of the fixed delays
+    new = dict((w['index'], w['new']) for w in waits)
+    return [dict(c, seconds=new[c['index']]) if c['index'] in new else c for c in commands]
+
+
+def evaluate(name, classes_path=None, model=None):
+    protocol = sim.simulate(name)
+    liquids = load_classes(name, classes_path)
+    waits = plan_waits(protocol.commands, liquids)
+    deck = protocol.deck_layout()
+    before = sum(t['total'] for t in runtime.estimate(protocol.commands, deck, model))
+    after = sum(t['total'] for t in runtime.estimate(apply_waits(protocol.commands, waits), deck, model))
+    return {'protocol': protocol, 'waits': waits, 'before': before, 'after': after}
+
+
+def line_waits(waits):
+    # {line: (calls, fixed seconds, largest computed wait)} in line order
+    lines = {}
+    for w in waits:
+        calls, old, new = lines.get(w['line'], (0, w['old'], 0.0))
+        lines[w['line']] = (calls + 1, old, max(new, w['new']))
+    return dict(sorted(lines.items()))
+
+
+def rewrite_source(path, waits):
+    # Writes the largest computed wait of each line into protocol.delay(seconds=...). Returns the lines changed
+    with open(path) as f:
+        source = f.read().split('\n')
+    changed = []
+    for line, (calls, old, new) in line_waits(waits).items():
+        text = source[line - 1]
+        match = DELAY_PATTERN.search(text)
+        if match is None or float(match.group(2)) == new:
+            continue
+        source[line - 1] = text[:match.start(2)] + ('%g' % new) + text[match.end(2):]
+        changed.append(line)
+    with open(path, 'w') as f:
+        f.write('\n'.join(source))
+    return changed
+
+
+def format_report(name, result, by_line=False):
+    waits = result['waits']
+    old = sum(w['old'] for w in waits)
+    new = sum(w['new'] for w in waits)
+    lines = ['%s: %d settle delays, %s fixed -> %s computed, run %s -> %s (%s saved)' % (
+        name, len(waits), runtime.format_seconds(old), runtime.format_seconds(new),
+        runtime.format_seconds(result['before']), runtime.format_seconds(result['after']),
+        runtime.format_seconds(result['before'] - result['after']))]
+    steps = {}
+    for w in waits:
+        entry = steps.setdefault(w['step'], [w['liquid'], 0, 0.0, 0.0])
+        entry[1] += 1
+        entry[2] += w['old']
+        entry[3] += w['new']
+    for step, (liquid, count, fixed, computed) in steps.items():
+        lines.append('    %4dx %6.1fs -> %6.1fs  %-22s %s' % (count, fixed, computed, liquid, step))
+    if by_line:
+        for line, (calls, fixed, computed) in line_waits(waits).items():
+            lines.append('        line %-4s %4dx delay(seconds=%g) -> %g' % (line, calls, fixed, computed))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Replace fixed settle delays with computed waits')
+    parser.add_argument('protocols', nargs='+', help='protocol files or: %s' % ', '.join(sorted(sim.PROTOCOLS)))
+    parser.add_argument('--classes', help='JSON file with liquid class / step overrides (calibration)')
+    parser.add_argument('--by-line', action='store_true', help='list the computed wait of every delay line')
+    parser.add_argument('--write', action='store_true', help='write the computed waits into the protocol source')
+    args = parser.parse_args(argv)
+    for name in args.protocols:
+        result = evaluate(name, args.classes)
+        print(format_report(name, result, args.by_line))
+        if args.write:
+            changed = rewrite_source(result['protocol'].path, result['waits'])
+            print('    %d delay lines rewritten in %s' % (len(changed), result['protocol'].path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#Readme:
+#Multi-robot sharding runner. One logical job (a protocol + N 24-well plates) is split into per-robot shards.
+#Each shard is a list of protocol runs with its own deck layout and tip budget. Shards are simulated in parallel
+#(process pool, one simulated robot per process) and the command logs and timing reports are merged.
+#Protocols that take a fixed 4 plates per run (harvest, sampling, nucleofection) get one run per 4 plates,
+#24well_Plate_Seed gets one run per robot with PLATE_COUNT set to that robot's share.
+#Operator time: --swap-minutes between runs on the same robot (new plates/tips/trough), --pause-minutes per protocol pause.
+#Usage: python -m ot2_tools.shard sampling --plates 24 --robots 1 2 3 [--log merged.json]
+
+import json
+import math
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from . import plancache
+from . import runtime
+
+# plates per protocol run, or the protocol setting that takes the plate count
+JOBS = {
+    'harvest': {'plates_per_run': 4},
+    'sampling': {'plates_per_run': 4},
+    'nucleofection': {'plates_per_run': 4},
+    'seed': {'plates_per_run': None, 'setting': 'PLATE_COUNT'},
+}
+
+
+def split_job(protocol, plates, robots):
+    # Returns [{'robot': name, 'runs': [{'plates': [plate numbers], 'overrides': {...}}]}], runs balanced across robots
+    if protocol not in JOBS:
+        raise KeyError("No sharding rule for '%s', add it to JOBS: %s" % (protocol, ', '.join(sorted(JOBS))))
+    job = JOBS[protocol]
+    shards = [{'robot': 'OT2-%d' % (r + 1), 'protocol': protocol, 'runs': []} for r in range(robots)]
+    numbers = list(range(1, plates + 1))
+    if job['plates_per_run'] is None:
+        share = int(math.ceil(plates / float(robots)))
+        for r, shard in enumerate(shards):
+            mine = numbers[r * share:(r + 1) * share]
+            if mine:
+                shard['runs'].append({'plates': mine, 'overrides': {job['setting']: len(mine)}})
+    else:
+        size = job['plates_per_run']
+        runs = [numbers[i:i + size] for i in range(0, plates, size)]
+        for n, run in enumerate(runs):
+            # Short last run still runs the full protocol, the unused positions are left empty
+            shards[n % robots]['runs'].append({'plates': run, 'overrides': {}})
+    return [shard for shard in shards if shard['runs']]
+
+
+def run_shard(shard, swap_minutes=10.0, pause_minutes=2.0):
+    # Simulates every run of one shard back to back on one robot. Runs in a worker process
+    clock = 0.0
+    runs = []
+    log = []
+    for n, run in enumerate(shard['runs']):
+        if n:
+            clock += swap_minutes * 60.0
+        # Every run of a shard repeats the same protocol, replay its compiled plan instead of rerunning run()
+        protocol = plancache.simulate(shard['protocol'], run['overrides'])
+        deck = protocol.deck_layout()
+        timings = runtime.estimate(protocol.commands, deck)
+        start = clock
+        tips = OrderedDict()
+        for command, timing in zip(protocol.commands, timings):
+            if command['name'] == 'pause':
+                clock += pause_minutes * 60.0
+            log.append(dict(command, robot=shard['robot'], run=n + 1, start=round(clock, 2), duration=round(timing['total'], 2)))
+            clock += timing['total']
+            if command['name'] == 'pick_up_tip':
+                slot = command['location']['slot']
+                tips[slot] = tips.get(slot, 0) + 1
+        runs.append({'run': n + 1, 'plates': run['plates'], 'deck': deck, 'tip_columns': tips,
+                     'start': start, 'end': clock, 'summary': runtime.summarise(protocol, timings)})
+    return {'robot': shard['robot'], 'protocol': shard['protocol'], 'runs': runs, 'log': log, 'end': clock}
+
+
+def _run_shard(args):
+    return run_shard(*args)
+
+
+def run_job(protocol, plates, robots, swap_minutes=10.0, pause_minutes=2.0, processes=None):
+    # Simulates all shards in parallel and merges them. Returns {'shards': [...], 'log': [...], 'makespan': s}
+    shards = split_job(protocol, plates, robots)
+    with ProcessPoolExecutor(max_workers=processes or len(shards)) as pool:
+        results = list(pool.map(_run_shard, [(shard, swap_minutes, pause_minutes) for shard in shards]))
+    log = sorted((c for result in results for c in result['log']), key=lambda c: (c['start'], c['robot'], c['index']))
+    return {'protocol': protocol, 'plates': plates, 'robots': robots, 'shards': results, 'log': log,
+            'makespan': max(result['end'] for result in results)}
+
+
+def format_job(job):
+    lines = ['%s: %d plates on %d robots -> %s makespan' % (
+        job['protocol'], job['plates'], job['robots'], runtime.format_seconds(job['makespan']))]
+    for shard in job['shards']:
+        tips = sum(sum(run['tip_columns'].values()) for run in shard['runs'])
+        lines.append('    %s: %d runs, plates %s, %d tip columns, done at %s' % (
+            shard['robot'], len(shard['runs']), ','.join(str(p) for run in shard['runs'] for p in run['plates']),
+            tips, runtime.format_seconds(shard['end'])))
+        deck = None
+        for run in shard['runs']:
+            lines.append('        run %d %s-%s  tip columns per slot %s' % (
+                run['run'], runtime.format_seconds(run['start']), runtime.format_seconds(run['end']),
+                ', '.join('%s: %d' % item for item in run['tip_columns'].items())))
+            if run['deck'] != deck:
+                deck = run['deck']
+                lines.append('            deck %s' % ' '.join('%s:%s' % (slot, name) for slot, name in sorted(deck.items(), key=lambda s: int(s[0]))))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Split a screen across several simulated OT2s')
+    parser.add_argument('protocol', choices=sorted(JOBS))
+    parser.add_argument('--plates', type=int, required=True, help='24-well plates in the job')
+    parser.add_argument('--robots', type=int, nargs='+', default=[1], help='robot counts to compare (default 1)')
+    parser.add_argument('--swap-minutes', type=float, default=10.0, help='operator time between runs on one robot (default 10)')
+    parser.add_argument('--pause-minutes', type=float, default=2.0, help='operator time per protocol pause (default 2)')
+    parser.add_argument('--log', help='write the merged command log of the last robot count to this JSON file')
+    args = parser.parse_args(argv)
+    job = None
+    for robots in args.robots:
+        job = run_job(args.protocol, args.plates, robots, args.swap_minutes, args.pause_minutes)
+        print(format_job(job))
+    if args.log:
+        with open(args.log, 'w') as f:
+            json.dump(job['log'], f)
+        print('Merged command log (%d commands) written to %s' % (len(job['log']), args.log))
+
+
+if __name__ == '__main__':
+    main()
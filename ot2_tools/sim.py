@@ -0,0 +1,587 @@
+#Readme:
+#Recording stand-in for the opentrons ProtocolContext (API 2.0 subset used by the protocols in this repo).
+#run(protocol) executes exactly as written, every robot action is appended to protocol.commands as a plain dict.
+#Each command is tagged with the '#Step ...' / '#Intervention ...' comment of the protocol it belongs to.
+#Usage: python -m ot2_tools.sim harvest      (or a path to any protocol file)
+
+import contextlib
+import math
+import os
+import re
+import sys
+import types as pytypes
+from collections import namedtuple
+
+from . import geometry
+from . import labware as lw
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Short names for the protocols in this repo
+PROTOCOLS = {
+    'harvest': '24SWP_Harvest_Iprasense_Sampling_100um_API2.0.py',
+    'seed': '24well_Plate_Seed_API2.0.py',
+    'nucleofection': 'Nucleofection_FullPlate_API2.0.py',
+    'sampling': 'OE-KD-Screen_D3_Iprasense_WB-Sampling_API2.0.py',
+    'valitatiter': 'ValitaTiter-Opentrons_AppNote__Standard-Curve_API2.0.py',
+}
+
+STEP_PATTERN = re.compile(r'^\s*#\s*((?:Step|Intervention).*?)\s*$', re.IGNORECASE)
+SETUP_STEP = 'Setup'
+
+
+class SimulationError(Exception):
+    pass
+
+
+class Point(namedtuple('Point', 'x y z')):
+    __slots__ = ()
+
+    def __new__(cls, x=0.0, y=0.0, z=0.0):
+        return super(Point, cls).__new__(cls, x, y, z)
+
+    def __add__(self, other):
+        return Point(self.x + other.x, self.y + other.y, self.z + other.z)
+
+    def __sub__(self, other):
+        return Point(self.x - other.x, self.y - other.y, self.z - other.z)
+
+
+class Location(object):
+    # Same shape as opentrons.types.Location: a point plus the well/labware it refers to. reference = ('top' / 'bottom' /
+    # 'center', z from it) for points a well gave out, so a plan can address them the same way on the robot
+    def __init__(self, point, labware, reference=None):
+        self.point = point
+        self.labware = labware
+        self.reference = reference
+
+    def move(self, point):
+        reference = (self.reference[0], self.reference[1] + point.z) if self.reference else None
+        return Location(self.point + point, self.labware, reference)
+
+    def __repr__(self):
+        return 'Location(point=%r, labware=%r)' % (self.point, self.labware)
+
+
+class SimWell(object):
+    def __init__(self, labware, name, index, offset):
+        # offset: (x, y, bottom, top, depth) from the labware corner, a row of the geometry index
+        self.parent = labware
+        self.name = name
+        self.index = index
+        sx, sy = lw.DECK_SLOTS[labware.slot]
+        x, y, bottom, top = sx + offset[0], sy + offset[1], offset[2], offset[3]
+        self._bottom = Point(x, y, bottom)
+        self._top = Point(x, y, top)
+        self.has_tip = labware.spec['kind'] == 'tiprack'
+
+    def top(self, z=0.0):
+        return Location(self._top + Point(0, 0, z), self, ('top', z))
+
+    def bottom(self, z=0.0):
+        return Location(self._bottom + Point(0, 0, z), self, ('bottom', z))
+
+    def center(self):
+        return Location(Point(self._top.x, self._top.y, (self._top.z + self._bottom.z) / 2), self, ('center', 0.0))
+
+    def __repr__(self):
+        return '%s of %s on %s' % (self.name, self.parent.load_name, self.parent.slot)
+
+
+class SimLabware(object):
+    def __init__(self, load_name, slot, label=None):
+        self.load_name = load_name
+        self.slot = str(slot)
+        self.label = label
+        self.spec = lw.labware_spec(load_name)
+        self._wells = [SimWell(self, name, i, offset) for i, (name, offset) in enumerate(geometry.index().wells(load_name))]
+        self._by_name = dict((w.name, w) for w in self._wells)
+
+    def wells(self, *names):
+        # API 2.0: wells() gives every well, wells('A1', 'A2') gives a list of the named wells
+        if names:
+            return [self._by_name[n] for n in names]
+        return list(self._wells)
+
+    def wells_by_name(self):
+        return dict(self._by_name)
+
+    def columns(self):
+        rows = self.spec['rows']
+        return [self._wells[c * rows:(c + 1) * rows] for c in range(self.spec['cols'])]
+
+    def rows(self):
+        return [list(r) for r in zip(*self.columns())]
+
+    def __getitem__(self, name):
+        return self._by_name[name]
+
+    def __repr__(self):
+        return '%s on %s' % (self.load_name, self.slot)
+
+
+class _Settings(object):
+    # flow_rate / well_bottom_clearance: every assignment is recorded as a 'set' command
+    def __init__(self, pipette, group, values):
+        object.__setattr__(self, '_pipette', pipette)
+        object.__setattr__(self, '_group', group)
+        for key, value in values.items():
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, name, value):
+        self._pipette._set('%s.%s' % (self._group, name), getattr(self, name, None), value)
+        object.__setattr__(self, name, value)
+
+
+class SimPipette(object):
+    def __init__(self, protocol, name, mount, tip_racks=None):
+        object.__setattr__(self, '_ready', False)
+        self.protocol = protocol
+        self.name = name
+        self.mount = mount
+        self.spec = lw.PIPETTES[name]
+        self.tip_racks = list(tip_racks or [])
+        self.channels = self.spec['channels']
+        self.max_volume = self.spec['max_volume']
+        self.min_volume = self.spec['min_volume']
+        self.flow_rate = _Settings(self, 'flow_rate', {
+            'aspirate': self.spec['aspirate'], 'dispense': self.spec['dispense'], 'blow_out': self.spec['blow_out']})
+        self.well_bottom_clearance = _Settings(self, 'well_bottom_clearance', {'aspirate': 1.0, 'dispense': 1.0})
+        self.has_tip = False
+        self.current_tip = None
+        self.current_volume = 0.0
+        self.location = None
+        self._ready = True
+
+    def __setattr__(self, name, value):
+        # maximum_volume / minimum_volume are not API 2.0 settings, the robot ignores them. Recorded so the tools can see them.
+        if self._ready and name in ('maximum_volume', 'minimum_volume'):
+            self._set(name, getattr(self, name, None), value)
+        object.__setattr__(self, name, value)
+
+    def _set(self, setting, old, new):
+        self.protocol._record('set', self, setting=setting, value=new, previous=old)
+
+    def __repr__(self):
+        return '%s on %s mount' % (self.name, self.mount)
+
+    # locations
+    def _resolve(self, location, clearance):
+        if isinstance(location, (list, tuple)):
+            location = location[0]
+        if isinstance(location, SimWell):
+            return location.bottom(clearance)
+        if isinstance(location, Location):
+            return location
+        if location is None:
+            if self.location is None:
+                raise SimulationError('%s has no current location, give a location' % self)
+            return self.location
+        raise SimulationError('Unsupported location %r' % (location,))
+
+    def _check_tip(self, action):
+        if not self.has_tip:
+            raise SimulationError('%s cannot %s without a tip' % (self, action))
+
+    def _well_list(self, target):
+        if isinstance(target, (SimWell, Location)):
+            return [target]
+        wells = list(target)
+        if self.channels > 1:
+            # A multichannel addresses a column by its A row well
+            firsts = [w for w in wells if isinstance(w, SimWell) and w.name[0] == 'A']
+            if firsts:
+                return firsts
+        return wells
+
+    # liquid handling
+    def aspirate(self, volume=None, location=None, rate=1.0):
+        loc = self._resolve(location, self.well_bottom_clearance.aspirate)
+        self._check_tip('aspirate')
+        if volume is None:
+            volume = self.max_volume - self.current_volume
+        if self.current_volume + volume > self.max_volume + 1e-6:
+            raise SimulationError('%s cannot aspirate %sul, holding %sul of %sul' % (self, volume, self.current_volume, self.max_volume))
+        self.protocol._record('aspirate', self, loc, volume=float(volume), flow_rate=self.flow_rate.aspirate, rate=rate)
+        self.current_volume += volume
+        self.location = loc
+        return self
+
+    def dispense(self, volume=None, location=None, rate=1.0):
+        loc = self._resolve(location, self.well_bottom_clearance.dispense)
+        self._check_tip('dispense')
+        actual = self.current_volume if volume is None else min(volume, self.current_volume)
+        self.protocol._record('dispense', self, loc, volume=float(actual), requested=volume, flow_rate=self.flow_rate.dispense, rate=rate)
+        self.current_volume -= actual
+        self.location = loc
+        return self
+
+    def blow_out(self, location=None):
+        if isinstance(location, SimWell):
+            location = location.top()
+        loc = self._resolve(location, 0.0)
+        self._check_tip('blow out')
+        self.protocol._record('blow_out', self, loc, flow_rate=self.flow_rate.blow_out)
+        self.current_volume = 0.0
+        self.location = loc
+        return self
+
+    def mix(self, repetitions=1, volume=None, location=None, rate=1.0):
+        if volume is None:
+            volume = self.max_volume
+        self.protocol._groups.append('mix')
+        try:
+            self.aspirate(volume, location, rate)
+            for r in range(repetitions):
+                self.dispense(volume, rate=rate)
+                if r < repetitions - 1:
+                    self.aspirate(volume, rate=rate)
+        finally:
+            self.protocol._groups.pop()
+        return self
+
+    def touch_tip(self, location=None, radius=1.0, v_offset=-1.0, speed=60.0):
+        self._check_tip('touch tip')
+        if isinstance(location, (list, tuple)):
+            location = location[0]
+        if location is None:
+            if self.location is None or not isinstance(self.location.labware, SimWell):
+                raise SimulationError('%s touch_tip needs a well' % self)
+            location = self.location.labware
+        loc = location.top(v_offset)
+        self.protocol._record('touch_tip', self, loc, speed=speed)
+        self.location = loc
+        return self
+
+    def move_to(self, location, force_direct=False):
+        self.protocol._record('move_to', self, location, force_direct=force_direct)
+        self.location = location
+        return self
+
+    def transfer(self, volume, source, dest, **kwargs):
+        new_tip = kwargs.get('new_tip', 'once')
+        sources = self._well_list(source)
+        dests = self._well_list(dest)
+        if len(sources) == 1 and len(dests) > 1:
+            sources = sources * len(dests)
+        elif len(dests) == 1 and len(sources) > 1:
+            dests = dests * len(sources)
+        elif len(sources) != len(dests):
+            raise SimulationError('transfer needs matching source and destination lists')
+        chunks = int(math.ceil(float(volume) / self.max_volume))
+        part = float(volume) / chunks
+        self.protocol._groups.append('transfer')
+        try:
+            if new_tip == 'once':
+                self.pick_up_tip()
+            for src, dst in zip(sources, dests):
+                if new_tip == 'always':
+                    self.pick_up_tip()
+                for c in range(chunks):
+                    if kwargs.get('mix_before'):
+                        self.mix(kwargs['mix_before'][0], kwargs['mix_before'][1], src)
+                    self.aspirate(part, src)
+                    if kwargs.get('touch_tip'):
+                        self.touch_tip()
+                    self.dispense(part, dst)
+                    if kwargs.get('mix_after'):
+                        self.mix(kwargs['mix_after'][0], kwargs['mix_after'][1], dst)
+                    if kwargs.get('touch_tip'):
+                        self.touch_tip()
+                    if kwargs.get('blow_out'):
+                        self.blow_out(self.protocol.trash['A1'])
+                if new_tip == 'always':
+                    self.drop_tip()
+            if new_tip == 'once':
+                self.drop_tip()
+        finally:
+            self.protocol._groups.pop()
+        return self
+
+    # tips
+    def _column_of(self, tip_well):
+        rack = tip_well.parent
+        rows = rack.spec['rows']
+        col = tip_well.index // rows
+        first = tip_well.index % rows
+        return rack.wells()[col * rows + first:col * rows + min(rows, first + self.channels)]
+
+    def _next_tip(self):
+        for rack in self.tip_racks:
+            for well in rack.wells():
+                tips = self._column_of(well) if self.channels > 1 else [well]
+                if len(tips) == self.channels and all(t.has_tip for t in tips):
+                    return well
+        raise SimulationError('%s is out of tips' % self)
+
+    def pick_up_tip(self, location=None, presses=None, increment=None):
+        if self.has_tip:
+            raise SimulationError('%s already has a tip' % self)
+        if location is None:
+            well = self._next_tip()
+        elif isinstance(location, Location):
+            well = location.labware
+        else:
+            well = location
+        tips = self._column_of(well) if self.channels > 1 else [well]
+        loc = well.top()
+        self.protocol._record('pick_up_tip', self, loc, tips=sum(1 for t in tips if t.has_tip))
+        for t in tips:
+            t.has_tip = False
+        self.has_tip = True
+        self.current_tip = well
+        self.current_volume = 0.0
+        self.location = loc
+        return self
+
+    def drop_tip(self, location=None, home_after=True):
+        self._check_tip('drop tip')
+        if location is None:
+            location = self.protocol.trash['A1'].top()
+        elif isinstance(location, SimWell):
+            location = location.top()
+        self.protocol._record('drop_tip', self, location)
+        self._release_tip(location)
+        return self
+
+    def return_tip(self, home_after=True):
+        self._check_tip('return tip')
+        well = self.current_tip
+        loc = well.top()
+        self.protocol._record('return_tip', self, loc)
+        for t in (self._column_of(well) if self.channels > 1 else [well]):
+            t.has_tip = True
+        self._release_tip(loc)
+        return self
+
+    def _release_tip(self, location):
+        self.has_tip = False
+        self.current_tip = None
+        self.current_volume = 0.0
+        self.location = location
+
+    def reset_tipracks(self):
+        for rack in self.tip_racks:
+            for well in rack.wells():
+                well.has_tip = True
+        self.protocol._record('reset_tipracks', self, racks=[rack.slot for rack in self.tip_racks])
+
+    def home(self):
+        self.protocol._record('home', self)
+        self.location = None
+        return self
+
+
+class SimProtocol(object):
+    def __init__(self, path=None):
+        self.path = os.path.abspath(path) if path else None
+        self.commands = []
+        self.labware = {}
+        self.instruments = {}
+        self._groups = []
+        self._steps = step_labels(self.path) if self.path else []
+        self.trash = SimLabware(lw.TRASH_LABWARE, lw.TRASH_SLOT)
+
+    # API 2.0 ProtocolContext subset
+    def load_labware(self, load_name, location, label=None):
+        slot = str(location)
+        if slot in self.labware or slot == lw.TRASH_SLOT:
+            raise SimulationError('Slot %s is already occupied' % slot)
+        labware = SimLabware(load_name, slot, label)
+        self.labware[slot] = labware
+        return labware
+
+    def load_instrument(self, instrument_name, mount, tip_racks=None, replace=False):
+        if mount in self.instruments and not replace:
+            raise SimulationError('%s mount is already in use' % mount)
+        pipette = SimPipette(self, instrument_name, mount, tip_racks)
+        self.instruments[mount] = pipette
+        return pipette
+
+    def delay(self, seconds=0, minutes=0, msg=None):
+        self._record('delay', seconds=float(seconds) + 60.0 * minutes, message=msg)
+
+    def pause(self, msg=None):
+        self._record('pause', message=msg)
+
+    def resume(self):
+        pass
+
+    def is_simulating(self):
+        return True
+
+    def comment(self, msg):
+        self._record('comment', message=msg)
+
+    def home(self):
+        self._record('home')
+        for pipette in self.instruments.values():
+            pipette.location = None
+
+    # recording
+    def deck_layout(self):
+        return dict((slot, labware.load_name) for slot, labware in self.labware.items())
+
+    def _current_step(self):
+        return current_step(self.path, self._steps, sys._getframe(1))
+
+    def _record(self, name, pipette=None, location=None, **fields):
+        step, line = self._current_step()
+        command = {'index': len(self.commands), 'name': name, 'step': step, 'line': line,
+                   'group': self._groups[0] if self._groups else None,
+                   'pipette': pipette.name if pipette else None, 'mount': pipette.mount if pipette else None}
+        if location is not None:
+            command['location'] = location_info(location)
+            command['point'] = [round(v, 3) for v in location.point]
+        command.update(fields)
+        self.commands.append(command)
+        return command
+
+
+def location_info(location):
+    # offset: x, y, z from the well bottom in the simulator's geometry. reference / z: the well point the protocol
+    # addressed ('top', 'bottom', 'center') and the z from it, which is what a replay on real labware has to keep
+    target = location.labware
+    if isinstance(target, SimWell):
+        offset = location.point - target.bottom().point
+        reference, z = getattr(location, 'reference', None) or ('bottom', offset.z)
+        return {'slot': target.parent.slot, 'labware': target.parent.load_name, 'well': target.name,
+                'offset': [round(v, 3) for v in offset], 'reference': reference, 'z': round(z, 3)}
+    if isinstance(target, SimLabware):
+        return {'slot': target.slot, 'labware': target.load_name, 'well': None, 'offset': None}
+    return {'slot': None, 'labware': None, 'well': None, 'offset': None}
+
+
+def step_labels(path):
+    # [(line number, label)] for every '#Step ...' / '#Intervention ...' comment in the protocol source
+    labels = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            match = STEP_PATTERN.match(line)
+            if match:
+                labels.append((number, match.group(1)))
+    return labels
+
+
+def current_step(path, steps, frame):
+    # (step label, line) of the protocol code on the stack above frame, steps = step_labels(path)
+    frames = []
+    while frame is not None:
+        if frame.f_code.co_filename == path:
+            frames.append(frame)
+        frame = frame.f_back
+    if not frames:
+        return SETUP_STEP, None
+    # Innermost protocol frame first. A helper function (eg IP_slide_load) with no step comment
+    # of its own takes the step of the line that called it
+    for frame in frames:
+        label = None
+        for line, text in steps:
+            if frame.f_code.co_firstlineno <= line <= frame.f_lineno:
+                label = text
+        if label:
+            return label, frames[0].f_lineno
+    return SETUP_STEP, frames[0].f_lineno
+
+
+def protocol_path(name):
+    # Accepts a short name from PROTOCOLS or a path to a protocol file
+    if name in PROTOCOLS:
+        return os.path.join(REPO_DIR, PROTOCOLS[name])
+    if os.path.exists(name):
+        return os.path.abspath(name)
+    raise KeyError("Unknown protocol '%s'. Use a file path or one of: %s" % (name, ', '.join(sorted(PROTOCOLS))))
+
+
+def _opentrons_modules():
+    opentrons = pytypes.ModuleType('opentrons')
+    api = pytypes.ModuleType('opentrons.protocol_api')
+    api.ProtocolContext = SimProtocol
+    api.InstrumentContext = SimPipette
+    api.Labware = SimLabware
+    api.Well = SimWell
+    ot_types = pytypes.ModuleType('opentrons.types')
+    ot_types.Point = Point
+    ot_types.Location = Location
+    opentrons.protocol_api = api
+    opentrons.types = ot_types
+    return {'opentrons': opentrons, 'opentrons.protocol_api': api, 'opentrons.types': ot_types}
+
+
+@contextlib.contextmanager
+def offline_opentrons():
+    # Protocols import from opentrons, swap in the recording classes only while the protocol file is executed
+    modules = _opentrons_modules()
+    saved = dict((name, sys.modules.get(name)) for name in modules)
+    sys.modules.update(modules)
+    try:
+        yield
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = module
+
+
+def load_protocol(path):
+    # Executes the protocol file and returns its namespace (metadata, run)
+    path = protocol_path(path)
+    with open(path) as f:
+        code = compile(f.read(), path, 'exec')
+    namespace = {'__name__': 'ot2_protocol', '__file__': path}
+    with offline_opentrons():
+        exec(code, namespace)
+    return namespace
+
+
+def simulate(path, overrides=None):
+    # Runs the protocol against a SimProtocol and returns it, commands are in protocol.commands.
+    # overrides replace module level settings of the protocol first, eg {'PLATE_COUNT': 8}
+    path = protocol_path(path)
+    namespace = load_protocol(path)
+    for name, value in (overrides or {}).items():
+        if name not in namespace:
+            raise KeyError("%s has no setting '%s'" % (os.path.basename(path), name))
+        namespace[name] = value
+    protocol = SimProtocol(path)
+    namespace['run'](protocol)
+    return protocol
+
+
+def describe(command):
+    text = command['name']
+    if command.get('pipette'):
+        text = '%s %s' % (command['pipette'], text)
+    if 'volume' in command:
+        text += ' %.1ful' % command['volume']
+    location = command.get('location')
+    if location and location['labware']:
+        text += ' %s of %s on %s' % (location['well'], location['labware'], location['slot'])
+    if 'flow_rate' in command and command['name'] != 'blow_out':
+        text += ' at %.1ful/s' % (command['flow_rate'] * command.get('rate', 1.0))
+    if command['name'] == 'set':
+        text += ' %s = %s' % (command['setting'], command['value'])
+    if command.get('seconds') is not None:
+        text += ' %.1fs' % command['seconds']
+    if command.get('message'):
+        text += ' "%s"' % command['message']
+    return text
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Simulate an OT2 protocol offline and list its commands')
+    parser.add_argument('protocol', help='protocol file or one of: %s' % ', '.join(sorted(PROTOCOLS)))
+    args = parser.parse_args(argv)
+    protocol = simulate(args.protocol)
+    step = None
+    for command in protocol.commands:
+        if command['step'] != step:
+            step = command['step']
+            print('#%s' % step)
+        print('    %s' % describe(command))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+#Readme:
+#Run telemetry store. Needs pyarrow. Every recorded run adds one row per step segment (a contiguous run of calls in the
+#same '#Step ...') to an append-only columnar store: one Arrow IPC file per run in the store directory, never rewritten,
+#read back memory-mapped and concatenated. Rows carry the protocol, step, labware touched, liquid class (settle.py),
+#mean aspirate / dispense flow rates, volume, the runtime.py prediction for the step and the actual robot seconds, with
+#operator pause time kept apart (actual = wall clock of the step less its pauses). Settings are not calls, a trace has no
+#span for them, so they count in the step of the call before them. Traced segments are matched to the predicted ones by
+#step label in order, a trace that runs out of labels is a stopped run and its last segment keeps no actual time.
+#Actual times come from a real run traced with trace.trace_run (the Chrome trace it writes, or its spans), predictions
+#from simulating the same protocol (plancache). Queries:
+#   drift        - actual / predicted per robot, protocol and step over the runs in time order, the trend per run
+#                  (least squares) catches a step that slows down run after run, eg an edge-mix loop as a pipette wears
+#   calibration  - actual / predicted per protocol and liquid class, the factor to calibrate settle.py / liquids.py with
+#   robots       - actual / predicted per robot over its last run and all runs, a slow robot before it holds up a campaign
+#Record on the robot (or copy the trace over first):
+#   spans = trace.trace_run('/data/user_storage/harvest.py', protocol, 'harvest.trace.json')
+#   telemetry.record('harvest', spans, robot='OT2-A')
+#A run recorded again in the same second gets a -2, -3 ... suffix, --run-id picks the id, --force replaces a stored run.
+#Usage: python -m ot2_tools.telemetry harvest --record harvest.trace.json --robot OT2-A
+#       python -m ot2_tools.telemetry [harvest ...] [--robot OT2-A] [--tolerance 10] [--store .telemetry]
+
+import datetime
+import json
+import os
+import re
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from . import plancache
+from . import runtime
+from . import settle
+from . import sim
+
+TELEMETRY_VERSION = 1
+UNTRACED = ('set',)
+STORE_DIR = os.path.join(sim.REPO_DIR, '.telemetry')
+SCHEMA = pa.schema([
+    ('run_id', pa.string()), ('recorded', pa.timestamp('s')), ('robot', pa.string()), ('protocol', pa.string()),
+    ('segment', pa.int32()), ('step', pa.string()), ('labware', pa.list_(pa.string())), ('liquid_class', pa.string()),
+    ('aspirate_rate', pa.float64()), ('dispense_rate', pa.float64()), ('volume', pa.float64()),
+    ('commands', pa.int32()), ('pauses', pa.int32()),
+    ('predicted_seconds', pa.float64()), ('actual_seconds', pa.float64()), ('pause_seconds', pa.float64()),
+], metadata={'telemetry_version': str(TELEMETRY_VERSION)})
+
+
+def protocol_name(path):
+    # Short name for the protocols of this repo, the file name for the rest
+    path = sim.protocol_path(path)
+    return next((short for short, filename in sim.PROTOCOLS.items() if filename == os.path.basename(path)),
+                os.path.basename(path))
+
+
+def spans_from_chrome(path):
+    # Call spans back from a Chrome trace written by trace.py
+    with open(path) as f:
+        events = json.load(f)['traceEvents']
+    return [{'kind': 'call', 'name': e['name'], 'step': e['args']['step'], 'start': e['ts'] / 1e6, 'seconds': e['dur'] / 1e6}
+            for e in events if e.get('cat') == 'call']
+
+
+def _segments(items, step_of):
+    # [(step, [items])] for each contiguous run of items in the same step
+    segments = []
+    for item in items:
+        if segments and segments[-1][0] == step_of(item):
+            segments[-1][1].append(item)
+        else:
+            segments.append((step_of(item), [item]))
+    return segments
+
+
+def _mean_rate(commands, action):
+    rates = [c['flow_rate'] * c.get('rate', 1.0) for c in commands if c['name'] == action and c.get('flow_rate')]
+    return sum(rates) / len(rates) if rates else None
+
+
+def _traced_steps(commands):
+    # Step of each command as a trace sees it. Settings are attribute assignments, not calls, so a trace has no span
+    # for them: they count in the step of the call before them (the first call for settings at the start)
+    steps, current = [], None
+    for command in commands:
+        if command['name'] not in UNTRACED:
+            current = command['step']
+        steps.append(current)
+    first = next((step for step in steps if step is not None), None)
+    return [first if step is None else step for step in steps]
+
+
+def predicted_segments(name, overrides=None, model=None):
+    # Step segments of the simulated run as a trace of it would show them: [{'step', 'labware', 'liquid_class', ...,
+    # 'predicted_seconds'}]
+    protocol = plancache.simulate(name, overrides)
+    timings = runtime.estimate(protocol.commands, protocol.deck_layout(), model)
+    liquids = settle.load_classes(protocol_name(name))
+    out = []
+    triples = list(zip(_traced_steps(protocol.commands), protocol.commands, timings))
+    for step, segment in _segments(triples, lambda triple: triple[0]):
+        pairs = [(command, timing) for _, command, timing in segment]
+        commands = [command for command, _ in pairs]
+        out.append({'step': step, 'liquid_class': settle.step_class(liquids, step),
+                    'labware': sorted(set(c['location']['labware'] for c in commands
+                                          if c.get('location') and c['location'].get('labware'))),
+                    'aspirate_rate': _mean_rate(commands, 'aspirate'), 'dispense_rate': _mean_rate(commands, 'dispense'),
+                    'volume': sum(c['volume'] for c in commands if c['name'] == 'aspirate'),
+                    'commands': len(commands), 'pauses': sum(1 for c in commands if c['name'] == 'pause'),
+                    'predicted_seconds': sum(t['total'] for _, t in pairs)})
+    return out
+
+
+def actual_segments(spans):
+    # Step segments of a traced run: [{'step', 'actual_seconds', 'pause_seconds'}]
+    out = []
+    for step, calls in _segments([s for s in spans if s['kind'] == 'call'], lambda span: span['step']):
+        wall = calls[-1]['start'] + calls[-1]['seconds'] - calls[0]['start']
+        paused = sum(s['seconds'] for s in calls if s['name'] == 'pause')
+        out.append({'step': step, 'actual_seconds': wall - paused, 'pause_seconds': paused})
+    return out
+
+
+def match_segments(predicted, measured):
+    # Actual segment for each predicted one, in order, matched on the step labels. The trace stops matching at the
+    # first label that differs. A run that stopped early leaves predicted segments it never reached, the last one it
+    # reached is where it stopped and keeps no actual time either
+    matched = []
+    for segment, actual in zip(predicted, measured):
+        if segment['step'] != actual['step']:
+            break
+        matched.append(actual)
+    if len(matched) < len(predicted) and matched:
+        matched.pop()
+    return matched + [None] * (len(predicted) - len(matched))
+
+
+def run_rows(name, spans, robot, run_id, recorded, overrides=None, model=None):
+    # One row per predicted segment with the actual time of the matching traced segment (None where there is none)
+    predicted = predicted_segments(name, overrides, model)
+    rows = []
+    for number, (segment, measured) in enumerate(zip(predicted, match_segments(predicted, actual_segments(spans)))):
+        measured = measured or {}
+        rows.append(dict(segment, run_id=run_id, recorded=recorded, robot=robot, protocol=protocol_name(name),
+                         segment=number, actual_seconds=measured.get('actual_seconds'),
+                         pause_seconds=measured.get('pause_seconds')))
+    return rows
+
+
+def record(name, spans, robot, run_id=None, recorded=None, overrides=None, store=STORE_DIR, model=None, force=False):
+    # Appends one run to the store. Returns the file written. The default id gets a -2, -3 ... suffix when the same
+    # robot, protocol and second are already stored, a given id that is taken is an error unless force (replaces it)
+    recorded = recorded or datetime.datetime.now().replace(microsecond=0)
+    if run_id is None:
+        base = '%s-%s-%s' % (robot, protocol_name(name).split('.')[0], recorded.strftime('%Y%m%dT%H%M%S'))
+        run_id, n = base, 1
+        while os.path.exists(os.path.join(store, run_id + '.arrow')):
+            n += 1
+            run_id = '%s-%d' % (base, n)
+    if not re.match(r'^[\w.-]+$', run_id):
+        raise ValueError("Run id '%s' may only use letters, digits, '.', '-' and '_'" % run_id)
+    path = os.path.join(store, run_id + '.arrow')
+    if os.path.exists(path) and not force:
+        raise ValueError('Run %s is already in the store (%s), use another run id or --force to replace it' % (run_id, path))
+    rows = run_rows(name, spans, robot, run_id, recorded, overrides, model)
+    if not any(row['actual_seconds'] is not None for row in rows):
+        raise ValueError('No step of the trace matches a step of %s' % protocol_name(name))
+    table = pa.Table.from_pylist(rows, schema=SCHEMA)
+    if not os.path.isdir(store):
+        os.makedirs(store)
+    # Uncompressed IPC file so it can be memory-mapped, written aside and moved into place
+    partial = '%s.%d.tmp' % (path, os.getpid())
+    with pa.OSFile(partial, 'wb') as sink:
+        with pa.ipc.new_file(sink, SCHEMA) as writer:
+            writer.write_table(table)
+    os.replace(partial, path)
+    return path
+
+
+def read_store(store=STORE_DIR, protocols=None, robot=None):
+    # Every run in the store as one table, memory-mapped, filtered on protocol names and robot
+    files = sorted(f for f in os.listdir(store) if f.endswith('.arrow')) if os.path.isdir(store) else []
+    tables = [pa.ipc.open_file(pa.memory_map(os.path.join(store, f))).read_all() for f in files]
+    table = pa.concat_tables([t.cast(SCHEMA) for t in tables]) if tables else SCHEMA.empty_table()
+    if protocols:
+        table = table.filter(pc.is_in(table['protocol'], value_set=pa.array([protocol_name(p) for p in protocols])))
+    if robot:
+        table = table.filter(pc.equal(table['robot'], robot))
+    return table.filter(pc.is_valid(table['actual_seconds']))
+
+
+def _per_run(table, keys):
+    # Summed predicted / actual / pause seconds per keys and run, runs in time order
+    grouped = table.group_by(list(keys) + ['run_id', 'recorded']).aggregate(
+        [('predicted_seconds', 'sum'), ('actual_seconds', 'sum'), ('pause_seconds', 'sum')])
+    return sorted(grouped.to_pylist(), key=lambda row: (row['recorded'], row['run_id']))
+
+
+def _trend(ratios):
+    # Least squares slope of the ratio per run
+    n = len(ratios)
+    if n < 2:
+        return 0.0
+    mean_x, mean_y = (n - 1) / 2.0, sum(ratios) / n
+    return (sum((x - mean_x) * (y - mean_y) for x, y in enumerate(ratios))
+            / sum((x - mean_x) ** 2 for x in range(n)))
+
+
+def _ratios(table, keys):
+    # {keys: [(run row, actual / predicted)]} in time order
+    out = {}
+    for row in _per_run(table, keys):
+        if row['predicted_seconds_sum'] > 0:
+            out.setdefault(tuple(row[k] for k in keys), []).append(
+                (row, row['actual_seconds_sum'] / row['predicted_seconds_sum']))
+    return out
+
+
+def drift(table, tolerance=0.1):
+    # [{'robot', 'protocol', 'step', 'runs', 'predicted', 'first', 'last', 'ratio', 'trend', 'flag'}], worst first.
+    # flag: the last run is more than tolerance slower than predicted, or the trend adds that much over the runs seen
+    out = []
+    for (robot, protocol, step), runs in _ratios(table, ('robot', 'protocol', 'step')).items():
+        ratios = [ratio for _, ratio in runs]
+        trend = _trend(ratios)
+        flags = []
+        if ratios[-1] > 1 + tolerance:
+            flags.append('slow')
+        if len(ratios) > 2 and trend * (len(ratios) - 1) > tolerance:
+            flags.append('slowing')
+        out.append({'robot': robot, 'protocol': protocol, 'step': step, 'runs': len(runs),
+                    'predicted': runs[-1][0]['predicted_seconds_sum'], 'first': runs[0][0]['actual_seconds_sum'],
+                    'last': runs[-1][0]['actual_seconds_sum'], 'ratio': ratios[-1], 'trend': trend, 'flag': flags})
+    return sorted(out, key=lambda row: (-len(row['flag']), -row['trend'], row['robot'], row['protocol'], row['step']))
+
+
+def calibration(table):
+    # [{'protocol', 'liquid_class', 'runs', 'predicted', 'actual', 'ratio'}], robots pooled
+    out = []
+    grouped = table.group_by(['protocol', 'liquid_class']).aggregate(
+        [('predicted_seconds', 'sum'), ('actual_seconds', 'sum'), ('run_id', 'count_distinct')])
+    for row in grouped.to_pylist():
+        if row['predicted_seconds_sum'] > 0:
+            out.append({'protocol': row['protocol'], 'liquid_class': row['liquid_class'],
+                        'runs': row['run_id_count_distinct'], 'predicted': row['predicted_seconds_sum'],
+                        'actual': row['actual_seconds_sum'],
+                        'ratio': row['actual_seconds_sum'] / row['predicted_seconds_sum']})
+    return sorted(out, key=lambda row: (row['protocol'], row['liquid_class']))
+
+
+def robots(table, tolerance=0.1):
+    # [{'robot', 'runs', 'last_run', 'last', 'mean', 'pauses', 'flag'}], slowest last run first
+    out = []
+    for (robot,), runs in _ratios(table, ('robot',)).items():
+        ratios = [ratio for _, ratio in runs]
+        out.append({'robot': robot, 'runs': len(runs), 'last_run': runs[-1][0]['run_id'], 'last': ratios[-1],
+                    'mean': sum(ratios) / len(ratios),
+                    'pauses': sum(row['pause_seconds_sum'] or 0.0 for row, _ in runs) / len(runs),
+                    'flag': ratios[-1] > 1 + tolerance})
+    return sorted(out, key=lambda row: -row['last'])
+
+
+def format_report(table, tolerance=0.1, top=10):
+    runs = len(pc.unique(table['run_id']))
+    lines = ['%d runs, %d step segments, tolerance %.0f%%' % (runs, table.num_rows, tolerance * 100)]
+    if not runs:
+        return lines[0]
+    lines.append('robots (actual / predicted):')
+    for row in robots(table, tolerance):
+        lines.append('    %-12s %3d runs  last %5.2f (%s)  mean %5.2f  operator pauses %s per run%s' % (
+            row['robot'], row['runs'], row['last'], row['last_run'], row['mean'], runtime.format_seconds(row['pauses']),
+            '  SLOW' if row['flag'] else ''))
+    lines.append('step drift (actual / predicted, last run, trend per run):')
+    for row in drift(table, tolerance)[:top]:
+        lines.append('    %-12s %-14s %3d runs  predicted %s  first %s  last %s  %5.2f  %+6.1f%%/run  %-12s %s' % (
+            row['robot'], row['protocol'], row['runs'], runtime.format_seconds(row['predicted']),
+            runtime.format_seconds(row['first']), runtime.format_seconds(row['last']), row['ratio'],
+            row['trend'] * 100, ' '.join(row['flag']), row['step'][:60]))
+    lines.append('model calibration per liquid class (actual / predicted, all robots):')
+    for row in calibration(table):
+        lines.append('    %-14s %-24s %3d runs  predicted %s  actual %s  %5.2f' % (
+            row['protocol'], row['liquid_class'], row['runs'], runtime.format_seconds(row['predicted']),
+            runtime.format_seconds(row['actual']), row['ratio']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Record run step timings and compare them with the run-time model')
+    parser.add_argument('protocols', nargs='*', help='protocol files or: %s' % ', '.join(sorted(sim.PROTOCOLS)))
+    parser.add_argument('--record', help='Chrome trace of a real run (trace.trace_run) to add, one protocol only')
+    parser.add_argument('--robot', help='robot the run was on (--record) / report only this robot')
+    parser.add_argument('--run-id', help='id of the recorded run (default robot-protocol-time)')
+    parser.add_argument('--recorded', help='start of the recorded run, eg 2026-10-18T09:30 (default now)')
+    parser.add_argument('--overrides', help='JSON object of the protocol settings the run used')
+    parser.add_argument('--store', default=STORE_DIR)
+    parser.add_argument('--tolerance', type=float, default=10.0, help='percent slower than predicted to flag (default 10)')
+    parser.add_argument('--top', type=int, default=10, help='step drift rows (default 10)')
+    parser.add_argument('--force', action='store_true', help='replace a stored run with the same --run-id')
+    args = parser.parse_args(argv)
+    try:
+        if args.record:
+            if len(args.protocols) != 1 or not args.robot:
+                raise ValueError('--record needs one protocol and --robot')
+            recorded = datetime.datetime.strptime(args.recorded, '%Y-%m-%dT%H:%M') if args.recorded else None
+            path = record(args.protocols[0], spans_from_chrome(args.record), args.robot, args.run_id, recorded,
+                          json.loads(args.overrides) if args.overrides else None, args.store, force=args.force)
+            print('Run recorded in %s' % path)
+        table = read_store(args.store, args.protocols, None if args.record else args.robot)
+    except (ValueError, KeyError, IOError, OSError) as e:
+        raise SystemExit('telemetry: %s' % (e.args[0] if isinstance(e, KeyError) else e))
+    print(format_report(table, args.tolerance / 100.0, args.top))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+#Readme:
+#Declarative tip policy engine. Each protocol step states its contamination constraint instead of hard-coding
+#pick_up_tip/drop_tip, and the engine works out the fewest tip pick-ups and the tip rack columns they need.
+#Policies (per step label, longest matching prefix wins, unlisted steps keep the protocol's own tips):
+#   fresh       - new tip for every tip cycle the protocol makes (the protocol as written)
+#   reagent     - reagent only: the tip only aspirates from its reagent source and dispenses from above the liquid,
+#                 one tip is kept while every well it aspirates from already holds everything on the tip
+#   same_sample - one tip per sample: the tip may carry reagents (media, buffer) into a well, never another sample
+#   low_to_high - like same_sample for one analyte across a dilution series: the tip may carry the analyte into a well
+#                 with an equal or higher concentration, so the step's cycles are run from low to high concentration
+#Well contents are followed through the trace: wells aspirated before anything is put in them are origins (trough
+#columns, cultures, DNA stocks), every other well holds a mix of origins. Trough origins are reagents unless listed
+#as samples (eg the ValitaTiter standard in trough A1). A tip touches a well when it aspirates there or dispenses
+#into a well that already holds liquid (reagent steps only count aspirates, dispenses are free jet).
+#Tip cycles only share a tip if they need the same rows of tips (odd/even row tips for 24-well plates, see tipstate).
+#Usage: python -m ot2_tools.tippolicy valitatiter [--policy policy.json] [--show-groups]
+#       policy.json = {"samples": [["8", "A1"]], "steps": {"Step 4": "low_to_high"}}
+
+import json
+
+from . import labware as lw
+from . import multidispense
+from . import pathopt
+from . import runtime
+from . import sim
+from . import tipstate
+
+POLICY_NAMES = ('fresh', 'reagent', 'same_sample', 'low_to_high')
+ORIGIN_VOLUME = 1e6     # nominal ul of an origin well, big enough that dispensing back into it does not change it
+
+POLICIES = {
+    'harvest': {'samples': [], 'steps': {
+        'Step 1': 'reagent', 'Step 2': 'same_sample', 'Step 3': 'same_sample', 'Step 5': 'same_sample'}},
+    'sampling': {'samples': [], 'steps': {
+        'Step 1': 'reagent', 'Step 2': 'same_sample', 'Step 3': 'same_sample', 'Step 4: Feed': 'reagent',
+        'Step 4: Seperate': 'same_sample', 'Step 5': 'reagent'}},
+    'nucleofection': {'samples': [], 'steps': {
+        'Step 1': 'reagent', 'Step 2': 'same_sample', 'Step 3': 'same_sample', 'Step 4': 'same_sample',
+        'Step 5': 'reagent', 'Step 8': 'same_sample'}},
+    'seed': {'samples': [], 'steps': {'Step 2': 'reagent'}},
+    'valitatiter': {'samples': [('8', 'A1')], 'steps': {
+        'Step1': 'reagent', 'Step2': 'reagent', 'Step3: Dilute': 'same_sample', 'Step3: Add': 'reagent',
+        'Step 4': 'low_to_high'}},
+}
+
+
+def load_policy(name, path=None):
+    # Default policy of a protocol, updated from a JSON file if given
+    policy = {'samples': list(POLICIES.get(name, {}).get('samples', [])),
+              'steps': dict(POLICIES.get(name, {}).get('steps', {}))}
+    if path:
+        with open(path) as f:
+            extra = json.load(f)
+        policy['samples'].extend(tuple(s) for s in extra.get('samples', []))
+        policy['steps'].update(extra.get('steps', {}))
+    for step, rule in policy['steps'].items():
+        if rule not in POLICY_NAMES:
+            raise ValueError("Unknown tip policy '%s' for '%s', use one of: %s" % (rule, step, ', '.join(POLICY_NAMES)))
+    policy['samples'] = set(tuple(s) for s in policy['samples'])
+    return policy
+
+
+def step_policy(policy, step):
+    matches = [key for key in policy['steps'] if step.startswith(key)]
+    return policy['steps'][max(matches, key=len)] if matches else 'fresh'
+
+
+def _fractions(contents):
+    total = sum(contents.values())
+    return dict((k, v / total) for k, v in contents.items() if v > 0) if total > 0 else {}
+
+
+def track_contents(commands):
+    # Follows liquid through the trace. Returns ({index: contact}, origins) where contact is
+    # {'well', 'kind', 'fractions'} for every aspirate and every dispense into a well that already held liquid
+    wells = {}
+    tips = {}
+    origins = set()
+    contacts = {}
+    for c in commands:
+        well = pathopt._well(c)
+        mount = c.get('mount')
+        if c['name'] in ('pick_up_tip', 'drop_tip', 'return_tip'):
+            tips[mount] = {}
+        elif c['name'] == 'aspirate' and well is not None and not multidispense._is_air(c):
+            if well not in wells:
+                wells[well] = {well: ORIGIN_VOLUME}
+                origins.add(well)
+            contents = wells[well]
+            fractions = _fractions(contents)
+            contacts[c['index']] = {'well': well, 'kind': 'aspirate', 'fractions': fractions}
+            tip = tips.setdefault(mount, {})
+            for k, f in fractions.items():
+                tip[k] = tip.get(k, 0.0) + f * c['volume']
+                if well not in origins:
+                    contents[k] = max(0.0, contents[k] - f * c['volume'])
+        elif c['name'] in ('dispense', 'blow_out') and well is not None:
+            contents = wells.setdefault(well, {})
+            if c['name'] == 'dispense' and _fractions(contents) and not multidispense._is_air(c):
+                contacts[c['index']] = {'well': well, 'kind': 'dispense', 'fractions': _fractions(contents)}
+            tip = tips.get(mount, {})
+            volume = sum(tip.values()) if c['name'] == 'blow_out' else min(c['volume'], sum(tip.values()))
+            for k, f in _fractions(tip).items():
+                contents[k] = contents.get(k, 0.0) + f * volume
+                tip[k] = max(0.0, tip[k] - f * volume)
+    return contacts, origins
+
+
+def _tip_ops(commands):
+    # Step instances: runs of tip cycles of one step inside one barrier-free segment
+    instances = []
+    for segment in pathopt.split_operations(commands):
+        current = None
+        for op in segment.get('ops', []):
+            names = [c['name'] for c in op['commands']]
+            if 'pick_up_tip' not in names or names[-1] not in pathopt.TIP_ENDS:
+                current = None
+                continue
+            pick = op['commands'][names.index('pick_up_tip')]
+            if current is None or current['step'] != pick['step'] or current['pipette'] != pick['pipette']:
+                current = {'step': pick['step'], 'pipette': pick['pipette'], 'ops': []}
+                instances.append(current)
+            current['ops'].append(op)
+    return instances
+
+
+def _touched(op, contacts, rule):
+    # Wells the op's tip touches, in order: [(well, fractions)]
+    touched = []
+    for c in op['commands']:
+        contact = contacts.get(c['index'])
+        if contact is None or (rule == 'reagent' and contact['kind'] != 'aspirate'):
+            continue
+        touched.append((contact['well'], contact['fractions']))
+    return touched
+
+
+def _analyte(ops, touched, reagents):
+    # The non-reagent origin whose share changes most across the ops' first wells (the dilution series)
+    spread = {}
+    for op in ops:
+        if not touched[id(op)]:
+            continue
+        for origin, f in touched[id(op)][0][1].items():
+            if origin not in reagents:
+                low, high = spread.get(origin, (f, f))
+                spread[origin] = (min(low, f), max(high, f))
+    firsts = [touched[id(op)][0][1] for op in ops if touched[id(op)]]
+    for origin in spread:
+        if any(origin not in f for f in firsts):
+            spread[origin] = (0.0, spread[origin][1])
+    return max(spread, key=lambda k: (spread[k][1] - spread[k][0], k)) if spread else None
+
+
+def _allowed(rule, carried, level, op_touched, reagents, analyte):
+    # Can a tip that already touched `carried` origins (highest analyte share `level`) run this op as well
+    if rule == 'fresh':
+        return False
+    if rule == 'low_to_high' and analyte in carried:
+        first = op_touched[0][1] if op_touched else {}
+        if level > first.get(analyte, 0.0) + 1e-9:
+            return False
+    for well, fractions in op_touched:
+        present = set(fractions)
+        foreign = carried - present
+        if rule == 'reagent' or well in reagents:
+            if foreign:
+                return False
+        elif foreign - reagents - (set([analyte]) if rule == 'low_to_high' else set()):
+            return False
+    return True
+
+
+def plan_tips(commands, policy):
+    # Groups the tip cycles of every step instance into the fewest tips the step's policy allows.
+    # Returns [{'step', 'pipette', 'policy', 'ops', 'order', 'groups', 'analyte'}], groups = lists of positions in ops
+    contacts, origins = track_contents(commands)
+    reagents = set(o for o in origins if lw.labware_spec(_labware(commands, o))['kind'] == 'reservoir') - policy['samples']
+    plans = []
+    for instance in _tip_ops(commands):
+        ops = instance['ops']
+        rule = step_policy(policy, instance['step'])
+        touched = dict((id(op), _touched(op, contacts, rule)) for op in ops)
+        order = list(range(len(ops)))
+        analyte = None
+        if rule == 'low_to_high':
+            analyte = _analyte(ops, touched, reagents)
+            independent = all(not pathopt.depends(ops[i], ops[j]) for i in order for j in order if i < j)
+            if analyte is not None and independent:
+                order.sort(key=lambda i: (touched[id(ops[i])][0][1].get(analyte, 0.0) if touched[id(ops[i])] else 0.0, i))
+        groups = []
+        carried, level = set(), 0.0
+        for i in order:
+            op_touched = touched[id(ops[i])]
+            # A tip only carries on if the next cycle needs the same rows of tips (odd/even rows for 24-well plates)
+            same_tips = groups and tipstate.op_pattern(ops[groups[-1][0]]) == tipstate.op_pattern(ops[i])
+            if same_tips and _allowed(rule, carried, level, op_touched, reagents, analyte):
+                groups[-1].append(i)
+            else:
+                groups.append([i])
+                carried, level = set(), 0.0
+            for well, fractions in op_touched:
+                carried |= set(fractions)
+                level = max(level, fractions.get(analyte, 0.0))
+        plans.append({'step': instance['step'], 'pipette': instance['pipette'], 'policy': rule, 'ops': ops,
+                      'order': order, 'groups': groups, 'analyte': analyte})
+    return plans
+
+
+def _labware(commands, well):
+    return next(c['location']['labware'] for c in commands if pathopt._well(c) == well)
+
+
+def apply_plan(commands, plans):
+    # Rewritten trace: merged tip cycles lose their inner drop/pick-up, low_to_high steps run in their new order
+    replace = {}
+    for plan in plans:
+        ops = plan['ops']
+        merged = []
+        for group in plan['groups']:
+            for n, i in enumerate(group):
+                keep = []
+                for c in ops[i]['commands']:
+                    if c['name'] == 'pick_up_tip' and n > 0:
+                        continue
+                    if c['name'] in pathopt.TIP_ENDS and n < len(group) - 1:
+                        continue
+                    keep.append(c)
+                merged.extend(keep)
+        replace[ops[0]['commands'][0]['index']] = (ops[-1]['commands'][-1]['index'], merged)
+    plan_commands = []
+    skip_to = None
+    for c in commands:
+        if skip_to is not None:
+            if c['index'] == skip_to:
+                skip_to = None
+            continue
+        if c['index'] in replace:
+            skip_to, merged = replace[c['index']]
+            plan_commands.extend(merged)
+            if c['index'] == skip_to:
+                skip_to = None
+            continue
+        plan_commands.append(c)
+    return [dict(c, index=n, original_index=c['index']) for n, c in enumerate(plan_commands)]
+
+
+def _tip_positions(commands):
+    # (pipette, rack load, slot, well) of every pick-up. A reset_tipracks after a pause is an operator refill (new load),
+    # without a pause it only rewinds the tip tracking (eg Harvest Step 1 returns its tip and picks it up again later).
+    # Returns ({index: position}, reuses) where reuses are pick-ups of a tip that was returned earlier in the same load
+    loads = {}
+    paused = set()
+    returned = set()
+    positions, reuses = {}, set()
+    for c in commands:
+        if c['name'] == 'pause':
+            paused = set(loads) | set(p[0] for p in positions.values())
+        elif c['name'] == 'reset_tipracks' and c['pipette'] in paused:
+            loads[c['pipette']] = loads.get(c['pipette'], 0) + 1
+            paused.discard(c['pipette'])
+        elif c['name'] in ('pick_up_tip', 'return_tip'):
+            position = (c['pipette'], loads.get(c['pipette'], 0)) + pathopt._well(c)
+            if c['name'] == 'return_tip':
+                returned.add(position)
+                continue
+            if position in returned:
+                reuses.add(c['index'])
+            positions[c['index']] = position
+    return positions, reuses
+
+
+def allocate_racks(commands, plans):
+    # Tip positions per pipette before and after, and the rack load/slot/well each tip of the new plan comes from.
+    # New tips take the protocol's own positions, rack by rack in the order it first used them, so odd/even row racks
+    # and the operator's rack refills stay as they are. A tip picked up again after return_tip keeps its position.
+    positions, reuses = _tip_positions(commands)
+    racks = {}
+    for index in sorted(positions):
+        entry = racks.setdefault(positions[index][0], {'positions': []})
+        if index not in reuses and positions[index] not in entry['positions']:
+            entry['positions'].append(positions[index])
+    for entry in racks.values():
+        # Fill one rack before starting the next
+        first = []
+        for p in entry['positions']:
+            if p[1:3] not in first:
+                first.append(p[1:3])
+        entry['positions'].sort(key=lambda p: first.index(p[1:3]))
+    allocation = []
+    given = {}
+    used = {}
+    for c in apply_plan(commands, plans):
+        if c['name'] != 'pick_up_tip':
+            continue
+        original = positions[c['original_index']]
+        reused = c['original_index'] in reuses and original in given
+        if not reused:
+            n = used.get(c['pipette'], 0)
+            used[c['pipette']] = n + 1
+            given[original] = racks[c['pipette']]['positions'][n]
+        position = given[original]
+        allocation.append({'step': c['step'], 'pipette': c['pipette'], 'load': position[1], 'slot': position[2],
+                           'well': position[3], 'reused': reused})
+    for pipette, entry in racks.items():
+        mine = [a for a in allocation if a['pipette'] == pipette]
+        entry['before'] = len(entry['positions'])
+        entry['after'] = used.get(pipette, 0)
+        entry['racks_before'] = len(set(p[1:3] for p in entry['positions']))
+        entry['racks_after'] = len(set((a['load'], a['slot']) for a in mine))
+    return racks, allocation
+
+
+def evaluate(name, policy_path=None, model=None):
+    protocol = sim.simulate(name)
+    policy = load_policy(name, policy_path)
+    plans = plan_tips(protocol.commands, policy)
+    deck = protocol.deck_layout()
+    planned = apply_plan(protocol.commands, plans)
+    racks, allocation = allocate_racks(protocol.commands, plans)
+    before = sum(t['total'] for t in runtime.estimate(protocol.commands, deck, model))
+    after = sum(t['total'] for t in runtime.estimate(planned, deck, model))
+    return {'name': name, 'plans': plans, 'commands': planned, 'racks': racks, 'allocation': allocation,
+            'seconds_before': before, 'seconds_after': after}
+
+
+def format_report(result, show_groups=False):
+    tips_before = sum(len(p['ops']) for p in result['plans'])
+    tips_after = sum(len(p['groups']) for p in result['plans'])
+    lines = ['%s: %d -> %d tips, %s -> %s (%s saved)' % (
+        result['name'], tips_before, tips_after, runtime.format_seconds(result['seconds_before']),
+        runtime.format_seconds(result['seconds_after']), runtime.format_seconds(result['seconds_before'] - result['seconds_after']))]
+    for plan in result['plans']:
+        reordered = ', low to high by %s %s' % plan['analyte'] if plan['order'] != sorted(plan['order']) else ''
+        lines.append('    %-12s %-11s %3d -> %-3d #%s%s' % (
+            plan['pipette'], plan['policy'], len(plan['ops']), len(plan['groups']), plan['step'][:60], reordered))
+        if show_groups:
+            for group in plan['groups']:
+                lines.append('        tip: cycles %s' % ' '.join(str(plan['ops'][i]['commands'][0]['index']) for i in group))
+    for pipette, entry in sorted(result['racks'].items()):
+        lines.append('    %s: %d -> %d tip columns, %d -> %d racks' % (
+            pipette, entry['before'], entry['after'], entry['racks_before'], entry['racks_after']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Fewest tips a protocol needs under declared contamination rules')
+    parser.add_argument('protocols', nargs='+', help='protocol files or: %s' % ', '.join(sorted(sim.PROTOCOLS)))
+    parser.add_argument('--policy', help='JSON file with extra samples / step policies')
+    parser.add_argument('--show-groups', action='store_true', help='list the tip cycles that share each tip')
+    args = parser.parse_args(argv)
+    for name in args.protocols:
+        print(format_report(evaluate(name, args.policy), args.show_groups))
+
+
+if __name__ == '__main__':
+    main()
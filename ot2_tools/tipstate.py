@@ -0,0 +1,329 @@
+#Readme:
+#Partial-rack tip state tracker. Models every tip of every rack, so racks loaded with only odd rows (A,C,E,G) or only
+#even rows (B,D,F,H) for the 24-well compression trick are tracked tip by tip instead of by operator instructions.
+#A multichannel picks up whatever tips sit under its 8 nozzles, so a pick-up is only valid if the column holds exactly
+#the rows it needs: odd rows for nunc_24_pseudo_a / nunc_24_plate, even rows for nunc_24_pseudo_b, all 8 otherwise.
+#Rack layouts are per slot: 'full', 'odd', 'even', 'empty' or {'1-3': 'full', '4-7': 'odd', '8-12': 'empty'}.
+#   check - replays a protocol's pick-ups against the layouts its README asks for (LAYOUTS), reload at every
+#           reset_tipracks that follows a pause
+#   plan  - lays out the racks for the whole run: picks a valid column for every pick-up and only reloads racks at a
+#           pause the protocol already has when the deck runs out of tips, so tip rearrangement pauses go away
+#Usage: python -m ot2_tools.tipstate nucleofection [--check] [--tip-policy] [--reload-minutes 10]
+
+from collections import OrderedDict
+
+from . import labware as lw
+from . import pathopt
+from . import sim
+
+ROWS = lw.ROW_NAMES[:8]
+PATTERNS = OrderedDict([('full', 'ABCDEFGH'), ('odd', 'ACEG'), ('even', 'BDFH'), ('empty', '')])
+# Labware the multichannel can only reach with one parity of tips (see compression)
+PATTERN_LABWARE = {'nunc_24_pseudo_a': 'odd', 'nunc_24_pseudo_b': 'even', 'nunc_24_plate': 'odd'}
+
+# Rack layouts the protocols ask the operator for, one dict per rack load (start, then each tip reload)
+LAYOUTS = {
+    'harvest': [{'7': 'odd', '10': 'even', '11': 'full'}, {'7': 'full'}],
+    'sampling': [{'7': 'odd', '10': 'even', '11': 'full'},
+                 {'7': {'1-2': 'odd', '3-4': 'even', '5-12': 'full'}, '10': 'full'}],
+    # by SEED_TIPS (LAYOUT_SETTINGS)
+    'nucleofection': {'per_replicate': [{'7': 'full', '10': 'full', '11': 'full'}, {'7': 'odd', '10': 'even'}],
+                      'shared_per_sample': [{'7': {'1-3': 'full', '4-12': 'empty'},
+                                             '10': {'1-4': 'odd', '5-8': 'even', '9-12': 'empty'}, '11': 'full'}]},
+    'seed': [{'7': 'odd'}],
+    'valitatiter': [{'7': 'full', '10': 'full', '11': 'full', '9': 'full'}],
+}
+
+# Protocol setting that picks the layouts when they depend on it
+LAYOUT_SETTINGS = {'nucleofection': 'SEED_TIPS'}
+
+
+def protocol_layouts(name):
+    layouts = LAYOUTS[name]
+    if name in LAYOUT_SETTINGS:
+        layouts = layouts[sim.load_protocol(name)[LAYOUT_SETTINGS[name]]]
+    return layouts
+
+
+class TipStateError(Exception):
+    pass
+
+
+def _columns(spec):
+    # Layout spec of one rack -> pattern name per column (1-12)
+    if not isinstance(spec, dict):
+        spec = {'1-12': spec}
+    columns = ['empty'] * 12
+    for span, pattern in spec.items():
+        if pattern not in PATTERNS:
+            raise ValueError("Unknown tip pattern '%s', use one of: %s" % (pattern, ', '.join(PATTERNS)))
+        first, _, last = str(span).partition('-')
+        for c in range(int(first), int(last or first) + 1):
+            columns[c - 1] = pattern
+    return columns
+
+
+def describe_rack(columns):
+    # ['odd', 'odd', 'full', ...] -> 'cols 1-2 odd rows, col 3 full'
+    runs = []
+    for c, pattern in enumerate(columns):
+        if runs and runs[-1][2] == pattern:
+            runs[-1][1] = c + 1
+        else:
+            runs.append([c + 1, c + 1, pattern])
+    if len(runs) == 1:
+        return {'full': 'full rack', 'empty': 'no rack'}.get(runs[0][2], 'only %s rows (%s)' % (runs[0][2], ','.join(PATTERNS[runs[0][2]])))
+    return ', '.join('%s %s' % ('col %d' % a if a == b else 'cols %d-%d' % (a, b),
+                                pattern if pattern in ('full', 'empty') else '%s rows' % pattern) for a, b, pattern in runs)
+
+
+class TipTracker:
+    # Tip by tip state of the tip racks on the deck. Tips are tracked per slot as {column: set(rows)}
+    def __init__(self, layout=None):
+        self.racks = {}
+        self.on_pipette = {}
+        self.load(layout or {})
+
+    def load(self, layout):
+        # Operator puts new racks in these slots
+        for slot, spec in layout.items():
+            self.racks[slot] = dict((c + 1, set(PATTERNS[p])) for c, p in enumerate(_columns(spec)))
+
+    def rows(self, slot, column):
+        return ''.join(r for r in ROWS if r in self.racks.get(slot, {}).get(column, ()))
+
+    def valid(self, slot, column, pattern):
+        return self.rows(slot, column) == PATTERNS[pattern]
+
+    def choose(self, slots, pattern):
+        # First column in these slots that a multichannel can pick `pattern` tips from
+        for slot in slots:
+            for column in range(1, 13):
+                if PATTERNS[pattern] and self.valid(slot, column, pattern):
+                    return slot, 'A%d' % column
+        raise TipStateError('No column with %s tips left in slots %s' % (pattern, ', '.join(slots)))
+
+    def pick_up(self, mount, slot, well, pattern=None):
+        column = int(well[1:])
+        rows = self.rows(slot, column)
+        if pattern is not None and rows != PATTERNS[pattern]:
+            raise TipStateError('slot %s column %d holds rows %s, pick-up needs %s rows %s' % (
+                slot, column, rows or 'none', pattern, PATTERNS[pattern]))
+        if not rows:
+            raise TipStateError('slot %s column %d has no tips' % (slot, column))
+        self.racks[slot][column] = set()
+        self.on_pipette[mount] = (slot, column, rows)
+        return rows
+
+    def return_tip(self, mount):
+        slot, column, rows = self.on_pipette.pop(mount)
+        self.racks[slot][column] |= set(rows)
+
+    def drop_tip(self, mount):
+        self.on_pipette.pop(mount, None)
+
+
+def op_pattern(op):
+    # Tips an operation needs, from the labware it works in
+    for c in op['commands']:
+        pattern = PATTERN_LABWARE.get((c.get('location') or {}).get('labware'))
+        if pattern:
+            return pattern
+    return 'full'
+
+
+def tip_demands(commands):
+    # One entry per pick-up: {'index', 'step', 'pipette', 'mount', 'slot', 'well', 'pattern', 'tip_type', 'reuse'}
+    patterns = {}
+    for segment in pathopt.split_operations(commands):
+        for op in segment.get('ops', []):
+            for c in op['commands']:
+                if c['name'] == 'pick_up_tip':
+                    patterns[c['index']] = op_pattern(op)
+    # A returned tip is picked up again unless the operator reloaded the racks (reset_tipracks after a pause)
+    demands = []
+    returned = set()
+    paused = False
+    for c in commands:
+        location = c.get('location') or {}
+        if c['name'] == 'pause':
+            paused = True
+        elif c['name'] == 'return_tip':
+            returned.add((location['slot'], location['well']))
+        elif c['name'] == 'reset_tipracks' and paused:
+            returned = set()
+            paused = False
+        elif c['name'] == 'pick_up_tip':
+            demands.append({'index': c['index'], 'step': c['step'], 'pipette': c['pipette'], 'mount': c['mount'],
+                            'slot': location['slot'], 'well': location['well'], 'pattern': patterns.get(c['index'], 'full'),
+                            'tip_type': location['labware'], 'reuse': (location['slot'], location['well']) in returned})
+    return demands
+
+
+def reload_points(commands):
+    # Existing operator stops where racks can be swapped: {pause index: reset_tipracks command or None}
+    points = OrderedDict()
+    last_pause = None
+    for c in commands:
+        if c['name'] == 'pause':
+            last_pause = c['index']
+            points[last_pause] = None
+        elif c['name'] == 'reset_tipracks' and last_pause is not None:
+            points[last_pause] = c
+    return points
+
+
+def check_trace(commands, layouts):
+    # Replays the pick-ups with the rack layouts. A reset_tipracks after a pause loads the next layout.
+    # Returns (checked, problems)
+    tracker = TipTracker(layouts[0])
+    demands = dict((d['index'], d) for d in tip_demands(commands))
+    loads = 0
+    paused = False
+    problems = []
+    for c in commands:
+        if c['name'] == 'pause':
+            paused = True
+        elif c['name'] == 'reset_tipracks' and paused:
+            loads += 1
+            paused = False
+            tracker.load(dict((slot, spec) for slot, spec in layouts[min(loads, len(layouts) - 1)].items() if slot in c['racks']))
+        elif c['name'] == 'pick_up_tip':
+            d = demands[c['index']]
+            try:
+                tracker.pick_up(c['mount'], d['slot'], d['well'], d['pattern'])
+            except TipStateError as e:
+                problems.append({'index': c['index'], 'step': c['step'], 'pipette': c['pipette'], 'problem': str(e)})
+                tracker.on_pipette[c['mount']] = (d['slot'], int(d['well'][1:]), '')
+        elif c['name'] == 'return_tip':
+            tracker.return_tip(c['mount'])
+        elif c['name'] == 'drop_tip':
+            tracker.drop_tip(c['mount'])
+    return len(demands), problems
+
+
+def _fill(demands, slots_for):
+    # Lays out one rack load for these pick-ups. Returns ({slot: [pattern per column]}, [(slot, well)]) or
+    # (layout, picks) for the pick-ups that fit before the load runs out
+    columns = {}
+    picks = []
+    users = {}
+    for d in demands:
+        for slot in slots_for[d['pipette']]:
+            users.setdefault(slot, set()).add(d['pipette'])
+    for d in demands:
+        if d['reuse'] and picks:
+            match = next((p for p, e in zip(picks, demands) if (e['slot'], e['well']) == (d['slot'], d['well'])), None)
+            if match is not None:
+                picks.append(match)
+                continue
+        candidates = [s for s in slots_for[d['pipette']] if len(columns.get(s, [])) < 12]
+        if not candidates:
+            break
+
+        def affinity(slot):
+            # Keep one pattern per rack where possible (operators load odd racks and even racks), then racks only
+            # this pipette uses, then the pipette's own rack order
+            used = columns.get(slot, [])
+            return (0 if d['pattern'] in used else 1 if not used else 2, len(users[slot]), slots_for[d['pipette']].index(slot))
+        slot = min(candidates, key=affinity)
+        columns.setdefault(slot, []).append(d['pattern'])
+        picks.append((slot, len(columns[slot])))
+    # Group each rack's columns by pattern so the operator loads blocks of columns (cols 1-4 odd, 5-8 even ...)
+    moved = {}
+    for slot, cols in columns.items():
+        order = list(OrderedDict.fromkeys(cols))
+        ranked = sorted(range(len(cols)), key=lambda c: (order.index(cols[c]), c))
+        for new, old in enumerate(ranked):
+            moved[(slot, old + 1)] = new + 1
+        columns[slot] = [cols[c] for c in ranked]
+    picks = [(slot, 'A%d' % moved[(slot, column)]) for slot, column in picks]
+    return dict((slot, cols + ['empty'] * (12 - len(cols))) for slot, cols in columns.items()), picks
+
+
+def plan_racks(commands):
+    # Rack loads for the whole run. Returns [{'at': pause index or None (start) or 'new' (needs a new pause), 'layout',
+    # 'demands', 'picks'}]
+    demands = tip_demands(commands)
+    slots_for = {}
+    for d in demands:
+        slots = slots_for.setdefault(d['pipette'], [])
+        if d['slot'] not in slots:
+            slots.append(d['slot'])
+    points = reload_points(commands)
+    loads = []
+    start, at = 0, None
+    while start < len(demands):
+        layout, picks = _fill(demands[start:], slots_for)
+        end = start + len(picks)
+        if end < len(demands):
+            stops = [p for p in points if demands[start]['index'] < p < demands[end]['index']]
+            if stops:
+                # Latest stop the protocol already reloads tips at, else the latest pause
+                stop = ([p for p in stops if points[p] is not None] or stops)[-1]
+                cut = next(n for n in range(start, end + 1) if n == end or demands[n]['index'] > stop)
+                layout, picks = _fill(demands[start:cut], slots_for)
+                end, following = cut, stop
+            else:
+                following = 'new'
+        loads.append({'at': at, 'layout': layout, 'demands': demands[start:end], 'picks': picks})
+        start = end
+        at = following if end < len(demands) else None
+    return loads
+
+
+def existing_reloads(commands):
+    return [p for p, reset in reload_points(commands).items() if reset is not None]
+
+
+def format_plan(name, loads, commands, reload_minutes=10.0):
+    before = existing_reloads(commands)
+    after = [load['at'] for load in loads[1:]]
+    lines = ['%s: %d pick-ups, %d rack loads, tip reloads %d -> %d (%d min operator time saved at %d min per reload)' % (
+        name, sum(len(load['demands']) for load in loads), len(loads), len(before), len(after),
+        (len(before) - len(after)) * reload_minutes, reload_minutes)]
+    for n, load in enumerate(loads):
+        where = 'start' if load['at'] is None else 'NEW PAUSE before command %d' % load['demands'][0]['index'] if load['at'] == 'new' \
+            else 'pause at command %d' % load['at']
+        lines.append('    load %d (%s):' % (n + 1, where))
+        for slot, columns in sorted(load['layout'].items(), key=lambda s: int(s[0])):
+            lines.append('        slot %-3s %s' % (slot, describe_rack(columns)))
+        step = None
+        for d, (slot, well) in zip(load['demands'], load['picks']):
+            if d['step'] != step:
+                step = d['step']
+                lines.append('        #%s' % step[:70])
+            lines.append('            %-10s %-5s tips from slot %s %s%s' % (d['pipette'], d['pattern'], slot, well, ' (returned tip)' if d['reuse'] else ''))
+    for p in before:
+        if p not in after:
+            lines.append('    pause at command %d no longer needs a tip reload' % p)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Tip by tip rack tracker and whole-run rack planner')
+    parser.add_argument('protocol', help='protocol file or: %s' % ', '.join(sorted(sim.PROTOCOLS)))
+    parser.add_argument('--check', action='store_true', help='check the pick-ups against the layouts in the protocol README')
+    parser.add_argument('--tip-policy', action='store_true', help='plan for the tips left after the tip policy engine (tippolicy)')
+    parser.add_argument('--reload-minutes', type=float, default=10.0, help='operator time per tip reload (default 10)')
+    args = parser.parse_args(argv)
+    protocol = sim.simulate(args.protocol)
+    commands = protocol.commands
+    if args.check:
+        if args.protocol not in LAYOUTS:
+            raise SystemExit("No rack layouts for '%s', add them to LAYOUTS" % args.protocol)
+        checked, problems = check_trace(commands, protocol_layouts(args.protocol))
+        print('%s: %d pick-ups checked, %d invalid' % (args.protocol, checked, len(problems)))
+        for p in problems:
+            print('    command %d %s #%s: %s' % (p['index'], p['pipette'], p['step'][:50], p['problem']))
+        return
+    if args.tip_policy:
+        from . import tippolicy
+        policy = tippolicy.load_policy(args.protocol)
+        commands = tippolicy.apply_plan(commands, tippolicy.plan_tips(commands, policy))
+    print(format_plan(args.protocol, plan_racks(commands), commands, args.reload_minutes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+#Readme:
+#Tracing and profiling hooks for protocol runs. The ProtocolContext and every pipette it loads are wrapped, each call the
+#protocols make (aspirate, dispense, mix, transfer, blow_out, touch_tip, move_to, pick_up_tip, drop_tip, return_tip, delay, home,
+#pause) becomes a span tagged with its '#Step ...' comment and protocol line. Helper functions defined in the protocol
+#(eg IP_slide_load) become spans too, through sys.setprofile. Output is a Chrome trace (open in chrome://tracing or
+#ui.perfetto.dev) and a flat cost table per step, per call, per function or per protocol line.
+#Simulation: times are the runtime.py predictions for the commands each call recorded (pauses take no robot time).
+#Real runs: times are wall clock, pauses include the operator. On the robot (jupyter / ssh), with ot2_tools copied over:
+#   from opentrons import execute
+#   from ot2_tools import trace
+#   spans = trace.trace_run('/data/user_storage/harvest.py', execute.get_protocol_api('2.0'), 'harvest.trace.json')
+#opentrons.simulate.get_protocol_api('2.0') works the same way for the opentrons simulator.
+#Usage: python -m ot2_tools.trace harvest [--out harvest.trace.json] [--by line|call|function]
+
+import contextlib
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+
+from . import runtime
+from . import sim
+
+PIPETTE_CALLS = ('aspirate', 'dispense', 'mix', 'transfer', 'blow_out', 'touch_tip', 'move_to', 'pick_up_tip', 'drop_tip',
+                 'return_tip', 'home')
+PROTOCOL_CALLS = ('delay', 'pause', 'home')
+
+
+class Tracer(object):
+    # Collects spans: {'kind': 'call'/'function', 'name', 'owner', 'step', 'line', 'args', 'begin', 'end'}.
+    # begin/end are clock() readings, seconds for real runs, command counts in simulation (see timebase)
+    def __init__(self, path, clock=time.perf_counter):
+        self.path = os.path.abspath(path)
+        self.steps = sim.step_labels(self.path)
+        self.clock = clock
+        self.spans = []
+        self._functions = []
+
+    def wrap(self, protocol):
+        return _TracedProtocol(self, protocol, 'protocol')
+
+    def call(self, owner, name, method, args, kwargs):
+        step, line = sim.current_step(self.path, self.steps, sys._getframe(1))
+        span = {'kind': 'call', 'name': name, 'owner': owner, 'step': step, 'line': line,
+                'args': _describe_args(args, kwargs), 'begin': self.clock(), 'end': None}
+        self.spans.append(span)
+        try:
+            return method(*args, **kwargs)
+        finally:
+            span['end'] = self.clock()
+
+    def _profile(self, frame, event, arg):
+        code = frame.f_code
+        if code.co_filename != self.path or code.co_name == 'run' or code.co_name.startswith('<'):
+            return
+        if event == 'call':
+            step, line = sim.current_step(self.path, self.steps, frame.f_back)
+            span = {'kind': 'function', 'name': '%s()' % code.co_name, 'owner': 'protocol', 'step': step, 'line': line,
+                    'args': _describe_args([frame.f_locals[v] for v in code.co_varnames[:code.co_argcount]], {}),
+                    'begin': self.clock(), 'end': None}
+            self.spans.append(span)
+            self._functions.append(span)
+        elif event == 'return' and self._functions:
+            self._functions.pop()['end'] = self.clock()
+
+    @contextlib.contextmanager
+    def profiling(self):
+        previous = sys.getprofile()
+        sys.setprofile(self._profile)
+        try:
+            yield self
+        finally:
+            sys.setprofile(previous)
+            for span in self._functions:
+                span['end'] = self.clock()
+            self._functions = []
+
+    def timed_spans(self, timebase=None):
+        # Spans with 'start'/'seconds' from run start. timebase maps a clock reading to seconds
+        if timebase is None:
+            origin = min(s['begin'] for s in self.spans) if self.spans else 0.0
+            timebase = lambda tick: tick - origin
+        spans = []
+        for span in self.spans:
+            start = timebase(span['begin'])
+            spans.append(dict(span, start=start, seconds=timebase(span['end']) - start))
+        return spans
+
+
+class _Traced(object):
+    # Forwards everything to the wrapped API object, the names in calls are timed through the tracer
+    def __init__(self, tracer, target, owner, calls):
+        object.__setattr__(self, '_tracer', tracer)
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_owner', owner)
+        object.__setattr__(self, '_calls', calls)
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if name not in self._calls:
+            return value
+        tracer, owner = self._tracer, self._owner
+
+        def traced(*args, **kwargs):
+            return tracer.call(owner, name, value, args, kwargs)
+        return traced
+
+    def __setattr__(self, name, value):
+        setattr(self._target, name, value)
+
+    def __repr__(self):
+        return repr(self._target)
+
+
+class _TracedProtocol(_Traced):
+    def __init__(self, tracer, target, owner):
+        _Traced.__init__(self, tracer, target, owner, PROTOCOL_CALLS)
+
+    def load_instrument(self, *args, **kwargs):
+        pipette = self._target.load_instrument(*args, **kwargs)
+        return _Traced(self._tracer, pipette, '%s %s' % (pipette.name, pipette.mount), PIPETTE_CALLS)
+
+
+def _describe_args(args, kwargs):
+    parts = [repr(a) if isinstance(a, (int, float, str)) else str(a) for a in args]
+    parts += ['%s=%r' % item for item in sorted(kwargs.items())]
+    text = ', '.join(parts)
+    return text if len(text) <= 120 else text[:117] + '...'
+
+
+def trace_simulation(path, overrides=None, model=None):
+    # Runs the protocol on the recording simulator through the tracer. Returns (spans, protocol, timings)
+    path = sim.protocol_path(path)
+    namespace = sim.load_protocol(path)
+    for name, value in (overrides or {}).items():
+        namespace[name] = value
+    protocol = sim.SimProtocol(path)
+    tracer = Tracer(path, clock=lambda: len(protocol.commands))
+    with tracer.profiling():
+        namespace['run'](tracer.wrap(protocol))
+    timings = runtime.estimate(protocol.commands, protocol.deck_layout(), model)
+    starts = [0.0]
+    for t in timings:
+        starts.append(starts[-1] + t['total'])
+    return tracer.timed_spans(lambda tick: starts[tick]), protocol, timings
+
+
+def trace_run(path, protocol, out=None):
+    # Runs a protocol file on a real opentrons ProtocolContext (robot or opentrons.simulate) and times every call.
+    # Writes the Chrome trace to out if given, returns the spans
+    path = os.path.abspath(path)
+    with open(path) as f:
+        code = compile(f.read(), path, 'exec')
+    namespace = {'__name__': 'ot2_protocol', '__file__': path}
+    exec(code, namespace)
+    tracer = Tracer(path)
+    try:
+        with tracer.profiling():
+            namespace['run'](tracer.wrap(protocol))
+    finally:
+        # A stopped or failed run still leaves the trace up to that point
+        spans = tracer.timed_spans()
+        if out:
+            write_chrome_trace(spans, out, os.path.basename(path))
+    return spans
+
+
+def step_spans(spans):
+    # One span per contiguous run of calls in the same step
+    steps = []
+    for span in spans:
+        if span['kind'] != 'call':
+            continue
+        end = span['start'] + span['seconds']
+        if steps and steps[-1]['step'] == span['step']:
+            steps[-1]['seconds'] = end - steps[-1]['start']
+        else:
+            steps.append({'step': span['step'], 'start': span['start'], 'seconds': end - span['start']})
+    return steps
+
+
+def chrome_trace(spans, name='protocol'):
+    # Chrome trace event format: complete ('X') events in microseconds. Thread 1 = steps, thread 2 = functions and calls
+    events = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': name}},
+              {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': 1, 'args': {'name': 'steps'}},
+              {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': 2, 'args': {'name': 'calls'}}]
+    for step in step_spans(spans):
+        events.append({'name': step['step'], 'cat': 'step', 'ph': 'X', 'pid': 1, 'tid': 1,
+                       'ts': round(step['start'] * 1e6), 'dur': round(step['seconds'] * 1e6)})
+    for span in spans:
+        events.append({'name': span['name'], 'cat': span['kind'], 'ph': 'X', 'pid': 1, 'tid': 2,
+                       'ts': round(span['start'] * 1e6), 'dur': round(span['seconds'] * 1e6),
+                       'args': {'step': span['step'], 'line': span['line'], 'owner': span['owner'], 'args': span['args']}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_chrome_trace(spans, path, name='protocol'):
+    with open(path, 'w') as f:
+        json.dump(chrome_trace(spans, name), f)
+
+
+def cost_table(spans, by='call'):
+    # {step: {key: [calls, seconds]}} over the call spans (function spans for by='function'). pause is kept apart
+    # as it is operator time on a real run
+    table = OrderedDict()
+    for span in spans:
+        if (span['kind'] == 'function') != (by == 'function'):
+            continue
+        key = span['line'] if by == 'line' else span['name']
+        row = table.setdefault(span['step'], OrderedDict()).setdefault(key, [0, 0.0])
+        row[0] += 1
+        row[1] += span['seconds']
+    return table
+
+
+def format_table(table, spans, by='call', path=None, top=8):
+    source = []
+    if by == 'line' and path:
+        with open(path) as f:
+            source = f.read().splitlines()
+    calls = [s for s in spans if s['kind'] == 'call' and s['name'] != 'pause']
+    total = sum(s['seconds'] for s in calls) or 1.0
+    lines = ['%s in traced calls, %d calls, %d pauses' % (
+        runtime.format_seconds(total), len(calls), sum(1 for s in spans if s['name'] == 'pause'))]
+    for step, rows in table.items():
+        seconds = sum(row[1] for key, row in rows.items() if key != 'pause')
+        lines.append('%s %5.1f%%  %s' % (runtime.format_seconds(seconds), 100.0 * seconds / total, step))
+        for key, (count, spent) in sorted(rows.items(), key=lambda item: -item[1][1])[:top]:
+            label = key
+            if by == 'line':
+                label = 'line %s: %s' % (key, source[key - 1].strip() if key and key <= len(source) else '')
+            lines.append('        %s %5.1f%%  %5dx  %s' % (runtime.format_seconds(spent), 100.0 * spent / total, count, label))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Trace a simulated protocol run, Chrome trace + cost per step')
+    parser.add_argument('protocol', help='protocol file or one of: %s' % ', '.join(sorted(sim.PROTOCOLS)))
+    parser.add_argument('--out', help='write the Chrome trace JSON to this file')
+    parser.add_argument('--by', choices=['call', 'line', 'function'], default='call', help='cost table rows (default call)')
+    parser.add_argument('--top', type=int, default=8, help='rows per step (default 8)')
+    args = parser.parse_args(argv)
+    spans, protocol, timings = trace_simulation(args.protocol)
+    print(format_table(cost_table(spans, args.by), spans, args.by, protocol.path, args.top))
+    if args.out:
+        write_chrome_trace(spans, args.out, os.path.basename(protocol.path))
+        print('Chrome trace (%d spans) written to %s' % (len(spans), args.out))
+
+
+if __name__ == '__main__':
+    main()
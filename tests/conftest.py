@@ -0,0 +1,5 @@
+import os
+import sys
+
+# ot2_tools is run from the repo root, not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
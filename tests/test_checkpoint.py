@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+from ot2_tools import checkpoint
+from ot2_tools import plancache
+from ot2_tools import sim
+
+
+@pytest.mark.parametrize('name', sorted(sim.PROTOCOLS))
+def test_resumed_run_finishes_the_plan(name):
+    # Same check as python -m ot2_tools.checkpoint <name>: stopped half way, resumed from the checkpoint
+    result = checkpoint.rehearse(name)
+    assert result['matches']
+    assert result['final']['complete']
+    assert result['state']['index'] <= result['fail_at']
+    assert result['resumed'] < result['full']
+
+
+def test_groups_start_with_empty_tips():
+    commands = plancache.load_plan('harvest')[0]['commands']
+    starts = checkpoint.command_groups(commands)
+    assert starts[0] == 0 and starts == sorted(set(starts))
+    assert set(commands[s]['name'] for s in starts[1:]) <= {'aspirate', 'pick_up_tip', 'pause'}
+    # a mix is one group: its aspirates never start one
+    for s in starts[1:]:
+        previous = commands[s - 1]
+        assert not (commands[s]['name'] == 'aspirate' and commands[s].get('group') and commands[s]['group'] == previous.get('group'))
+
+
+def test_resume_asks_for_the_tips_the_mounts_had(tmp_path):
+    plan = plancache.load_plan('harvest')[0]
+    path = str(tmp_path / 'harvest.checkpoint.json')
+    stop = next(n for n, c in enumerate(plan['commands']) if c['name'] == 'dispense') + 1
+    checkpoint.replay_sim(plan, checkpoint.checkpoint_writer(plan, path), stop)
+    state = checkpoint.read_checkpoint(path, plan)
+    assert not state['complete']
+    resume = checkpoint.resume_plan(plan, state)
+    preamble = [c for c in resume['commands'] if c.get('resume')]
+    assert [c['name'] for c in preamble[:2]] == ['comment', 'pause']
+    for mount, tip in state['tips'].items():
+        if tip:
+            assert 'slot %s %s' % tuple(tip) in preamble[1]['message']
+            assert {'slot': tip[0], 'well': tip[1]} in [c['location'] for c in preamble if c['name'] == 'pick_up_tip']
+    assert resume['commands'][len(preamble):] == plan['commands'][state['index']:]
+
+
+def test_checkpoint_of_another_plan_is_refused(tmp_path):
+    plan = plancache.load_plan('seed')[0]
+    path = str(tmp_path / 'seed.checkpoint.json')
+    checkpoint.replay_sim(plan, checkpoint.checkpoint_writer(plan, path))
+    state = checkpoint.read_checkpoint(path, plan)
+    assert state['complete'] and os.path.exists(path)
+    with pytest.raises(ValueError):
+        checkpoint.resume_plan(plan, state)
+    with pytest.raises(ValueError):
+        checkpoint.read_checkpoint(path, plancache.load_plan('seed', {'PLATE_COUNT': 8})[0])
@@ -0,0 +1,41 @@
+import pytest
+
+pytest.importorskip('numpy')
+
+from ot2_tools import dilution  # noqa: E402
+
+
+def test_vt_curve_matches_the_protocol():
+    # VT_SC_Plate: 222ul standard in col 1, 100ul media in cols 2-12, 122ul transfers, col 12 the blank
+    curve = dilution.design_curve(2000, 11, transfer=122)
+    assert curve['ratio'] == pytest.approx(122 / 222.0)
+    assert list(curve['volume']) == [100.0] + [100.0] * 9 + [222.0, 100.0]
+    assert curve['concentration'][-1] == 0.0
+
+
+@pytest.mark.parametrize('final', [100.0, 250.0])
+def test_plan_fills_every_column(final):
+    # Columns above the tip volume are filled from several trips, every well ends at its designed volume
+    curve = dilution.design_curve(2000, 11, bottom=5, final=final)
+    plan = dilution.pipetting_plan(curve, plates=2)
+    protocol = dilution.simulate_plan(plan, plates=2)
+    assert all(c['volume'] <= 200.0 for c in protocol.commands if c['name'] == 'aspirate')
+    for p in range(2):
+        volume = [0.0] * len(curve['volume'])
+        for c in protocol.commands:
+            location = c.get('location') or {}
+            if c['name'] in ('aspirate', 'dispense') and location.get('slot') == dilution.PLATE_SLOTS[p]:
+                column = int(location['well'][1:]) - 1
+                volume[column] += c['volume'] if c['name'] == 'dispense' else -c['volume']
+        assert volume == pytest.approx(list(curve['volume']))
+
+
+def test_cli_checks_plates_and_tip_volume(capsys):
+    for plates in ('0', '4'):
+        with pytest.raises(SystemExit):
+            dilution.main(['--top', '2000', '--bottom', '5', '--plates', plates])
+        assert '--plates must be 1 to 3' in capsys.readouterr().err
+    with pytest.raises(SystemExit, match='does not fit a 200ul tip'):
+        dilution.main(['--top', '2000', '--transfer', '250', '--discard-last'])
+    dilution.main(['--top', '2000', '--bottom', '5', '--final', '250', '--plates', '3'])
+    assert 'Plan for 3 plates' in capsys.readouterr().out
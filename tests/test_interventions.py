@@ -0,0 +1,34 @@
+import pytest
+
+from ot2_tools import interventions
+from ot2_tools import sim
+
+VARIANTS = [(name, {}) for name in sorted(sim.PROTOCOLS)] + [
+    ('nucleofection', {'SEED_TIPS': mode}) for mode in sorted(interventions.INTERVENTIONS['nucleofection'])]
+
+
+@pytest.mark.parametrize('name, overrides', VARIANTS)
+def test_declared_interventions_match_the_pauses(name, overrides):
+    protocol = sim.simulate(name, overrides)
+    pauses = sum(1 for c in protocol.commands if c['name'] == 'pause')
+    declared = interventions.declared_interventions(name, overrides)
+    assert len(declared if declared is not None else []) == pauses
+    units, stops = interventions.split_trace(protocol.commands)
+    tasks = interventions.build_tasks(name, units, stops, overrides)
+    assert None not in [r for task in tasks for r in task['resources']] or declared is None
+
+
+def test_pause_count_mismatch_is_an_error():
+    protocol = sim.simulate('nucleofection', {'SEED_TIPS': 'shared_per_sample'})
+    units, stops = interventions.split_trace(protocol.commands)
+    with pytest.raises(ValueError):
+        interventions.build_tasks('nucleofection', units, stops, {'SEED_TIPS': 'per_replicate'})
+
+
+def test_consolidation_keeps_every_liquid_action():
+    result = interventions.consolidate('sampling')
+    assert result['after']['stops'] < result['before']['stops']
+
+    def actions(commands):
+        return sorted(sim.describe(c) for c in commands if c['name'] in ('aspirate', 'dispense'))
+    assert actions(result['commands']) == actions(c for u in result['units'] for c in u['commands'])
@@ -0,0 +1,40 @@
+import pytest
+
+pytest.importorskip('numpy')
+
+from ot2_tools import ledger  # noqa: E402
+from ot2_tools import sim  # noqa: E402
+
+
+def test_troughs_are_filled_at_their_interventions():
+    # Nucleofection: cells go into trough A2 at the first pause, media into A3 at the electroporation pause
+    result = ledger.evaluate('nucleofection')
+    pauses = [c['index'] for c in result['protocol'].commands if c['name'] == 'pause']
+    when = dict((e['well'], e['when']) for e in result['bom'] if e['slot'] == '8')
+    assert when == {'A1': 'setup', 'A2': pauses[0], 'A3': pauses[1]}
+
+
+@pytest.mark.parametrize('name', sorted(sim.PROTOCOLS))
+def test_bill_of_materials_covers_every_aspirate(name):
+    result = ledger.evaluate(name)
+    assert not result['overflows']
+    for entry in result['bom']:
+        assert entry['required'] == pytest.approx(entry['used'] + entry['dead'])
+        assert entry['dead'] > 0
+    # a run loaded with the bill of materials never runs a well dry
+    assert all(e['short'] == 0 for e in result['bom'])
+
+
+def test_seed_trough_dead_volume_matches_the_ledger():
+    # 24well_Plate_Seed is standalone, its TROUGH_DEAD is the ledger's dead volume rounded up to 0.1ml
+    settings = sim.load_protocol('seed')
+    result = ledger.evaluate('seed')
+    dead = set(round(e['dead']) for e in result['bom'])
+    assert len(dead) == 1
+    assert 0 <= settings['TROUGH_DEAD'] - dead.pop() < 100
+    # The trough fill the protocol shows (0.1ml) is the bill of materials
+    comment = next(c['message'] for c in result['protocol'].commands if c['name'] == 'comment')
+    fill = dict((well, float(ml[:-2]) * 1000) for well, ml in (f.split() for f in comment.split('Trough: ')[1].split(', ')))
+    assert sorted(fill) == sorted(e['well'] for e in result['bom'])
+    for entry in result['bom']:
+        assert abs(fill[entry['well']] - entry['required']) < 100
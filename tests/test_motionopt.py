@@ -0,0 +1,36 @@
+import pytest
+
+from ot2_tools import motionopt
+from ot2_tools import plancache
+from ot2_tools import sim
+
+
+@pytest.mark.parametrize('name', sorted(sim.PROTOCOLS))
+def test_pruned_plan_is_equivalent(name):
+    result = motionopt.optimise(name)
+    assert result['diffs'] == []
+    assert result['after'] <= result['before']
+    removed = sum(count for _, count, _ in result['passes'])
+    assert len(result['pruned']['commands']) == len(result['plan']['commands']) - removed
+
+
+def test_rehome_interval_keeps_homes():
+    # valitatiter homes between its steps, with re-zeroing on every home none of them go
+    result = motionopt.optimise('valitatiter')
+    assert dict((p[0], p[1]) for p in result['passes'])['homes'] > 0
+    kept = motionopt.optimise('valitatiter', rehome_minutes=0)
+    assert dict((p[0], p[1]) for p in kept['passes'])['homes'] == 0
+
+
+def test_repeated_move_is_removed():
+    commands = plancache.load_plan('valitatiter')[0]['commands']
+    n = next(n for n, c in enumerate(commands) if c['name'] == 'move_to')
+    doubled = [dict(c, index=i) for i, c in enumerate(commands[:n + 1] + [commands[n]] + commands[n + 1:])]
+    assert len(motionopt.prune_moves(doubled)) == len(motionopt.prune_moves(commands)) + 1
+
+
+def test_removing_an_action_is_not_equivalent():
+    plan = plancache.load_plan('seed')[0]
+    blow_out = next(c for c in plan['commands'] if c['name'] == 'blow_out')
+    diffs, _ = motionopt.prove(plan, motionopt.pruned_plan(plan, {blow_out['index']}))
+    assert diffs
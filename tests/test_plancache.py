@@ -0,0 +1,59 @@
+import pytest
+
+from ot2_tools import plancache
+from ot2_tools import sim
+
+
+@pytest.mark.parametrize('name', sorted(sim.PROTOCOLS))
+def test_replay_is_identical(name):
+    # Same check as python -m ot2_tools.plancache <name> --verify
+    plan = plancache.compile_protocol(sim.protocol_path(name))
+    assert len(plan['commands']) == len(sim.simulate(name).commands)
+    assert plancache.verify(plan) == []
+
+
+def test_plan_is_cached_per_override(tmp_path):
+    cache_dir = str(tmp_path)
+    plan, compiled = plancache.load_plan('seed', cache_dir=cache_dir)
+    assert compiled
+    cached, compiled = plancache.load_plan('seed', cache_dir=cache_dir)
+    assert not compiled and cached['key'] == plan['key']
+    eight, compiled = plancache.load_plan('seed', {'PLATE_COUNT': 8}, cache_dir=cache_dir)
+    assert compiled and eight['key'] != plan['key']
+    assert len(plancache.simulate('seed', {'PLATE_COUNT': 8}, cache_dir=cache_dir).commands) == len(eight['commands'])
+
+
+def test_changed_plan_fails_verify():
+    plan = plancache.compile_protocol(sim.protocol_path('seed'))
+    dispense = next(c for c in plan['commands'] if c['name'] == 'dispense')
+    dispense['volume'] += 1.0
+    assert [d['index'] for d in plancache.verify(plan)] == [dispense['index']]
+
+
+def test_replay_follows_the_robots_labware(monkeypatch):
+    # A plan replayed on a deeper trough: points addressed from top(z) move up with the top, bottom(z) ones stay
+    plan = plancache.compile_protocol(sim.protocol_path('seed'))
+    index = sim.geometry.index()
+
+    class DeeperTrough(object):
+        def wells(self, load_name):
+            rows = index.wells(load_name)
+            if load_name != 'axygen_12_reservior_22ml':
+                return rows
+            return [(name, (x, y, bottom, top + 5.0, depth + 5.0)) for name, (x, y, bottom, top, depth) in rows]
+
+    monkeypatch.setattr(sim.geometry, 'index', lambda *args: DeeperTrough())
+    protocol = sim.SimProtocol()
+    with sim.offline_opentrons():
+        import opentrons.types as ot_types
+        plancache.replay(plan, protocol, ot_types)
+    moved = set()
+    for planned, replayed in zip(plan['commands'], protocol.commands):
+        location = planned.get('location')
+        if not location or location.get('slot') != '8':
+            assert planned.get('point') == replayed.get('point')
+            continue
+        dz = replayed['point'][2] - planned['point'][2]
+        assert dz == pytest.approx(5.0 if location['reference'] == 'top' else 0.0)
+        moved.add(location['reference'])
+    assert moved == {'top', 'bottom'}
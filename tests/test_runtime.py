@@ -0,0 +1,38 @@
+import pytest
+
+from ot2_tools import bench
+from ot2_tools import runtime
+from ot2_tools import sim
+
+
+@pytest.mark.parametrize('name', sorted(sim.PROTOCOLS))
+def test_estimate_matches_baseline(name):
+    # benchmarks/baselines.json is updated with every intended run-time change (python -m ot2_tools.bench --update)
+    results = bench.run_benchmarks([name])
+    baseline = bench.load_baselines()[name]
+    assert results[name]['total'] == baseline['total']
+    assert results[name]['steps'] == baseline['steps']
+    assert bench.compare(results, bench.load_baselines())[name] == []
+
+
+def test_estimate_counts_actions():
+    protocol, timings = runtime.estimate_protocol('valitatiter')
+    assert len(timings) == len(protocol.commands)
+    model = runtime.TimingModel()
+    for command, timing in zip(protocol.commands, timings):
+        assert timing['travel'] >= 0
+        assert timing['total'] == pytest.approx(timing['travel'] + timing['action'])
+        # The first aspirate after a blow out also resets the plunger
+        assert timing['action'] - runtime.action_time(command, model) in (0.0, pytest.approx(model.plunger_reset))
+    delays = [c['seconds'] for c in protocol.commands if c['name'] == 'delay']
+    assert sum(t['action'] for t in timings if t['name'] == 'delay') == pytest.approx(sum(delays))
+
+
+def test_slower_step_is_a_regression():
+    results = bench.run_benchmarks(['seed'])
+    baselines = {'seed': dict(results['seed'], steps=dict(results['seed']['steps']))}
+    step = max(baselines['seed']['steps'], key=baselines['seed']['steps'].get)
+    baselines['seed']['steps'][step] -= 60.0
+    baselines['seed']['total'] -= 60.0
+    changes = bench.compare(results, baselines)['seed']
+    assert [c['name'] for c in changes if c['regression']] == ['TOTAL', step]
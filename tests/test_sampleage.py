@@ -0,0 +1,37 @@
+import pytest
+
+from ot2_tools import plancache
+from ot2_tools import sampleage
+from ot2_tools import sim
+
+
+@pytest.mark.parametrize('name', sorted(sampleage.SAMPLING))
+def test_interleaved_samples_are_younger(name):
+    result = sampleage.plan_schedule(name)
+    assert result['fits'] and result['young']
+    assert result['best']['max_age'] < result['original']['max_age']
+    assert all(c['age'] > 0 for c in result['best']['columns'])
+    # Same liquid actions, only their order changes, and the plan replays as planned
+    actions = lambda commands: sorted(sim.describe(c) for c in commands if c['name'] in ('aspirate', 'dispense'))
+    assert actions(result['plan']['commands']) == actions(sim.simulate(name).commands)
+    assert plancache.verify(result['plan']) == []
+
+
+@pytest.mark.parametrize('name', sorted(sampleage.SAMPLING))
+def test_columns_are_sampled_before_loading(name):
+    result = sampleage.plan_schedule(name)
+    units, _ = sampleage.split_units(plancache.load_plan(name)[0]['commands'])
+    info = sampleage.classify(units, sampleage.SAMPLING[name])
+    # Setting changes can move in the interleaved order, the liquid actions of every sample come before its load
+    position = dict((c['original_index'], n) for n, c in enumerate(result['plan']['commands']) if c.get('original_index') is not None)
+    liquid = lambda unit: [position[c['index']] for c in units[unit]['commands'] if c['name'] in ('aspirate', 'dispense')]
+    for load, (_, _, column) in info['loads'].items():
+        for sample in info['samples'][column]:
+            assert max(liquid(sample)) < min(liquid(load))
+
+
+def test_protocols_without_a_slide_are_refused():
+    with pytest.raises(ValueError):
+        sampleage.plan_schedule('seed')
+    with pytest.raises(SystemExit):
+        sampleage.main(['seed'])
@@ -0,0 +1,58 @@
+import json
+import shutil
+
+import pytest
+
+from ot2_tools import settle
+from ot2_tools import sim
+
+
+@pytest.mark.parametrize('name', sorted(sim.PROTOCOLS))
+def test_waits_stay_within_their_class(name):
+    result = settle.evaluate(name)
+    liquids = settle.load_classes(name)
+    assert result['waits']
+    for w in result['waits']:
+        liquid = liquids['classes'][w['liquid']]
+        assert w['old'] <= settle.KEEP_SECONDS
+        assert liquid['minimum'] <= w['new'] <= liquid['maximum']
+    # Only the settle delays change, the run gets shorter by exactly their difference
+    saved = sum(w['old'] - w['new'] for w in result['waits'])
+    assert result['before'] - result['after'] == pytest.approx(saved)
+
+
+def test_steps_use_the_liquid_they_handle():
+    seed = settle.evaluate('seed')['waits']
+    assert set(w['liquid'] for w in seed) == {'media'}
+    liquids = settle.load_classes('nucleofection')
+    assert settle.step_class(liquids, 'Step 1: Distrubute Nuc Solution to DNA plate') == 'nucleofection_solution'
+    assert settle.step_class(liquids, 'Step 3: Mix cells + transfer to DNA plate') == 'cell_suspension'
+    assert settle.step_class(liquids, 'Step 6: not listed') == 'media'
+
+
+def test_calibration_file(tmp_path):
+    path = str(tmp_path / 'liquids.json')
+    with open(path, 'w') as f:
+        json.dump({'classes': {'media': {'base': 0.8, 'maximum': 0.8}}, 'steps': {'Step 2': 'cell_suspension'}}, f)
+    liquids = settle.load_classes('seed', path)
+    assert liquids['steps'] == {'Step 2': 'cell_suspension'}
+    assert liquids['classes']['media']['base'] == 0.8 and settle.LIQUID_CLASSES['media']['base'] == 0.2
+    with open(path, 'w') as f:
+        json.dump({'classes': {'media': {'viscosity': 2}}}, f)
+    with pytest.raises(ValueError):
+        settle.load_classes('seed', path)
+    with open(path, 'w') as f:
+        json.dump({'steps': {'Step 2': 'honey'}}, f)
+    with pytest.raises(ValueError):
+        settle.load_classes('seed', path)
+
+
+def test_write_puts_the_largest_wait_per_line(tmp_path):
+    path = str(tmp_path / sim.PROTOCOLS['nucleofection'])
+    shutil.copy(sim.protocol_path('nucleofection'), path)
+    waits = settle.evaluate(path)['waits']
+    assert settle.rewrite_source(path, waits)
+    largest = settle.line_waits(waits)
+    for command in sim.simulate(path).commands:
+        if command['line'] in largest:
+            assert command['seconds'] == largest[command['line']][2]
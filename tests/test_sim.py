@@ -0,0 +1,48 @@
+import pytest
+
+from ot2_tools import sim
+
+
+@pytest.mark.parametrize('name', sorted(sim.PROTOCOLS))
+def test_simulate_is_deterministic(name):
+    first = sim.simulate(name).commands
+    second = sim.simulate(name).commands
+    assert first
+    assert [sim.describe(c) for c in first] == [sim.describe(c) for c in second]
+
+
+@pytest.mark.parametrize('name', sorted(sim.PROTOCOLS))
+def test_every_command_has_a_step(name):
+    protocol = sim.simulate(name)
+    assert all(c['step'] for c in protocol.commands)
+    # Tips picked up are dropped again
+    tips = [c['name'] for c in protocol.commands if c['name'] in ('pick_up_tip', 'drop_tip', 'return_tip')]
+    assert tips.count('pick_up_tip') == len(tips) - tips.count('pick_up_tip')
+
+
+def test_overrides_replace_protocol_settings():
+    four = sim.simulate('seed').commands
+    eight = sim.simulate('seed', {'PLATE_COUNT': 8}).commands
+    assert sum(c['name'] == 'dispense' for c in eight) == 2 * sum(c['name'] == 'dispense' for c in four)
+    with pytest.raises(KeyError):
+        sim.simulate('seed', {'PLATE_COUNTS': 8})
+
+
+def test_seed_checks_its_settings():
+    with pytest.raises(ValueError):
+        sim.simulate('seed', {'PLATE_COUNT': 0})
+    with pytest.raises(ValueError):
+        sim.simulate('seed', {'SEED_VOLUME': 6000})
+
+
+def test_transfer_mix_after_uses_aspirate_clearance():
+    # Harvest Step 2 dispenses at 2.5mm ('culture') and mixes the dilution well at the 1mm aspirate clearance
+    commands = sim.simulate('harvest').commands
+    for n, c in enumerate(commands):
+        if c['name'] == 'dispense' and c['group'] == 'transfer' and c['location']['slot'] == '6':
+            mix = commands[n + 1]
+            assert c['location']['offset'][2] == 2.5
+            assert (mix['name'], mix['location']['well'], mix['location']['offset'][2]) == ('aspirate', c['location']['well'], 1.0)
+            break
+    else:
+        pytest.fail('no transfer into the dilution plate')
@@ -0,0 +1,44 @@
+import datetime
+
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from ot2_tools import sim  # noqa: E402
+from ot2_tools import telemetry  # noqa: E402
+from ot2_tools import trace  # noqa: E402
+
+RECORDED = datetime.datetime(2026, 10, 1, 9, 30)
+
+
+@pytest.mark.parametrize('name', sorted(sim.PROTOCOLS))
+def test_complete_run_has_every_step(name, tmp_path):
+    # A full simulated trace, through the Chrome trace file a real run writes
+    spans = trace.trace_simulation(name)[0]
+    trace.write_chrome_trace(spans, str(tmp_path / 'run.trace.json'))
+    store = str(tmp_path / 'store')
+    telemetry.record(name, telemetry.spans_from_chrome(str(tmp_path / 'run.trace.json')), 'OT2-A', recorded=RECORDED,
+                     store=store)
+    rows = telemetry.read_store(store).to_pylist()
+    assert len(rows) == len(telemetry.predicted_segments(name))
+    for row in rows:
+        assert row['actual_seconds'] == pytest.approx(row['predicted_seconds'], abs=1e-3)
+
+
+def test_stopped_run_keeps_no_time_for_the_step_it_stopped_in():
+    spans = trace.trace_simulation('harvest')[0]
+    steps = [segment['step'] for segment in telemetry.actual_segments(spans)]
+    stopped = [s for s in spans if s['step'] in steps[:2]]
+    rows = telemetry.run_rows('harvest', stopped, 'OT2-A', 'stopped', RECORDED)
+    assert [row['actual_seconds'] is not None for row in rows] == [True] + [False] * (len(rows) - 1)
+
+
+def test_run_id_gets_a_suffix(tmp_path):
+    spans = trace.trace_simulation('seed')[0]
+    first = telemetry.record('seed', spans, 'OT2-A', recorded=RECORDED, store=str(tmp_path))
+    second = telemetry.record('seed', spans, 'OT2-A', recorded=RECORDED, store=str(tmp_path))
+    assert second == first.replace('.arrow', '-2.arrow')
+    telemetry.record('seed', spans, 'OT2-A', run_id='run', store=str(tmp_path))
+    with pytest.raises(ValueError):
+        telemetry.record('seed', spans, 'OT2-A', run_id='run', store=str(tmp_path))
+    telemetry.record('seed', spans, 'OT2-A', run_id='run', store=str(tmp_path), force=True)